@@ -0,0 +1,393 @@
+""" The append-only file: a log of the write commands of ``pyredis.server``.
+
+Every write command is appended to the log in RESP, the format clients send
+commands in, preceded by a SELECT whenever the database changes.  Commands
+whose effect depends on when or by chance they ran are logged as the
+deterministic commands they amounted to, so that replaying the log
+rebuilds the same keyspace.
+
+Appending only copies the command to a buffer.  A writer thread writes the
+buffer out and calls fsync according to the policy: after every write with
+"always", at most once a second with "everysec", or never with "no",
+leaving it to the operating system.  Every command buffered while the
+thread was busy goes out in its next write and fsync, so under load many
+commands share an fsync.  With "always" the server only replies once the
+commands of the reply are on disk.
+
+A rewrite compacts the log into an RDB preamble holding the current state
+of the keyspace followed by the commands run since it started.  It runs in
+the event loop a slice of keys at a time, between client commands.  A
+command about to write keys that the rewrite has not reached yet dumps
+them first, so that every command logged during the rewrite applies on top
+of the state of its keys, and is buffered to follow the preamble.  Once
+the preamble is complete the buffer is appended and the new log replaces
+the old one.
+
+At startup the log is replayed by calling the command functions directly,
+without the arity checks, reply encoding and bookkeeping of a client
+command.  A truncated command at the end of the log, left by a crash in
+the middle of a write, is dropped, as is a transaction without its EXEC.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from . import rdb
+from .commands import COMMANDS
+from .database import Database, _is_empty
+from .exceptions import RedisError
+from .resp import Parser
+
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+# Keys dumped by a rewrite between two chances for clients to run commands
+REWRITE_KEYS_PER_STEP = 1000
+
+READ_SIZE = 1024 * 1024
+
+
+def encode_command(args):
+    "Returns the RESP encoding of the command ``args``, a list of bytes"
+    out = bytearray(b'*%d\r\n' % len(args))
+    for arg in args:
+        out += b'$%d\r\n' % len(arg)
+        out += arg
+        out += b'\r\n'
+    return out
+
+
+class _Rewrite(object):
+    """ A rewrite in progress: the temporary file receiving the preamble,
+    the keys dumped so far and the commands logged since the start.
+    """
+
+    def __init__(self, path, databases):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.out = rdb._Writer(self.f, True)
+        rdb._write_preamble(self.out, databases, aof_base=1)
+        # the (database index, key) pairs dumped or created since the start
+        self.dumped = set()
+        self.buffer = bytearray()
+        self.selected = None
+        self.dumping = None
+        self.aborted = False
+
+    def dump(self, index, db, key):
+        self.dumped.add((index, key))
+        value = db._data.get(key)
+        if value is None or _is_empty(value):
+            return
+        when = db._expires.get(key)
+        if when is not None and when <= int(time.time() * 1000):
+            return
+        if index != self.dumping:
+            self.out.write(bytes((rdb.OPCODE_SELECTDB,)))
+            self.out.write(rdb._encode_length(index))
+            self.dumping = index
+        rdb._write_entry(self.out, key, value, when)
+
+    def feed(self, index, command):
+        if index is not None and index != self.selected:
+            self.buffer += encode_command([b'select', b'%d' % index])
+            self.selected = index
+        self.buffer += command
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AppendOnlyFile(object):
+    """ Appends commands to the log at ``path`` and syncs it to disk with
+    the ``fsync`` policy, "always", "everysec" or "no".
+
+    A rewrite is started automatically once the log has grown by
+    ``auto_rewrite_percentage`` percent since the last one and is at least
+    ``auto_rewrite_min_size`` bytes long.
+    """
+
+    auto_rewrite_percentage = 100
+    auto_rewrite_min_size = 64 * 1024 * 1024
+
+    def __init__(self, path, fsync='everysec'):
+        if fsync not in FSYNC_POLICIES:
+            raise RedisError("appendfsync must be one of %s" % ', '.join(FSYNC_POLICIES))
+        self.path = path
+        self.fsync = fsync
+        self._file = open(path, 'ab')
+        self.size = self.base_size = self._file.tell()
+        # the thread writing takes _io_lock before _cond, which guards the
+        # rest of the state shared with it
+        self._io_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending = bytearray()
+        self._selected = None
+        # bytes appended, written and synced since the file was opened
+        self._fed = self._written = self._synced = 0
+        self._sync_waiters = []
+        self._force = False
+        self._closed = False
+        self._rewrite = None
+        self._thread = threading.Thread(target=self._run, name='pyredis-aof', daemon=True)
+        self._thread.start()
+
+    def feed(self, index, args):
+        """ Appends the command ``args`` run against the database numbered
+        ``index``, or None for commands such as MULTI that run against none.
+        """
+        command = encode_command(args)
+        with self._cond:
+            if index is not None and index != self._selected:
+                self._append(encode_command([b'select', b'%d' % index]))
+                self._selected = index
+            self._append(command)
+            if self._rewrite is not None:
+                self._rewrite.feed(index, command)
+            self._cond.notify()
+
+    def _append(self, data):
+        self._pending += data
+        self._fed += len(data)
+
+    def before_write(self, index, db, keys):
+        """ Called before a command writes ``keys`` of ``db``, or the whole
+        database for None, so that a rewrite dumps them first.  Writing a
+        whole database restarts the rewrite instead.
+        """
+        rewrite = self._rewrite
+        if rewrite is None:
+            return
+        if keys is None:
+            rewrite.aborted = True
+            self._rewrite = None
+            return
+        for key in keys:
+            if (index, key) not in rewrite.dumped:
+                rewrite.dump(index, db, key)
+
+    def sync(self):
+        """ Returns a future done once every command appended so far is on
+        disk, for the server to await before replying with "always".
+        """
+        future = asyncio.get_running_loop().create_future()
+        with self._cond:
+            if self._synced >= self._fed:
+                future.set_result(None)
+            else:
+                self._sync_waiters.append((self._fed, future))
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        "Writes and syncs every command appended so far, blocking until done"
+        with self._cond:
+            target = self._fed
+            while self._synced < target and self._thread.is_alive():
+                self._force = True
+                self._cond.notify_all()
+                self._cond.wait(0.1)
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        "Writes and syncs the buffered commands in batches until closed"
+        last_fsync = time.monotonic()
+        while True:
+            with self._cond:
+                while not (self._pending or self._force or self._closed):
+                    timeout = None
+                    if self.fsync == 'everysec' and self._synced < self._written:
+                        timeout = last_fsync + 1 - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                if self._closed and not self._pending:
+                    return
+            with self._io_lock:
+                with self._cond:
+                    data, f, offset, force = self._pending, self._file, self._fed, self._force
+                    self._pending = bytearray()
+                    self._force = False
+                if data:
+                    f.write(data)
+                    f.flush()
+                now = time.monotonic()
+                sync = (force or self.fsync == 'always'
+                        or self.fsync == 'everysec' and now - last_fsync >= 1)
+                if sync:
+                    os.fsync(f.fileno())
+                    last_fsync = now
+            with self._cond:
+                if offset > self._written:
+                    self.size += len(data)
+                    self._written = offset
+                if sync and offset > self._synced:
+                    self._synced = offset
+                self._wake_syncs()
+                self._cond.notify_all()
+
+    def _wake_syncs(self):
+        waiting = []
+        for target, future in self._sync_waiters:
+            if target <= self._synced:
+                future.get_loop().call_soon_threadsafe(_set_done, future)
+            else:
+                waiting.append((target, future))
+        self._sync_waiters = waiting
+
+    def should_rewrite(self):
+        "Returns True if the log has grown enough to be rewritten"
+        return (self._rewrite is None and self.size >= self.auto_rewrite_min_size
+                and self.size >= self.base_size * (100 + self.auto_rewrite_percentage) / 100)
+
+    async def rewrite(self, databases):
+        """ Rewrites the log from the current state of ``databases``, the
+        list of Database the commands were logged against, yielding to the
+        event loop every ``REWRITE_KEYS_PER_STEP`` keys.
+        """
+        if self._rewrite is not None:
+            raise RedisError("Background append only file rewriting already in progress")
+        tmp = os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                           'temp-rewriteaof-%d.aof' % os.getpid())
+        while True:
+            rewrite = self._rewrite = _Rewrite(tmp, databases)
+            try:
+                for index, db in enumerate(databases):
+                    keys = list(db._data)
+                    for start in range(0, len(keys), REWRITE_KEYS_PER_STEP):
+                        for key in keys[start:start + REWRITE_KEYS_PER_STEP]:
+                            if (index, key) not in rewrite.dumped:
+                                rewrite.dump(index, db, key)
+                        await asyncio.sleep(0)
+                        if rewrite.aborted:
+                            break
+                    if rewrite.aborted:
+                        break
+                if not rewrite.aborted:
+                    self._finish(rewrite)
+                    return
+            finally:
+                if self._rewrite is rewrite:
+                    self._rewrite = None
+                rewrite.close()
+
+    def _finish(self, rewrite):
+        "Completes the log written by ``rewrite`` and puts it in place"
+        rdb._write_end(rewrite.out, rewrite.f)
+        with self._io_lock:
+            with self._cond:
+                rewrite.f.write(rewrite.buffer)
+                rewrite.f.flush()
+                os.fsync(rewrite.f.fileno())
+                rewrite.f.close()
+                os.replace(rewrite.path, self.path)
+                self._file.close()
+                self._file = open(self.path, 'ab')
+                self.size = self.base_size = self._file.tell()
+                # the commands not written yet are in the new log already
+                self._pending = bytearray()
+                self._selected = rewrite.selected
+                self._written = self._synced = self._fed
+                self._rewrite = None
+                self._wake_syncs()
+                self._cond.notify_all()
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _ReplayClient(object):
+    "Stands for both the client and the server of the commands replayed"
+
+    protocol = 2
+    deny_blocking = True
+
+    def __init__(self, databases):
+        self.server = self
+        self.databases = databases
+        self.db = databases[0]
+        self.rewritten = None
+
+
+def replay(f, databases):
+    """ Runs the commands read from the binary file object ``f`` against
+    ``databases``, a list of Database, and returns the number of bytes
+    holding complete commands, a truncated command or transaction being
+    left out.
+    """
+    client = _ReplayClient(databases)
+    funcs = {}
+    parser = Parser()
+    transaction = None
+    # the length of the log read and of the transaction pending, the only
+    # commands whose encoding is measured
+    read = pending = 0
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        read += len(data)
+        parser.feed(data)
+        for args in parser.parse():
+            name = args[0].lower()
+            if name == b'multi':
+                transaction, pending = [], len(encode_command(args))
+            elif transaction is None:
+                _apply(client, funcs, args)
+            elif name == b'exec':
+                for queued in transaction:
+                    _apply(client, funcs, queued)
+                transaction = None
+            else:
+                transaction.append(args)
+                pending += len(encode_command(args))
+        if parser.error is not None:
+            raise RedisError("Bad file format reading the append only file: %s" % parser.error)
+    return read - len(parser._buffer) - (pending if transaction is not None else 0)
+
+
+def _apply(client, funcs, args):
+    func = funcs.get(args[0])
+    if func is None:
+        command = COMMANDS.get(args[0].lower().decode('latin-1'))
+        if command is None:
+            raise RedisError("unknown command '%s' reading the append only file" % args[0].decode('latin-1'))
+        func = funcs[args[0]] = command.func
+    try:
+        func(client, args[1:])
+    except RedisError:
+        pass
+
+
+def load(path, databases=None):
+    """ Loads the log at ``path``, its RDB preamble and then its commands,
+    into ``databases``, a list of Database which is created if not given,
+    and returns it.  A log ending with an incomplete command is truncated
+    after the last complete one.
+    """
+    if databases is None:
+        databases = [Database()]
+    with open(path, 'rb') as f:
+        start = 0
+        if f.read(5) == b'REDIS':
+            f.seek(0)
+            start = rdb._load(f, databases)[1]
+        f.seek(start)
+        end = start + replay(f, databases)
+    if end < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+    return databases
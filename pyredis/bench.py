@@ -1,42 +1,466 @@
-from redis import Redis
-from zset import ZSet
-import time
-import random
-import os
+""" Benchmarks of the datastructures, run with::
+
+    $ python -m pyredis.bench --output before.json
+    $ python -m pyredis.bench --output after.json --compare before.json
+
+Every command of ``ZSet``, ``Hash``, ``Set`` and ``List``, and of
+``ColumnarZSet`` when numpy is installed, is timed against a structure of
+each size class.  A command is called with members picked at random, up to
+``OPS`` times or for ``TIME_LIMIT`` seconds, and the calls that change the
+structure are undone after being timed, so that every call sees the same
+structure.  The results give the calls per second and the median and 99th
+percentile latency of each command, and the bytes taken per element by the
+structure as traced by ``tracemalloc`` while building it.
+
+The results are written as JSON.  ``--compare`` reads the results of an
+earlier run and lists the commands whose throughput or p99 latency, and
+the structures whose memory, got worse by more than ``--threshold``,
+exiting with status 1 if there are any.
+
+Lock contention is measured by threads running ``zincrby`` on random keys
+of a ``ShardedDatabase``, for each number of ``--threads`` and
+``--shards``, a single shard standing for one lock around the keyspace.
+The results give the calls per second of all the threads together and the
+latency of the calls, waiting for the locks included.
+
+The commands combining structures, such as ``zunion`` or ``sinter``, are
+given a second structure of at most ``OTHER_SIZE`` elements.  The asyncio
+versions of the blocking commands run the same code and are left out.  The
+10M size class takes several GB of memory, so it only runs when asked for
+with ``--sizes``.
+"""
+import argparse
 import gc
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from .columnar import ColumnarZSet, USE_NUMPY
+from .hash import Hash
+from .list import List
+from .set import Set
+from .sharded import SHARDS, ShardedDatabase
+from .zset import ZSet
+
+
+SIZES = (10, 1000, 100000, 10000000)
+DEFAULT_SIZES = SIZES[:3]
+
+# Calls timed per command and size class, at most, and for how long
+OPS = 10000
+TIME_LIMIT = 1.0
+
+OTHER_SIZE = 1000
+
+THRESHOLD = 0.1
+
+# Threads and shards of the contention benchmark, and the keys they share
+THREADS = (1, 4)
+CONTENTION_SHARDS = (1, SHARDS)
+CONTENTION_KEYS = 1000
+
+
+def _member(k):
+    return b'member:%d' % k
+
+
+def _value(k):
+    return b'value:%d' % k
+
+
+def _name(k):
+    "Returns the member of a sorted set, a str like the keywords of ``zadd``"
+    return 'member:%d' % k
+
+
+def _command(name, call, after=None, before=None):
+    """ Describes the benchmark of the command ``name``.  ``call`` runs it
+    as called with the structure, the other structure, and the index and
+    the element picked, ``before`` prepares it and ``after`` undoes it,
+    given its result as well, both untimed.
+    """
+    return name, call, after, before
+
+
+def _readd(s, o, k, m, result):
+    s.zadd_many([(m, k)])
+
+
+ZSET_COMMANDS = [
+    _command('bzpopmax', lambda s, o, k, m: s.bzpopmax(), lambda s, o, k, m, r: s.zadd_many([r[1:]])),
+    _command('bzpopmin', lambda s, o, k, m: s.bzpopmin(), lambda s, o, k, m, r: s.zadd_many([r[1:]])),
+    _command('iter_range', lambda s, o, k, m: list(s.iter_range(k, k + 9))),
+    _command('iter_rangebyscore', lambda s, o, k, m: list(s.iter_rangebyscore(k, k + 9))),
+    _command('memory_usage', lambda s, o, k, m: s.memory_usage()),
+    _command('zadd', lambda s, o, k, m: s.zadd(new=k), lambda s, o, k, m, r: s.zrem('new')),
+    _command('zadd_many', lambda s, o, k, m: s.zadd_many([('new', k)]), lambda s, o, k, m, r: s.zrem('new')),
+    _command('zcard', lambda s, o, k, m: s.zcard()),
+    _command('zcount', lambda s, o, k, m: s.zcount(k, k + 9)),
+    _command('zdiff', lambda s, o, k, m: s.zdiff(o)),
+    _command('zdiffstore', lambda s, o, k, m: type(s)().zdiffstore(s, o)),
+    _command('zincrby', lambda s, o, k, m: s.zincrby(m, 1), lambda s, o, k, m, r: s.zincrby(m, -1)),
+    _command('zinter', lambda s, o, k, m: s.zinter(o)),
+    _command('zinterstore', lambda s, o, k, m: type(s)().zinterstore(s, o)),
+    _command('zlexcount', lambda s, o, k, m: s.zlexcount('[' + m, '+')),
+    _command('zpopmax', lambda s, o, k, m: s.zpopmax(), lambda s, o, k, m, r: s.zadd_many(r)),
+    _command('zpopmin', lambda s, o, k, m: s.zpopmin(), lambda s, o, k, m, r: s.zadd_many(r)),
+    _command('zrange', lambda s, o, k, m: s.zrange(k, k + 9)),
+    _command('zrangebylex', lambda s, o, k, m: s.zrangebylex('[' + m, '+', 0, 10)),
+    _command('zrangebyscore', lambda s, o, k, m: s.zrangebyscore(k, k + 9)),
+    _command('zrank', lambda s, o, k, m: s.zrank(m)),
+    _command('zrem', lambda s, o, k, m: s.zrem(m), _readd),
+    _command('zremrangebylex', lambda s, o, k, m: s.zremrangebylex('[' + m, '[' + m), _readd),
+    _command('zremrangebyrank', lambda s, o, k, m: s.zremrangebyrank(k, k), _readd),
+    _command('zremrangebyscore', lambda s, o, k, m: s.zremrangebyscore(k, k), _readd),
+    _command('zrevrange', lambda s, o, k, m: s.zrevrange(k, k + 9)),
+    _command('zrevrangebylex', lambda s, o, k, m: s.zrevrangebylex('[' + m, '+', 0, 10)),
+    _command('zrevrangebyscore', lambda s, o, k, m: s.zrevrangebyscore(k, k + 9)),
+    _command('zrevrank', lambda s, o, k, m: s.zrevrank(m)),
+    _command('zscan', lambda s, o, k, m: s.zscan(0)),
+    _command('zscan_iter', lambda s, o, k, m: list(itertools.islice(s.zscan_iter(), 10))),
+    _command('zscore', lambda s, o, k, m: s.zscore(m)),
+    _command('zunion', lambda s, o, k, m: s.zunion(o)),
+    _command('zunionstore', lambda s, o, k, m: type(s)().zunionstore(s, o)),
+]
+
+COLUMNAR_COMMANDS = ZSET_COMMANDS + [
+    _command('zrangebyscore_arrays', lambda s, o, k, m: s.zrangebyscore_arrays(k, k + 9)),
+]
+
+HASH_COMMANDS = [
+    _command('hdel', lambda s, o, k, m: s.hdel(m), lambda s, o, k, m, r: s.hset(m, _value(k))),
+    _command('hexists', lambda s, o, k, m: s.hexists(m)),
+    _command('hexpire', lambda s, o, k, m: s.hexpire(60, m), lambda s, o, k, m, r: s.hpersist(m)),
+    _command('hget', lambda s, o, k, m: s.hget(m)),
+    _command('hgetall', lambda s, o, k, m: s.hgetall()),
+    _command('hincrby', lambda s, o, k, m: s.hincrby(b'counter', 1), lambda s, o, k, m, r: s.hdel(b'counter')),
+    _command('hincrbyfloat', lambda s, o, k, m: s.hincrbyfloat(b'counter', 0.5),
+             lambda s, o, k, m, r: s.hdel(b'counter')),
+    _command('hkeys', lambda s, o, k, m: s.hkeys()),
+    _command('hlen', lambda s, o, k, m: s.hlen()),
+    _command('hmget', lambda s, o, k, m: s.hmget([m])),
+    _command('hmset', lambda s, o, k, m: s.hmset({m: b'new'}), lambda s, o, k, m, r: s.hset(m, _value(k))),
+    _command('hpersist', lambda s, o, k, m: s.hpersist(m), before=lambda s, o, k, m: s.hexpire(60, m)),
+    _command('hpexpire', lambda s, o, k, m: s.hpexpire(60000, m), lambda s, o, k, m, r: s.hpersist(m)),
+    _command('hpexpireat', lambda s, o, k, m: s.hpexpireat(int(time.time() * 1000) + 60000, m),
+             lambda s, o, k, m, r: s.hpersist(m)),
+    _command('hpttl', lambda s, o, k, m: s.hpttl(m), lambda s, o, k, m, r: s.hpersist(m),
+             lambda s, o, k, m: s.hexpire(60, m)),
+    _command('hscan', lambda s, o, k, m: s.hscan(0)),
+    _command('hscan_iter', lambda s, o, k, m: list(itertools.islice(s.hscan_iter(), 10))),
+    _command('hset', lambda s, o, k, m: s.hset(b'new', b'new'), lambda s, o, k, m, r: s.hdel(b'new')),
+    _command('hsetnx', lambda s, o, k, m: s.hsetnx(b'new', b'new'), lambda s, o, k, m, r: s.hdel(b'new')),
+    _command('httl', lambda s, o, k, m: s.httl(m), lambda s, o, k, m, r: s.hpersist(m),
+             lambda s, o, k, m: s.hexpire(60, m)),
+    _command('hvals', lambda s, o, k, m: s.hvals()),
+    _command('memory_usage', lambda s, o, k, m: s.memory_usage()),
+]
+
+SET_COMMANDS = [
+    _command('memory_usage', lambda s, o, k, m: s.memory_usage()),
+    _command('sadd', lambda s, o, k, m: s.sadd(b'new'), lambda s, o, k, m, r: s.srem(b'new')),
+    _command('scard', lambda s, o, k, m: s.scard()),
+    _command('sdiff', lambda s, o, k, m: s.sdiff(o)),
+    _command('sdiffstore', lambda s, o, k, m: Set().sdiffstore(s, o)),
+    _command('sinter', lambda s, o, k, m: s.sinter(o)),
+    _command('sintercard', lambda s, o, k, m: s.sintercard(o)),
+    _command('sinterstore', lambda s, o, k, m: Set().sinterstore(s, o)),
+    _command('sismember', lambda s, o, k, m: s.sismember(m)),
+    _command('smembers', lambda s, o, k, m: s.smembers()),
+    _command('spop', lambda s, o, k, m: s.spop(), lambda s, o, k, m, r: s.sadd(r)),
+    _command('srandmember', lambda s, o, k, m: s.srandmember()),
+    _command('srem', lambda s, o, k, m: s.srem(m), lambda s, o, k, m, r: s.sadd(m)),
+    _command('sscan', lambda s, o, k, m: s.sscan(0)),
+    _command('sscan_iter', lambda s, o, k, m: list(itertools.islice(s.sscan_iter(), 10))),
+    _command('sunion', lambda s, o, k, m: s.sunion(o)),
+    _command('sunionstore', lambda s, o, k, m: Set().sunionstore(s, o)),
+]
+
+
+def _reinsert(s, o, k, m, result):
+    "Puts the value ``m`` removed from the index ``k`` back"
+    if k < s.llen():
+        s.linsert('before', _value(k + 1), m)
+    else:
+        s.rpush(m)
+
+
+LIST_COMMANDS = [
+    _command('blmove', lambda s, o, k, m: s.blmove(o), lambda s, o, k, m, r: s.lpush(o.rpop())),
+    _command('blpop', lambda s, o, k, m: s.blpop(), lambda s, o, k, m, r: s.lpush(r[1])),
+    _command('brpop', lambda s, o, k, m: s.brpop(), lambda s, o, k, m, r: s.rpush(r[1])),
+    _command('lindex', lambda s, o, k, m: s.lindex(k)),
+    _command('linsert', lambda s, o, k, m: s.linsert('before', m, b'new'), lambda s, o, k, m, r: s.lrem(1, b'new')),
+    _command('llen', lambda s, o, k, m: s.llen()),
+    _command('lmove', lambda s, o, k, m: s.lmove(o), lambda s, o, k, m, r: s.lpush(o.rpop())),
+    _command('lpop', lambda s, o, k, m: s.lpop(), lambda s, o, k, m, r: s.lpush(r)),
+    _command('lpush', lambda s, o, k, m: s.lpush(b'new'), lambda s, o, k, m, r: s.lpop()),
+    _command('lrange', lambda s, o, k, m: s.lrange(k, k + 9)),
+    _command('lrem', lambda s, o, k, m: s.lrem(1, m), _reinsert),
+    _command('lset', lambda s, o, k, m: s.lset(k, b'new'), lambda s, o, k, m, r: s.lset(k, m)),
+    _command('ltrim', lambda s, o, k, m: s.ltrim(1, -1), lambda s, o, k, m, r: s.lpush(_value(0))),
+    _command('memory_usage', lambda s, o, k, m: s.memory_usage()),
+    _command('rpop', lambda s, o, k, m: s.rpop(), lambda s, o, k, m, r: s.rpush(r)),
+    _command('rpush', lambda s, o, k, m: s.rpush(b'new'), lambda s, o, k, m, r: s.rpop()),
+]
+
+
+def _build_zset(cls, n, step=1):
+    z = cls()
+    z.zadd_many([(_name(k), k) for k in range(0, n, step)])
+    return z
+
+
+def _build_hash(cls, n):
+    h = cls()
+    for k in range(n):
+        h.hset(_member(k), _value(k))
+    return h
+
+
+def _build_set(cls, n, step=1):
+    s = cls()
+    s.sadd(*[_member(k) for k in range(0, n, step)])
+    return s
+
+
+def _build_list(cls, n):
+    l = cls()
+    l.rpush(*[_value(k) for k in range(n)])
+    return l
+
+
+def _other_zset(cls, n):
+    "Returns a sorted set holding every other member up to ``OTHER_SIZE``"
+    return _build_zset(cls, 2 * min(n, OTHER_SIZE), step=2)
+
+
+def _other_set(cls, n):
+    return _build_set(cls, 2 * min(n, OTHER_SIZE), step=2)
+
+
+# The structures benchmarked, as (class, element of the index k, builder,
+# builder of the other structure, commands)
+STRUCTURES = {
+    'ZSet': (ZSet, _name, _build_zset, _other_zset, ZSET_COMMANDS),
+    'Hash': (Hash, _member, _build_hash, None, HASH_COMMANDS),
+    'Set': (Set, _member, _build_set, _other_set, SET_COMMANDS),
+    'List': (List, _value, _build_list, lambda cls, n: cls(), LIST_COMMANDS),
+}
+if USE_NUMPY:
+    STRUCTURES['ColumnarZSet'] = (ColumnarZSet, _name, _build_zset, _other_zset, COLUMNAR_COMMANDS)
+
+
+def _percentile(timings, q):
+    "Returns the ``q`` quantile of the sorted ``timings``"
+    return timings[min(int(q * len(timings)), len(timings) - 1)]
+
+
+def time_command(s, o, n, element, command, ops=OPS, time_limit=TIME_LIMIT, rng=random):
+    """ Times ``command`` against the structure ``s`` of ``n`` elements and
+    returns a dict of the calls made, the calls per second and the p50 and
+    p99 latency in microseconds.
+    """
+    name, call, after, before = command
+    timings = []
+    deadline = time.perf_counter() + time_limit
+    while len(timings) < ops:
+        k = rng.randrange(n)
+        m = element(k)
+        if before is not None:
+            before(s, o, k, m)
+        start = time.perf_counter_ns()
+        result = call(s, o, k, m)
+        timings.append(time.perf_counter_ns() - start)
+        if after is not None:
+            after(s, o, k, m, result)
+        if time.perf_counter() > deadline:
+            break
+    return _stats(timings, sum(timings))
+
+
+def measure_memory(build, cls, n):
+    "Returns the structure built by ``build`` and the bytes it takes per element"
+    gc.collect()
+    tracemalloc.start()
+    try:
+        s = build(cls, n)
+        used = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return s, round(used / float(n), 1)
+
+
+def _stats(timings, elapsed):
+    "Returns the calls per second over ``elapsed`` nanoseconds and the latencies of ``timings``"
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'ops_per_sec': round(len(timings) * 1e9 / max(elapsed, 1), 1),
+        'p50_us': round(_percentile(timings, 0.5) / 1000.0, 3),
+        'p99_us': round(_percentile(timings, 0.99) / 1000.0, 3),
+    }
+
+
+def time_contention(shards, threads, ops=OPS, time_limit=TIME_LIMIT, seed=0):
+    """ Times ``threads`` threads making ``ops`` calls of ``zincrby``
+    together on random keys of a ``ShardedDatabase`` of ``shards`` shards,
+    and returns a dict like ``time_command``, the calls per second being
+    those of all the threads.
+    """
+    db = ShardedDatabase(shards)
+    keys = ['key:%d' % i for i in range(CONTENTION_KEYS)]
+    for key in keys:
+        db.zadd(key, member=0)
+    timings = [[] for i in range(threads)]
+    deadline = time.perf_counter() + time_limit
+    start = threading.Barrier(threads + 1)
+
+    def work(timings, rng):
+        start.wait()
+        for i in range(-(-ops // threads)):
+            key = keys[rng.randrange(CONTENTION_KEYS)]
+            begin = time.perf_counter_ns()
+            db.zincrby(key, 'member', 1)
+            timings.append(time.perf_counter_ns() - begin)
+            if time.perf_counter() > deadline:
+                break
+
+    workers = [threading.Thread(target=work, args=(timings[i], random.Random(seed + i)))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    began = time.perf_counter_ns()
+    for worker in workers:
+        worker.join()
+    return _stats([t for thread in timings for t in thread], time.perf_counter_ns() - began)
+
+
+def run(sizes=DEFAULT_SIZES, structures=None, ops=OPS, time_limit=TIME_LIMIT, seed=0, log=None,
+        threads=THREADS, shards=CONTENTION_SHARDS):
+    """ Benchmarks ``structures``, names of ``STRUCTURES`` defaulting to all
+    of them, at each of ``sizes``, and the contention of each number of
+    ``threads`` on each number of ``shards``, and returns the results,
+    writing progress to the file ``log`` if given.
+    """
+    rng = random.Random(seed)
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'numpy': USE_NUMPY,
+        'sizes': list(sizes),
+        'structures': {},
+    }
+    for name in structures or STRUCTURES:
+        cls, element, build, build_other, commands = STRUCTURES[name]
+        by_size = results['structures'][name] = {}
+        for n in sizes:
+            s, per_element = measure_memory(build, cls, n)
+            o = build_other(cls, n) if build_other is not None else None
+            timed = by_size[str(n)] = {'bytes_per_element': per_element, 'commands': {}}
+            if log is not None:
+                log.write('%s %d: %.1f bytes per element\n' % (name, n, per_element))
+            for command in commands:
+                stats = timed['commands'][command[0]] = time_command(
+                    s, o, n, element, command, ops, time_limit, rng)
+                if log is not None:
+                    log.write('  %-18s %12.1f ops/s  p50 %9.3fus  p99 %9.3fus\n' % (
+                        command[0], stats['ops_per_sec'], stats['p50_us'], stats['p99_us']))
+            del s, o
+    contention = results['contention'] = {}
+    for n in shards:
+        by_threads = contention[str(n)] = {}
+        for count in threads:
+            stats = by_threads[str(count)] = time_contention(n, count, ops, time_limit, seed)
+            if log is not None:
+                log.write('contention %d shards %d threads %12.1f ops/s  p50 %9.3fus  p99 %9.3fus\n' % (
+                    n, count, stats['ops_per_sec'], stats['p50_us'], stats['p99_us']))
+    return results
+
+
+def _compare_stats(regressions, name, size, command, before, stats, threshold):
+    if stats['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+        regressions.append((name, size, command, 'ops_per_sec', before['ops_per_sec'], stats['ops_per_sec']))
+    if stats['p99_us'] > before['p99_us'] * (1 + threshold):
+        regressions.append((name, size, command, 'p99_us', before['p99_us'], stats['p99_us']))
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    """ Returns the regressions of ``results`` from ``baseline`` by more than
+    ``threshold``, a fraction, as a list of (structure, size, command or
+    None for the memory, metric, baseline value, value) tuples.  Those of
+    the contention benchmark are listed as ("contention", shards, "N
+    threads", ...).
+    """
+    regressions = []
+    for name, by_size in sorted(results['structures'].items()):
+        for size, timed in sorted(by_size.items(), key=lambda item: int(item[0])):
+            base = baseline.get('structures', {}).get(name, {}).get(size)
+            if base is None:
+                continue
+            if timed['bytes_per_element'] > base['bytes_per_element'] * (1 + threshold):
+                regressions.append((name, int(size), None, 'bytes_per_element',
+                                    base['bytes_per_element'], timed['bytes_per_element']))
+            for command, stats in sorted(timed['commands'].items()):
+                before = base['commands'].get(command)
+                if before is not None:
+                    _compare_stats(regressions, name, int(size), command, before, stats, threshold)
+    for shards, by_threads in sorted(results.get('contention', {}).items(), key=lambda item: int(item[0])):
+        for threads, stats in sorted(by_threads.items(), key=lambda item: int(item[0])):
+            before = baseline.get('contention', {}).get(shards, {}).get(threads)
+            if before is not None:
+                _compare_stats(regressions, 'contention', int(shards), '%s threads' % threads,
+                               before, stats, threshold)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pyredis datastructures")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma separated size classes, up to %d" % SIZES[-1])
+    parser.add_argument('--structures', default=','.join(STRUCTURES),
+                        help="comma separated structures among %s" % ', '.join(STRUCTURES))
+    parser.add_argument('--ops', type=int, default=OPS)
+    parser.add_argument('--time-limit', type=float, default=TIME_LIMIT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', default=','.join(map(str, THREADS)),
+                        help="comma separated thread counts of the contention benchmark, empty to skip it")
+    parser.add_argument('--shards', default=','.join(map(str, CONTENTION_SHARDS)),
+                        help="comma separated shard counts of the contention benchmark")
+    parser.add_argument('--output', default='-', help="file to write the JSON results to")
+    parser.add_argument('--compare', default=None, help="JSON results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args(argv)
+    structures = args.structures.split(',')
+    unknown = [name for name in structures if name not in STRUCTURES]
+    if unknown:
+        parser.error("unknown structures: %s" % ', '.join(unknown))
+    sizes = [int(size) for size in args.sizes.split(',')]
+    threads = [int(count) for count in args.threads.split(',') if count]
+    shards = [int(count) for count in args.shards.split(',') if count]
+    results = run(sizes, structures, args.ops, args.time_limit, args.seed, sys.stderr, threads, shards)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for name, size, command, metric, before, after in regressions:
+            sys.stderr.write('REGRESSION %s %d %s %s: %s -> %s\n' % (
+                name, size, command or '-', metric, before, after))
+        if regressions:
+            sys.exit(1)
 
-def mem(size="rss"):
-    """Generalization; memory sizes: rss, rsz, vsz."""
-    return int(os.popen('ps -p %d -o %s | tail -1' % (os.getpid(), size)).read())
-
-# initialize
-r = Redis(unix_socket_path='/tmp/redis.sock')
-start_memory = mem()
-# get dataset
-values = []
-for i in range(100000):
-    values.append((str(i), random.randint(0, 9999999)))
-
-# reset
-r.flushdb()
-
-# Measure Redis
-start = time.time()
-for member, score in values:
-    r.zadd('aaaaa', **{member: score})
-end = time.time()
-print end - start
-after_redis_memory = mem() - start_memory
-
-print "Memory after Redis: %s" % after_redis_memory
-
-# Measure Zset
-zset = ZSet()
-start = time.time()
-for member, score in values:
-    zset.zadd(**{member: score})
-end = time.time()
-print end - start
-after_zset_memory = mem() - after_redis_memory
-print "Memory after ZSet: %s" % after_zset_memory
 
+if __name__ == '__main__':
+    main()
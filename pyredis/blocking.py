@@ -0,0 +1,158 @@
+""" Blocking pops shared by the datastructures.
+
+A consumer that finds every structure it watches empty registers a waiter
+on each of them.  Structures call ``wake`` after adding elements, which
+hands elements to their waiters in FIFO order, one element per waiter, in
+the producer's thread.  Consumers therefore never poll and a push never
+wakes more consumers than it can satisfy.
+
+Waiters are registered and served under the module ``lock``, so checking
+for an element and registering a waiter cannot race with a producer.  The
+structures themselves are not thread-safe: producers running in other
+threads than the consumers should hold ``lock`` while they modify a
+structure that consumers block on.
+"""
+import asyncio
+import threading
+from collections import deque
+
+
+lock = threading.RLock()
+
+
+class Waiter(object):
+    """ A consumer blocked on one or more structures.
+
+    ``pop`` is called with a structure and returns the result to hand to
+    the consumer, or None if the structure is empty.  ``restore`` undoes a
+    pop whose result could not be delivered.
+    """
+
+    def __init__(self, structures, pop, restore):
+        self.structures = structures
+        self.pop = pop
+        self.restore = restore
+        self.result = None
+        self.done = False
+
+    def register(self):
+        for structure in self.structures:
+            if structure._waiters is None:
+                structure._waiters = deque()
+            structure._waiters.append(self)
+
+    def unregister(self, served_by=None):
+        for structure in self.structures:
+            if structure is not served_by and structure._waiters:
+                try:
+                    structure._waiters.remove(self)
+                except ValueError:
+                    pass
+
+    def wake(self, result):
+        raise NotImplementedError
+
+
+class ThreadWaiter(Waiter):
+
+    def __init__(self, structures, pop, restore):
+        super(ThreadWaiter, self).__init__(structures, pop, restore)
+        self.event = threading.Event()
+
+    def wake(self, result):
+        self.result = result
+        self.event.set()
+
+
+class AsyncWaiter(Waiter):
+
+    def __init__(self, structures, pop, restore, loop):
+        super(AsyncWaiter, self).__init__(structures, pop, restore)
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def _deliver(self, result):
+        if self.future.cancelled():
+            self.restore(result)
+        else:
+            self.future.set_result(result)
+
+    def wake(self, result):
+        self.result = result
+        self.loop.call_soon_threadsafe(self._deliver, result)
+
+
+def _pop_any(structures, pop):
+    for structure in structures:
+        result = pop(structure)
+        if result is not None:
+            return result
+    return None
+
+
+def wake(structure):
+    """ Serves the waiters blocked on ``structure``, oldest first, for as
+    long as it has elements to pop.
+    """
+    with lock:
+        waiters = structure._waiters
+        while waiters:
+            waiter = waiters[0]
+            result = waiter.pop(structure)
+            if result is None:
+                break
+            waiters.popleft()
+            waiter.done = True
+            waiter.unregister(served_by=structure)
+            waiter.wake(result)
+
+
+def block(structures, pop, restore, timeout=0):
+    """ Pops from the first of ``structures`` that is not empty, waiting
+    up to ``timeout`` seconds for an element to arrive if they all are.
+    A ``timeout`` of 0 or None waits forever.
+
+    Returns the result of ``pop`` or None if the timeout expired.
+    """
+    with lock:
+        result = _pop_any(structures, pop)
+        if result is not None:
+            return result
+        waiter = ThreadWaiter(structures, pop, restore)
+        waiter.register()
+
+    waiter.event.wait(timeout or None)
+    with lock:
+        if not waiter.done:
+            waiter.unregister()
+            return None
+    return waiter.result
+
+
+async def block_async(structures, pop, restore, timeout=0):
+    """ The asyncio counterpart of ``block``, suspending the calling task
+    instead of a thread while waiting.
+    """
+    with lock:
+        result = _pop_any(structures, pop)
+        if result is not None:
+            return result
+        waiter = AsyncWaiter(structures, pop, restore, asyncio.get_running_loop())
+        waiter.register()
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(waiter.future), timeout or None)
+    except asyncio.TimeoutError:
+        with lock:
+            if not waiter.done:
+                waiter.unregister()
+                return None
+        return await waiter.future
+    except asyncio.CancelledError:
+        with lock:
+            if not waiter.done:
+                waiter.unregister()
+            elif not waiter.future.cancel():
+                # the result reached the future but not the cancelled task
+                waiter.restore(waiter.result)
+        raise
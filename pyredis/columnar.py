@@ -0,0 +1,287 @@
+import bisect
+from operator import xor
+
+try:
+    import numpy
+    USE_NUMPY = True
+except ImportError:
+    USE_NUMPY = False
+
+from . import blocking, memory
+from .exceptions import RedisError
+from .scan import ScanDict
+from .zset import ZSet
+
+
+INITIAL_CAPACITY = 16
+ITER_CHUNK = 256
+
+
+class ColumnarZSet(ZSet):
+    """ A sorted set for numeric scores which keeps its scores in a
+    contiguous float64 NumPy array next to an array of members, both in
+    (score, member) order.
+
+    Score ranges are found with a vectorised ``searchsorted`` and counted
+    with index arithmetic, and ranges can be read back as array slices
+    without building a tuple per element.  Inserting in the middle shifts
+    the tail of both arrays, so this mode suits append-mostly data such as
+    time series.
+
+    Requires numpy.
+    """
+
+    def __init__(self):
+        if not USE_NUMPY:
+            raise ImportError("ColumnarZSet requires numpy")
+        self._dict = ScanDict()
+        self._scores = numpy.empty(INITIAL_CAPACITY, dtype=numpy.float64)
+        self._members = numpy.empty(INITIAL_CAPACITY, dtype=object)
+        self._len = 0
+        self._used = 0
+
+    def _cast(self, score):
+        "Returns ``score`` as a float or raises a RedisError"
+        try:
+            score = float(score)
+        except (TypeError, ValueError):
+            raise RedisError("value is not a valid float")
+        if score != score:
+            raise RedisError("value is not a valid float")
+        return score
+
+    def _reserve(self, size):
+        "Grows the arrays so they can hold at least ``size`` members"
+        capacity = len(self._scores)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        scores = numpy.empty(capacity, dtype=numpy.float64)
+        members = numpy.empty(capacity, dtype=object)
+        scores[:self._len] = self._scores[:self._len]
+        members[:self._len] = self._members[:self._len]
+        self._scores, self._members = scores, members
+
+    def _locate(self, score, member):
+        """ Returns the index where (``score``, ``member``) is, or where it
+        would be inserted.
+        """
+        scores = self._scores[:self._len]
+        lo = int(scores.searchsorted(score, 'left'))
+        hi = int(scores.searchsorted(score, 'right'))
+        if hi - lo <= 1:
+            if lo < hi and self._members[lo] < member:
+                return hi
+            return lo
+        return bisect.bisect_left(self._members, member, lo, hi)
+
+    def _insert_at(self, i, score, member):
+        n = self._len
+        self._reserve(n + 1)
+        if i < n:
+            self._scores[i + 1:n + 1] = self._scores[i:n]
+            self._members[i + 1:n + 1] = self._members[i:n]
+        self._scores[i] = score
+        self._members[i] = member
+        self._len = n + 1
+
+    def _delete_range(self, i, j):
+        "Removes the members at indexes ``i`` up to ``j`` from the arrays"
+        n = self._len
+        removed = j - i
+        self._scores[i:n - removed] = self._scores[j:n]
+        self._members[i:n - removed] = self._members[j:n]
+        # drop the references left behind in the unused tail
+        self._members[n - removed:n] = None
+        self._len = n - removed
+
+    def _delete_members(self, i, j):
+        """ Removes the members at indexes ``i`` up to ``j`` from the sorted
+        set and returns the number removed.
+        """
+        for member in self._members[i:j]:
+            del self._dict[member]
+            self._used -= memory.sizeof(member)
+        self._delete_range(i, j)
+        return j - i
+
+    def _insert_or_update(self, member, score):
+        score = self._cast(score)
+        current = self._dict.get(member)
+        if current is not None:
+            if current == score:
+                return 0
+            i = self._locate(current, member)
+            self._delete_range(i, i + 1)
+        self._insert_at(self._locate(score, member), score, member)
+        self._dict[member] = score
+        if current is None:
+            self._used += memory.sizeof(member)
+            return 1
+        return 0
+
+    def _iter_sorted(self):
+        n = self._len
+        return zip(self._scores[:n].tolist(), self._members[:n].tolist())
+
+    def _load_sorted(self, items):
+        items = list(items)
+        n = len(items)
+        self._scores = numpy.empty(max(n, INITIAL_CAPACITY), dtype=numpy.float64)
+        self._members = numpy.empty(max(n, INITIAL_CAPACITY), dtype=object)
+        if n:
+            self._scores[:n] = [score for score, member in items]
+            self._members[:n] = [member for score, member in items]
+        self._len = n
+
+    def _replace(self, scores):
+        return ZSet._replace(self, dict((member, self._cast(score)) for member, score in scores.items()))
+
+    def _pairs(self, members, scores, withscores, score_cast_func):
+        "Turns array slices into the list format returned by ``zrange``"
+        if withscores:
+            scores = scores.tolist()
+            if score_cast_func is not float:
+                scores = map(score_cast_func, scores)
+            return list(zip(members.tolist(), scores))
+        return members.tolist()
+
+    def _iter_slice(self, lo, hi, desc, withscores, score_cast_func):
+        """ Yields the members, or (member, score) pairs, between indexes
+        ``lo`` and ``hi`` converting ``ITER_CHUNK`` of them at a time.
+        """
+        if desc:
+            for end in range(hi, lo, -ITER_CHUNK):
+                begin = max(lo, end - ITER_CHUNK)
+                for item in self._pairs(self._members[begin:end][::-1], self._scores[begin:end][::-1],
+                                        withscores, score_cast_func):
+                    yield item
+        else:
+            for begin in range(lo, hi, ITER_CHUNK):
+                end = min(hi, begin + ITER_CHUNK)
+                for item in self._pairs(self._members[begin:end], self._scores[begin:end],
+                                        withscores, score_cast_func):
+                    yield item
+
+    def _score_slice(self, min, max, start=None, num=None, desc=False):
+        """ Returns the (lo, hi) indexes of the members with a score between
+        ``min`` and ``max`` after skipping ``start`` and keeping at most
+        ``num`` of them, counting from the top if ``desc`` is True.
+        """
+        if xor(start is None, num is None):
+            raise Exception("``start`` and ``num`` must both be specified")
+        scores = self._scores[:self._len]
+        lo = int(scores.searchsorted(min, 'left'))
+        hi = int(scores.searchsorted(max, 'right'))
+        if start is not None:
+            if desc:
+                hi -= start
+                if num >= 0:
+                    lo = lo if hi - num < lo else hi - num
+            else:
+                lo += start
+                if num >= 0:
+                    hi = hi if lo + num > hi else lo + num
+        if lo > hi:
+            lo = hi
+        return lo, hi
+
+    def _count_members_below(self, member, inclusive=False):
+        if inclusive:
+            return bisect.bisect_right(self._members, member, 0, self._len)
+        return bisect.bisect_left(self._members, member, 0, self._len)
+
+    def memory_usage(self):
+        return (memory.STRUCTURE + len(self._scores) * memory.COLUMNAR_SLOT
+                + self._len * (memory.COLUMNAR_ENTRY + memory.SCAN_ENTRY) + self._used)
+
+    def zadd_many(self, pairs):
+        if hasattr(pairs, 'items'):
+            pairs = pairs.items()
+        return ZSet.zadd_many(self, [(member, self._cast(score)) for member, score in pairs])
+
+    def zrank(self, member):
+        score = self._dict.get(member)
+        if score is None:
+            return None
+        return self._locate(score, member)
+
+    def zrevrank(self, member):
+        score = self._dict.get(member)
+        if score is None:
+            return None
+        return self._len - 1 - self._locate(score, member)
+
+    def zcount(self, low, high):
+        scores = self._scores[:self._len]
+        count = int(scores.searchsorted(high, 'right') - scores.searchsorted(low, 'left'))
+        return count if count > 0 else 0
+
+    def zincrby(self, member, amount=1):
+        amount = self._cast(amount)
+        current = self._dict.get(member)
+        new_score = amount if current is None else current + amount
+        self._insert_or_update(member, new_score)
+        if self._waiters:
+            blocking.wake(self)
+        return new_score
+
+    def _zrange(self, start, end, desc=False, withscores=False, score_cast_func=float):
+        bounds = self._normalize_range(start, end)
+        if bounds is None:
+            return []
+        start, end = bounds
+        if desc:
+            start, end = self._len - 1 - end, self._len - 1 - start
+        members = self._members[start:end + 1]
+        scores = self._scores[start:end + 1]
+        if desc:
+            members, scores = members[::-1], scores[::-1]
+        return self._pairs(members, scores, withscores, score_cast_func)
+
+    def _iter_between(self, first, last, desc, withscores, score_cast_func):
+        return self._iter_slice(first, last + 1, desc, withscores, score_cast_func)
+
+    def iter_rangebyscore(self, min, max, start=None, num=None, withscores=False, score_cast_func=float, desc=False):
+        lo, hi = self._score_slice(min, max, start, num, desc)
+        return self._iter_slice(lo, hi, desc, withscores, score_cast_func)
+
+    def _zrangebyscore(self, min, max, start=None, num=None, withscores=False, score_cast_func=float, desc=False):
+        members, scores = self.zrangebyscore_arrays(min, max, start, num, desc=desc)
+        return self._pairs(members, scores, withscores, score_cast_func)
+
+    def zrangebyscore_arrays(self, min, max, start=None, num=None, desc=False):
+        """ Returns the members and scores in the score range of ``min`` and
+        ``max`` as a pair of NumPy array views, without copying them.
+
+        ``start`` and ``num`` page through the range and ``desc`` returns
+        the views in reverse order, like ``zrangebyscore``.
+        """
+        lo, hi = self._score_slice(min, max, start, num, desc)
+        members = self._members[lo:hi]
+        scores = self._scores[lo:hi]
+        if desc:
+            return members[::-1], scores[::-1]
+        return members, scores
+
+    def zrem(self, *members):
+        removed = 0
+        for member in members:
+            score = self._dict.pop(member, None)
+            if score is not None:
+                i = self._locate(score, member)
+                self._delete_range(i, i + 1)
+                self._used -= memory.sizeof(member)
+                removed += 1
+        return removed
+
+    def zremrangebyrank(self, min, max):
+        bounds = self._normalize_range(min, max)
+        if bounds is None:
+            return 0
+        return self._delete_members(bounds[0], bounds[1] + 1)
+
+    def zremrangebyscore(self, min, max):
+        lo, hi = self._score_slice(min, max)
+        return self._delete_members(lo, hi)
@@ -0,0 +1,1533 @@
+""" The command table of ``pyredis.server``.
+
+Each command is a function taking the client and the list of bytes
+arguments following the command name, and returning the reply to encode
+with ``pyredis.resp.encode``.  Blocking commands are coroutines.  Commands
+are registered with their Redis arity, positive for an exact number of
+arguments (counting the command name) and negative for a minimum, flags
+such as "write" for commands that modify the keyspace and "denyoom" for
+the ones that may use more memory, and the positions
+of their keys as a (first, last, step) tuple, a negative last position
+counting from the end.
+
+Write commands are propagated to the append-only file as they were
+received, except those whose effect depends on when or by chance they run,
+which set ``client.rewritten`` to the commands to propagate instead: EXPIRE
+becomes PEXPIREAT, SPOP becomes SREM and BLPOP becomes LPOP, for example.
+"""
+import math
+import time
+
+from . import blocking, expiry, instrument
+from .database import type_name
+from .exceptions import RedisError
+from .hash import Hash
+from .intset import parse_int64
+from .list import List
+from .resp import NULL_ARRAY, OK, Status, format_float
+from .set import Set
+from .zset import ZSet
+
+
+COMMANDS = {}
+
+
+class Command(object):
+
+    def __init__(self, name, func, arity, flags, keys=(1, 1, 1)):
+        self.name = name
+        self.func = func
+        self.arity = arity
+        self.flags = flags
+        self.keys = keys
+
+    @property
+    def write(self):
+        return 'write' in self.flags
+
+    def check_arity(self, argc):
+        "Returns True if ``argc`` arguments, counting the name, are accepted"
+        if self.arity < 0:
+            return argc >= -self.arity
+        return argc == self.arity
+
+    def keys_of(self, args):
+        "Returns the keys among ``args``, the command name included"
+        first, last, step = self.keys
+        if not first:
+            return []
+        if last < 0:
+            last += len(args)
+        return args[first:last + 1:step]
+
+
+def command(name, arity, flags='', keys=(1, 1, 1)):
+    "Registers the decorated function as the command ``name``"
+    def register(func):
+        COMMANDS[name] = Command(name, func, arity, frozenset(flags.split()), keys)
+        return func
+    return register
+
+
+def _int(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        raise RedisError("value is not an integer or out of range")
+
+
+def _float(arg):
+    try:
+        value = float(arg)
+    except ValueError:
+        raise RedisError("value is not a valid float")
+    if math.isnan(value):
+        raise RedisError("value is not a valid float")
+    return value
+
+
+def _timeout(arg):
+    try:
+        timeout = float(arg)
+    except ValueError:
+        raise RedisError("timeout is not a float or out of range")
+    if timeout < 0:
+        raise RedisError("timeout is negative")
+    return timeout
+
+
+def _score_bound(arg, upper):
+    """ Parses a ZRANGEBYSCORE style bound, turning an exclusive "(" bound
+    into the next float inwards.
+    """
+    if arg[:1] == b'(':
+        try:
+            value = float(arg[1:])
+        except ValueError:
+            raise RedisError("min or max is not a float")
+        return math.nextafter(value, -math.inf if upper else math.inf)
+    try:
+        return float(arg)
+    except ValueError:
+        raise RedisError("min or max is not a float")
+
+
+def _option(arg):
+    return arg.decode('latin-1').lower()
+
+
+def _bulk(value):
+    "Returns ``value`` as bytes, formatting numbers stored in-process"
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return format_float(value).encode()
+    return str(value).encode()
+
+
+def _bulks(values):
+    return [_bulk(value) for value in values]
+
+
+def _syntax_error():
+    return RedisError("syntax error")
+
+
+def _parse_scan(args, allow_type=False):
+    "Parses the cursor and the MATCH, COUNT and TYPE options of a scan"
+    cursor = _int(args[0])
+    match, count, _type = None, 10, None
+    i = 1
+    while i < len(args):
+        option = _option(args[i])
+        if i + 1 >= len(args):
+            raise _syntax_error()
+        if option == 'match':
+            match = args[i + 1]
+        elif option == 'count':
+            count = _int(args[i + 1])
+        elif option == 'type' and allow_type:
+            _type = _option(args[i + 1])
+        else:
+            raise _syntax_error()
+        i += 2
+    return cursor, match, count, _type
+
+
+def _with_scores(client, items, withscores):
+    """ Formats (member, score) pairs as a flat array in RESP2 or an array
+    of pairs in RESP3, or only the members if ``withscores`` is False.
+    """
+    if not withscores:
+        return _bulks(items)
+    if client.protocol == 3:
+        return [[_bulk(member), score] for member, score in items]
+    reply = []
+    for member, score in items:
+        reply.append(_bulk(member))
+        reply.append(score)
+    return reply
+
+
+# Connection and server
+
+@command('ping', -1)
+def ping(client, args):
+    if len(args) > 1:
+        raise RedisError("wrong number of arguments for 'ping' command")
+    return args[0] if args else Status('PONG')
+
+
+@command('echo', 2)
+def echo(client, args):
+    return args[0]
+
+
+@command('quit', -1, 'transaction')
+def quit(client, args):
+    client.closing = True
+    return OK
+
+
+@command('select', 2)
+def select(client, args):
+    index = _int(args[0])
+    if not 0 <= index < len(client.server.databases):
+        raise RedisError("DB index is out of range")
+    client.db = client.server.databases[index]
+    return OK
+
+
+@command('hello', -1)
+def hello(client, args):
+    if args:
+        protocol = _int(args[0])
+        if protocol not in (2, 3):
+            raise RedisError("NOPROTO unsupported protocol version")
+        i = 1
+        while i < len(args):
+            option = _option(args[i])
+            if option == 'auth' and i + 2 < len(args):
+                i += 3
+            elif option == 'setname' and i + 1 < len(args):
+                client.name = args[i + 1]
+                i += 2
+            else:
+                raise _syntax_error()
+        client.protocol = protocol
+    return {
+        b'server': b'redis',
+        b'version': client.server.version.encode(),
+        b'proto': client.protocol,
+        b'id': client.id,
+        b'mode': b'standalone',
+        b'role': b'master',
+        b'modules': [],
+    }
+
+
+@command('client', -2)
+def client_(client, args):
+    subcommand = _option(args[0])
+    if subcommand == 'setname' and len(args) == 2:
+        client.name = args[1]
+        return OK
+    if subcommand == 'getname' and len(args) == 1:
+        return client.name
+    if subcommand == 'id' and len(args) == 1:
+        return client.id
+    if subcommand == 'setinfo' and len(args) == 3:
+        return OK
+    if subcommand == 'list' and len(args) == 1:
+        return ''.join('id=%d name=%s db=%d\n' % (
+            other.id, (other.name or b'').decode('latin-1'), client.server.databases.index(other.db))
+            for other in client.server.clients)
+    raise RedisError("unknown subcommand '%s'" % args[0].decode('latin-1'))
+
+
+@command('command', -1)
+def command_(client, args):
+    if args and _option(args[0]) == 'count':
+        return len(COMMANDS)
+    return []
+
+
+@command('info', -1)
+def info(client, args):
+    server = client.server
+    lines = [
+        '# Server',
+        'redis_version:%s' % server.version,
+        'redis_mode:standalone',
+        'uptime_in_seconds:%d' % (time.time() - server.started),
+        '',
+        '# Clients',
+        'connected_clients:%d' % len(server.clients),
+        '',
+        '# Memory',
+        'used_memory:%d' % server.used_memory,
+        'maxmemory:%d' % server.maxmemory,
+        'maxmemory_policy:%s' % server.maxmemory_policy,
+        '',
+        '# Persistence',
+        'aof_enabled:%d' % (server.aof is not None),
+        'aof_rewrite_in_progress:%d' % server.aof_rewrite_in_progress,
+    ]
+    if server.aof is not None:
+        lines += [
+            'aof_current_size:%d' % server.aof.size,
+            'aof_base_size:%d' % server.aof.base_size,
+        ]
+    lines += [
+        '',
+        '# Stats',
+        'evicted_keys:%d' % server.evicted_keys,
+        '',
+        '# Keyspace',
+    ]
+    for i, db in enumerate(server.databases):
+        if db.dbsize():
+            lines.append('db%d:keys=%d,expires=%d' % (i, db.dbsize(), len(db._expires)))
+    if instrument.enabled():
+        lines += ['', instrument.info()]
+        return '\r\n'.join(lines)
+    return '\r\n'.join(lines) + '\r\n'
+
+
+@command('slowlog', -2, keys=(0, 0, 0))
+def slowlog(client, args):
+    subcommand = _option(args[0])
+    if subcommand == 'get' and len(args) <= 2:
+        count = _int(args[1]) if len(args) == 2 else 10
+        # the client address and name are not known to the datastructures
+        return [[id, when, duration, arguments, b'', b'']
+                for id, when, duration, arguments in instrument.slowlog.get(count)]
+    if subcommand == 'len' and len(args) == 1:
+        return len(instrument.slowlog)
+    if subcommand == 'reset' and len(args) == 1:
+        instrument.slowlog.reset()
+        return OK
+    raise RedisError("unknown subcommand or wrong number of arguments for '%s'. Try SLOWLOG HELP."
+                     % args[0].decode('latin-1'))
+
+
+@command('save', 1)
+def save(client, args):
+    client.server.save()
+    return OK
+
+
+@command('bgrewriteaof', 1)
+def bgrewriteaof(client, args):
+    client.server.rewrite_aof()
+    return Status('Background append only file rewriting started')
+
+
+@command('time', 1)
+def time_(client, args):
+    now = time.time()
+    return [b'%d' % now, b'%d' % ((now % 1) * 1000000)]
+
+
+@command('dbsize', 1)
+def dbsize(client, args):
+    return client.db.dbsize()
+
+
+@command('flushdb', -1, 'write', keys=(0, 0, 0))
+def flushdb(client, args):
+    client.db.flushdb()
+    return OK
+
+
+@command('flushall', -1, 'write', keys=(0, 0, 0))
+def flushall(client, args):
+    for db in client.server.databases:
+        db.flushdb()
+    return OK
+
+
+# Transactions
+
+@command('multi', 1, 'transaction')
+def multi(client, args):
+    if client.multi is not None:
+        raise RedisError("MULTI calls can not be nested")
+    client.multi = []
+    client.multi_error = False
+    return OK
+
+
+@command('exec', 1, 'transaction')
+def exec_(client, args):
+    """ Runs the queued commands unless one of them was rejected, which
+    aborts the transaction, or a watched key was modified, which makes the
+    reply null.  Blocking commands do not block inside a transaction.
+    """
+    if client.multi is None:
+        raise RedisError("EXEC without MULTI")
+    queued, failed = client.multi, client.multi_error
+    client.multi = None
+    changed = any(db.watched_changed(key, version) for db, key, version in client.watched)
+    client.unwatch()
+    if failed:
+        raise RedisError("EXECABORT Transaction discarded because of previous errors.")
+    if changed:
+        return NULL_ARRAY
+    server = client.server
+    write = any(command.write for command, args in queued)
+    if write:
+        server.propagate(None, [b'multi'])
+    client.deny_blocking = True
+    try:
+        return [server.execute(client, command, args) for command, args in queued]
+    finally:
+        client.deny_blocking = False
+        if write:
+            server.propagate(None, [b'exec'])
+
+
+@command('discard', 1, 'transaction')
+def discard(client, args):
+    if client.multi is None:
+        raise RedisError("DISCARD without MULTI")
+    client.multi = None
+    client.unwatch()
+    return OK
+
+
+@command('watch', -2, 'transaction')
+def watch(client, args):
+    if client.multi is not None:
+        raise RedisError("WATCH inside MULTI is not allowed")
+    for key in args:
+        client.watched.append((client.db, key, client.db.watch(key)))
+    return OK
+
+
+@command('unwatch', 1, 'transaction')
+def unwatch(client, args):
+    client.unwatch()
+    return OK
+
+
+# Keys
+
+@command('del', -2, 'write', keys=(1, -1, 1))
+def delete(client, args):
+    return client.db.delete(*args)
+
+
+COMMANDS['unlink'] = Command('unlink', delete, -2, frozenset(['write']), (1, -1, 1))
+
+
+@command('exists', -2)
+def exists(client, args):
+    return client.db.exists(*args)
+
+
+@command('memory', -2, keys=(2, 2, 1))
+def memory_(client, args):
+    if _option(args[0]) != 'usage':
+        raise RedisError("unknown subcommand '%s'. Try MEMORY HELP." % args[0].decode('latin-1'))
+    if len(args) not in (2, 4):
+        raise RedisError("syntax error")
+    # the estimate needs no samples, SAMPLES is accepted and ignored
+    if len(args) == 4 and _option(args[2]) != 'samples':
+        raise RedisError("syntax error")
+    return client.db.memory_usage(args[1])
+
+
+@command('type', 2)
+def type_(client, args):
+    return Status(client.db.type(args[0]))
+
+
+def _expire_options(args):
+    flags = dict(nx=False, xx=False, gt=False, lt=False)
+    for arg in args:
+        option = _option(arg)
+        if option not in flags:
+            raise RedisError("Unsupported option %s" % arg.decode('latin-1'))
+        flags[option] = True
+    return flags
+
+
+def _expireat(client, key, when, options):
+    """ Expires ``key`` at the unix time ``when`` in milliseconds, which is
+    propagated as a PEXPIREAT, or as a DEL if ``when`` has passed.
+    """
+    if not client.db.pexpireat(key, when, **_expire_options(options)):
+        client.rewritten = []
+        return 0
+    if when <= expiry.now_ms():
+        client.rewritten = [[b'del', key]]
+    else:
+        client.rewritten = [[b'pexpireat', key, b'%d' % when]]
+    return 1
+
+
+@command('expire', -3, 'write')
+def expire(client, args):
+    return _expireat(client, args[0], expiry.now_ms() + _int(args[1]) * 1000, args[2:])
+
+
+@command('pexpire', -3, 'write')
+def pexpire(client, args):
+    return _expireat(client, args[0], expiry.now_ms() + _int(args[1]), args[2:])
+
+
+@command('expireat', -3, 'write')
+def expireat(client, args):
+    return _expireat(client, args[0], _int(args[1]) * 1000, args[2:])
+
+
+@command('pexpireat', -3, 'write')
+def pexpireat(client, args):
+    return _expireat(client, args[0], _int(args[1]), args[2:])
+
+
+@command('ttl', 2)
+def ttl(client, args):
+    return client.db.ttl(args[0])
+
+
+@command('pttl', 2)
+def pttl(client, args):
+    return client.db.pttl(args[0])
+
+
+@command('persist', 2, 'write')
+def persist(client, args):
+    return int(client.db.persist(args[0]))
+
+
+@command('keys', 2)
+def keys(client, args):
+    return client.db.keys(args[0])
+
+
+@command('scan', -2)
+def scan(client, args):
+    cursor, match, count, _type = _parse_scan(args, allow_type=True)
+    cursor, keys = client.db.scan(cursor, count, match, _type)
+    return [b'%d' % cursor, keys]
+
+
+# Strings
+
+def _get_string(client, key):
+    value = client.db.get(key)
+    return None if value is None else _bulk(value)
+
+
+@command('get', 2)
+def get(client, args):
+    return _get_string(client, args[0])
+
+
+@command('mget', -2)
+def mget(client, args):
+    values = []
+    for key in args:
+        value = client.db.lookup(key)
+        values.append(_bulk(value) if value is not None and type_name(value) == 'string' else None)
+    return values
+
+
+@command('set', -3, 'write denyoom')
+def set_(client, args):
+    key, value = args[0], args[1]
+    options = dict(ex=None, px=None, nx=False, xx=False, keepttl=False, pxat=None)
+    get = False
+    i = 2
+    while i < len(args):
+        option = _option(args[i])
+        if option in ('ex', 'px') and i + 1 < len(args):
+            options[option] = _int(args[i + 1])
+            i += 2
+        elif option in ('exat', 'pxat') and i + 1 < len(args):
+            options['pxat'] = _int(args[i + 1]) * (1000 if option == 'exat' else 1)
+            i += 2
+        elif option in ('nx', 'xx', 'keepttl'):
+            options[option] = True
+            i += 1
+        elif option == 'get':
+            get = True
+            i += 1
+        else:
+            raise _syntax_error()
+    if options['nx'] and options['xx']:
+        raise _syntax_error()
+    old = _get_string(client, key) if get else None
+    result = client.db.set(key, value, **options)
+    # propagated with its absolute expiry, if it has one, and no options
+    when = client.db._expires.get(key) if result else None
+    if not result:
+        client.rewritten = []
+    elif when is not None:
+        client.rewritten = [[b'set', key, value, b'pxat', b'%d' % when]]
+    else:
+        client.rewritten = [[b'set', key, value]]
+    if get:
+        return old
+    return OK if result else None
+
+
+@command('mset', -3, 'write denyoom', keys=(1, -1, 2))
+def mset(client, args):
+    if len(args) % 2:
+        raise RedisError("wrong number of arguments for 'mset' command")
+    for i in range(0, len(args), 2):
+        client.db.set(args[i], args[i + 1])
+    return OK
+
+
+def _incr(client, key, amount, cast=int):
+    value = client.db.get(key)
+    if value is None:
+        value = 0
+    try:
+        value = cast(value)
+    except ValueError:
+        if cast is int:
+            raise RedisError("value is not an integer or out of range")
+        raise RedisError("value is not a valid float")
+    value += amount
+    client.db.set(key, value, keepttl=True)
+    return value
+
+
+@command('incr', 2, 'write denyoom')
+def incr(client, args):
+    return _incr(client, args[0], 1)
+
+
+@command('decr', 2, 'write denyoom')
+def decr(client, args):
+    return _incr(client, args[0], -1)
+
+
+@command('incrby', 3, 'write denyoom')
+def incrby(client, args):
+    return _incr(client, args[0], _int(args[1]))
+
+
+@command('decrby', 3, 'write denyoom')
+def decrby(client, args):
+    return _incr(client, args[0], -_int(args[1]))
+
+
+@command('incrbyfloat', 3, 'write denyoom')
+def incrbyfloat(client, args):
+    return _bulk(_incr(client, args[0], _float(args[1]), float))
+
+
+# Hashes
+
+@command('hset', -4, 'write denyoom')
+def hset(client, args):
+    if len(args) % 2 == 0:
+        raise RedisError("wrong number of arguments for 'hset' command")
+    h = client.db.lookup(args[0], Hash, create=True)
+    return sum(h.hset(args[i], args[i + 1]) for i in range(1, len(args), 2))
+
+
+@command('hmset', -4, 'write denyoom')
+def hmset(client, args):
+    hset(client, args)
+    return OK
+
+
+@command('hsetnx', 4, 'write denyoom')
+def hsetnx(client, args):
+    return client.db.lookup(args[0], Hash, create=True).hsetnx(args[1], args[2])
+
+
+@command('hget', 3)
+def hget(client, args):
+    h = client.db.lookup(args[0], Hash)
+    value = h.hget(args[1]) if h is not None else None
+    return None if value is None else _bulk(value)
+
+
+@command('hmget', -3)
+def hmget(client, args):
+    h = client.db.lookup(args[0], Hash)
+    if h is None:
+        return [None] * (len(args) - 1)
+    return [None if value is None else _bulk(value) for value in h.hmget(args[1:])]
+
+
+@command('hdel', -3, 'write')
+def hdel(client, args):
+    h = client.db.lookup(args[0], Hash)
+    return h.hdel(*args[1:]) if h is not None else 0
+
+
+@command('hexists', 3)
+def hexists(client, args):
+    h = client.db.lookup(args[0], Hash)
+    return int(h is not None and h.hexists(args[1]))
+
+
+@command('hgetall', 2)
+def hgetall(client, args):
+    h = client.db.lookup(args[0], Hash)
+    if h is None:
+        return {}
+    return dict((_bulk(key), _bulk(value)) for key, value in h.hgetall().items())
+
+
+@command('hkeys', 2)
+def hkeys(client, args):
+    h = client.db.lookup(args[0], Hash)
+    return _bulks(h.hkeys()) if h is not None else []
+
+
+@command('hvals', 2)
+def hvals(client, args):
+    h = client.db.lookup(args[0], Hash)
+    return _bulks(h.hvals()) if h is not None else []
+
+
+@command('hlen', 2)
+def hlen(client, args):
+    h = client.db.lookup(args[0], Hash)
+    return h.hlen() if h is not None else 0
+
+
+@command('hincrby', 4, 'write denyoom')
+def hincrby(client, args):
+    return client.db.lookup(args[0], Hash, create=True).hincrby(args[1], _int(args[2]))
+
+
+@command('hincrbyfloat', 4, 'write denyoom')
+def hincrbyfloat(client, args):
+    h = client.db.lookup(args[0], Hash, create=True)
+    return _bulk(h.hincrbyfloat(args[1], _float(args[2])))
+
+
+@command('hscan', -3)
+def hscan(client, args):
+    cursor, match, count, _type = _parse_scan(args[1:])
+    h = client.db.lookup(args[0], Hash)
+    if h is None:
+        return [b'0', []]
+    cursor, data = h.hscan(cursor, count, match)
+    reply = []
+    for key, value in data.items():
+        reply.append(_bulk(key))
+        reply.append(_bulk(value))
+    return [b'%d' % cursor, reply]
+
+
+def _hash_fields(args):
+    "Parses the FIELDS numfields field ... arguments of the field TTL commands"
+    if len(args) < 2 or _option(args[0]) != 'fields':
+        raise RedisError("Mandatory argument FIELDS is missing or not at the right position")
+    numfields = _int(args[1])
+    if numfields <= 0 or numfields != len(args) - 2:
+        raise RedisError("The `numfields` parameter must match the number of arguments")
+    return args[2:]
+
+
+def _hexpire(client, args, scale, relative):
+    """ Serves the field TTL commands, propagating the fields whose expiry
+    was set as an HPEXPIREAT and the ones deleted as an HDEL.
+    """
+    key, when, args = args[0], _int(args[1]) * scale, args[2:]
+    if relative:
+        when += expiry.now_ms()
+    flags = dict(nx=False, xx=False, gt=False, lt=False)
+    if args and _option(args[0]) in flags:
+        flags[_option(args[0])] = True
+        args = args[1:]
+    fields = _hash_fields(args)
+    client.rewritten = []
+    h = client.db.lookup(key, Hash)
+    if h is None:
+        return [-2] * len(fields)
+    results = h.hpexpireat(when, *fields, **flags)
+    expired = [field for field, result in zip(fields, results) if result == 1]
+    deleted = [field for field, result in zip(fields, results) if result == 2]
+    if expired:
+        client.rewritten.append([b'hpexpireat', key, b'%d' % when, b'fields', b'%d' % len(expired)] + expired)
+    if deleted:
+        client.rewritten.append([b'hdel', key] + deleted)
+    return results
+
+
+@command('hexpire', -6, 'write')
+def hexpire(client, args):
+    return _hexpire(client, args, 1000, True)
+
+
+@command('hpexpire', -6, 'write')
+def hpexpire(client, args):
+    return _hexpire(client, args, 1, True)
+
+
+@command('hexpireat', -6, 'write')
+def hexpireat(client, args):
+    return _hexpire(client, args, 1000, False)
+
+
+@command('hpexpireat', -6, 'write')
+def hpexpireat(client, args):
+    return _hexpire(client, args, 1, False)
+
+
+def _hash_fields_command(method):
+    def handler(client, args):
+        fields = _hash_fields(args[1:])
+        h = client.db.lookup(args[0], Hash)
+        if h is None:
+            return [-2] * len(fields)
+        return getattr(h, method)(*fields)
+    return handler
+
+
+command('httl', -5)(_hash_fields_command('httl'))
+command('hpttl', -5)(_hash_fields_command('hpttl'))
+command('hpersist', -5, 'write')(_hash_fields_command('hpersist'))
+
+
+# Sets
+
+def _member(arg):
+    """ Returns an integer for arguments that are the canonical form of a
+    64 bit integer, so that sets of numbers use the intset encoding.
+    """
+    value = parse_int64(arg)
+    return arg if value is None else value
+
+
+def _sets(client, keys):
+    "Returns the sets at ``keys``, using empty sets for missing keys"
+    return [client.db.lookup(key, Set) or Set() for key in keys]
+
+
+def _set_reply(client, members):
+    return set(_bulks(members)) if client.protocol == 3 else _bulks(members)
+
+
+@command('sadd', -3, 'write denyoom')
+def sadd(client, args):
+    return client.db.lookup(args[0], Set, create=True).sadd(*map(_member, args[1:]))
+
+
+@command('srem', -3, 'write')
+def srem(client, args):
+    s = client.db.lookup(args[0], Set)
+    return s.srem(*map(_member, args[1:])) if s is not None else 0
+
+
+@command('scard', 2)
+def scard(client, args):
+    s = client.db.lookup(args[0], Set)
+    return s.scard() if s is not None else 0
+
+
+@command('sismember', 3)
+def sismember(client, args):
+    s = client.db.lookup(args[0], Set)
+    return int(s is not None and s.sismember(_member(args[1])))
+
+
+@command('smembers', 2)
+def smembers(client, args):
+    s = client.db.lookup(args[0], Set)
+    return _set_reply(client, s.smembers() if s is not None else [])
+
+
+@command('spop', -2, 'write')
+def spop(client, args):
+    if len(args) > 2:
+        raise _syntax_error()
+    s = client.db.lookup(args[0], Set)
+    client.rewritten = []
+    if len(args) == 1:
+        member = s.spop() if s is not None else None
+        if member is None:
+            return None
+        client.rewritten.append([b'srem', args[0], _bulk(member)])
+        return _bulk(member)
+    count = _int(args[1])
+    if count < 0:
+        raise RedisError("value is out of range, must be positive")
+    members = s.spop(count) if s is not None else []
+    if members:
+        client.rewritten.append([b'srem', args[0]] + _bulks(members))
+    return _set_reply(client, members)
+
+
+@command('srandmember', -2)
+def srandmember(client, args):
+    if len(args) > 2:
+        raise _syntax_error()
+    s = client.db.lookup(args[0], Set)
+    if len(args) == 1:
+        member = s.srandmember() if s is not None else None
+        return None if member is None else _bulk(member)
+    return _bulks(s.srandmember(_int(args[1])) if s is not None else [])
+
+
+@command('sinter', -2)
+def sinter(client, args):
+    first, others = _sets(client, args)[0], _sets(client, args)[1:]
+    return _set_reply(client, first.sinter(*others))
+
+
+@command('sunion', -2)
+def sunion(client, args):
+    sets = _sets(client, args)
+    return _set_reply(client, sets[0].sunion(*sets[1:]))
+
+
+@command('sdiff', -2)
+def sdiff(client, args):
+    sets = _sets(client, args)
+    return _set_reply(client, sets[0].sdiff(*sets[1:]))
+
+
+def _set_store(method):
+    def handler(client, args):
+        result = Set()
+        count = getattr(result, method)(*_sets(client, args[1:]))
+        client.db.store(args[0], result)
+        return count
+    return handler
+
+
+command('sinterstore', -3, 'write')(_set_store('sinterstore'))
+command('sunionstore', -3, 'write')(_set_store('sunionstore'))
+command('sdiffstore', -3, 'write')(_set_store('sdiffstore'))
+
+
+@command('sintercard', -3)
+def sintercard(client, args):
+    numkeys = _int(args[0])
+    if numkeys <= 0 or numkeys > len(args) - 1:
+        raise RedisError("numkeys should be greater than 0")
+    limit = 0
+    rest = args[1 + numkeys:]
+    if rest:
+        if len(rest) != 2 or _option(rest[0]) != 'limit':
+            raise _syntax_error()
+        limit = _int(rest[1])
+    sets = _sets(client, args[1:1 + numkeys])
+    return sets[0].sintercard(*sets[1:], limit=limit)
+
+
+@command('sscan', -3)
+def sscan(client, args):
+    cursor, match, count, _type = _parse_scan(args[1:])
+    s = client.db.lookup(args[0], Set)
+    if s is None:
+        return [b'0', []]
+    cursor, members = s.sscan(cursor, count, match)
+    return [b'%d' % cursor, _bulks(members)]
+
+
+# Lists
+
+@command('lpush', -3, 'write denyoom')
+def lpush(client, args):
+    return client.db.lookup(args[0], List, create=True).lpush(*args[1:])
+
+
+@command('rpush', -3, 'write denyoom')
+def rpush(client, args):
+    return client.db.lookup(args[0], List, create=True).rpush(*args[1:])
+
+
+def _pop(client, args, method):
+    if len(args) > 2:
+        raise _syntax_error()
+    l = client.db.lookup(args[0], List)
+    if len(args) == 1:
+        value = getattr(l, method)() if l is not None else None
+        return None if value is None else _bulk(value)
+    count = _int(args[1])
+    if count < 0:
+        raise RedisError("value is out of range, must be positive")
+    if l is None:
+        return NULL_ARRAY
+    values = []
+    for i in range(min(count, l.llen())):
+        values.append(_bulk(getattr(l, method)()))
+    return values
+
+
+@command('lpop', -2, 'write')
+def lpop(client, args):
+    return _pop(client, args, 'lpop')
+
+
+@command('rpop', -2, 'write')
+def rpop(client, args):
+    return _pop(client, args, 'rpop')
+
+
+@command('llen', 2)
+def llen(client, args):
+    l = client.db.lookup(args[0], List)
+    return l.llen() if l is not None else 0
+
+
+@command('lindex', 3)
+def lindex(client, args):
+    l = client.db.lookup(args[0], List)
+    value = l.lindex(_int(args[1])) if l is not None else None
+    return None if value is None else _bulk(value)
+
+
+@command('linsert', 5, 'write denyoom')
+def linsert(client, args):
+    l = client.db.lookup(args[0], List)
+    if l is None:
+        return 0
+    return l.linsert(_option(args[1]), args[2], args[3])
+
+
+@command('lrange', 4)
+def lrange(client, args):
+    l = client.db.lookup(args[0], List)
+    return _bulks(l.lrange(_int(args[1]), _int(args[2]))) if l is not None else []
+
+
+@command('lrem', 4, 'write')
+def lrem(client, args):
+    l = client.db.lookup(args[0], List)
+    return l.lrem(_int(args[1]), args[2]) if l is not None else 0
+
+
+@command('lset', 4, 'write denyoom')
+def lset(client, args):
+    l = client.db.lookup(args[0], List)
+    if l is None:
+        raise RedisError("no such key")
+    l.lset(_int(args[1]), args[2])
+    return OK
+
+
+@command('ltrim', 4, 'write')
+def ltrim(client, args):
+    l = client.db.lookup(args[0], List)
+    if l is not None:
+        l.ltrim(_int(args[1]), _int(args[2]))
+    return OK
+
+
+@command('lmove', 5, 'write denyoom', keys=(1, 2, 1))
+def lmove(client, args):
+    wherefrom, whereto = _option(args[2]), _option(args[3])
+    source = client.db.lookup(args[0], List)
+    destination = client.db.lookup(args[1], List)
+    if source is None:
+        return None
+    if destination is None:
+        destination = client.db.lookup(args[1], List, create=True)
+    value = source.lmove(destination, wherefrom, whereto)
+    return None if value is None else _bulk(value)
+
+
+@command('rpoplpush', 3, 'write denyoom', keys=(1, 2, 1))
+def rpoplpush(client, args):
+    return lmove(client, [args[0], args[1], b'right', b'left'])
+
+
+def _keys(args):
+    return COMMANDS[args[0].decode()].keys_of(args)
+
+
+async def _block(client, blocked, pop, restore, popped, pushed, timeout=0):
+    """ Waits on the ``Blocked`` consumers of ``blocked`` with
+    ``blocking.block_async``, propagating the command ``popped(structure)``
+    when the client is handed an element, as part of the push that served
+    it, and ``pushed(result)`` when the element could not be delivered and
+    is put back.
+    """
+    server, db = client.server, client.db
+
+    def propagating_pop(structure):
+        args = popped(structure)
+        server.before_write(db, _keys(args))
+        result = pop(structure)
+        if result is not None:
+            server.propagate(db, args)
+        return result
+
+    def propagating_restore(result):
+        args = pushed(result)
+        server.before_write(db, _keys(args))
+        server.propagate(db, args)
+        restore(result)
+
+    try:
+        return await blocking.block_async(blocked, propagating_pop, propagating_restore, timeout)
+    finally:
+        for b in blocked:
+            db.unblocked(b)
+
+
+def _blocking_keys(client, keys, cls):
+    """ Returns the ``Blocked`` consumers of ``keys`` waiting for a ``cls``
+    and a function returning the key of the structure they are handed, the
+    structure stored at the key when it is pushed to sharing them.
+    """
+    blocked = [client.db.blocked(key, cls) for key in keys]
+    names = dict((id(b._waiters), key) for b, key in zip(blocked, keys))
+    return blocked, lambda structure: names[id(structure._waiters)]
+
+
+def _stored(client, key, cls):
+    "Returns the ``cls`` at ``key`` to pop from, None if it holds none or is empty"
+    value = client.db.lookup(key)
+    return value if isinstance(value, cls) else None
+
+
+async def _await_pop(waiting):
+    result = await waiting
+    if result is None:
+        return NULL_ARRAY
+    key, value = result
+    return [key, _bulk(value)]
+
+
+def _blocking_pop(client, args, pop, push):
+    """ Pops from the first non-empty list at once, propagated as a ``pop``
+    of that list, otherwise returns a coroutine waiting for a push, or a
+    null inside a transaction.
+    """
+    timeout = _timeout(args[-1])
+    keys = args[:-1]
+    client.rewritten = []
+    for key in keys:
+        l = client.db.lookup(key, List)
+        if l is not None and l.llen():
+            client.rewritten.append([pop.encode(), key])
+            return [key, _bulk(getattr(l, pop)())]
+    if client.deny_blocking:
+        return NULL_ARRAY
+    blocked, name = _blocking_keys(client, keys, List)
+
+    def pop_one(structure):
+        key = name(structure)
+        l = _stored(client, key, List)
+        value = None if l is None else getattr(l, pop)()
+        return None if value is None else (key, value)
+
+    def restore(result):
+        getattr(client.db.lookup(result[0], List, create=True), push)(result[1])
+
+    return _await_pop(_block(
+        client, blocked, pop_one, restore,
+        lambda structure: [pop.encode(), name(structure)],
+        lambda result: [push.encode(), result[0], result[1]], timeout))
+
+
+@command('blpop', -3, 'write blocking', keys=(1, -2, 1))
+def blpop(client, args):
+    return _blocking_pop(client, args, 'lpop', 'lpush')
+
+
+@command('brpop', -3, 'write blocking', keys=(1, -2, 1))
+def brpop(client, args):
+    return _blocking_pop(client, args, 'rpop', 'rpush')
+
+
+async def _await_value(waiting):
+    value = await waiting
+    return None if value is None else _bulk(value)
+
+
+@command('blmove', 6, 'write denyoom blocking', keys=(1, 2, 1))
+def blmove(client, args):
+    timeout = _timeout(args[4])
+    wherefrom, whereto = _option(args[2]), _option(args[3])
+    source = client.db.lookup(args[0], List)
+    if client.deny_blocking or source is not None and source.llen():
+        value = lmove(client, args[:4])
+        client.rewritten = [[b'lmove'] + args[:4]] if value is not None else []
+        return value
+    client.rewritten = []
+    # fail at once if the destination holds another type
+    client.db.lookup(args[1], List)
+    blocked, name = _blocking_keys(client, [args[0]], List)
+
+    def move(structure):
+        source = _stored(client, args[0], List)
+        if source is None or not source.llen():
+            return None
+        destination = client.db.lookup(args[1], List, create=True)
+        return source.lmove(destination, wherefrom, whereto)
+
+    def restore(value):
+        destination = client.db.lookup(args[1], List)
+        source = client.db.lookup(args[0], List, create=True)
+        destination.lmove(source, whereto, wherefrom)
+
+    return _await_value(_block(
+        client, blocked, move, restore,
+        lambda structure: [b'lmove', args[0], args[1], args[2], args[3]],
+        lambda value: [b'lmove', args[1], args[0], args[3], args[2]], timeout))
+
+
+# Sorted sets
+
+@command('zadd', -4, 'write denyoom')
+def zadd(client, args):
+    key, args = args[0], list(args[1:])
+    flags = set()
+    while args and _option(args[0]) in ('nx', 'xx', 'gt', 'lt', 'ch', 'incr'):
+        flags.add(_option(args.pop(0)))
+    if not args or len(args) % 2:
+        raise _syntax_error()
+    if 'nx' in flags and ('xx' in flags or 'gt' in flags or 'lt' in flags) or 'gt' in flags and 'lt' in flags:
+        raise RedisError("GT, LT, and/or NX options at the same time are not compatible")
+    if 'incr' in flags and len(args) != 2:
+        raise RedisError("INCR option supports a single increment-element pair")
+    pairs = [(args[i + 1], _float(args[i])) for i in range(0, len(args), 2)]
+    zset = client.db.lookup(key, ZSet, create=True)
+    batch = {}
+    added = changed = 0
+    for member, score in pairs:
+        current = batch.get(member, zset.zscore(member))
+        if 'nx' in flags and current is not None or 'xx' in flags and current is None:
+            score = None
+        elif 'incr' in flags and current is not None:
+            score += current
+        if score is not None and current is not None and (
+                'gt' in flags and score <= current or 'lt' in flags and score >= current):
+            score = None
+        if score is None:
+            if 'incr' in flags:
+                return None
+            continue
+        if current is None:
+            added += 1
+        elif current != score:
+            changed += 1
+        batch[member] = score
+    zset.zadd_many(batch)
+    if 'incr' in flags:
+        return batch[pairs[0][0]]
+    return added + changed if 'ch' in flags else added
+
+
+@command('zcard', 2)
+def zcard(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zcard() if zset is not None else 0
+
+
+@command('zscore', 3)
+def zscore(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zscore(args[1]) if zset is not None else None
+
+
+@command('zincrby', 4, 'write denyoom')
+def zincrby(client, args):
+    return client.db.lookup(args[0], ZSet, create=True).zincrby(args[2], _float(args[1]))
+
+
+@command('zrank', 3)
+def zrank(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zrank(args[1]) if zset is not None else None
+
+
+@command('zrevrank', 3)
+def zrevrank(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zrevrank(args[1]) if zset is not None else None
+
+
+@command('zcount', 4)
+def zcount(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    if zset is None:
+        return 0
+    return zset.zcount(_score_bound(args[1], False), _score_bound(args[2], True))
+
+
+@command('zlexcount', 4)
+def zlexcount(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zlexcount(args[1], args[2]) if zset is not None else 0
+
+
+def _zrange(client, key, start, stop, by=None, rev=False, limit=None, withscores=False):
+    """ Serves every form of ZRANGE.  ``start`` and ``stop`` are in the
+    order given by the client, which is (max, min) for reverse score and
+    lex ranges.
+    """
+    zset = client.db.lookup(key, ZSet)
+    offset, count = limit if limit is not None else (None, None)
+    if by is None:
+        if limit is not None:
+            raise RedisError("syntax error, LIMIT is only supported in combination with either BYSCORE or BYLEX")
+        if zset is None:
+            return []
+        items = zset.zrange(_int(start), _int(stop), desc=rev, withscores=withscores)
+    elif by == 'byscore':
+        if rev:
+            start, stop = stop, start
+        low, high = _score_bound(start, False), _score_bound(stop, True)
+        if zset is None:
+            return []
+        method = zset.zrevrangebyscore if rev else zset.zrangebyscore
+        items = method(low, high, start=offset, num=count, withscores=withscores)
+    else:
+        if withscores:
+            raise RedisError("syntax error, WITHSCORES not supported in combination with BYLEX")
+        if rev:
+            start, stop = stop, start
+        if zset is None:
+            return []
+        method = zset.zrevrangebylex if rev else zset.zrangebylex
+        items = method(start, stop, start=offset, num=count)
+    return _with_scores(client, items, withscores)
+
+
+def _range_options(args, allowed):
+    "Parses the options of the ZRANGE family listed in ``allowed``"
+    options = {}
+    i = 0
+    while i < len(args):
+        option = _option(args[i])
+        if option not in allowed:
+            raise _syntax_error()
+        if option == 'limit':
+            if i + 2 >= len(args):
+                raise _syntax_error()
+            options['limit'] = (_int(args[i + 1]), _int(args[i + 2]))
+            i += 3
+            continue
+        if option in ('byscore', 'bylex'):
+            if 'by' in options:
+                raise _syntax_error()
+            options['by'] = option
+        elif option == 'rev':
+            options['rev'] = True
+        elif option == 'withscores':
+            options['withscores'] = True
+        i += 1
+    return options
+
+
+@command('zrange', -4)
+def zrange(client, args):
+    options = _range_options(args[3:], ('byscore', 'bylex', 'rev', 'limit', 'withscores'))
+    return _zrange(client, args[0], args[1], args[2], **options)
+
+
+@command('zrevrange', -4)
+def zrevrange(client, args):
+    options = _range_options(args[3:], ('withscores',))
+    return _zrange(client, args[0], args[1], args[2], rev=True, **options)
+
+
+@command('zrangebyscore', -4)
+def zrangebyscore(client, args):
+    options = _range_options(args[3:], ('limit', 'withscores'))
+    return _zrange(client, args[0], args[1], args[2], by='byscore', **options)
+
+
+@command('zrevrangebyscore', -4)
+def zrevrangebyscore(client, args):
+    options = _range_options(args[3:], ('limit', 'withscores'))
+    return _zrange(client, args[0], args[1], args[2], by='byscore', rev=True, **options)
+
+
+@command('zrangebylex', -4)
+def zrangebylex(client, args):
+    options = _range_options(args[3:], ('limit',))
+    return _zrange(client, args[0], args[1], args[2], by='bylex', **options)
+
+
+@command('zrevrangebylex', -4)
+def zrevrangebylex(client, args):
+    options = _range_options(args[3:], ('limit',))
+    return _zrange(client, args[0], args[1], args[2], by='bylex', rev=True, **options)
+
+
+@command('zrem', -3, 'write')
+def zrem(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zrem(*args[1:]) if zset is not None else 0
+
+
+@command('zremrangebyrank', 4, 'write')
+def zremrangebyrank(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zremrangebyrank(_int(args[1]), _int(args[2])) if zset is not None else 0
+
+
+@command('zremrangebyscore', 4, 'write')
+def zremrangebyscore(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    if zset is None:
+        return 0
+    return zset.zremrangebyscore(_score_bound(args[1], False), _score_bound(args[2], True))
+
+
+@command('zremrangebylex', 4, 'write')
+def zremrangebylex(client, args):
+    zset = client.db.lookup(args[0], ZSet)
+    return zset.zremrangebylex(args[1], args[2]) if zset is not None else 0
+
+
+def _zpop(client, args, method):
+    if len(args) > 2:
+        raise _syntax_error()
+    count = _int(args[1]) if len(args) == 2 else None
+    if count is not None and count < 0:
+        raise RedisError("value is out of range, must be positive")
+    zset = client.db.lookup(args[0], ZSet)
+    items = getattr(zset, method)(1 if count is None else count) if zset is not None else []
+    if count is None and client.protocol == 3:
+        return [_bulk(items[0][0]), items[0][1]] if items else []
+    return _with_scores(client, items, True)
+
+
+@command('zpopmin', -2, 'write')
+def zpopmin(client, args):
+    return _zpop(client, args, 'zpopmin')
+
+
+@command('zpopmax', -2, 'write')
+def zpopmax(client, args):
+    return _zpop(client, args, 'zpopmax')
+
+
+async def _await_zpop(waiting):
+    result = await waiting
+    if result is None:
+        return NULL_ARRAY
+    key, member, score = result
+    return [key, _bulk(member), score]
+
+
+def _bzpop(client, args, pop):
+    timeout = _timeout(args[-1])
+    keys = args[:-1]
+    client.rewritten = []
+    for key in keys:
+        zset = client.db.lookup(key, ZSet)
+        if zset is not None and zset.zcard():
+            client.rewritten.append([pop.encode(), key])
+            member, score = getattr(zset, pop)(1)[0]
+            return [key, _bulk(member), score]
+    if client.deny_blocking:
+        return NULL_ARRAY
+    blocked, name = _blocking_keys(client, keys, ZSet)
+
+    def pop_one(structure):
+        key = name(structure)
+        zset = _stored(client, key, ZSet)
+        items = getattr(zset, pop)(1) if zset is not None else None
+        return (key,) + tuple(items[0]) if items else None
+
+    def restore(result):
+        client.db.lookup(result[0], ZSet, create=True).zadd_many([(result[1], result[2])])
+
+    return _await_zpop(_block(
+        client, blocked, pop_one, restore,
+        lambda structure: [pop.encode(), name(structure)],
+        lambda result: [b'zadd', result[0], format_float(result[2]).encode(), _bulk(result[1])],
+        timeout))
+
+
+@command('bzpopmin', -3, 'write blocking', keys=(1, -2, 1))
+def bzpopmin(client, args):
+    return _bzpop(client, args, 'zpopmin')
+
+
+@command('bzpopmax', -3, 'write blocking', keys=(1, -2, 1))
+def bzpopmax(client, args):
+    return _bzpop(client, args, 'zpopmax')
+
+
+def _zsets_with_options(client, args, allow_weights=True):
+    """ Parses ``numkeys key [key ...] [WEIGHTS ...] [AGGREGATE ...]
+    [WITHSCORES]`` into the sorted sets and the keyword arguments.
+    """
+    numkeys = _int(args[0])
+    if numkeys <= 0 or numkeys > len(args) - 1:
+        raise RedisError("at least 1 input key is needed for this command")
+    zsets = []
+    for key in args[1:1 + numkeys]:
+        value = client.db.lookup(key)
+        if value is None:
+            value = ZSet()
+        elif isinstance(value, Set):
+            value = ZSet.from_pairs((_bulk(member), 1.0) for member in value.smembers())
+        elif not isinstance(value, ZSet):
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        zsets.append(value)
+    options = {}
+    withscores = False
+    rest = args[1 + numkeys:]
+    i = 0
+    while i < len(rest):
+        option = _option(rest[i])
+        if option == 'weights' and allow_weights and i + numkeys < len(rest):
+            options['weights'] = [_float(weight) for weight in rest[i + 1:i + 1 + numkeys]]
+            i += 1 + numkeys
+        elif option == 'aggregate' and allow_weights and i + 1 < len(rest):
+            options['aggregate'] = _option(rest[i + 1]).upper()
+            i += 2
+        elif option == 'withscores':
+            withscores = True
+            i += 1
+        else:
+            raise _syntax_error()
+    return zsets, options, withscores
+
+
+def _zsetop(method):
+    def handler(client, args):
+        zsets, options, withscores = _zsets_with_options(client, args, method != 'zdiff')
+        items = getattr(zsets[0], method)(*zsets[1:], withscores=withscores, **options)
+        return _with_scores(client, items, withscores)
+    return handler
+
+
+def _zsetop_store(method):
+    def handler(client, args):
+        zsets, options, withscores = _zsets_with_options(client, args[1:], method != 'zdiffstore')
+        if withscores:
+            raise _syntax_error()
+        result = ZSet()
+        count = getattr(result, method)(*zsets, **options)
+        client.db.store(args[0], result)
+        return count
+    return handler
+
+
+command('zunion', -3)(_zsetop('zunion'))
+command('zinter', -3)(_zsetop('zinter'))
+command('zdiff', -3)(_zsetop('zdiff'))
+command('zunionstore', -4, 'write')(_zsetop_store('zunionstore'))
+command('zinterstore', -4, 'write')(_zsetop_store('zinterstore'))
+command('zdiffstore', -4, 'write')(_zsetop_store('zdiffstore'))
+
+
+@command('zscan', -3)
+def zscan(client, args):
+    cursor, match, count, _type = _parse_scan(args[1:])
+    zset = client.db.lookup(args[0], ZSet)
+    if zset is None:
+        return [b'0', []]
+    cursor, items = zset.zscan(cursor, count, match=match)
+    reply = []
+    for member, score in items:
+        reply.append(_bulk(member))
+        reply.append(format_float(score).encode())
+    return [b'%d' % cursor, reply]
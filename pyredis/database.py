@@ -0,0 +1,508 @@
+import random
+import threading
+import time
+from collections import deque
+
+from . import blocking, expiry, memory
+from .denseset import DenseSet
+from .exceptions import RedisError
+from .hash import Hash
+from .list import List
+from .pipeline import Pipeline
+from .scan import ScanDict, compile_match, filter_match
+from .set import Set
+from .zset import ZSet
+
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+# Keys sampled per loop of the active expiry cycle and the time it may take
+ACTIVE_EXPIRE_CYCLE_KEYS = 20
+ACTIVE_EXPIRE_CYCLE_TIME = 0.025
+
+STRING_TYPES = (str, bytes, int, float)
+
+TYPES = (
+    (ZSet, 'zset'),
+    (Hash, 'hash'),
+    (Set, 'set'),
+    (List, 'list'),
+)
+
+
+def type_name(value):
+    "Returns the Redis type name of ``value``, anything else being a string"
+    for cls, name in TYPES:
+        if isinstance(value, cls):
+            return name
+    return 'string'
+
+
+def _is_empty(value):
+    # the containers are measured rather than calling zcard, hlen, ... to
+    # leave expired hash fields to lazy and active expiry
+    if isinstance(value, ZSet):
+        return not len(value._dict)
+    if isinstance(value, Hash):
+        return not len(value._data)
+    if isinstance(value, Set):
+        return not len(value._set)
+    if isinstance(value, List):
+        return not len(value._list)
+    return False
+
+
+class Blocked(object):
+    """ The consumers blocked on ``key`` of a ``Database`` until it holds a
+    ``cls`` with elements, for ``pyredis.blocking`` to register them on.
+    A ``cls`` stored at the key shares the consumers, so that its pushes
+    serve them.
+    """
+    __slots__ = ('key', 'cls', '_waiters')
+
+    def __init__(self, key, cls):
+        self.key = key
+        self.cls = cls
+        self._waiters = deque()
+
+
+class Database(object):
+    """ A keyspace holding strings and ``ZSet``, ``Hash``, ``Set`` and
+    ``List`` values, some of which can expire.
+
+    Expired keys are removed when they are next accessed, and
+    ``active_expire_cycle`` reclaims the ones nobody reads by sampling
+    volatile keys at random, like Redis, and expires the hash fields due
+    on the timer wheel of the database.  Collections that become empty
+    are removed as if they did not exist.
+
+    Threads sharing a database should hold ``lock`` around their calls, or
+    batch them in a ``pipeline``, which takes it once for the whole batch.
+
+    Consumers blocked on a key until a list or sorted set is pushed there
+    are kept by the database, see ``blocked``, and never stored as an
+    empty value.
+
+    ``used_memory`` estimates the memory taken by the keys, each accounted
+    when it is touched.  With ``maxmemory`` set, keys are evicted by
+    ``maxmemory_policy`` before a key is set, stored or created past it,
+    see ``pyredis.memory``.  Set those class attributes (or override them
+    in a subclass or instance) to tune them.
+    """
+
+    maxmemory = 0
+    maxmemory_policy = 'noeviction'
+    maxmemory_samples = memory.MAXMEMORY_SAMPLES
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._data = ScanDict()
+        # unix time in milliseconds at which each volatile key expires,
+        # with the volatile keys also in a DenseSet to sample them
+        self._expires = {}
+        self._volatile = DenseSet()
+        # the expiry times of the fields of the hashes stored, as (key,
+        # field) entries, see ``Hash._bind``
+        self._wheel = expiry.TimerWheel()
+        # [version, number of watchers] of the keys being watched
+        self._watched = {}
+        # the memory accounted to each key and their sum
+        self._sizes = {}
+        self.used_memory = 0
+        # the LRU clock or LFU stamp of each key, with those policies
+        self._access = {}
+        # the Blocked consumers of each (key, class)
+        self._blocked = {}
+        self._pool = memory.EvictionPool()
+
+    def _delete(self, key):
+        del self._data[key]
+        if key in self._expires:
+            del self._expires[key]
+            self._volatile.discard(key)
+        self.touch(key)
+        if self._access:
+            self._access.pop(key, None)
+
+    def _adopt(self, key, value):
+        "Called when ``value`` is stored at ``key``"
+        if isinstance(value, Hash):
+            value._bind(self, key)
+        elif self._blocked:
+            for cls in (List, ZSet):
+                blocked = self._blocked.get((key, cls))
+                if blocked is not None and isinstance(value, cls):
+                    value._waiters = blocked._waiters
+                    if not _is_empty(value):
+                        blocking.wake(value)
+
+    def _schedule_field(self, key, field, when):
+        "Expires ``field`` of the hash at ``key`` at the unix time ``when`` in milliseconds"
+        self._wheel.schedule(self, (key, field), when)
+
+    def _expire(self, entry, when):
+        "Removes the field of a (key, field) ``entry`` if it still expires at ``when``, for the timer wheel"
+        key, field = entry
+        value = self._data.get(key)
+        if not isinstance(value, Hash) or not value._expire(field, when):
+            return False
+        if _is_empty(value):
+            self._delete(key)
+        else:
+            self.touch(key)
+        return True
+
+    def _account(self, key):
+        "Updates ``used_memory`` with the memory now taken by ``key``"
+        value = self._data.get(key)
+        before = self._sizes.pop(key, 0)
+        size = 0
+        if value is not None:
+            size = self._sizes[key] = memory.key_memory(key, value, key in self._expires)
+        self.used_memory += size - before
+
+    def _record_access(self, key):
+        policy = self.maxmemory_policy
+        if policy == 'allkeys-lru':
+            self._access[key] = memory.lru_clock()
+        elif policy == 'allkeys-lfu':
+            self._access[key] = memory.lfu_access(self._access.get(key))
+
+    def _reserve(self):
+        "Evicts keys before a write if ``used_memory`` is over ``maxmemory``"
+        if self.maxmemory and self.used_memory > self.maxmemory:
+            self.evict()
+            if self.used_memory > self.maxmemory:
+                raise RedisError(memory.OOM)
+
+    def _persist(self, key):
+        if key in self._expires:
+            del self._expires[key]
+            self._volatile.discard(key)
+            return True
+        return False
+
+    def _expire_if_needed(self, key, now=None):
+        "Removes ``key`` if it has expired and returns True if it did"
+        when = self._expires.get(key)
+        if when is not None and when <= (now or expiry.now_ms()):
+            self._delete(key)
+            return True
+        return False
+
+    def _is_live(self, key):
+        "Returns True if ``key`` exists, removing it if it expired or is empty"
+        if key not in self._data or self._expire_if_needed(key):
+            return False
+        if _is_empty(self._data[key]):
+            self._delete(key)
+            return False
+        return True
+
+    def lookup(self, key, cls=None, create=False):
+        """ Returns the value of ``key`` or None if it does not exist.
+
+        If ``cls`` is given the value must be an instance of it, otherwise
+        a WRONGTYPE RedisError is raised, and if ``create`` is True a new
+        empty ``cls`` is stored when the key does not exist.
+        """
+        if not self._is_live(key):
+            if not create:
+                return None
+            self._reserve()
+            value = self._data[key] = cls()
+            self._adopt(key, value)
+        else:
+            value = self._data[key]
+            if cls is not None and not isinstance(value, cls):
+                raise RedisError(WRONGTYPE)
+        self._record_access(key)
+        return value
+
+    def store(self, key, value, when=None):
+        """ Stores the datastructure ``value`` at ``key``, replacing
+        whatever it held and its time to live, and expiring it at the unix
+        time ``when`` in milliseconds if given.  An empty ``value`` deletes
+        the key instead.
+        """
+        self._reserve()
+        if key in self._data:
+            self._delete(key)
+        if not _is_empty(value):
+            self._data[key] = value
+            self._adopt(key, value)
+            self._record_access(key)
+            if when is not None:
+                self._expires[key] = when
+                self._volatile.add(key)
+            self.touch(key)
+        return value
+
+    def active_expire_cycle(self, keys_per_loop=ACTIVE_EXPIRE_CYCLE_KEYS, time_limit=ACTIVE_EXPIRE_CYCLE_TIME):
+        """ Samples ``keys_per_loop`` volatile keys at random and removes
+        the expired ones, repeating while more than a quarter of the sample
+        had expired and for at most ``time_limit`` seconds.
+
+        Returns the number of keys removed.
+        """
+        self._wheel.tick()
+        start = time.monotonic()
+        members = self._volatile._members
+        removed = 0
+        while members:
+            now = expiry.now_ms()
+            sampled = min(keys_per_loop, len(members))
+            expired = 0
+            for i in range(sampled):
+                if not members:
+                    break
+                if self._expire_if_needed(members[random.randrange(len(members))], now):
+                    expired += 1
+            removed += expired
+            if expired * 4 <= sampled or time.monotonic() - start > time_limit:
+                break
+        return removed
+
+    def blocked(self, key, cls):
+        """ Returns the ``Blocked`` consumers of ``key`` waiting for a
+        ``cls`` to be pushed there.  Call ``unblocked`` once done waiting.
+        """
+        blocked = self._blocked.get((key, cls))
+        if blocked is None:
+            blocked = self._blocked[key, cls] = Blocked(key, cls)
+            value = self._data.get(key)
+            if isinstance(value, cls):
+                value._waiters = blocked._waiters
+        return blocked
+
+    def unblocked(self, blocked):
+        "Forgets ``blocked``, returned by ``blocked``, if no consumer waits on it"
+        if not blocked._waiters and self._blocked.get((blocked.key, blocked.cls)) is blocked:
+            del self._blocked[blocked.key, blocked.cls]
+
+    def dbsize(self):
+        "Returns the number of keys, including ones not yet found expired"
+        return len(self._data)
+
+    def delete(self, *keys):
+        "Delete ``keys`` and return the number of keys that existed"
+        deleted = 0
+        for key in keys:
+            if self._is_live(key):
+                self._delete(key)
+                deleted += 1
+        return deleted
+
+    def evict(self):
+        """ Evicts keys by ``maxmemory_policy`` while ``used_memory`` is
+        over ``maxmemory`` and returns the keys evicted.
+        """
+        return [key for db, key in memory.evict(
+            [self], self.maxmemory, self.maxmemory_policy, self.maxmemory_samples, self._pool)]
+
+    def exists(self, *keys):
+        "Returns the number of ``keys`` that exist, counting repeats"
+        return sum(1 for key in keys if self._is_live(key))
+
+    def expire(self, key, seconds, nx=False, xx=False, gt=False, lt=False):
+        """
+        Set a time to live of ``seconds`` on ``key``.  Only keys without a
+        time to live are changed if ``nx`` is True, only keys with one if
+        ``xx`` is True, and only if the new expiry is greater or lower than
+        the current one with ``gt`` or ``lt``, keys without a time to live
+        counting as never expiring.
+
+        Returns True if the time to live was set, or the key deleted because
+        ``seconds`` is not positive, and False otherwise.
+        """
+        return self.pexpire(key, int(seconds * 1000), nx=nx, xx=xx, gt=gt, lt=lt)
+
+    def flushdb(self):
+        "Delete every key"
+        self.touch(*[key for key in self._watched if key in self._data])
+        self._data = ScanDict()
+        self._expires = {}
+        self._volatile = DenseSet()
+        self._wheel = expiry.TimerWheel()
+        self._sizes = {}
+        self.used_memory = 0
+        self._access = {}
+        return True
+
+    def get(self, key):
+        "Return the string value of ``key`` or None if it does not exist"
+        value = self.lookup(key)
+        if value is not None and type_name(value) != 'string':
+            raise RedisError(WRONGTYPE)
+        return value
+
+    def keys(self, pattern='*'):
+        "Returns a list of the keys matching the glob-style ``pattern``"
+        matches = compile_match(pattern)
+        return [key for key in list(self._data) if matches(key) and self._is_live(key)]
+
+    def memory_usage(self, key):
+        "Returns the memory taken by ``key`` in bytes, or None if it does not exist"
+        if not self._is_live(key):
+            return None
+        return memory.key_memory(key, self._data[key], key in self._expires)
+
+    def persist(self, key):
+        "Remove the time to live of ``key`` and return True if it had one"
+        if self._is_live(key) and self._persist(key):
+            self.touch(key)
+            return True
+        return False
+
+    def pipeline(self):
+        "Returns a ``Pipeline`` batching commands against this database"
+        return Pipeline(self)
+
+    def pexpire(self, key, milliseconds, nx=False, xx=False, gt=False, lt=False):
+        "Like ``expire`` but the time to live is given in ``milliseconds``"
+        return self.pexpireat(key, expiry.now_ms() + milliseconds, nx=nx, xx=xx, gt=gt, lt=lt)
+
+    def pexpireat(self, key, when, nx=False, xx=False, gt=False, lt=False):
+        "Like ``pexpire`` but expires ``key`` at the unix time ``when`` in milliseconds"
+        if nx + xx + gt + lt > 1:
+            raise RedisError("NX, XX, GT and LT options are not compatible")
+        if not self._is_live(key):
+            return False
+        current = self._expires.get(key)
+        if (nx and current is not None or xx and current is None
+                or gt and (current is None or when <= current)
+                or lt and current is not None and when >= current):
+            return False
+        if when <= expiry.now_ms():
+            self._delete(key)
+        else:
+            self._expires[key] = when
+            self._volatile.add(key)
+            self.touch(key)
+        return True
+
+    def pttl(self, key):
+        """
+        Returns the remaining time to live of ``key`` in milliseconds, -1
+        if it has none or -2 if it does not exist.
+        """
+        if not self._is_live(key):
+            return -2
+        when = self._expires.get(key)
+        if when is None:
+            return -1
+        return max(when - expiry.now_ms(), 0)
+
+    def scan(self, cursor=0, count=10, match=None, _type=None):
+        """
+        Incrementally iterate over the keys.
+
+        Returns a ``(cursor, keys)`` tuple with about ``count`` keys, only
+        keeping those matching the glob-style ``match`` pattern and holding
+        a value of type ``_type`` if given.  Pass the returned cursor back
+        in to continue; a cursor of 0 means the iteration is complete.
+        """
+        cursor, keys = self._data.scan(cursor, count)
+        keys = [key for key in filter_match(keys, match) if self._is_live(key)]
+        if _type is not None:
+            keys = [key for key in keys if type_name(self._data[key]) == _type]
+        return cursor, keys
+
+    def scan_iter(self, count=10, match=None, _type=None):
+        "Yields keys by repeatedly calling ``scan``"
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, count, match, _type)
+            for key in keys:
+                yield key
+            if cursor == 0:
+                break
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False, keepttl=False, pxat=None):
+        """
+        Set the string value of ``key`` to ``value``.
+
+        ``ex`` and ``px`` set a time to live in seconds or milliseconds and
+        ``pxat`` an expiry at a unix time in milliseconds, otherwise any time to live is removed unless ``keepttl`` is True.
+        ``nx`` only sets the key if it does not exist and ``xx`` only if it
+        does.
+
+        Returns True if the key was set, otherwise None.
+        """
+        if not isinstance(value, STRING_TYPES):
+            raise RedisError("value is not a string")
+        if ex is not None:
+            px = int(ex * 1000)
+        if px is not None and px <= 0 or pxat is not None and pxat <= 0:
+            raise RedisError("invalid expire time in 'set' command")
+        exists = self._is_live(key)
+        if nx and exists or xx and not exists:
+            return None
+        self._reserve()
+        self._data[key] = value
+        self._record_access(key)
+        if px is not None:
+            pxat = expiry.now_ms() + px
+        if pxat is not None:
+            self._expires[key] = pxat
+            self._volatile.add(key)
+        elif not keepttl:
+            self._persist(key)
+        self.touch(key)
+        return True
+
+    def touch(self, *keys):
+        """ Marks ``keys`` as modified, which fails the transactions
+        watching them, and accounts the memory they now take, removing the
+        collections left empty.  Code modifying a datastructure returned by
+        ``lookup`` should touch its key if other clients may watch it or
+        memory is capped.
+        """
+        watched = self._watched
+        for key in keys:
+            value = self._data.get(key)
+            if value is not None and _is_empty(value):
+                # a collection the write emptied, deleting it touches it
+                self._delete(key)
+                continue
+            self._account(key)
+            if watched:
+                entry = watched.get(key)
+                if entry is not None:
+                    entry[0] += 1
+
+    def ttl(self, key):
+        """
+        Returns the remaining time to live of ``key`` in seconds, -1 if it
+        has none or -2 if it does not exist.
+        """
+        ttl = self.pttl(key)
+        return ttl if ttl < 0 else (ttl + 500) // 1000
+
+    def type(self, key):
+        "Returns the type of the value of ``key``, or 'none' if it does not exist"
+        if not self._is_live(key):
+            return 'none'
+        return type_name(self._data[key])
+
+    def unwatch(self, key):
+        "Stops one watch of ``key`` started by ``watch``"
+        entry = self._watched[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._watched[key]
+
+    def watch(self, key):
+        """ Starts watching ``key`` and returns its version, which
+        ``watched_changed`` compares to detect a modification.
+        """
+        entry = self._watched.setdefault(key, [0, 0])
+        entry[1] += 1
+        return entry[0]
+
+    def watched_changed(self, key, version):
+        """ Returns True if ``key``, watched at ``version``, was modified or
+        expired since.
+        """
+        self._expire_if_needed(key)
+        return self._watched[key][0] != version
@@ -0,0 +1,78 @@
+import random
+
+
+class DenseSet(dict):
+    """ A set that also keeps its members in a dense list, mapping each
+    member to its position in the list, so random members can be picked
+    in O(1).
+
+    Removing a member moves the last member of the list into its slot, so
+    the list never has holes and removals stay O(1) too.
+    """
+    __slots__ = ('_members',)
+
+    def __init__(self, values=()):
+        dict.__init__(self)
+        self._members = []
+        self.update(values)
+
+    def __eq__(self, other):
+        if isinstance(other, DenseSet):
+            return self.keys() == other.keys()
+        if isinstance(other, (set, frozenset)):
+            return self.keys() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'DenseSet(%r)' % self._members
+
+    def __and__(self, other):
+        return self.keys() & other
+
+    def __or__(self, other):
+        return self.keys() | other
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def add(self, value):
+        "Adds ``value`` and returns True if it was not a member"
+        if value in self:
+            return False
+        self[value] = len(self._members)
+        self._members.append(value)
+        return True
+
+    def update(self, values):
+        "Adds ``values`` and returns the number of new members"
+        added = 0
+        for value in values:
+            added += self.add(value)
+        return added
+
+    def discard(self, value):
+        "Removes ``value`` and returns True if it was a member"
+        i = dict.pop(self, value, None)
+        if i is None:
+            return False
+        last = self._members.pop()
+        if i < len(self._members):
+            self._members[i] = last
+            self[last] = i
+        return True
+
+    def remove(self, value):
+        if not self.discard(value):
+            raise KeyError(value)
+
+    def pop(self):
+        "Removes and returns a random member"
+        if not self._members:
+            raise KeyError('pop from an empty set')
+        value = self._members[random.randrange(len(self._members))]
+        self.discard(value)
+        return value
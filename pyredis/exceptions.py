@@ -1,3 +1,7 @@
 
 class RedisError(Exception):
     pass
+
+
+class WatchError(RedisError):
+    "Raised when a key watched by a transaction was modified"
@@ -0,0 +1,101 @@
+""" Active expiry of fields and keys with a time to live.
+
+Expired entries are removed lazily when they are accessed, but entries
+nobody reads again would keep their memory forever.  ``TimerWheel`` indexes
+them by expiry time in buckets of ``resolution`` milliseconds, and each
+``tick`` examines at most ``max_work`` entries from the buckets that are
+due, so an active expiry cycle never stalls the caller however many
+entries expire at once.  Whatever is left is picked up by the next tick.
+
+Targets scheduled on the wheel implement ``_expire(key, when)``, which
+removes ``key`` if it is still due to expire at ``when`` and returns
+whether it did.  Entries made stale by a new expiry time or a persist are
+simply skipped when their bucket comes up, and the wheel only keeps weak
+references to the targets, so that a target nobody else references is
+freed rather than kept until its last entry comes up.
+
+A ``Database`` schedules the fields of its hashes on a wheel of its own,
+ticked by its ``active_expire_cycle`` with its lock held, and so does each
+shard of a ``ShardedDatabase``.  The module's ``wheel`` serves the hashes
+outside any database: call ``wheel.tick()`` periodically, for example from
+an event loop timer.  A wheel has a lock of its own so that threads can
+schedule entries at once, but ``tick`` expires them without the locks
+guarding the targets, which the caller should hold.
+"""
+import heapq
+import threading
+import time
+import weakref
+
+
+RESOLUTION = 100
+ACTIVE_EXPIRE_WORK = 200
+
+
+def now_ms():
+    "Returns the current unix time in milliseconds"
+    return int(time.time() * 1000)
+
+
+class TimerWheel(object):
+
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self._buckets = {}
+        # heap of the bucket numbers in ``_buckets``
+        self._slots = []
+        self._len = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._len
+
+    def schedule(self, target, key, when):
+        "Expires ``key`` of ``target`` at the unix time ``when`` in milliseconds"
+        slot = when // self.resolution
+        with self._lock:
+            bucket = self._buckets.get(slot)
+            if bucket is None:
+                bucket = self._buckets[slot] = []
+                heapq.heappush(self._slots, slot)
+            bucket.append((weakref.ref(target), key, when))
+            self._len += 1
+
+    def tick(self, max_work=ACTIVE_EXPIRE_WORK, now=None):
+        """ Examines up to ``max_work`` entries that are due at ``now``
+        (defaults to the current time) and expires them.
+
+        Returns the number of keys expired.
+        """
+        if now is None:
+            now = now_ms()
+        current = now // self.resolution
+        with self._lock:
+            slots, buckets = self._slots, self._buckets
+            expired = work = 0
+            while slots and slots[0] <= current and work < max_work:
+                slot = slots[0]
+                bucket = buckets[slot]
+                pending = []
+                while bucket and work < max_work:
+                    ref, key, when = entry = bucket.pop()
+                    work += 1
+                    self._len -= 1
+                    target = ref()
+                    if target is None:
+                        continue
+                    if when > now:
+                        pending.append(entry)
+                    elif target._expire(key, when):
+                        expired += 1
+                self._len += len(pending)
+                bucket.extend(pending)
+                if bucket:
+                    # out of work, or the current bucket is not entirely due
+                    break
+                heapq.heappop(slots)
+                del buckets[slot]
+            return expired
+
+
+wheel = TimerWheel()
@@ -1,58 +1,277 @@
-from collections import defaultdict
+from . import expiry, memory
+from .exceptions import RedisError
+from .listpack import ListPack
+from .scan import ScanDict, filter_match
+
+
+HASH_MAX_LISTPACK_ENTRIES = 128
+HASH_MAX_LISTPACK_VALUE = 64
+
+
+def _number(value, cast, message):
+    "Returns the hash value ``value`` as a number, parsing strings with ``cast``"
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise RedisError(message)
 
 
 class Hash(object):
+    """ Small hashes are stored in a compact ``ListPack`` and converted to a
+    dict once they hold more than ``max_listpack_entries`` fields or a
+    string field or value longer than ``max_listpack_value``, like Redis'
+    ``hash-max-listpack-entries`` and ``hash-max-listpack-value``.  Set
+    those class attributes (or override them in a subclass) to tune them.
+
+    Fields given a time to live with ``hexpire`` or ``hpexpire`` are
+    removed when they are next accessed after expiring, or by the active
+    expiry cycle of a timer wheel, whichever comes first.  A hash stored in
+    a ``Database`` is expired by the wheel of the database, which accounts
+    for the fields removed, and other hashes by ``timer_wheel``.  Like in
+    Redis, ``hlen`` counts the fields that expired but were not removed
+    yet.
+    """
+    __slots__ = ('_data', '_expires', '_used', '_owner', '__weakref__')
+
+    max_listpack_entries = HASH_MAX_LISTPACK_ENTRIES
+    max_listpack_value = HASH_MAX_LISTPACK_VALUE
+    timer_wheel = expiry.wheel
 
     def __init__(self):
-        self._data = defaultdict(int)
+        self._data = ListPack()
+        # unix time in milliseconds at which each volatile field expires
+        self._expires = None
+        # the bytes taken by the fields and values, see ``memory_usage``
+        self._used = 0
+        # the (database, key) the hash is stored at, see ``_bind``
+        self._owner = None
+
+    def _too_long(self, value):
+        return isinstance(value, (str, bytes)) and len(value) > self.max_listpack_value
+
+    def _delete(self, key):
+        self._used -= memory.sizeof(key) + memory.sizeof(self._data[key])
+        del self._data[key]
+        if self._expires:
+            self._expires.pop(key, None)
+
+    def _expire(self, key, when):
+        "Removes ``key`` if it still expires at ``when``, for the timer wheel"
+        if self._expires and self._expires.get(key) == when:
+            self._delete(key)
+            return True
+        return False
+
+    def _expire_if_needed(self, key, now=None):
+        "Removes ``key`` if its time to live has run out"
+        if self._expires:
+            when = self._expires.get(key)
+            if when is not None and when <= (now or expiry.now_ms()):
+                self._delete(key)
+
+    def _expire_all(self):
+        "Removes every field whose time to live has run out"
+        if self._expires:
+            now = expiry.now_ms()
+            for key, when in list(self._expires.items()):
+                if when <= now:
+                    self._delete(key)
+
+    def _items(self):
+        "Returns the (field, value) pairs, removing the expired fields met"
+        items = list(self._data.items())
+        if not self._expires:
+            return items
+        expires, now = self._expires, expiry.now_ms()
+        live = []
+        for key, value in items:
+            when = expires.get(key)
+            if when is not None and when <= now:
+                self._delete(key)
+            else:
+                live.append((key, value))
+        return live
+
+    def _bind(self, db, key):
+        """ Records that the hash is stored at ``key`` of ``db``, which
+        expires its fields from now on.
+        """
+        self._owner = (db, key)
+        if self._expires:
+            for field, when in self._expires.items():
+                self._schedule(field, when)
+
+    def _schedule(self, field, when):
+        if self._owner is None:
+            self.timer_wheel.schedule(self, field, when)
+        else:
+            db, key = self._owner
+            db._schedule_field(key, field, when)
+
+    def _set(self, key, value, keepttl=False):
+        """ Sets ``key`` to ``value``, converting the hash to a dict first
+        if the listpack would outgrow its limits.  Any time to live of
+        ``key`` is removed unless ``keepttl`` is True.
+
+        Returns True if ``key`` is a new field.
+        """
+        self._expire_if_needed(key)
+        data = self._data
+        created = key not in data
+        if type(data) is ListPack and (
+                created and len(data) >= self.max_listpack_entries
+                or self._too_long(key) or self._too_long(value)):
+            data = self._data = ScanDict(data.items())
+        if created:
+            self._used += memory.sizeof(key) + memory.sizeof(value)
+        else:
+            self._used += memory.sizeof(value) - memory.sizeof(data[key])
+        data[key] = value
+        if self._expires and not keepttl:
+            self._expires.pop(key, None)
+        return created
+
+    def _set_expiry(self, when, fields, nx, xx, gt, lt):
+        if nx + xx + gt + lt > 1:
+            raise RedisError("NX, XX, GT and LT options are not compatible")
+        now = expiry.now_ms()
+        results = []
+        for field in fields:
+            self._expire_if_needed(field, now)
+            if field not in self._data:
+                results.append(-2)
+                continue
+            current = self._expires.get(field) if self._expires else None
+            if (nx and current is not None or xx and current is None
+                    or gt and (current is None or when <= current)
+                    or lt and current is not None and when >= current):
+                results.append(0)
+            elif when <= now:
+                self._delete(field)
+                results.append(2)
+            else:
+                if self._expires is None:
+                    self._expires = {}
+                self._expires[field] = when
+                self._schedule(field, when)
+                results.append(1)
+        return results
+
+    def _ttl(self, field, now):
+        self._expire_if_needed(field, now)
+        if field not in self._data:
+            return -2
+        when = self._expires.get(field) if self._expires else None
+        if when is None:
+            return -1
+        return when - now
+
+    def memory_usage(self):
+        """ Returns an estimate of the bytes used by the hash, kept up to
+        date as fields are set and deleted rather than computed by walking
+        it.
+        """
+        per_field = memory.LISTPACK_ENTRY if type(self._data) is ListPack else memory.DICT_ENTRY + memory.SCAN_ENTRY
+        expires = len(self._expires) * memory.DICT_ENTRY if self._expires else 0
+        return memory.STRUCTURE + len(self._data) * per_field + expires + self._used
+
+    def hscan(self, cursor=0, count=10, match=None):
+        """
+        Incrementally iterate over the fields of the hash.
+
+        Returns a ``(cursor, mapping)`` tuple with about ``count`` of the
+        fields and their values, only keeping fields matching the
+        glob-style ``match`` pattern if given.  Pass the returned cursor
+        back in to continue; a cursor of 0 means the iteration is complete.
+        Fields present for the whole iteration are returned at least once.
+        """
+        data = self._data
+        if isinstance(data, ScanDict):
+            cursor, keys = data.scan(cursor, count)
+        else:
+            cursor, keys = 0, list(data.keys())
+        if self._expires:
+            for key in keys:
+                self._expire_if_needed(key)
+        keys = filter_match(keys, match)
+        return cursor, dict((key, data[key]) for key in keys if key in data)
+
+    def hscan_iter(self, count=10, match=None):
+        "Yields (field, value) pairs by repeatedly calling ``hscan``"
+        cursor = 0
+        while True:
+            cursor, data = self.hscan(cursor, count, match)
+            for item in data.items():
+                yield item
+            if cursor == 0:
+                break
 
     def hset(self, key, value):
         """
         Set ``key`` to ``value`` within hash ``name``
         Returns 1 if HSET created a new field, otherwise 0
         """
-        if key in self._data:
-            created = 0
-        else:
-            created = 1
-        self._data[key] = value
-        return created
+        return 1 if self._set(key, value) else 0
 
     def hget(self, key):
         "Return the value of ``key``"
+        self._expire_if_needed(key)
         return self._data.get(key, None)
 
     def hdel(self, *keys):
         "Delete ``keys``"
         deleted = 0
         for key in keys:
+            self._expire_if_needed(key)
             if key in self._data:
                 deleted += 1
-                del self._data[key]
+                self._delete(key)
         return deleted
 
     def hexists(self, key):
         "Returns a boolean indicating if ``key`` exists within hash ``name``"
+        self._expire_if_needed(key)
         return key in self._data
 
+    def hexpire(self, seconds, *fields, nx=False, xx=False, gt=False, lt=False):
+        """
+        Set a time to live of ``seconds`` on each of ``fields``.  Only
+        fields without a time to live are changed if ``nx`` is True, only
+        fields with one if ``xx`` is True, and only if the new expiry is
+        greater or lower than the current one with ``gt`` or ``lt``, fields
+        without a time to live counting as never expiring.
+
+        Returns a list with, for each field, -2 if it does not exist, 0 if
+        a condition was not met, 1 if the time to live was set and 2 if
+        ``seconds`` is not positive and the field was deleted.
+        """
+        return self.hpexpire(int(seconds * 1000), *fields, nx=nx, xx=xx, gt=gt, lt=lt)
+
     def hgetall(self):
         "Return a Python dict of the hash's name/value pairs"
-        return self._data
+        return dict(self._items())
 
     def hincrby(self, key, amount=1):
         "Increment the value of ``key`` in hash by ``amount``"
-        self._data[key] += amount
-        return self._data[key]
+        self._expire_if_needed(key)
+        value = _number(self._data.get(key, 0), int, "hash value is not an integer") + amount
+        self._set(key, value, keepttl=True)
+        return value
 
     def hincrbyfloat(self, key, amount=1.0):
         """
         Increment the value of ``key`` in hash by floating ``amount``
         """
-        return self.hincrby(key, amount)
+        self._expire_if_needed(key)
+        value = _number(self._data.get(key, 0), float, "hash value is not a float") + amount
+        self._set(key, value, keepttl=True)
+        return value
 
     def hkeys(self):
         "Return the list of keys within hash"
-        return self._data.keys()
+        return [key for key, value in self._items()]
 
     def hlen(self):
         "Return the number of elements in hash"
@@ -63,9 +282,10 @@ class Hash(object):
         Set ``key`` to ``value`` within hash if ``key`` does not
         exist.  Returns 1 if HSETNX created a field, otherwise 0.
         """
+        self._expire_if_needed(key)
         if key in self._data:
             return 0
-        self._data[key] = value
+        self._set(key, value)
         return 1
 
     def hmset(self, mapping):
@@ -73,15 +293,57 @@ class Hash(object):
         Sets each key in the ``mapping`` dict to its corresponding value
         in the hash
         """
-        return self._data.update(mapping)
+        for key, value in mapping.items():
+            self._set(key, value)
 
     def hmget(self, keys):
         "Returns a list of values ordered identically to ``keys``"
         values = []
         for key in keys:
+            self._expire_if_needed(key)
             values.append(self._data.get(key, None))
         return values
 
     def hvals(self):
         "Return the list of values within hash"
-        return self._data.values()
+        return [value for key, value in self._items()]
+
+    def hpersist(self, *fields):
+        """
+        Remove the time to live of each of ``fields``.
+
+        Returns a list with, for each field, -2 if it does not exist, -1 if
+        it has no time to live and 1 if its time to live was removed.
+        """
+        now = expiry.now_ms()
+        results = []
+        for field in fields:
+            ttl = self._ttl(field, now)
+            if ttl >= 0:
+                del self._expires[field]
+                ttl = 1
+            results.append(ttl)
+        return results
+
+    def hpexpire(self, milliseconds, *fields, nx=False, xx=False, gt=False, lt=False):
+        "Like ``hexpire`` but the time to live is given in ``milliseconds``"
+        return self._set_expiry(expiry.now_ms() + milliseconds, fields, nx, xx, gt, lt)
+
+    def hpexpireat(self, when, *fields, nx=False, xx=False, gt=False, lt=False):
+        """ Like ``hpexpire`` but expires ``fields`` at the unix time
+        ``when`` in milliseconds.
+        """
+        return self._set_expiry(when, fields, nx, xx, gt, lt)
+
+    def hpttl(self, *fields):
+        "Like ``httl`` but returns the time to live in milliseconds"
+        now = expiry.now_ms()
+        return [self._ttl(field, now) for field in fields]
+
+    def httl(self, *fields):
+        """
+        Returns a list with the remaining time to live of each of
+        ``fields`` in seconds, -1 if a field has none or -2 if it does not
+        exist.
+        """
+        return [ttl if ttl < 0 else (ttl + 500) // 1000 for ttl in self.hpttl(*fields)]
@@ -0,0 +1,277 @@
+""" Optional instrumentation of the datastructures: call counts, latency
+histograms and a slow log of their public methods.
+
+``enable()`` replaces every public method of ``ZSet``, ``Hash``, ``Set``
+and ``List``, and of their subclasses defined by then, with a wrapper
+timing its calls, and ``disable()`` puts the original methods back.  The
+structures are never checked for being instrumented, so while disabled
+they run exactly as without this module.
+
+A method called from another instrumented method is not counted, so a
+ZUNIONSTORE shows as one call to ``zunionstore`` rather than as the calls
+to ``zadd_many`` it makes.  The time of a blocking method includes the
+time it spent blocked, and a method returning an iterator is timed until
+it returns the iterator.
+
+Latencies are recorded in nanoseconds in a ``Histogram`` of log-linear
+buckets, like HdrHistogram: values below ``2 * SUB_BUCKETS`` have a bucket
+of their own and larger ones are within ``1 / SUB_BUCKETS`` of their
+bucket, so percentiles stay accurate from nanoseconds to minutes for a
+few hundred buckets.  Calls slower than ``SlowLog.slower_than``
+microseconds are kept with their arguments, truncated like Redis does, in
+a ring buffer of the last ``SlowLog.max_len``.
+
+``info()`` reports the statistics in the format of the commandstats and
+latencystats sections of INFO and ``prometheus()`` in the Prometheus text
+exposition format.
+"""
+import functools
+import inspect
+import itertools
+import threading
+import time
+from collections import deque
+
+from .hash import Hash
+from .list import List
+from .set import Set
+from .zset import ZSet
+
+
+CLASSES = (ZSet, Hash, Set, List)
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# The percentiles of latencystats and the upper bounds of the buckets
+# exported to Prometheus, in seconds
+PERCENTILES = (50.0, 99.0, 99.9)
+PROMETHEUS_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005,
+                      0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                      0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """ The count of the values recorded in each log-linear bucket, along
+    with their number, sum and maximum.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 2 * SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def highest(index):
+        "Returns the highest value falling in the bucket ``index``"
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, percentile):
+        """ Returns the value ``percentile`` percent of the recorded values
+        are lower than or equal to, within the precision of the buckets.
+        """
+        if not self.count:
+            return 0
+        wanted = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(self.highest(index), self.max)
+        return self.max
+
+    def count_below(self, value):
+        "Returns the number of recorded values at most ``value``, to the precision of the buckets"
+        return sum(count for index, count in self.counts.items() if self.highest(index) <= value)
+
+
+class SlowLog(object):
+    """ The last calls slower than ``slower_than`` microseconds, newest
+    first, as (id, unix time, microseconds, arguments) tuples where the
+    arguments are bytes, the name of the method first.  A negative
+    ``slower_than`` logs nothing and 0 logs every call.
+
+    Only ``max_argc`` arguments are kept, the last one noting how many
+    more there were, and arguments are cut after ``max_arg_len`` bytes.
+    Set those class attributes (or override them in a subclass) to tune
+    the log.
+    """
+
+    slower_than = 10000
+    max_len = 128
+    max_argc = 32
+    max_arg_len = 128
+
+    def __init__(self):
+        self.entries = deque(maxlen=self.max_len)
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, duration, key, args, kwargs):
+        """ Logs the call of the method ``key``, a (class name, method name)
+        tuple, with ``args`` and ``kwargs`` if it took ``duration``
+        microseconds.
+        """
+        if self.slower_than < 0 or duration < self.slower_than:
+            return
+        if self.entries.maxlen != self.max_len:
+            self.entries = deque(self.entries, maxlen=self.max_len)
+        arguments = [('%s.%s' % key).encode()]
+        arguments.extend(self._argument(arg) for arg in args)
+        arguments.extend(b'%s=%s' % (key.encode(), self._argument(value)) for key, value in kwargs.items())
+        if len(arguments) > self.max_argc:
+            more = len(arguments) - self.max_argc + 1
+            arguments[self.max_argc - 1:] = [b'... (%d more arguments)' % more]
+        self.entries.appendleft((next(self._ids), int(time.time()), duration, arguments))
+
+    def _argument(self, arg):
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = repr(arg).encode()
+        if len(arg) > self.max_arg_len:
+            arg = b'%s... (%d more bytes)' % (arg[:self.max_arg_len], len(arg) - self.max_arg_len)
+        return arg
+
+    def get(self, count=10):
+        "Returns the ``count`` newest entries, or every entry for a negative ``count``"
+        entries = list(self.entries)
+        return entries if count < 0 else entries[:count]
+
+    def reset(self):
+        self.entries.clear()
+
+
+# The histogram of each (class name, method name) called so far
+histograms = {}
+slowlog = SlowLog()
+
+# The original methods replaced, by (class, name)
+_originals = {}
+
+
+class _Local(threading.local):
+    # Set while an instrumented method runs in the thread
+    busy = False
+
+
+_local = _Local()
+
+
+def _record(key, elapsed, args, kwargs):
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram()
+    histogram.record(elapsed)
+    slowlog.record(elapsed // 1000, key, args, kwargs)
+
+
+def _timed(name, func):
+    "Returns a wrapper of the method ``func`` recording its calls"
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        if _local.busy:
+            return func(self, *args, **kwargs)
+        key = (type(self).__name__, name)
+        _local.busy = True
+        start = time.perf_counter_ns()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            _local.busy = False
+            _record(key, elapsed, args, kwargs)
+    return timed
+
+
+def _with_subclasses(classes):
+    seen = []
+    pending = list(classes)
+    while pending:
+        cls = pending.pop(0)
+        if cls not in seen:
+            seen.append(cls)
+            pending.extend(cls.__subclasses__())
+    return seen
+
+
+def enable(classes=CLASSES):
+    "Instruments the public methods of ``classes`` and of their subclasses"
+    for cls in _with_subclasses(classes):
+        for name, func in list(vars(cls).items()):
+            if (name.startswith('_') or not inspect.isfunction(func)
+                    or inspect.iscoroutinefunction(func) or (cls, name) in _originals):
+                continue
+            _originals[cls, name] = func
+            setattr(cls, name, _timed(name, func))
+
+
+def disable():
+    "Puts back the methods replaced by ``enable``"
+    for (cls, name), func in _originals.items():
+        setattr(cls, name, func)
+    _originals.clear()
+
+
+def enabled():
+    return bool(_originals)
+
+
+def reset():
+    "Forgets the calls recorded so far"
+    histograms.clear()
+    slowlog.reset()
+
+
+def info():
+    "Returns the statistics as the commandstats and latencystats sections of INFO"
+    lines = ['# Commandstats']
+    for (structure, method), histogram in sorted(histograms.items()):
+        usec = histogram.total / 1000.0
+        lines.append('cmdstat_%s.%s:calls=%d,usec=%d,usec_per_call=%.2f' % (
+            structure, method, histogram.count, usec, usec / histogram.count))
+    lines += ['', '# Latencystats']
+    for (structure, method), histogram in sorted(histograms.items()):
+        percentiles = ','.join('p%g=%.3f' % (p, histogram.percentile(p) / 1000.0) for p in PERCENTILES)
+        lines.append('latency_percentiles_usec_%s.%s:%s' % (structure, method, percentiles))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def prometheus():
+    "Returns the statistics in the Prometheus text exposition format"
+    lines = [
+        '# HELP pyredis_call_duration_seconds Duration of the calls of the datastructure methods.',
+        '# TYPE pyredis_call_duration_seconds histogram',
+    ]
+    for (structure, method), histogram in sorted(histograms.items()):
+        labels = 'structure="%s",method="%s"' % (structure, method)
+        for bound in PROMETHEUS_BUCKETS:
+            lines.append('pyredis_call_duration_seconds_bucket{%s,le="%s"} %d' % (
+                labels, bound, histogram.count_below(int(bound * 1e9))))
+        lines.append('pyredis_call_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.count))
+        lines.append('pyredis_call_duration_seconds_sum{%s} %.9f' % (labels, histogram.total / 1e9))
+        lines.append('pyredis_call_duration_seconds_count{%s} %d' % (labels, histogram.count))
+    lines += [
+        '# HELP pyredis_slowlog_length Entries in the slow log.',
+        '# TYPE pyredis_slowlog_length gauge',
+        'pyredis_slowlog_length %d' % len(slowlog),
+    ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,158 @@
+import bisect
+import random
+from array import array
+
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def is_int64(value):
+    "Returns True if ``value`` is an int that fits in an IntSet"
+    return type(value) is int and INT64_MIN <= value <= INT64_MAX
+
+
+def parse_int64(data):
+    """ Returns the int written in canonical decimal form in the bytes
+    ``data``, or None if it is not one or does not fit in an IntSet.
+    """
+    if data[:1].isdigit() or data[:1] == b'-' and data[1:2].isdigit():
+        try:
+            value = int(data)
+        except ValueError:
+            return None
+        if b'%d' % value == data and INT64_MIN <= value <= INT64_MAX:
+            return value
+    return None
+
+
+class IntSet(array):
+    """ A set of integers stored as a sorted array of 64 bit integers, like
+    Redis' intset encoding.
+
+    Each member costs 8 bytes instead of a hash table slot and an int
+    object.  Membership is a binary search, and intersections and unions of
+    two IntSets merge their sorted arrays.
+    """
+    __slots__ = ()
+
+    def __new__(cls, values=()):
+        return array.__new__(cls, 'q', sorted(set(values)))
+
+    def __contains__(self, value):
+        try:
+            i = bisect.bisect_left(self, value)
+        except TypeError:
+            return False
+        return i < len(self) and self[i] == value
+
+    def __eq__(self, other):
+        if isinstance(other, IntSet):
+            return array.__eq__(self, other)
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(value in other for value in self)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'IntSet(%r)' % self.tolist()
+
+    def __and__(self, other):
+        if not isinstance(other, IntSet):
+            return set(value for value in self if value in other)
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        result = IntSet()
+        if len(small) * len(large).bit_length() < len(large):
+            # binary search the few members of ``small`` in ``large``
+            lo = 0
+            for value in small:
+                lo = bisect.bisect_left(large, value, lo)
+                if lo == len(large):
+                    break
+                if large[lo] == value:
+                    result.append(value)
+            return result
+        i = j = 0
+        n, m = len(small), len(large)
+        while i < n and j < m:
+            a, b = small[i], large[j]
+            if a < b:
+                i += 1
+            elif b < a:
+                j += 1
+            else:
+                result.append(a)
+                i += 1
+                j += 1
+        return result
+
+    def __or__(self, other):
+        if not isinstance(other, IntSet):
+            return set(self).union(other)
+        result = IntSet()
+        i = j = 0
+        n, m = len(self), len(other)
+        while i < n and j < m:
+            a, b = self[i], other[j]
+            if a < b:
+                result.append(a)
+                i += 1
+            elif b < a:
+                result.append(b)
+                j += 1
+            else:
+                result.append(a)
+                i += 1
+                j += 1
+        result.extend(self[i:])
+        result.extend(other[j:])
+        return result
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def add(self, value):
+        "Adds the int ``value`` and returns True if it was not a member"
+        i = bisect.bisect_left(self, value)
+        if i < len(self) and self[i] == value:
+            return False
+        self.insert(i, value)
+        return True
+
+    def discard(self, value):
+        "Removes ``value`` and returns True if it was a member"
+        try:
+            i = bisect.bisect_left(self, value)
+        except TypeError:
+            return False
+        if i < len(self) and self[i] == value:
+            del self[i]
+            return True
+        return False
+
+    def update(self, values):
+        """ Adds the ints ``values`` and returns the number of new members.
+        A few values are inserted one by one, many are merged in a single
+        pass.
+        """
+        values = IntSet(values)
+        if len(values) * len(self).bit_length() < len(self):
+            added = 0
+            for value in values:
+                added += self.add(value)
+            return added
+        merged = self | values
+        added = len(merged) - len(self)
+        self[:] = merged
+        return added
+
+    def pop(self):
+        "Removes and returns a random member"
+        if not self:
+            raise KeyError('pop from an empty set')
+        return array.pop(self, random.randrange(len(self)))
@@ -1,10 +1,112 @@
+from . import blocking, memory
 from .exceptions import RedisError
+from .quicklist import QuickList
+
+
+def _pop_left(l):
+    if l._list:
+        return l, l._list.popleft()
+    return None
+
+
+def _pop_right(l):
+    if l._list:
+        return l, l._list.pop()
+    return None
+
+
+def _push_left(result):
+    result[0].lpush(result[1])
+
+
+def _push_right(result):
+    result[0].rpush(result[1])
+
+
+def _check_where(where):
+    "Validates a LEFT/RIGHT argument and returns it in lower case"
+    where = where.lower()
+    if where not in ("left", "right"):
+        raise RedisError("syntax error")
+    return where
 
 
 class List(object):
 
+    # Consumers blocked in blpop/brpop/blmove, created on first use
+    _waiters = None
+
     def __init__(self):
-        self._list = []
+        self._list = QuickList()
+
+    def _normalize_range(self, start, end):
+        """ Converts ``start`` and ``end`` (which can be negative) into
+        positive indexes, ``end`` being clamped to the end of the list.
+        """
+        llen = len(self._list)
+        if start < 0:
+            start = max(llen + start, 0)
+        if end < 0:
+            end = llen + end
+        return start, min(end, llen - 1)
+
+    def _mover(self, destination, wherefrom, whereto):
+        """ Returns the pop and restore functions used to block on an
+        ``lmove`` to ``destination``.
+        """
+        wherefrom, whereto = _check_where(wherefrom), _check_where(whereto)
+
+        def pop(l):
+            if not l._list:
+                return None
+            return l.lmove(destination, wherefrom, whereto)
+
+        def restore(value):
+            destination.lmove(self, whereto, wherefrom)
+
+        return pop, restore
+
+    def blmove(self, destination, wherefrom="left", whereto="right", timeout=0):
+        """
+        Like ``lmove`` but if the list is empty, block the calling thread for
+        up to ``timeout`` seconds (0 waits forever) until an item is pushed.
+
+        Returns the value moved or None on timeout.
+        """
+        pop, restore = self._mover(destination, wherefrom, whereto)
+        return blocking.block((self,), pop, restore, timeout)
+
+    async def ablmove(self, destination, wherefrom="left", whereto="right", timeout=0):
+        "The asyncio version of ``blmove``, which suspends the calling task"
+        pop, restore = self._mover(destination, wherefrom, whereto)
+        return await blocking.block_async((self,), pop, restore, timeout)
+
+    def blpop(self, *others, timeout=0):
+        """
+        Remove and return the first item of the first of this list and
+        ``others`` that is not empty.
+
+        If they are all empty, block the calling thread for up to
+        ``timeout`` seconds (0 waits forever) until an item is pushed.
+        Blocked callers are served in the order they arrived, one per item.
+        Producers in other threads should hold ``pyredis.blocking.lock``
+        while pushing.
+
+        Returns a (list, item) tuple or None on timeout.
+        """
+        return blocking.block((self,) + others, _pop_left, _push_left, timeout)
+
+    async def ablpop(self, *others, timeout=0):
+        "The asyncio version of ``blpop``, which suspends the calling task"
+        return await blocking.block_async((self,) + others, _pop_left, _push_left, timeout)
+
+    def brpop(self, *others, timeout=0):
+        "Like ``blpop`` but remove the last item of the list"
+        return blocking.block((self,) + others, _pop_right, _push_right, timeout)
+
+    async def abrpop(self, *others, timeout=0):
+        "The asyncio version of ``brpop``, which suspends the calling task"
+        return await blocking.block_async((self,) + others, _pop_right, _push_right, timeout)
 
     def lindex(self, index):
         """
@@ -39,21 +141,52 @@ class List(object):
             raise RedisError("syntax error")
         return len(self._list)
 
+    def memory_usage(self):
+        """ Returns an estimate of the bytes used by the list, kept up to
+        date as values are pushed and popped rather than computed by walking
+        it.
+        """
+        values = self._list
+        return (memory.STRUCTURE + len(values._chunks) * memory.LIST_CHUNK
+                + len(values) * memory.LIST_ENTRY + values._used)
+
     def llen(self):
         "Return the length of the list"
         return len(self._list)
 
+    def lmove(self, destination, wherefrom="left", whereto="right"):
+        """
+        Atomically pop a value from the ``wherefrom`` end of the list and
+        push it onto the ``whereto`` end of ``destination``, where both are
+        either "left" or "right".
+
+        Returns the value moved, or None if the list is empty.
+        """
+        wherefrom, whereto = _check_where(wherefrom), _check_where(whereto)
+        if not self._list:
+            return None
+        value = self._list.popleft() if wherefrom == "left" else self._list.pop()
+        if whereto == "left":
+            destination.lpush(value)
+        else:
+            destination.rpush(value)
+        return value
+
     def lpop(self):
         "Remove and return the first item of the list"
         try:
-            return self._list.pop(0)
+            return self._list.popleft()
         except IndexError:
             return None
 
     def lpush(self, *values):
         "Push ``values`` onto the head of the list"
-        self._list = list(values) + self._list
-        return self.llen()
+        self._list.extendleft(values)
+        # like Redis, the length before blocked clients are served
+        length = len(self._list)
+        if self._waiters:
+            blocking.wake(self)
+        return length
 
     def lrange(self, start, end):
         """
@@ -62,7 +195,7 @@ class List(object):
         ``start`` and ``end`` can be negative numbers just like Python slicing
         notation
         """
-        return self._list[start:end + 1]
+        return self._list.between(*self._normalize_range(start, end))
 
     def lrem(self, count, value):
         """
@@ -74,29 +207,7 @@ class List(object):
             count < 0: Remove elements equal to value moving from tail to head.
             count = 0: Remove all elements equal to value.
         """
-        indexes = []
-        l = len(self._list)
-        limit = abs(count)
-        if count < 0:
-            for i, item in enumerate(reversed(self._list)):
-                if item == value:
-                    indexes.append(l - i - 1)
-                    if count and len(indexes) == limit:
-                        break
-        else:
-            for i, item in enumerate(self._list):
-                if item == value:
-                    indexes.append(i)
-                    if len(indexes) == count:
-                        break
-        # If the count is less than 0, then use normal iterator because the
-        # indexes are already reversed.
-        iterator = indexes.__iter__() if count < 0 else reversed(indexes)
-        # remove items using stored indexes in the reverse order so that
-        # removing items doesn't mess with the index mapping
-        for i in iterator:
-            self._list.pop(i)
-        return len(indexes)
+        return self._list.remove(value, count)
 
     def lset(self, index, value):
         "Set ``position`` of list ``name`` to ``value``"
@@ -114,7 +225,7 @@ class List(object):
         ``start`` and ``end`` can be negative numbers just like
         Python slicing notation
         """
-        self._list = self._list[start:end + 1]
+        self._list.trim(*self._normalize_range(start, end))
 
     def rpop(self):
         "Remove and return the last item of the list"
@@ -125,5 +236,9 @@ class List(object):
 
     def rpush(self, *values):
         "Push ``values`` onto the tail of the list ``name``"
-        self._list =  self._list + list(values)
-        return self.llen()
+        self._list.extend(values)
+        # like Redis, the length before blocked clients are served
+        length = len(self._list)
+        if self._waiters:
+            blocking.wake(self)
+        return length
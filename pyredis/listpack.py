@@ -0,0 +1,87 @@
+class ListPack(list):
+    """ A small mapping stored as one flat list of interleaved keys and
+    values, like Redis' listpack encoding.
+
+    A dict keeps a hash table sized for growth next to its entries, while
+    this only costs a pointer per key and per value.  Lookups scan the keys
+    with ``list.index``, which is fast while there are only a few of them.
+    Keys compare the way they do in a dict.
+    """
+    __slots__ = ()
+
+    def __init__(self, mapping=()):
+        if hasattr(mapping, 'items'):
+            mapping = mapping.items()
+        for key, value in mapping:
+            self[key] = value
+
+    def _find(self, key):
+        "Returns the position of ``key`` in the list or -1"
+        start = 0
+        index = list.index
+        try:
+            while True:
+                i = index(self, key, start)
+                if not i & 1:
+                    return i
+                # matched a value, keep looking from the next key
+                start = i + 1
+        except ValueError:
+            return -1
+
+    def __len__(self):
+        return list.__len__(self) // 2
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return list.__getitem__(self, i + 1)
+
+    def __setitem__(self, key, value):
+        i = self._find(key)
+        if i < 0:
+            self.extend((key, value))
+        else:
+            list.__setitem__(self, i + 1, value)
+
+    def __delitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        list.__delitem__(self, slice(i, i + 2))
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, ListPack)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ListPack(%r)' % dict(self.items())
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0:
+            return default
+        return list.__getitem__(self, i + 1)
+
+    def keys(self):
+        return list.__getitem__(self, slice(0, None, 2))
+
+    def values(self):
+        return list.__getitem__(self, slice(1, None, 2))
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
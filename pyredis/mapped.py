@@ -0,0 +1,650 @@
+""" Snapshots that are mapped into memory rather than read, for restarts
+that do not wait for the keyspace to be rebuilt.
+
+``load`` maps the file with ``mmap`` and only reads its key directory.
+Sorted sets, sets and hashes are served read-only straight from the
+mapping: their members sit in sorted arrays and string tables that are
+searched in place, and a member is only copied out of the mapping when it
+is returned.  The first write to such a structure turns it into a regular
+one holding the same members, in place, so the keyspace and any client
+blocked on it keep the same object.  Strings, lists and hashes whose
+fields have a time to live are read as regular values when the file is
+loaded.
+
+The file is made of a header, the records of the values, each starting on
+an 8 byte boundary, the key directory and a footer locating it.  Numbers
+are written in the byte order of the machine saving the file, which must
+be the one loading it.  A string table is the offsets of its n strings as
+n + 1 unsigned 64 bit integers followed by the strings themselves.  Each
+record starts with its number of elements n:
+
+- a string is followed by its n bytes,
+- a list by a table of its elements in order,
+- a set of integers by their sorted signed 64 bit integers,
+- any other set by a table of its members sorted in bytes order,
+- a sorted set by the 64 bit float scores of its members in (score,
+  member) order, the ranks of its members sorted in bytes order as
+  unsigned 64 bit integers and a table of its members in (score, member)
+  order,
+- a hash by a table of its fields sorted in bytes order and a table of
+  their values, then, if some fields have a time to live, the unix times
+  in milliseconds they expire at as signed 64 bit integers, 0 for none.
+
+Like with ``pyredis.rdb``, strings and the members of hashes, lists and
+sorted sets are loaded as bytes, while set members that are integers are
+loaded as ints.
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections.abc import Sequence
+
+from . import memory, rdb
+from .database import Database, _is_empty, type_name
+from .exceptions import RedisError
+from .hash import Hash
+from .intset import IntSet, is_int64, parse_int64
+from .scan import filter_match, scan_sequence
+from .set import Set
+from .zset import ZSet
+
+
+MAGIC = b'PYREDMAP'
+VERSION = 1
+
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_SET = 2
+TYPE_INTSET = 3
+TYPE_ZSET = 4
+TYPE_HASH = 5
+TYPE_HASH_TTL = 6
+
+_BYTE_ORDERS = {'little': 1, 'big': 2}
+
+_HEADER = struct.Struct('=8sII')
+# database index, type, unix time in milliseconds it expires at or -1,
+# offset of the record and length of the key, which follows
+_ENTRY = struct.Struct('=HB5xqQQ')
+# offset of the key directory and number of keys
+_FOOTER = struct.Struct('=QQ8s')
+
+
+def _search(get, n, value, right=False):
+    """ Returns the index where ``value`` would be inserted among the ``n``
+    sorted values returned by ``get``, before any equal to it, or after
+    them if ``right`` is True.
+    """
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        current = get(mid)
+        if current < value or right and current == value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _Table(Sequence):
+    """ A read-only sequence of the strings of a mapped string table, each
+    copied out of the mapping when it is accessed.
+    """
+    __slots__ = ('_offsets', '_blob')
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _get(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("table index out of range")
+        return self._decode(self._get(i))
+
+    def __iter__(self):
+        offsets, blob, decode = self._offsets, self._blob, self._decode
+        for i in range(len(offsets) - 1):
+            yield decode(blob[offsets[i]:offsets[i + 1]].tobytes())
+
+    @staticmethod
+    def _decode(value):
+        return value
+
+    @property
+    def nbytes(self):
+        return self._offsets.nbytes + self._blob.nbytes
+
+    def find(self, value):
+        "Returns the index of ``value`` in a table sorted in bytes order, or -1"
+        n = len(self)
+        i = _search(self._get, n, value)
+        return i if i < n and self._get(i) == value else -1
+
+
+class _MemberTable(_Table):
+    """ The members of a mapped set, sorted in bytes order, the integers
+    among them being returned as ints like the members of a ``Set``.
+    """
+    __slots__ = ()
+
+    _decode = staticmethod(rdb._set_member)
+
+    def __contains__(self, value):
+        if is_int64(value):
+            value = b'%d' % value
+        elif not isinstance(value, bytes) or parse_int64(value) is not None:
+            return False
+        return self.find(value) >= 0
+
+    @property
+    def _members(self):
+        return self
+
+
+class _IntTable(Sequence):
+    "The sorted members of a mapped set of integers"
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._values[i].tolist()
+        return self._values[i]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes
+
+    def __contains__(self, value):
+        if not is_int64(value):
+            return False
+        n = len(self._values)
+        i = _search(self._values.__getitem__, n, value)
+        return i < n and self._values[i] == value
+
+    @property
+    def _members(self):
+        return self
+
+
+class _Scores(object):
+    """ The member to score mapping of a ``MappedZSet``, which finds members
+    by binary search over their ranks sorted in bytes order.
+    """
+    __slots__ = ('_members', '_scores', '_by_member')
+
+    def __init__(self, members, scores, by_member):
+        self._members = members
+        self._scores = scores
+        self._by_member = by_member
+
+    def rank(self, member):
+        "Returns the rank of ``member`` or -1 if it is not in the sorted set"
+        if not isinstance(member, bytes):
+            return -1
+        get, by_member = self._members._get, self._by_member
+        n = len(by_member)
+        i = _search(lambda i: get(by_member[i]), n, member)
+        if i < n and get(by_member[i]) == member:
+            return by_member[i]
+        return -1
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, member):
+        return self.rank(member) >= 0
+
+    def __getitem__(self, member):
+        rank = self.rank(member)
+        if rank < 0:
+            raise KeyError(member)
+        return self._scores[rank]
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def get(self, member, default=None):
+        rank = self.rank(member)
+        return default if rank < 0 else self._scores[rank]
+
+    def keys(self):
+        return iter(self._members)
+
+    def values(self):
+        return iter(self._scores)
+
+    def items(self):
+        return zip(self._members, self._scores)
+
+    def scan(self, cursor, count):
+        return scan_sequence(self._members, cursor, count)
+
+
+def _materializing(name):
+    """ Returns a method which turns the mapped structure into a regular
+    one before calling its method ``name``.
+    """
+    def method(self, *args, **kwargs):
+        self._materialize()
+        return getattr(self, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class MappedZSet(ZSet):
+    """ A sorted set served read-only from a mapped snapshot until its first
+    write, which turns it into a regular ``ZSet``.
+
+    Ranks and score ranges are binary searches over the mapped scores and
+    members are found by binary search over their ranks sorted in bytes
+    order, so every read costs O(log n) plus the members returned.
+    """
+
+    def __init__(self, scores, by_member, members):
+        self._scores = scores
+        self._members = members
+        self._dict = _Scores(members, scores, by_member)
+
+    def memory_usage(self):
+        "Returns the bytes of the mapped snapshot the sorted set is served from"
+        return memory.STRUCTURE + 2 * self._scores.nbytes + self._members.nbytes
+
+    def _materialize(self):
+        items = list(self._iter_sorted())
+        waiters = self._waiters
+        self.__dict__.clear()
+        self.__class__ = ZSet
+        ZSet.__init__(self)
+        self._load_sorted(items)
+        self._dict.update((member, score) for score, member in items)
+        self._used = sum(memory.sizeof(member) for score, member in items)
+        if waiters is not None:
+            self._waiters = waiters
+
+    def _iter_sorted(self):
+        return zip(self._scores, self._members)
+
+    def _iter_between(self, first, last, desc, withscores, score_cast_func):
+        members, scores = self._members, self._scores
+        ranks = range(last, first - 1, -1) if desc else range(first, last + 1)
+        if withscores:
+            return ((members[i], score_cast_func(scores[i])) for i in ranks)
+        return (members[i] for i in ranks)
+
+    def iter_rangebyscore(self, min, max, start=None, num=None, withscores=False, score_cast_func=float, desc=False):
+        n = len(self._scores)
+        first = _search(self._scores.__getitem__, n, min)
+        last = _search(self._scores.__getitem__, n, max, right=True) - 1
+        return self._iter_ranks(first, last, start, num, desc, withscores, score_cast_func)
+
+    def _count_members_below(self, member, inclusive=False):
+        return _search(self._members._get, len(self._members), member, right=inclusive)
+
+    def zrank(self, member):
+        rank = self._dict.rank(member)
+        return None if rank < 0 else rank
+
+    def zrevrank(self, member):
+        rank = self._dict.rank(member)
+        return None if rank < 0 else len(self._scores) - 1 - rank
+
+    def zcount(self, low, high):
+        if low > high:
+            return 0
+        n = len(self._scores)
+        return (_search(self._scores.__getitem__, n, high, right=True)
+                - _search(self._scores.__getitem__, n, low))
+
+    _insert_or_update = _materializing('_insert_or_update')
+    _load_sorted = _materializing('_load_sorted')
+    _replace = _materializing('_replace')
+    zadd = _materializing('zadd')
+    zadd_many = _materializing('zadd_many')
+    zincrby = _materializing('zincrby')
+    zrem = _materializing('zrem')
+    zremrangebyrank = _materializing('zremrangebyrank')
+    zremrangebyscore = _materializing('zremrangebyscore')
+
+
+class MappedSet(Set):
+    """ A set served read-only from a mapped snapshot until its first write,
+    which turns it into a regular ``Set``.  Membership is a binary search
+    over the sorted members.
+    """
+    __slots__ = ()
+
+    def __init__(self, members):
+        self._set = members
+        self._used = 0
+
+    def memory_usage(self):
+        "Returns the bytes of the mapped snapshot the set is served from"
+        return memory.STRUCTURE + self._set.nbytes
+
+    def _materialize(self):
+        fresh = rdb._make_set(list(self._set))
+        self.__class__ = Set
+        self._set, self._used = fresh._set, fresh._used
+
+    def __and__(self, rhs):
+        return set(self._set).intersection(rhs._set)
+
+    def __or__(self, rhs):
+        return set(self._set).union(rhs._set)
+
+    _replace = _materializing('_replace')
+    sadd = _materializing('sadd')
+    spop = _materializing('spop')
+    srem = _materializing('srem')
+
+
+class _Fields(object):
+    """ The field to value mapping of a ``MappedHash``, which finds fields by
+    binary search over the sorted field table.
+    """
+    __slots__ = ('_fields', '_values')
+
+    def __init__(self, fields, values):
+        self._fields = fields
+        self._values = values
+
+    def _index(self, field):
+        return self._fields.find(field) if isinstance(field, bytes) else -1
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, field):
+        return self._index(field) >= 0
+
+    def __getitem__(self, field):
+        i = self._index(field)
+        if i < 0:
+            raise KeyError(field)
+        return self._values[i]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def get(self, field, default=None):
+        i = self._index(field)
+        return default if i < 0 else self._values[i]
+
+    def keys(self):
+        return iter(self._fields)
+
+    def values(self):
+        return iter(self._values)
+
+    def items(self):
+        return zip(self._fields, self._values)
+
+
+class MappedHash(Hash):
+    """ A hash served read-only from a mapped snapshot until its first write,
+    which turns it into a regular ``Hash``.
+    """
+    __slots__ = ()
+
+    def __init__(self, fields, values):
+        self._data = _Fields(fields, values)
+        self._expires = None
+        self._used = 0
+        self._owner = None
+
+    def memory_usage(self):
+        "Returns the bytes of the mapped snapshot the hash is served from"
+        return memory.STRUCTURE + self._data._fields.nbytes + self._data._values.nbytes
+
+    def _materialize(self):
+        fresh = rdb._make_hash(list(self._data.items()))
+        self.__class__ = Hash
+        self._data, self._used = fresh._data, fresh._used
+
+    def hscan(self, cursor=0, count=10, match=None):
+        cursor, fields = scan_sequence(self._data._fields, cursor, count)
+        fields = filter_match(fields, match)
+        return cursor, dict((field, self._data[field]) for field in fields)
+
+    _delete = _materializing('_delete')
+    _set = _materializing('_set')
+    _set_expiry = _materializing('_set_expiry')
+
+
+# Saving
+
+class _Writer(object):
+    "Writes records to ``f`` keeping track of the offset and alignment"
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+
+    def align(self):
+        padding = -self.pos % 8
+        if padding:
+            self.write(bytes(padding))
+
+    def array(self, typecode, values):
+        self.write(array(typecode, values).tobytes())
+
+    def table(self, values):
+        offsets = array('Q', [0])
+        total = 0
+        for value in values:
+            total += len(value)
+            offsets.append(total)
+        self.write(offsets.tobytes())
+        for value in values:
+            self.write(value)
+        self.align()
+
+
+def _write_value(out, value):
+    "Writes the record of ``value`` and returns its type"
+    name = type_name(value)
+    if name == 'string':
+        value = rdb._to_bytes(value)
+        out.array('Q', [len(value)])
+        out.write(value)
+        out.align()
+        return TYPE_STRING
+    if name == 'list':
+        values = [rdb._to_bytes(v) for v in value._list]
+        out.array('Q', [len(values)])
+        out.table(values)
+        return TYPE_LIST
+    if name == 'set':
+        members = value._set
+        if type(members) is IntSet or all(is_int64(member) for member in members):
+            out.array('Q', [len(members)])
+            out.array('q', sorted(members))
+            return TYPE_INTSET
+        members = sorted(rdb._to_bytes(member) for member in members)
+        out.array('Q', [len(members)])
+        out.table(members)
+        return TYPE_SET
+    if name == 'zset':
+        items = list(value.iter_range(0, -1, withscores=True))
+        members = [rdb._to_bytes(member) for member, score in items]
+        out.array('Q', [len(items)])
+        out.array('d', [score for member, score in items])
+        out.array('Q', sorted(range(len(members)), key=members.__getitem__))
+        out.table(members)
+        return TYPE_ZSET
+    value._expire_all()
+    expires = value._expires
+    pairs = sorted((rdb._to_bytes(field), field, rdb._to_bytes(v)) for field, v in value._data.items())
+    out.array('Q', [len(pairs)])
+    out.table([field for field, original, v in pairs])
+    out.table([v for field, original, v in pairs])
+    if not expires:
+        return TYPE_HASH
+    out.array('q', [expires.get(original, 0) for field, original, v in pairs])
+    return TYPE_HASH_TTL
+
+
+def dump(databases, f):
+    "Writes ``databases``, a Database or a list of them, to the binary file ``f``"
+    if isinstance(databases, Database):
+        databases = [databases]
+    out = _Writer(f)
+    out.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder]))
+    now = int(time.time() * 1000)
+    entries = []
+    for index, db in enumerate(databases):
+        for key in list(db._data):
+            value = db._data[key]
+            if _is_empty(value):
+                continue
+            when = db._expires.get(key)
+            if when is not None and when <= now:
+                continue
+            offset = out.pos
+            entries.append((index, _write_value(out, value), -1 if when is None else when,
+                            offset, rdb._to_bytes(key)))
+    directory = out.pos
+    for index, kind, when, offset, key in entries:
+        out.write(_ENTRY.pack(index, kind, when, offset, len(key)))
+        out.write(key)
+    out.write(_FOOTER.pack(directory, len(entries), MAGIC))
+
+
+def save(databases, path):
+    """ Saves ``databases``, a Database or a list of them, to the snapshot
+    at ``path``.  Like ``pyredis.rdb.save`` it is written to a temporary
+    file renamed over ``path`` once complete, which also leaves the file
+    mapped by a previous ``load`` untouched.
+    """
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), 'temp-%d.map' % os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            dump(databases, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Loading
+
+def is_snapshot(path):
+    "Returns True if the file at ``path`` is a mapped snapshot"
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class _Reader(object):
+
+    def __init__(self, view):
+        self.view = view
+
+    def array(self, pos, typecode, n):
+        "Returns the ``n`` numbers at ``pos`` and the position following them"
+        end = pos + 8 * n
+        if end > len(self.view):
+            raise RedisError("truncated mapped snapshot")
+        return self.view[pos:end].cast(typecode), end
+
+    def table(self, pos, n):
+        "Returns the string table of ``n`` strings at ``pos`` and the position following it"
+        offsets, pos = self.array(pos, 'Q', n + 1)
+        end = pos + offsets[n]
+        if end > len(self.view):
+            raise RedisError("truncated mapped snapshot")
+        return _Table(offsets, self.view[pos:end]), end + -end % 8
+
+    def value(self, kind, pos):
+        n = struct.unpack_from('=Q', self.view, pos)[0]
+        pos += 8
+        if kind == TYPE_STRING:
+            return self.view[pos:pos + n].tobytes()
+        if kind == TYPE_LIST:
+            return rdb._make_list(list(self.table(pos, n)[0]))
+        if kind == TYPE_INTSET:
+            return MappedSet(_IntTable(self.array(pos, 'q', n)[0]))
+        if kind == TYPE_SET:
+            table = self.table(pos, n)[0]
+            return MappedSet(_MemberTable(table._offsets, table._blob))
+        if kind == TYPE_ZSET:
+            scores, pos = self.array(pos, 'd', n)
+            by_member, pos = self.array(pos, 'Q', n)
+            return MappedZSet(scores, by_member, self.table(pos, n)[0])
+        if kind in (TYPE_HASH, TYPE_HASH_TTL):
+            fields, pos = self.table(pos, n)
+            values, pos = self.table(pos, n)
+            if kind == TYPE_HASH:
+                return MappedHash(fields, values)
+            whens = self.array(pos, 'q', n)[0]
+            return rdb._make_hash(zip(fields, values), dict(
+                (field, when) for field, when in zip(fields, whens) if when))
+        raise RedisError("unknown value type %d in mapped snapshot" % kind)
+
+
+def load(path, databases=None):
+    """ Maps the snapshot at ``path`` into memory and loads its keys into
+    ``databases``, a list of Database numbered from 0, which is created
+    and grown as needed, and returns it.
+
+    The file stays mapped until every structure served from it has been
+    written to or deleted.
+    """
+    if databases is None:
+        databases = []
+    size = os.path.getsize(path)
+    if size < _HEADER.size + _FOOTER.size:
+        raise RedisError("not a mapped snapshot")
+    with open(path, 'rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, byte_order = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise RedisError("not a mapped snapshot")
+    if version > VERSION:
+        raise RedisError("can't handle mapped snapshot version %d" % version)
+    if byte_order != _BYTE_ORDERS[sys.byteorder]:
+        raise RedisError("mapped snapshot saved with another byte order")
+    directory, count, magic = _FOOTER.unpack_from(view, size - _FOOTER.size)
+    if magic != MAGIC:
+        raise RedisError("truncated mapped snapshot")
+    reader = _Reader(view)
+    now = int(time.time() * 1000)
+    pos = directory
+    for i in range(count):
+        index, kind, when, offset, length = _ENTRY.unpack_from(view, pos)
+        pos += _ENTRY.size
+        key = view[pos:pos + length].tobytes()
+        pos += length
+        if when != -1 and when <= now:
+            continue
+        while len(databases) <= index:
+            databases.append(Database())
+        databases[index].store(key, reader.value(kind, offset), None if when == -1 else when)
+    return databases
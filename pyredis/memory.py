@@ -0,0 +1,214 @@
+""" Memory accounting and eviction under ``maxmemory``.
+
+Every datastructure keeps a running total of the bytes of the members and
+values it holds, updated as they are added and removed, and its
+``memory_usage`` adds an estimate of the overhead of its encoding per
+entry, so it costs O(1) rather than a walk over the structure.  The
+overheads were measured on CPython 64 bit builds.
+
+A ``Database`` sums the memory of its keys into ``used_memory``, updating
+the key when it is touched.  Once it exceeds ``maxmemory`` keys are evicted
+by the policy:
+
+- "noeviction" evicts nothing and fails the commands that would use more
+  memory,
+- "allkeys-lru" evicts the least recently used keys,
+- "allkeys-lfu" evicts the least frequently used keys,
+- "volatile-ttl" evicts the keys with a time to live expiring first.
+
+Like Redis, eviction is approximate: each round samples
+``maxmemory_samples`` keys and merges them into a pool of the best
+``EVICTION_POOL_SIZE`` candidates seen so far, evicting the best one.  No
+ordered index of the keyspace is maintained, so accessing a key only
+stamps it, and evicting costs O(samples).
+
+The LFU counter of a key is the logarithmic counter of Redis, incremented
+with a probability that decreases as it grows, decremented once every
+``LFU_DECAY_TIME`` minutes the key is not accessed, and packed with the
+minute of the last access in one int.
+"""
+import itertools
+import random
+import sys
+import time
+
+from .exceptions import RedisError
+
+
+POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'volatile-ttl')
+MAXMEMORY_SAMPLES = 5
+EVICTION_POOL_SIZE = 16
+
+OOM = "OOM command not allowed when used memory > 'maxmemory'."
+
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1
+
+# Overheads in bytes per entry of each encoding, besides the members and
+# values themselves: a dict slot, a skiplist node and the score of a
+# sorted set member...
+DICT_ENTRY = 60
+ZSET_ENTRY = 290
+COLUMNAR_ENTRY = 84
+COLUMNAR_SLOT = 16
+DENSESET_ENTRY = 88
+INTSET_ENTRY = 8
+LISTPACK_ENTRY = 16
+LIST_ENTRY = 8
+LIST_CHUNK = 120
+# The cursor index of a ScanDict adds an entry to its key log and to its
+# positions to each key, as in the keyspace and large hashes and sorted sets
+SCAN_ENTRY = 80
+# ... and of the structure itself, of a key and of a time to live
+STRUCTURE = 200
+KEY = DICT_ENTRY + SCAN_ENTRY
+EXPIRE = 2 * DICT_ENTRY
+
+
+def sizeof(value):
+    "Returns the bytes taken by the member or value ``value``"
+    return sys.getsizeof(value)
+
+
+def key_memory(key, value, volatile=False):
+    """ Returns the memory used by ``key`` holding ``value``, a string or a
+    datastructure, with a time to live if ``volatile`` is True.
+    """
+    size = KEY + sizeof(key) + (EXPIRE if volatile else 0)
+    usage = getattr(value, 'memory_usage', None)
+    return size + (sizeof(value) if usage is None else usage())
+
+
+# Access tracking
+
+lru_clock = itertools.count(1).__next__
+
+
+def lfu_minutes():
+    return int(time.monotonic() // 60)
+
+
+def lfu_counter(stamp, now=None):
+    "Returns the counter of the LFU ``stamp`` decayed to the minute ``now``"
+    counter = stamp & 0xff
+    periods = ((lfu_minutes() if now is None else now) - (stamp >> 8)) // LFU_DECAY_TIME
+    return counter - periods if periods < counter else 0
+
+
+def lfu_access(stamp):
+    "Returns the LFU stamp following ``stamp``, or None for a new key, after an access"
+    now = lfu_minutes()
+    if stamp is None:
+        return now << 8 | LFU_INIT_VAL
+    counter = lfu_counter(stamp, now)
+    if counter < 255:
+        base = counter - LFU_INIT_VAL
+        if random.random() < 1.0 / (max(base, 0) * LFU_LOG_FACTOR + 1):
+            counter += 1
+    return now << 8 | counter
+
+
+# Eviction
+
+def _sample(sequence, n, present, size):
+    """ Returns up to ``n`` members of ``sequence`` picked at random for
+    which ``present(position, member)`` holds, ``size`` of them doing.
+    """
+    if not size:
+        return []
+    keys = []
+    # the key log of a ScanDict also holds stale entries, up to as many as
+    # its keys plus SCAN_LOG_SLACK, which the tries make up for
+    for i in range(2 * n * -(-len(sequence) // size)):
+        position = random.randrange(len(sequence))
+        key = sequence[position]
+        if present(position, key):
+            keys.append(key)
+            if len(keys) == n:
+                break
+    return keys
+
+
+class EvictionPool(object):
+    """ The best candidates for eviction seen by the last rounds of
+    sampling, as a list of (idle, database, key) sorted by idle, a higher
+    idle making a better candidate.
+    """
+
+    def __init__(self, size=EVICTION_POOL_SIZE):
+        self.size = size
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def populate(self, db, policy, samples):
+        "Samples ``samples`` keys of ``db`` and keeps the best candidates"
+        data = db._data
+        if policy == 'volatile-ttl':
+            expires = db._expires
+            keys = _sample(db._volatile._members, samples, lambda position, key: key in expires, len(expires))
+        else:
+            keys = _sample(data._keys, samples, data.current, len(data))
+        entries = self._entries
+        now = lfu_minutes()
+        clock = lru_clock()
+        for key in keys:
+            if getattr(data[key], '_waiters', None):
+                # evicting it would strand the clients blocked on it
+                continue
+            if policy == 'allkeys-lru':
+                idle = clock - db._access.get(key, 0)
+            elif policy == 'allkeys-lfu':
+                stamp = db._access.get(key)
+                idle = 255 - (LFU_INIT_VAL if stamp is None else lfu_counter(stamp, now))
+            else:
+                idle = -db._expires[key]
+            if len(entries) == self.size and idle <= entries[0][0]:
+                continue
+            if any(entry[1] is db and entry[2] == key for entry in entries):
+                continue
+            i = len(entries)
+            while i and entries[i - 1][0] > idle:
+                i -= 1
+            entries.insert(i, (idle, db, key))
+            if len(entries) > self.size:
+                del entries[0]
+
+    def pop(self):
+        "Returns the (database, key) of the best candidate still in its database, or None"
+        while self._entries:
+            idle, db, key = self._entries.pop()
+            if key in db._data:
+                return db, key
+        return None
+
+
+def evict(databases, maxmemory, policy, samples, pool):
+    """ Evicts keys of ``databases`` by ``policy`` while they use more than
+    ``maxmemory`` bytes, refilling ``pool`` with ``samples`` keys of each
+    database per round, and returns the (database, key) pairs evicted.
+
+    The caller finds the memory still over ``maxmemory`` when there was
+    nothing left to evict.
+    """
+    if policy not in POLICIES:
+        raise RedisError("maxmemory-policy must be one of %s" % ', '.join(POLICIES))
+    evicted = []
+    if policy == 'noeviction':
+        return evicted
+    used = sum(db.used_memory for db in databases)
+    while used > maxmemory:
+        for db in databases:
+            if db._data:
+                pool.populate(db, policy, samples)
+        candidate = pool.pop()
+        if candidate is None:
+            break
+        db, key = candidate
+        before = db.used_memory
+        db._delete(key)
+        used -= before - db.used_memory
+        evicted.append(candidate)
+    return evicted
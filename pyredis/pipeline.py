@@ -0,0 +1,200 @@
+""" Batched and transactional execution of commands against a ``Database``.
+
+A ``Pipeline`` queues commands and ``execute`` runs them all under a single
+acquisition of the database lock, returning their results together.  Like
+MULTI/EXEC in Redis, no other thread using the lock sees the keyspace
+between the commands of a batch, and ``watch`` makes ``execute`` fail with
+a ``WatchError`` if a watched key was modified since, so the batch can be
+retried.
+
+Commands are the methods of ``Database`` listed in ``DATABASE_COMMANDS``
+and the methods of the datastructures listed in ``COMMANDS``, called with
+the key first::
+
+    >>> with db.pipeline() as pipe:
+    ...     pipe.zadd('scores', alice=10).zincrby('scores', 'alice', 5)
+    ...     pipe.zscore('scores', 'alice')
+    ...     pipe.execute()
+    [1, 15, 15]
+"""
+from .exceptions import RedisError, WatchError
+from .hash import Hash
+from .list import List
+from .set import Set
+from .zset import ZSet
+
+
+DATABASE_COMMANDS = frozenset((
+    'dbsize', 'delete', 'exists', 'expire', 'flushdb', 'get', 'keys',
+    'persist', 'pexpire', 'pexpireat', 'pttl', 'scan', 'set', 'ttl', 'type',
+))
+
+# The datastructure methods callable in a pipeline, with their flags:
+# "write" for the ones modifying the structure, "create" for the writes
+# adding elements, which store a new structure at a missing key, "keys" for
+# the ones taking other keys as positional arguments, and "destination"
+# for the ones taking a key to write to as their first argument.
+COMMANDS = {}
+
+
+def _register(cls, names, flags=''):
+    for name in names.split():
+        COMMANDS[name] = (cls, frozenset(flags.split()))
+
+
+_register(ZSet, 'zcard zcount zlexcount zrange zrangebylex zrangebyscore zrank '
+                'zrevrange zrevrangebylex zrevrangebyscore zrevrank zscan zscore')
+_register(ZSet, 'zdiff zinter zunion', 'keys')
+_register(ZSet, 'zadd zadd_many zincrby', 'write create')
+_register(ZSet, 'zpopmax zpopmin zrem zremrangebylex zremrangebyrank zremrangebyscore', 'write')
+_register(ZSet, 'zdiffstore zinterstore zunionstore', 'write create keys')
+_register(Hash, 'hexists hget hgetall hkeys hlen hmget hpttl hscan httl hvals')
+_register(Hash, 'hincrby hincrbyfloat hmset hset hsetnx', 'write create')
+_register(Hash, 'hdel hexpire hpersist hpexpire hpexpireat', 'write')
+_register(Set, 'scard sismember smembers srandmember sscan')
+_register(Set, 'sdiff sinter sintercard sunion', 'keys')
+_register(Set, 'sadd', 'write create')
+_register(Set, 'spop srem', 'write')
+_register(Set, 'sdiffstore sinterstore sunionstore', 'write create keys')
+_register(List, 'lindex llen lrange')
+_register(List, 'lpush rpush', 'write create')
+_register(List, 'linsert lpop lrem lset ltrim rpop', 'write')
+_register(List, 'lmove', 'write destination')
+
+
+def _lookup(db, key, cls):
+    "Returns the ``cls`` at ``key``, an empty one standing for a missing key"
+    value = db.lookup(key, cls)
+    return cls() if value is None else value
+
+
+def call(db, name, args, kwargs):
+    """ Runs the command ``name`` against ``db``, the caller holding its
+    lock.  Only the commands adding elements store a structure at a missing
+    key, the others running against an empty one left out of the keyspace.
+    """
+    if name in DATABASE_COMMANDS:
+        return getattr(db, name)(*args, **kwargs)
+    cls, flags = COMMANDS[name]
+    if not args:
+        raise RedisError("wrong number of arguments for '%s' command" % name)
+    key, args = args[0], list(args[1:])
+    value = db.lookup(key, cls, create='create' in flags)
+    touched = []
+    if value is None:
+        value = cls()
+    elif 'write' in flags:
+        touched.append(key)
+    if 'keys' in flags:
+        args = [_lookup(db, other, cls) for other in args]
+    elif 'destination' in flags and args:
+        if touched:
+            touched.append(args[0])
+            args[0] = db.lookup(args[0], cls, create=True)
+        else:
+            # nothing is moved from a missing key
+            args[0] = cls()
+    result = getattr(value, name)(*args, **kwargs)
+    db.touch(*touched)
+    return result
+
+
+class Pipeline(object):
+    """ Queues commands against a ``Database`` and runs them together.
+
+    Commands are queued until ``execute``, except after ``watch`` and
+    before ``multi``, where they run immediately, so that the values a
+    transaction depends on can be read.  Use the pipeline as a context
+    manager to unwatch the keys however the block exits.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._commands = []
+        # the version of each watched key when it was watched
+        self._watched = {}
+        self._multi = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        if name not in COMMANDS and name not in DATABASE_COMMANDS:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            if self._watched and not self._multi:
+                with self.db.lock:
+                    return call(self.db, name, args, kwargs)
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        """ Runs the queued commands under the database lock and returns
+        their results.
+
+        Raises ``WatchError`` without running anything if a watched key was
+        modified.  A command that fails does not stop the others; its
+        RedisError is raised afterwards, or returned among the results if
+        ``raise_on_error`` is False.
+        """
+        commands, self._commands = self._commands, []
+        db = self.db
+        with db.lock:
+            try:
+                for key, version in self._watched.items():
+                    if db.watched_changed(key, version):
+                        raise WatchError("Watched variable changed.")
+                results = []
+                for name, args, kwargs in commands:
+                    try:
+                        results.append(call(db, name, args, kwargs))
+                    except RedisError as e:
+                        results.append(e)
+            finally:
+                self.reset()
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, RedisError):
+                    raise result
+        return results
+
+    def multi(self):
+        "Starts queueing commands after ``watch``"
+        if self._multi:
+            raise RedisError("MULTI calls can not be nested")
+        self._multi = True
+
+    def reset(self):
+        "Discards the queued commands and unwatches every key"
+        self._commands = []
+        self._multi = False
+        if self._watched:
+            self.unwatch()
+
+    def unwatch(self):
+        "Stops watching every key"
+        with self.db.lock:
+            for key in self._watched:
+                self.db.unwatch(key)
+        self._watched = {}
+        return True
+
+    def watch(self, *keys):
+        """ Watches ``keys``, so that ``execute`` fails if any of them is
+        modified before it.
+        """
+        if self._multi:
+            raise RedisError("WATCH inside MULTI is not allowed")
+        with self.db.lock:
+            for key in keys:
+                if key not in self._watched:
+                    self._watched[key] = self.db.watch(key)
+        return True
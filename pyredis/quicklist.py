@@ -0,0 +1,272 @@
+from collections import deque
+
+from .memory import sizeof
+
+
+CHUNK_SIZE = 128
+
+
+class QuickList(object):
+    """ A sequence stored as a deque of small Python lists (chunks), like
+    Redis' quicklist.
+
+    Pushing and popping at either end only touches the outermost chunk, so
+    it is O(1) amortised however long the list gets.  Positional access
+    walks the chunk lengths from the nearest end, which skips
+    ``chunk_size`` elements per step, and only the chunk holding the
+    position is modified.
+
+    ``_used`` keeps the bytes taken by the values as they come and go.
+    """
+
+    def __init__(self, values=(), chunk_size=CHUNK_SIZE):
+        self._chunks = deque()
+        self._len = 0
+        self._used = 0
+        self.chunk_size = chunk_size
+        self.extend(values)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for value in chunk:
+                yield value
+
+    def __reversed__(self):
+        for chunk in reversed(self._chunks):
+            for value in reversed(chunk):
+                yield value
+
+    def __repr__(self):
+        return 'QuickList(%r)' % list(self)
+
+    def _normalize(self, index):
+        "Turns ``index`` into a positive index or raises an IndexError"
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError('index out of range')
+        return index
+
+    def _locate(self, index):
+        """ Returns the (chunk index, offset) of the positive ``index``,
+        summing chunk lengths from whichever end is nearer.
+        """
+        chunks = self._chunks
+        if index < self._len // 2:
+            for i, chunk in enumerate(chunks):
+                if index < len(chunk):
+                    return i, index
+                index -= len(chunk)
+        else:
+            index = self._len - 1 - index
+            last = len(chunks) - 1
+            for i, chunk in enumerate(reversed(chunks)):
+                if index < len(chunk):
+                    return last - i, len(chunk) - 1 - index
+                index -= len(chunk)
+        raise IndexError('index out of range')
+
+    def _compact(self):
+        """ Merges neighbouring chunks that fit in one, so that removals do
+        not leave the list fragmented into many tiny chunks.
+        """
+        merged = deque()
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if merged and len(merged[-1]) + len(chunk) <= self.chunk_size:
+                merged[-1].extend(chunk)
+            else:
+                merged.append(chunk)
+        self._chunks = merged
+
+    def append(self, value):
+        chunks = self._chunks
+        if chunks and len(chunks[-1]) < self.chunk_size:
+            chunks[-1].append(value)
+        else:
+            chunks.append([value])
+        self._len += 1
+        self._used += sizeof(value)
+
+    def appendleft(self, value):
+        chunks = self._chunks
+        if chunks and len(chunks[0]) < self.chunk_size:
+            chunks[0].insert(0, value)
+        else:
+            chunks.appendleft([value])
+        self._len += 1
+        self._used += sizeof(value)
+
+    def extend(self, values):
+        "Appends every one of ``values`` to the tail"
+        values = list(values)
+        chunks = self._chunks
+        size = self.chunk_size
+        i = 0
+        if chunks:
+            i = size - len(chunks[-1])
+            chunks[-1].extend(values[:i])
+        for j in range(i, len(values), size):
+            chunks.append(values[j:j + size])
+        self._len += len(values)
+        self._used += sum(map(sizeof, values))
+
+    def extendleft(self, values):
+        """ Pushes every one of ``values`` onto the head in turn, so they end
+        up in the reverse order, like ``deque.extendleft``.
+        """
+        values = list(values)
+        values.reverse()
+        chunks = self._chunks
+        size = self.chunk_size
+        end = len(values)
+        if chunks:
+            start = max(0, end - (size - len(chunks[0])))
+            chunks[0][0:0] = values[start:end]
+            end = start
+        while end > 0:
+            start = max(0, end - size)
+            chunks.appendleft(values[start:end])
+            end = start
+        self._len += len(values)
+        self._used += sum(map(sizeof, values))
+
+    def pop(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty list')
+        chunk = chunks[-1]
+        value = chunk.pop()
+        if not chunk:
+            chunks.pop()
+        self._len -= 1
+        self._used -= sizeof(value)
+        return value
+
+    def popleft(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty list')
+        chunk = chunks[0]
+        value = chunk.pop(0)
+        if not chunk:
+            chunks.popleft()
+        self._len -= 1
+        self._used -= sizeof(value)
+        return value
+
+    def __getitem__(self, index):
+        i, offset = self._locate(self._normalize(index))
+        return self._chunks[i][offset]
+
+    def __setitem__(self, index, value):
+        i, offset = self._locate(self._normalize(index))
+        chunk = self._chunks[i]
+        self._used += sizeof(value) - sizeof(chunk[offset])
+        chunk[offset] = value
+
+    def insert(self, index, value):
+        """ Inserts ``value`` before the positive ``index``, splitting the
+        chunk in two if it overflows.
+        """
+        if index >= self._len:
+            return self.append(value)
+        if index <= 0:
+            return self.appendleft(value)
+        i, offset = self._locate(index)
+        chunk = self._chunks[i]
+        chunk.insert(offset, value)
+        if len(chunk) > self.chunk_size:
+            half = len(chunk) // 2
+            self._chunks.insert(i + 1, chunk[half:])
+            del chunk[half:]
+        self._len += 1
+        self._used += sizeof(value)
+
+    def index(self, value):
+        "Returns the position of the first occurrence of ``value``"
+        position = 0
+        for chunk in self._chunks:
+            if value in chunk:
+                return position + chunk.index(value)
+            position += len(chunk)
+        raise ValueError('value is not in list')
+
+    def between(self, start, end):
+        """ Returns the values between the positive indexes ``start`` and
+        ``end`` inclusive as a list.
+        """
+        if start > end or start >= self._len:
+            return []
+        i, offset = self._locate(start)
+        count = end - start + 1
+        chunks = self._chunks
+        data = chunks[i][offset:offset + count]
+        i += 1
+        while len(data) < count and i < len(chunks):
+            data.extend(chunks[i][:count - len(data)])
+            i += 1
+        return data
+
+    def trim(self, start, end):
+        """ Keeps only the values between the positive indexes ``start`` and
+        ``end`` inclusive.  Chunks falling entirely outside are dropped
+        without being copied.
+        """
+        chunks = self._chunks
+        if start > end or start >= self._len:
+            chunks.clear()
+            self._len = self._used = 0
+            return
+        end = min(end, self._len - 1)
+        drop_head = start
+        drop_tail = self._len - 1 - end
+        dropped = []
+        while drop_head and len(chunks[0]) <= drop_head:
+            dropped.append(chunks.popleft())
+            drop_head -= len(dropped[-1])
+        if drop_head:
+            dropped.append(chunks[0][:drop_head])
+            del chunks[0][:drop_head]
+        while drop_tail and len(chunks[-1]) <= drop_tail:
+            dropped.append(chunks.pop())
+            drop_tail -= len(dropped[-1])
+        if drop_tail:
+            dropped.append(chunks[-1][-drop_tail:])
+            del chunks[-1][-drop_tail:]
+        self._len = end - start + 1
+        self._used -= sum(sizeof(value) for chunk in dropped for value in chunk)
+
+    def remove(self, value, count=0):
+        """ Removes up to ``count`` occurrences of ``value`` (all of them if
+        ``count`` is 0), scanning from the tail if ``count`` is negative.
+
+        Returns the number of values removed.
+        """
+        limit = abs(count)
+        removed = 0
+        for chunk in reversed(self._chunks) if count < 0 else self._chunks:
+            if value not in chunk:
+                continue
+            if not count:
+                kept = [item for item in chunk if item != value]
+                removed += len(chunk) - len(kept)
+                self._used -= sum(sizeof(item) for item in chunk if item == value)
+                chunk[:] = kept
+            else:
+                positions = range(len(chunk) - 1, -1, -1) if count < 0 else range(len(chunk))
+                hits = [j for j in positions if chunk[j] == value][:limit - removed]
+                for j in sorted(hits, reverse=True):
+                    self._used -= sizeof(chunk[j])
+                    del chunk[j]
+                removed += len(hits)
+            if count and removed == limit:
+                break
+        if removed:
+            self._compact()
+            self._len -= removed
+        return removed
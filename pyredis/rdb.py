@@ -0,0 +1,920 @@
+""" Snapshots of databases in the Redis RDB format.
+
+``save`` streams the keyspace to disk through a small buffer, so a
+snapshot never needs more memory than the buffer, and writes small
+structures in the compact encodings Redis uses for them: intsets and
+listpacks.  ``load`` streams the dumps written by ``save`` and by
+redis-server from 2.6 to 7.4 through a buffer too, building each structure in one go from its
+serialized members rather than inserting them one by one.
+
+Strings and the members of hashes, lists and sorted sets are loaded as
+bytes, whatever type they were saved from, while set members that are
+integers are loaded as ints, like the server stores them.  Stream and
+module values are not supported.
+"""
+import io
+import os
+import struct
+import sys
+import time
+from array import array
+
+try:
+    import numpy
+    USE_NUMPY = True
+except ImportError:
+    USE_NUMPY = False
+
+from . import memory
+from .database import Database, type_name
+from .denseset import DenseSet
+from .exceptions import RedisError
+from .hash import Hash
+from .intset import INT64_MAX, INT64_MIN, IntSet, is_int64, parse_int64
+from .list import List
+from .listpack import ListPack
+from .quicklist import QuickList
+from .resp import format_float
+from .scan import ScanDict
+from .set import Set
+from .zset import ZSet
+
+
+RDB_VERSION = 11
+# The version needed for hash field expiry, introduced by Redis 7.4
+RDB_VERSION_HASH_TTL = 12
+
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_SET = 2
+TYPE_ZSET = 3
+TYPE_HASH = 4
+TYPE_ZSET_2 = 5
+TYPE_LIST_ZIPLIST = 10
+TYPE_SET_INTSET = 11
+TYPE_ZSET_ZIPLIST = 12
+TYPE_HASH_ZIPLIST = 13
+TYPE_LIST_QUICKLIST = 14
+TYPE_HASH_LISTPACK = 16
+TYPE_ZSET_LISTPACK = 17
+TYPE_LIST_QUICKLIST_2 = 18
+TYPE_SET_LISTPACK = 20
+TYPE_HASH_METADATA = 24
+TYPE_HASH_LISTPACK_EX = 25
+
+OPCODE_SLOT_INFO = 0xF4
+OPCODE_FUNCTION2 = 0xF5
+OPCODE_MODULE_AUX = 0xF7
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+QUICKLIST_NODE_PLAIN = 1
+QUICKLIST_NODE_PACKED = 2
+
+# Limits of the listpack encodings, as in the default redis.conf
+SET_MAX_LISTPACK_ENTRIES = 128
+SET_MAX_LISTPACK_VALUE = 64
+ZSET_MAX_LISTPACK_ENTRIES = 128
+ZSET_MAX_LISTPACK_VALUE = 64
+LIST_LISTPACK_ENTRIES = 128
+
+WRITE_BUFFER_SIZE = 64 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+
+_CRC64_POLY = 0x95ac9329ac4bc9b5
+
+
+def _crc64_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc >> 1) ^ _CRC64_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC64_TABLE = _crc64_table()
+
+
+def _crc64_tables(t0):
+    """ Returns the slice-by-8 tables extending ``t0``: table k updates a
+    checksum with a byte followed by k zero bytes.
+    """
+    tables = [t0]
+    for k in range(7):
+        tables.append([t0[crc & 0xff] ^ (crc >> 8) for crc in tables[-1]])
+    return tables
+
+
+_CRC64_TABLES = _crc64_tables(_CRC64_TABLE)
+
+# Bytes checksummed at once by each of the blocks numpy checksums side by
+# side, and the length below which the pure Python implementation is used
+CRC64_BLOCK = 512
+CRC64_NUMPY_MIN = 8 * CRC64_BLOCK
+
+_crc64_numpy_tables = None
+
+
+def crc64(crc, data):
+    """ Updates ``crc`` with ``data`` using the CRC-64/Jones checksum of
+    Redis.  Long data is checksummed by numpy when it is installed, and
+    else eight bytes at a time.
+    """
+    if USE_NUMPY and len(data) >= CRC64_NUMPY_MIN:
+        return _crc64_numpy(crc, data)
+    return _crc64_python(crc, data)
+
+
+def _crc64_python(crc, data):
+    t0, t1, t2, t3, t4, t5, t6, t7 = _CRC64_TABLES
+    data = memoryview(data).cast('B')
+    end = len(data) - len(data) % 8
+    for word, in struct.iter_unpack('<Q', data[:end]):
+        x = crc ^ word
+        crc = (t7[x & 0xff] ^ t6[x >> 8 & 0xff] ^ t5[x >> 16 & 0xff] ^ t4[x >> 24 & 0xff]
+               ^ t3[x >> 32 & 0xff] ^ t2[x >> 40 & 0xff] ^ t1[x >> 48 & 0xff] ^ t0[x >> 56])
+    for byte in data[end:]:
+        crc = t0[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def _crc64_numpy(crc, data):
+    """ Checksums the blocks of ``data`` from zero side by side, and then
+    folds them into ``crc`` in order: shifting a checksum over a block of
+    zero bytes before xoring the checksum of the block gives the checksum
+    over the block, the CRC being linear.
+    """
+    global _crc64_numpy_tables
+    if _crc64_numpy_tables is None:
+        t0 = numpy.array(_CRC64_TABLE, dtype=numpy.uint64)
+        # shift table i maps byte i of a checksum to its shift over a block
+        shift = numpy.arange(256, dtype=numpy.uint64) << (numpy.arange(8, dtype=numpy.uint64) * 8)[:, None]
+        for i in range(CRC64_BLOCK):
+            shift = t0[shift & 0xff] ^ (shift >> 8)
+        _crc64_numpy_tables = (numpy.array(_CRC64_TABLES, dtype=numpy.uint64), shift.tolist())
+    tables, shift = _crc64_numpy_tables
+    t0, t1, t2, t3, t4, t5, t6, t7 = tables
+    data = memoryview(data).cast('B')
+    blocks = len(data) // CRC64_BLOCK
+    words = numpy.frombuffer(data, dtype='<u8', count=blocks * CRC64_BLOCK // 8)
+    states = numpy.zeros(blocks, dtype=numpy.uint64)
+    for column in words.reshape(blocks, CRC64_BLOCK // 8).T:
+        x = states ^ column
+        states = (t7[x & 0xff] ^ t6[x >> 8 & 0xff] ^ t5[x >> 16 & 0xff] ^ t4[x >> 24 & 0xff]
+                  ^ t3[x >> 32 & 0xff] ^ t2[x >> 40 & 0xff] ^ t1[x >> 48 & 0xff] ^ t0[x >> 56])
+    s0, s1, s2, s3, s4, s5, s6, s7 = shift
+    for state in states.tolist():
+        crc = (s0[crc & 0xff] ^ s1[crc >> 8 & 0xff] ^ s2[crc >> 16 & 0xff] ^ s3[crc >> 24 & 0xff]
+               ^ s4[crc >> 32 & 0xff] ^ s5[crc >> 40 & 0xff] ^ s6[crc >> 48 & 0xff] ^ s7[crc >> 56] ^ state)
+    return _crc64_python(crc, data[blocks * CRC64_BLOCK:])
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return format_float(value).encode()
+    return b'%d' % value
+
+
+def _as_int(value):
+    "Returns ``value`` as an int if it is one or is the canonical form of one"
+    if type(value) is int:
+        return value if INT64_MIN <= value <= INT64_MAX else None
+    if isinstance(value, bytes) and len(value) <= 20:
+        return parse_int64(value)
+    return None
+
+
+# Writing
+
+def _encode_length(n):
+    if n < 0x40:
+        return bytes((n,))
+    if n < 0x4000:
+        return bytes((0x40 | n >> 8, n & 0xff))
+    if n <= 0xffffffff:
+        return b'\x80' + struct.pack('>I', n)
+    return b'\x81' + struct.pack('>Q', n)
+
+
+def _encode_string(value):
+    value = _to_bytes(value)
+    n = _as_int(value) if len(value) <= 11 else None
+    if n is not None:
+        if -0x80 <= n < 0x80:
+            return b'\xc0' + struct.pack('<b', n)
+        if -0x8000 <= n < 0x8000:
+            return b'\xc1' + struct.pack('<h', n)
+        if -0x80000000 <= n < 0x80000000:
+            return b'\xc2' + struct.pack('<i', n)
+    return _encode_length(len(value)) + value
+
+
+def _encode_backlen(n):
+    if n < 0x80:
+        return bytes((n,))
+    if n < 0x4000:
+        return bytes((n >> 7, n & 127 | 128))
+    if n < 0x200000:
+        return bytes((n >> 14, n >> 7 & 127 | 128, n & 127 | 128))
+    if n < 0x10000000:
+        return bytes((n >> 21, n >> 14 & 127 | 128, n >> 7 & 127 | 128, n & 127 | 128))
+    return bytes((n >> 28, n >> 21 & 127 | 128, n >> 14 & 127 | 128, n >> 7 & 127 | 128, n & 127 | 128))
+
+
+def _listpack_entry(value):
+    n = _as_int(value)
+    if n is not None:
+        if 0 <= n < 0x80:
+            entry = bytes((n,))
+        elif -0x1000 <= n < 0x1000:
+            n &= 0x1fff
+            entry = bytes((0xc0 | n >> 8, n & 0xff))
+        elif -0x8000 <= n < 0x8000:
+            entry = b'\xf1' + struct.pack('<h', n)
+        elif -0x800000 <= n < 0x800000:
+            entry = b'\xf2' + (n & 0xffffff).to_bytes(3, 'little')
+        elif -0x80000000 <= n < 0x80000000:
+            entry = b'\xf3' + struct.pack('<i', n)
+        else:
+            entry = b'\xf4' + struct.pack('<q', n)
+    else:
+        value = _to_bytes(value)
+        size = len(value)
+        if size < 0x40:
+            entry = bytes((0x80 | size,)) + value
+        elif size < 0x1000:
+            entry = bytes((0xe0 | size >> 8, size & 0xff)) + value
+        else:
+            entry = b'\xf0' + struct.pack('<I', size) + value
+    return entry + _encode_backlen(len(entry))
+
+
+def encode_listpack(values):
+    "Returns the serialized listpack of ``values``"
+    body = bytearray()
+    count = 0
+    for value in values:
+        body += _listpack_entry(value)
+        count += 1
+    return struct.pack('<IH', len(body) + 7, min(count, 0xffff)) + bytes(body) + b'\xff'
+
+
+def _encode_intset(values):
+    lo, hi = (values[0], values[-1]) if values else (0, 0)
+    if -0x8000 <= lo and hi < 0x8000:
+        width, data = 2, array('h', values)
+    elif -0x80000000 <= lo and hi < 0x80000000:
+        width, data = 4, array('i', values)
+    else:
+        width, data = 8, values
+    if sys.byteorder != 'little':
+        data = array(data.typecode, data)
+        data.byteswap()
+    return struct.pack('<II', width, len(values)) + data.tobytes()
+
+
+def _fits_listpack(values, max_entries, max_value):
+    if len(values) > max_entries:
+        return False
+    for value in values:
+        if isinstance(value, (str, bytes)) and len(value) > max_value:
+            return False
+    return True
+
+
+class _Writer(object):
+    "Buffers the output and keeps its checksum"
+
+    def __init__(self, f, checksum):
+        self._f = f
+        self._buffer = bytearray()
+        self._checksum = checksum
+        self.crc = 0
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._checksum:
+            self.crc = crc64(self.crc, self._buffer)
+        self._f.write(self._buffer)
+        self._buffer = bytearray()
+
+
+def _write_header(out, value_type, key):
+    out.write(bytes((value_type,)))
+    out.write(_encode_string(key))
+
+
+def _write_zset(out, key, zset):
+    if zset.zcard() <= ZSET_MAX_LISTPACK_ENTRIES:
+        items = zset.zrange(0, -1, withscores=True)
+        if _fits_listpack([member for member, score in items], ZSET_MAX_LISTPACK_ENTRIES, ZSET_MAX_LISTPACK_VALUE):
+            _write_header(out, TYPE_ZSET_LISTPACK, key)
+            values = []
+            for member, score in items:
+                values.append(member)
+                values.append(format_float(score).encode())
+            out.write(_encode_string(encode_listpack(values)))
+            return
+    _write_header(out, TYPE_ZSET_2, key)
+    out.write(_encode_length(zset.zcard()))
+    # highest first, like Redis, so that loading appends to the skiplist
+    for member, score in zset.iter_range(0, -1, desc=True, withscores=True):
+        out.write(_encode_string(member))
+        out.write(struct.pack('<d', score))
+
+
+def _write_hash(out, key, h):
+    h._expire_all()
+    data, expires = h._data, h._expires
+    if expires:
+        # times to live are saved relative to the earliest one, plus one
+        # since 0 means the field has none
+        min_expire = min(expires.values())
+        _write_header(out, TYPE_HASH_METADATA, key)
+        out.write(struct.pack('<q', min_expire))
+        out.write(_encode_length(len(data)))
+        for field, value in data.items():
+            when = expires.get(field)
+            out.write(_encode_length(0 if when is None else when - min_expire + 1))
+            out.write(_encode_string(field))
+            out.write(_encode_string(value))
+    elif type(data) is ListPack:
+        _write_header(out, TYPE_HASH_LISTPACK, key)
+        out.write(_encode_string(encode_listpack(item for pair in data.items() for item in pair)))
+    else:
+        _write_header(out, TYPE_HASH, key)
+        out.write(_encode_length(len(data)))
+        for field, value in data.items():
+            out.write(_encode_string(field))
+            out.write(_encode_string(value))
+
+
+def _write_set(out, key, s):
+    members = s._set
+    if type(members) is IntSet:
+        _write_header(out, TYPE_SET_INTSET, key)
+        out.write(_encode_string(_encode_intset(members)))
+    elif _fits_listpack(members._members, SET_MAX_LISTPACK_ENTRIES, SET_MAX_LISTPACK_VALUE):
+        _write_header(out, TYPE_SET_LISTPACK, key)
+        out.write(_encode_string(encode_listpack(members._members)))
+    else:
+        _write_header(out, TYPE_SET, key)
+        out.write(_encode_length(len(members)))
+        for member in members._members:
+            out.write(_encode_string(member))
+
+
+def _write_list(out, key, l):
+    values = l._list
+    nodes = -(-len(values) // LIST_LISTPACK_ENTRIES)
+    _write_header(out, TYPE_LIST_QUICKLIST_2, key)
+    out.write(_encode_length(nodes))
+    node = []
+    for value in values:
+        node.append(value)
+        if len(node) == LIST_LISTPACK_ENTRIES:
+            out.write(_encode_length(QUICKLIST_NODE_PACKED))
+            out.write(_encode_string(encode_listpack(node)))
+            node = []
+    if node:
+        out.write(_encode_length(QUICKLIST_NODE_PACKED))
+        out.write(_encode_string(encode_listpack(node)))
+
+
+def _write_string(out, key, value):
+    _write_header(out, TYPE_STRING, key)
+    out.write(_encode_string(value))
+
+
+_WRITERS = {
+    'zset': _write_zset,
+    'hash': _write_hash,
+    'set': _write_set,
+    'list': _write_list,
+    'string': _write_string,
+}
+
+
+def _has_hash_ttl(databases):
+    for db in databases:
+        for value in db._data.values():
+            if isinstance(value, Hash) and value._expires:
+                return True
+    return False
+
+
+def _write_preamble(out, databases, aof_base=0):
+    "Writes the magic string, version and auxiliary fields"
+    version = RDB_VERSION_HASH_TTL if _has_hash_ttl(databases) else RDB_VERSION
+    out.write(b'REDIS%04d' % version)
+    for key, value in (('redis-ver', '7.4.0' if version == RDB_VERSION_HASH_TTL else '7.2.0'),
+                       ('redis-bits', 64), ('ctime', int(time.time())),
+                       ('used-mem', 0), ('aof-base', aof_base)):
+        out.write(bytes((OPCODE_AUX,)))
+        out.write(_encode_string(key))
+        out.write(_encode_string(value))
+
+
+def _write_entry(out, key, value, when=None):
+    "Writes ``key`` holding ``value`` and expiring at ``when`` if given"
+    if when is not None:
+        out.write(bytes((OPCODE_EXPIRETIME_MS,)))
+        out.write(struct.pack('<q', when))
+    _WRITERS[type_name(value)](out, key, value)
+
+
+def _write_end(out, f):
+    "Writes the end of file opcode and the checksum"
+    out.write(bytes((OPCODE_EOF,)))
+    out.flush()
+    f.write(struct.pack('<Q', out.crc))
+
+
+def dump(databases, f, checksum=True):
+    """ Writes ``databases``, a Database or a list of them numbered from 0,
+    to the binary file object ``f`` in the RDB format.
+    """
+    if isinstance(databases, Database):
+        databases = [databases]
+    out = _Writer(f, checksum)
+    _write_preamble(out, databases)
+    for index, db in enumerate(databases):
+        with db.lock:
+            now = db._expires and int(time.time() * 1000)
+            live = [(key, db._expires.get(key)) for key in db._data]
+            live = [(key, when) for key, when in live if when is None or when > now]
+            if not live:
+                continue
+            out.write(bytes((OPCODE_SELECTDB,)))
+            out.write(_encode_length(index))
+            out.write(bytes((OPCODE_RESIZEDB,)))
+            out.write(_encode_length(len(live)))
+            out.write(_encode_length(sum(1 for key, when in live if when is not None)))
+            for key, when in live:
+                _write_entry(out, key, db._data[key], when)
+    _write_end(out, f)
+
+
+def save(databases, path, checksum=True):
+    """ Saves ``databases``, a Database or a list of them, to the RDB file
+    at ``path``.  The snapshot is written to a temporary file first and
+    renamed over ``path`` once complete, so a crash never leaves a
+    truncated snapshot behind.
+    """
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), 'temp-%d.rdb' % os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            dump(databases, f, checksum)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Loading
+
+def _lzf_decompress(data, length):
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # a literal run of ctrl + 1 bytes
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        size = ctrl >> 5
+        if size == 7:
+            size += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1f) << 8) - data[i] - 1
+        i += 1
+        size += 2
+        if ref < 0:
+            raise RedisError("invalid LZF compressed string")
+        if ref + size <= len(out):
+            out += out[ref:ref + size]
+        else:
+            # the back reference overlaps the bytes it produces
+            for j in range(ref, ref + size):
+                out.append(out[j])
+    if len(out) != length:
+        raise RedisError("invalid LZF compressed string")
+    return bytes(out)
+
+
+def _backlen_size(n):
+    if n < 0x80:
+        return 1
+    if n < 0x4000:
+        return 2
+    if n < 0x200000:
+        return 3
+    if n < 0x10000000:
+        return 4
+    return 5
+
+
+_LISTPACK_INT_SIZES = {0xf1: 2, 0xf2: 3, 0xf3: 4, 0xf4: 8}
+
+
+def decode_listpack(data):
+    "Returns the values of the serialized listpack ``data``, ints or bytes"
+    values = []
+    pos = 6
+    while True:
+        b = data[pos]
+        if b < 0x80:
+            value, start, end = b, pos, pos + 1
+        elif b < 0xc0:
+            start, end = pos + 1, pos + 1 + (b & 0x3f)
+            value = bytes(data[start:end])
+        elif b < 0xe0:
+            value = (b & 0x1f) << 8 | data[pos + 1]
+            if value >= 0x1000:
+                value -= 0x2000
+            end = pos + 2
+        elif b < 0xf0:
+            start = pos + 2
+            end = start + ((b & 0x0f) << 8 | data[pos + 1])
+            value = bytes(data[start:end])
+        elif b == 0xf0:
+            start = pos + 5
+            end = start + struct.unpack_from('<I', data, pos + 1)[0]
+            value = bytes(data[start:end])
+        elif b in _LISTPACK_INT_SIZES:
+            end = pos + 1 + _LISTPACK_INT_SIZES[b]
+            value = int.from_bytes(data[pos + 1:end], 'little', signed=True)
+        elif b == 0xff:
+            return values
+        else:
+            raise RedisError("invalid listpack encoding %d" % b)
+        values.append(value)
+        pos = end + _backlen_size(end - pos)
+
+
+def decode_ziplist(data):
+    "Returns the values of the serialized ziplist ``data``, ints or bytes"
+    values = []
+    pos = 10
+    while data[pos] != 0xff:
+        # skip the length of the previous entry
+        pos += 1 if data[pos] < 0xfe else 5
+        b = data[pos]
+        if b < 0xc0:
+            if b < 0x40:
+                size, pos = b, pos + 1
+            elif b < 0x80:
+                size, pos = (b & 0x3f) << 8 | data[pos + 1], pos + 2
+            else:
+                size, pos = struct.unpack_from('>I', data, pos + 1)[0], pos + 5
+            values.append(bytes(data[pos:pos + size]))
+            pos += size
+        elif 0xf1 <= b <= 0xfd:
+            values.append((b & 0x0f) - 1)
+            pos += 1
+        else:
+            size = {0xc0: 2, 0xd0: 4, 0xe0: 8, 0xf0: 3, 0xfe: 1}[b]
+            values.append(int.from_bytes(data[pos + 1:pos + 1 + size], 'little', signed=True))
+            pos += 1 + size
+    return values
+
+
+def _decode_intset(data):
+    width, length = struct.unpack_from('<II', data)
+    values = array({2: 'h', 4: 'i', 8: 'q'}[width])
+    values.frombytes(data[8:8 + width * length])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    result = IntSet()
+    if width == 8:
+        result.frombytes(values.tobytes())
+    else:
+        result.fromlist(values.tolist())
+    return result
+
+
+def _bulk(value):
+    return value if isinstance(value, bytes) else b'%d' % value
+
+
+def _set_member(value):
+    if isinstance(value, bytes):
+        n = parse_int64(value)
+        return value if n is None else n
+    return value
+
+
+def _pairs(values):
+    return zip(values[::2], values[1::2])
+
+
+def _make_hash(pairs, expires=None):
+    h = Hash()
+    pairs = list(pairs)
+    if len(pairs) <= h.max_listpack_entries and not any(
+            h._too_long(field) or h._too_long(value) for field, value in pairs):
+        data = ListPack()
+        for field, value in pairs:
+            data.append(field)
+            data.append(value)
+        h._data = data
+    else:
+        h._data = ScanDict(pairs)
+    h._used = sum(memory.sizeof(field) + memory.sizeof(value) for field, value in pairs)
+    if expires:
+        # scheduled once stored in a database, see ``Hash._bind``
+        h._expires = expires
+    return h
+
+
+def _make_set(members):
+    s = Set()
+    if len(members) <= s.max_intset_entries:
+        if type(members) is not IntSet and all(is_int64(member) for member in members):
+            members = IntSet(members)
+        if type(members) is IntSet:
+            s._set = members
+            return s
+    s._set = DenseSet(members)
+    s._used = sum(map(memory.sizeof, s._set._members))
+    return s
+
+
+def _make_list(values):
+    l = List()
+    l._list = QuickList(values)
+    return l
+
+
+class _Loader(object):
+    """ Reads a snapshot from the binary file ``f``, after the bytes
+    ``start`` already read from it, through a buffer of
+    ``READ_BUFFER_SIZE`` bytes, and checksums the bytes read as the buffer
+    is refilled, unless ``checksum`` is False.
+    """
+
+    def __init__(self, f, checksum=True, start=b''):
+        self._f = f
+        self._buffer = start
+        self._offset = self.pos = len(start)
+        self._checksum = checksum
+        self._crc = 0
+
+    def read(self, n):
+        start = self._offset
+        end = start + n
+        if end > len(self._buffer):
+            self._fill(n)
+            start, end = 0, n
+        self._offset = end
+        self.pos += n
+        return self._buffer[start:end]
+
+    def _fill(self, n):
+        "Refills the buffer with at least ``n`` bytes past the bytes read"
+        buffer, offset = self._buffer, self._offset
+        if self._checksum:
+            self._crc = crc64(self._crc, memoryview(buffer)[:offset])
+        rest = buffer[offset:]
+        self._buffer = rest + self._f.read(max(n - len(rest), READ_BUFFER_SIZE))
+        self._offset = 0
+        if len(self._buffer) < n:
+            raise RedisError("unexpected end of RDB file")
+
+    def crc(self):
+        "Returns the checksum of the bytes read so far"
+        return crc64(self._crc, memoryview(self._buffer)[:self._offset])
+
+    def read_byte(self):
+        return self.read(1)[0]
+
+    def read_length(self):
+        """ Returns a (length, special) tuple, special being True when the
+        length is the encoding of a string stored in a special format.
+        """
+        b = self.read_byte()
+        kind = b >> 6
+        if kind == 0:
+            return b & 0x3f, False
+        if kind == 1:
+            return (b & 0x3f) << 8 | self.read_byte(), False
+        if kind == 3:
+            return b & 0x3f, True
+        if b == 0x80:
+            return struct.unpack('>I', self.read(4))[0], False
+        if b == 0x81:
+            return struct.unpack('>Q', self.read(8))[0], False
+        raise RedisError("invalid RDB length encoding %d" % b)
+
+    def read_len(self):
+        length, special = self.read_length()
+        if special:
+            raise RedisError("invalid RDB length encoding")
+        return length
+
+    def read_string(self):
+        length, special = self.read_length()
+        if not special:
+            return bytes(self.read(length))
+        if length == 0:
+            return b'%d' % struct.unpack('<b', self.read(1))[0]
+        if length == 1:
+            return b'%d' % struct.unpack('<h', self.read(2))[0]
+        if length == 2:
+            return b'%d' % struct.unpack('<i', self.read(4))[0]
+        if length == 3:
+            compressed, size = self.read_len(), self.read_len()
+            return _lzf_decompress(self.read(compressed), size)
+        raise RedisError("invalid RDB string encoding %d" % length)
+
+    def read_double(self):
+        "Reads a score of the old ZSET type, stored as a string"
+        length = self.read_byte()
+        if length == 253:
+            return float('nan')
+        if length == 254:
+            return float('inf')
+        if length == 255:
+            return float('-inf')
+        return float(self.read(length))
+
+    def read_value(self, value_type):
+        if value_type == TYPE_STRING:
+            return self.read_string()
+        if value_type == TYPE_LIST:
+            return _make_list([self.read_string() for i in range(self.read_len())])
+        if value_type == TYPE_SET:
+            return _make_set([_set_member(self.read_string()) for i in range(self.read_len())])
+        if value_type in (TYPE_ZSET, TYPE_ZSET_2):
+            pairs = []
+            for i in range(self.read_len()):
+                member = self.read_string()
+                if value_type == TYPE_ZSET:
+                    pairs.append((member, self.read_double()))
+                else:
+                    pairs.append((member, struct.unpack('<d', self.read(8))[0]))
+            return ZSet.from_pairs(pairs)
+        if value_type == TYPE_HASH:
+            return _make_hash([(self.read_string(), self.read_string()) for i in range(self.read_len())])
+        if value_type == TYPE_HASH_METADATA:
+            return self.read_hash_metadata()
+        if value_type == TYPE_HASH_LISTPACK_EX:
+            return self.read_hash_listpack_ex()
+        if value_type in (TYPE_LIST_QUICKLIST, TYPE_LIST_QUICKLIST_2):
+            values = []
+            for i in range(self.read_len()):
+                if value_type == TYPE_LIST_QUICKLIST:
+                    values.extend(map(_bulk, decode_ziplist(self.read_string())))
+                elif self.read_len() == QUICKLIST_NODE_PLAIN:
+                    values.append(self.read_string())
+                else:
+                    values.extend(map(_bulk, decode_listpack(self.read_string())))
+            return _make_list(values)
+        # the remaining types are a single blob
+        blob = self.read_string()
+        if value_type == TYPE_SET_INTSET:
+            return _make_set(_decode_intset(blob))
+        if value_type == TYPE_LIST_ZIPLIST:
+            return _make_list([_bulk(value) for value in decode_ziplist(blob)])
+        if value_type == TYPE_SET_LISTPACK:
+            return _make_set(decode_listpack(blob))
+        if value_type in (TYPE_ZSET_ZIPLIST, TYPE_ZSET_LISTPACK):
+            values = decode_ziplist(blob) if value_type == TYPE_ZSET_ZIPLIST else decode_listpack(blob)
+            return ZSet.from_pairs((_bulk(member), float(score)) for member, score in _pairs(values))
+        if value_type in (TYPE_HASH_ZIPLIST, TYPE_HASH_LISTPACK):
+            values = decode_ziplist(blob) if value_type == TYPE_HASH_ZIPLIST else decode_listpack(blob)
+            return _make_hash((_bulk(field), _bulk(value)) for field, value in _pairs(values))
+        raise RedisError("unsupported RDB value type %d" % value_type)
+
+    def read_hash_metadata(self):
+        "Reads a hash with field expiry, the fields expired already dropped"
+        min_expire = struct.unpack('<q', self.read(8))[0]
+        now = int(time.time() * 1000)
+        pairs, expires = [], {}
+        for i in range(self.read_len()):
+            ttl = self.read_len()
+            field, value = self.read_string(), self.read_string()
+            if ttl:
+                when = min_expire + ttl - 1
+                if when <= now:
+                    continue
+                expires[field] = when
+            pairs.append((field, value))
+        return _make_hash(pairs, expires)
+
+    def read_hash_listpack_ex(self):
+        "Reads a small hash with field expiry stored as a listpack of triplets"
+        self.read(8)
+        values = decode_listpack(self.read_string())
+        now = int(time.time() * 1000)
+        pairs, expires = [], {}
+        for i in range(0, len(values), 3):
+            field, value, when = _bulk(values[i]), _bulk(values[i + 1]), values[i + 2]
+            if when:
+                if when <= now:
+                    continue
+                expires[field] = when
+            pairs.append((field, value))
+        return _make_hash(pairs, expires)
+
+
+def loads(data, databases=None, verify=True):
+    """ Loads the RDB snapshot in the bytes-like ``data`` into
+    ``databases``, a list of Database numbered from 0, which is created
+    and grown as needed, and returns it.  The checksum is verified unless
+    ``verify`` is False or the snapshot was saved without one.
+    """
+    return _load(io.BytesIO(data), databases, verify)[0]
+
+
+def _load(f, databases=None, verify=True):
+    """ Loads the RDB snapshot read from the binary file ``f`` like
+    ``loads`` does, and returns a (databases, length) tuple, ``f`` being
+    read past the snapshot, of ``length`` bytes.
+    """
+    if databases is None:
+        databases = []
+    header = f.read(9)
+    if header[:5] != b'REDIS' or not header[5:].isdigit():
+        raise RedisError("not an RDB file")
+    version = int(header[5:])
+    if version > RDB_VERSION_HASH_TTL:
+        raise RedisError("can't handle RDB format version %d" % version)
+    loader = _Loader(f, verify, header)
+    db = None
+    when = None
+    now = int(time.time() * 1000)
+    while True:
+        opcode = loader.read_byte()
+        if opcode == OPCODE_EOF:
+            break
+        if opcode == OPCODE_SELECTDB:
+            index = loader.read_len()
+            while len(databases) <= index:
+                databases.append(Database())
+            db = databases[index]
+        elif opcode == OPCODE_RESIZEDB:
+            loader.read_len()
+            loader.read_len()
+        elif opcode == OPCODE_EXPIRETIME_MS:
+            when = struct.unpack('<q', loader.read(8))[0]
+        elif opcode == OPCODE_EXPIRETIME:
+            when = struct.unpack('<i', loader.read(4))[0] * 1000
+        elif opcode == OPCODE_AUX:
+            loader.read_string()
+            loader.read_string()
+        elif opcode == OPCODE_IDLE:
+            loader.read_len()
+        elif opcode == OPCODE_FREQ:
+            loader.read_byte()
+        elif opcode == OPCODE_SLOT_INFO:
+            for i in range(3):
+                loader.read_len()
+        elif opcode == OPCODE_FUNCTION2:
+            loader.read_string()
+        elif opcode == OPCODE_MODULE_AUX:
+            raise RedisError("RDB files with module data are not supported")
+        else:
+            key = loader.read_string()
+            value = loader.read_value(opcode)
+            if db is None:
+                if not databases:
+                    databases.append(Database())
+                db = databases[0]
+            if when is None or when > now:
+                db.store(key, value, when)
+            when = None
+    if version >= 5:
+        crc = loader.crc() if verify else 0
+        expected = struct.unpack('<Q', loader.read(8))[0]
+        if verify and expected and crc != expected:
+            raise RedisError("wrong RDB checksum")
+    return databases, loader.pos
+
+
+def load(path, databases=None, verify=True):
+    """ Loads the RDB file at ``path`` like ``loads`` does, streaming it
+    rather than reading it whole.
+    """
+    with open(path, 'rb') as f:
+        return _load(f, databases, verify)[0]
@@ -0,0 +1,201 @@
+""" The Redis serialization protocol (RESP2 and RESP3).
+
+``Parser`` incrementally splits the bytes received from a client into
+commands.  It scans for line ends in place and copies each argument out of
+the read buffer exactly once, through a memoryview.  ``encode`` appends a
+reply to an output buffer, so that the replies to every command of a
+pipeline can be written in a single call.
+"""
+import math
+
+from .exceptions import RedisError
+
+
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+MAX_MULTIBULK_LENGTH = 1024 * 1024
+MAX_INLINE_LENGTH = 64 * 1024
+
+# Prefixes of error messages that already carry a Redis error code
+ERROR_CODES = frozenset((
+    'WRONGTYPE', 'NOPROTO', 'EXECABORT', 'NOAUTH', 'OOM', 'BUSYKEY', 'NOTBUSY',
+))
+
+
+class ProtocolError(RedisError):
+    pass
+
+
+class Status(str):
+    "A reply sent as a simple string, such as OK"
+
+
+OK = Status('OK')
+QUEUED = Status('QUEUED')
+
+
+class _NullArray(object):
+    "A null sent as a null array in RESP2, for example on a BLPOP timeout"
+
+
+NULL_ARRAY = _NullArray()
+
+
+def format_float(value):
+    "Formats the float ``value`` the way Redis replies with scores"
+    if math.isinf(value):
+        return 'inf' if value > 0 else '-inf'
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return '%d' % value
+    return repr(value)
+
+
+class Parser(object):
+    """ Splits a stream of RESP requests into commands, each a list of bytes
+    arguments.  Both multibulk requests and inline commands (as typed in
+    telnet) are accepted.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # the ProtocolError that stopped parsing, after which the
+        # connection must be closed
+        self.error = None
+
+    def feed(self, data):
+        self._buffer += data
+
+    def parse(self):
+        """ Returns every complete command in the buffer, keeping any
+        partial command for the next call.  Invalid input sets ``error``
+        and ends the commands returned.
+        """
+        buffer = self._buffer
+        commands = []
+        pos = 0
+        end = len(buffer)
+        with memoryview(buffer) as view:
+            while pos < end and self.error is None:
+                try:
+                    if buffer[pos] == 42:  # '*'
+                        result = self._parse_multibulk(buffer, view, pos)
+                    else:
+                        result = self._parse_inline(buffer, pos)
+                except ProtocolError as e:
+                    self.error = e
+                    break
+                if result is None:
+                    break
+                command, pos = result
+                if command:
+                    commands.append(command)
+        if pos:
+            del buffer[:pos]
+        return commands
+
+    def _parse_length(self, buffer, start, end, limit, kind):
+        try:
+            length = int(buffer[start:end])
+        except ValueError:
+            length = None
+        if length is None or length > limit or length < 0 and kind == 'bulk':
+            raise ProtocolError("Protocol error: invalid %s length" % kind)
+        return length
+
+    def _parse_multibulk(self, buffer, view, pos):
+        eol = buffer.find(b'\r\n', pos)
+        if eol < 0:
+            if len(buffer) - pos > MAX_INLINE_LENGTH:
+                raise ProtocolError("Protocol error: too big mbulk count string")
+            return None
+        count = self._parse_length(buffer, pos + 1, eol, MAX_MULTIBULK_LENGTH, 'multibulk')
+        pos = eol + 2
+        args = []
+        for i in range(count):
+            if pos >= len(buffer):
+                return None
+            if buffer[pos] != 36:  # '$'
+                raise ProtocolError("Protocol error: expected '$', got '%s'" % chr(buffer[pos]))
+            eol = buffer.find(b'\r\n', pos)
+            if eol < 0:
+                if len(buffer) - pos > MAX_INLINE_LENGTH:
+                    raise ProtocolError("Protocol error: too big bulk count string")
+                return None
+            length = self._parse_length(buffer, pos + 1, eol, MAX_BULK_LENGTH, 'bulk')
+            start = eol + 2
+            stop = start + length
+            if stop + 2 > len(buffer):
+                return None
+            args.append(bytes(view[start:stop]))
+            pos = stop + 2
+        return args, pos
+
+    def _parse_inline(self, buffer, pos):
+        eol = buffer.find(b'\n', pos)
+        if eol < 0:
+            if len(buffer) - pos > MAX_INLINE_LENGTH:
+                raise ProtocolError("Protocol error: too big inline request")
+            return None
+        return [bytes(arg) for arg in buffer[pos:eol].split()], eol + 1
+
+
+def _encode_bulk(out, value):
+    out += b'$%d\r\n' % len(value)
+    out += value
+    out += b'\r\n'
+
+
+def encode(out, value, protocol=2):
+    """ Appends the RESP encoding of ``value`` to the bytearray ``out``.
+
+    Python types map to reply types as follows: ``Status`` to a simple
+    string, RedisError to an error, None to a null, bool and int to an
+    integer (a boolean in RESP3), float to a bulk string (a double in
+    RESP3), bytes and str to a bulk string, lists and tuples to an array,
+    dicts to a map and sets to a set, the last two being flattened to
+    arrays in RESP2.
+    """
+    if isinstance(value, Status):
+        out += b'+%s\r\n' % value.encode()
+    elif isinstance(value, bytes):
+        _encode_bulk(out, value)
+    elif isinstance(value, str):
+        _encode_bulk(out, value.encode())
+    elif value is None:
+        out += b'_\r\n' if protocol == 3 else b'$-1\r\n'
+    elif value is NULL_ARRAY:
+        out += b'_\r\n' if protocol == 3 else b'*-1\r\n'
+    elif isinstance(value, bool):
+        if protocol == 3:
+            out += b'#t\r\n' if value else b'#f\r\n'
+        else:
+            out += b':1\r\n' if value else b':0\r\n'
+    elif isinstance(value, int):
+        out += b':%d\r\n' % value
+    elif isinstance(value, float):
+        if protocol == 3:
+            out += b',%s\r\n' % format_float(value).encode()
+        else:
+            _encode_bulk(out, format_float(value).encode())
+    elif isinstance(value, (list, tuple)):
+        out += b'*%d\r\n' % len(value)
+        for item in value:
+            encode(out, item, protocol)
+    elif isinstance(value, dict):
+        if protocol == 3:
+            out += b'%%%d\r\n' % len(value)
+        else:
+            out += b'*%d\r\n' % (2 * len(value))
+        for key, item in value.items():
+            encode(out, key, protocol)
+            encode(out, item, protocol)
+    elif isinstance(value, (set, frozenset)):
+        out += b'~%d\r\n' % len(value) if protocol == 3 else b'*%d\r\n' % len(value)
+        for item in value:
+            encode(out, item, protocol)
+    elif isinstance(value, RedisError):
+        message = str(value)
+        if message.split(' ', 1)[0] not in ERROR_CODES:
+            message = 'ERR ' + message
+        out += b'-%s\r\n' % message.replace('\r', ' ').replace('\n', ' ').encode()
+    else:
+        raise TypeError("cannot encode %r" % (value,))
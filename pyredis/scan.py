@@ -0,0 +1,184 @@
+""" Cursor based scanning shared by the datastructures.
+
+Collections are scanned from the end of a dense sequence of their members
+towards its start, and the cursor is the position the next call continues
+below.  Members are only ever appended to these sequences, and removals
+either move the last member into the freed slot (``DenseSet``) or leave
+stale entries, skipped when scanning and later compacted without
+reordering (``ScanDict``).
+Members below the cursor therefore stay below it, so a member present for
+the whole scan is always returned, while members added or moved during the
+scan may be returned twice or not at all, as in Redis.
+
+Compact encodings are returned in full with a cursor of 0.
+"""
+import functools
+import re
+
+from .exceptions import RedisError
+
+
+# Stale entries tolerated in a ScanDict's key log before it is compacted
+SCAN_LOG_SLACK = 64
+
+
+class ScanDict(dict):
+    """ A dict that also logs its keys in insertion order, so that it can be
+    scanned with a stable cursor.
+
+    Deleting a key leaves a stale entry in the log, and so does adding it
+    again, the position of its latest entry being kept along.  Stale
+    entries cost nothing until the log holds more than twice as many
+    entries as the dict, at which point it is compacted in order, so that
+    the log never takes more than twice the room of the keys plus
+    ``SCAN_LOG_SLACK`` entries.
+    """
+    __slots__ = ('_keys', '_positions')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._keys = list(dict.keys(self))
+        # the position of the latest entry of each key in the log
+        self._positions = dict((key, i) for i, key in enumerate(self._keys))
+
+    def __setitem__(self, key, value):
+        added = key not in self
+        dict.__setitem__(self, key, value)
+        if added:
+            self._log(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._forget(key)
+
+    def _log(self, key):
+        # adding a key never takes the log past its limit, being checked
+        # after each removal
+        keys = self._keys
+        self._positions[key] = len(keys)
+        keys.append(key)
+
+    def _forget(self, key):
+        del self._positions[key]
+        if len(self._keys) > 2 * len(self) + SCAN_LOG_SLACK:
+            self._compact()
+
+    def _compact(self):
+        # drop stale entries, keeping the order so that positions only ever
+        # move towards the start
+        keys = self._keys = [k for i, k in enumerate(self._keys) if self.current(i, k)]
+        self._positions = dict((k, i) for i, k in enumerate(keys))
+
+    def current(self, position, key):
+        "Tells whether ``key``, found at ``position`` of the log, is present and logged there last"
+        return self._positions.get(key) == position
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.pop(self, key)
+        self._forget(key)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._forget(key)
+        return key, value
+
+    def clear(self):
+        dict.clear(self)
+        self._keys = []
+        self._positions = {}
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def copy(self):
+        return ScanDict(self)
+
+    def scan(self, cursor, count):
+        """ Returns a (cursor, keys) tuple with the next keys, up to
+        ``count`` of them, below ``cursor``.
+        """
+        cursor, keys = scan_sequence(self._keys, cursor, count)
+        return cursor, [key for i, key in enumerate(keys, cursor) if self.current(i, key)]
+
+
+def scan_sequence(sequence, cursor, count):
+    """ Returns a (cursor, values) tuple with up to ``count`` values of
+    ``sequence`` below position ``cursor``, where 0 starts a new scan.  The
+    returned cursor is 0 once the scan is complete.
+    """
+    if count < 1:
+        raise RedisError("syntax error")
+    hi = len(sequence) if cursor == 0 else min(cursor, len(sequence))
+    lo = max(0, hi - count)
+    return lo, sequence[lo:hi]
+
+
+def _glob_to_regex(pattern):
+    "Translates a Redis glob-style ``pattern`` to a regular expression"
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        elif c == '\\' and i < n:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            negate = pattern[i:i + 1] == '^'
+            if negate:
+                i += 1
+            body = []
+            while i < n and pattern[i] != ']':
+                if pattern[i] == '\\' and i + 1 < n:
+                    i += 1
+                    body.append(re.escape(pattern[i]))
+                elif pattern[i] == '-' and body and pattern[i + 1:i + 2] not in ('', ']'):
+                    body.append('-')
+                else:
+                    body.append(re.escape(pattern[i]))
+                i += 1
+            # like Redis, an unterminated class ends with the pattern
+            i += 1
+            if body:
+                parts.append('[%s%s]' % ('^' if negate else '', ''.join(body)))
+            else:
+                parts.append('.' if negate else '(?!)')
+        else:
+            parts.append(re.escape(c))
+    return '(?s:%s)\\Z' % ''.join(parts)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_match(pattern):
+    """ Returns a predicate telling whether a member matches the glob-style
+    ``pattern``, compiling it once per distinct pattern.  Members that are
+    not strings are matched on their string representation.
+    """
+    if isinstance(pattern, bytes):
+        match = re.compile(_glob_to_regex(pattern.decode('latin-1')).encode('latin-1')).match
+        return lambda member: match(member if isinstance(member, bytes) else str(member).encode()) is not None
+    match = re.compile(_glob_to_regex(pattern)).match
+    return lambda member: match(member if isinstance(member, str) else str(member)) is not None
+
+
+def filter_match(members, match, key=None):
+    "Returns the items of ``members`` matching the glob ``match``, if given"
+    if match is None:
+        return list(members)
+    matches = compile_match(match)
+    if key is None:
+        return [member for member in members if matches(member)]
+    return [member for member in members if matches(key(member))]
@@ -0,0 +1,357 @@
+""" An asyncio server speaking RESP2 and RESP3 over TCP and Unix sockets.
+
+Every command received in a read is executed before the replies are
+written back, all at once, so a pipeline of commands costs one write and
+one drain.  Blocking commands flush the replies of the commands before
+them and then suspend only their own client.
+
+With an append-only file, write commands are propagated to it after they
+run, along with the pops they served to blocked clients, see
+``pyredis.aof``.
+
+With ``maxmemory`` set, keys of every database are evicted before a write
+command runs while they use more, and commands that would use more memory
+fail if nothing can be evicted, see ``pyredis.memory``.  Evicted keys are
+propagated as DEL.
+
+With ``--instrument`` the datastructure methods are timed, see
+``pyredis.instrument``, and their statistics reported by INFO and SLOWLOG.
+
+Run it with ``python -m pyredis.server``.
+"""
+import argparse
+import asyncio
+import inspect
+import itertools
+import os
+import time
+
+from . import aof, expiry, instrument, mapped, memory, rdb
+from .commands import COMMANDS
+from .database import Database
+from .exceptions import RedisError
+from .resp import QUEUED, Parser, encode
+
+
+READ_SIZE = 64 * 1024
+
+DB_FORMATS = ('rdb', 'mapped')
+
+
+class Client(object):
+    """ The state of a connection: its database, protocol version and name,
+    and the commands queued by MULTI and keys watched by WATCH.
+    """
+
+    def __init__(self, server, id, writer):
+        self.server = server
+        self.id = id
+        self.writer = writer
+        self.db = server.databases[0]
+        self.protocol = 2
+        self.name = None
+        self.closing = False
+        self.multi = None
+        self.multi_error = False
+        self.watched = []
+        self.deny_blocking = False
+        # the commands to propagate instead of the one running, if set
+        self.rewritten = None
+        # the task serving the connection
+        self.task = None
+
+    def unwatch(self):
+        for db, key, version in self.watched:
+            db.unwatch(key)
+        self.watched = []
+
+
+class Server(object):
+
+    version = '7.2.0'
+
+    def __init__(self, databases=16, hz=10, dbfilename=None, dbformat='rdb', appendfilename=None,
+                 appendfsync='everysec', maxmemory=0, maxmemory_policy='noeviction',
+                 maxmemory_samples=memory.MAXMEMORY_SAMPLES):
+        if maxmemory_policy not in memory.POLICIES:
+            raise RedisError("maxmemory-policy must be one of %s" % ', '.join(memory.POLICIES))
+        self.databases = [Database() for i in range(databases)]
+        self._indexes = dict((id(db), i) for i, db in enumerate(self.databases))
+        self.hz = hz
+        # the snapshot loaded on start and written by SAVE, if any, in the
+        # RDB format or mapped into memory, see ``pyredis.mapped``
+        if dbformat not in DB_FORMATS:
+            raise RedisError("dbformat must be one of %s" % ', '.join(DB_FORMATS))
+        self.dbfilename = dbfilename
+        self.dbformat = dbformat
+        # the append-only file, if enabled, loaded on start in preference
+        # to the RDB file
+        self.appendfilename = appendfilename
+        self.appendfsync = appendfsync
+        self.aof = None
+        # the memory limit of all the databases together, which track
+        # accesses for the policy but leave evicting to the server
+        self.maxmemory = maxmemory
+        self.maxmemory_policy = maxmemory_policy
+        self.maxmemory_samples = maxmemory_samples
+        for db in self.databases:
+            db.maxmemory_policy = maxmemory_policy
+        self._pool = memory.EvictionPool()
+        self.evicted_keys = 0
+        self.clients = set()
+        self.started = time.time()
+        self._ids = itertools.count(1)
+        self._servers = []
+        self._cron = None
+        self._rewrite = None
+        # the commands propagated while a command runs, which follow it
+        self._propagated = None
+
+    def call(self, client, args):
+        """ Executes the command ``args`` for ``client``, or queues it inside
+        MULTI, and returns its reply, a RedisError, or an awaitable for
+        blocking commands.
+        """
+        name = args[0].lower().decode('latin-1')
+        command = COMMANDS.get(name)
+        if command is None:
+            error = RedisError("unknown command '%s', with args beginning with: %s" % (
+                args[0].decode('latin-1'), ' '.join("'%s'" % arg.decode('latin-1') for arg in args[1:])))
+        elif not command.check_arity(len(args)):
+            error = RedisError("wrong number of arguments for '%s' command" % name)
+        else:
+            error = None
+        if client.multi is not None and (command is None or 'transaction' not in command.flags):
+            if error is not None:
+                client.multi_error = True
+                return error
+            client.multi.append((command, args))
+            return QUEUED
+        if error is not None:
+            return error
+        return self.execute(client, command, args)
+
+    def execute(self, client, command, args):
+        """ Runs ``command``, marks the keys it writes as modified for the
+        clients watching them and propagates it.
+        """
+        if command.write and self.maxmemory and not self.evict() and 'denyoom' in command.flags:
+            return RedisError(memory.OOM)
+        if command.write and self.aof is not None:
+            self.before_write(client.db, command.keys_of(args) if command.keys[0] else None)
+        client.rewritten = None
+        outer, self._propagated = self._propagated, []
+        try:
+            reply = command.func(client, args[1:])
+        except RedisError as e:
+            reply = e
+        propagated, self._propagated = self._propagated, outer
+        if command.write and not isinstance(reply, RedisError):
+            client.db.touch(*command.keys_of(args))
+            for argv in (client.rewritten if client.rewritten is not None else [args]):
+                self.propagate(client.db, argv)
+        for db, argv in propagated:
+            self.propagate(db, argv)
+        return reply
+
+    @property
+    def used_memory(self):
+        return sum(db.used_memory for db in self.databases)
+
+    def evict(self):
+        """ Evicts keys while the databases use more than ``maxmemory`` and
+        returns True if they no longer do.
+        """
+        for db, key in memory.evict(self.databases, self.maxmemory, self.maxmemory_policy,
+                                    self.maxmemory_samples, self._pool):
+            self.evicted_keys += 1
+            self.propagate(db, [b'del', key])
+        return self.used_memory <= self.maxmemory
+
+    def before_write(self, db, keys):
+        """ Must be called before writing ``keys`` of ``db``, or every key
+        for None, with the append-only file enabled.
+        """
+        if self.aof is not None:
+            self.aof.before_write(self._indexes[id(db)], db, keys)
+
+    def propagate(self, db, args):
+        """ Appends the write command ``args`` run against ``db`` to the
+        append-only file, after the command running if any.
+        """
+        if self.aof is None:
+            return
+        if self._propagated is not None:
+            self._propagated.append((db, args))
+        else:
+            self.aof.feed(None if db is None else self._indexes[id(db)], args)
+
+    async def _write(self, writer, out):
+        "Writes ``out``, once the commands it replies to are on disk with appendfsync always"
+        if self.aof is not None and self.aof.fsync == 'always':
+            await self.aof.sync()
+        writer.write(out)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        "Serves one connection until the client quits or disconnects"
+        client = Client(self, next(self._ids), writer)
+        client.task = asyncio.current_task()
+        self.clients.add(client)
+        parser = Parser()
+        out = bytearray()
+        try:
+            while not client.closing:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+                for args in parser.parse():
+                    reply = self.call(client, args)
+                    if inspect.isawaitable(reply):
+                        if out:
+                            await self._write(writer, out)
+                            out = bytearray()
+                        try:
+                            reply = await reply
+                        except RedisError as e:
+                            reply = e
+                    encode(out, reply, client.protocol)
+                    if client.closing:
+                        break
+                if parser.error is not None and not client.closing:
+                    encode(out, parser.error)
+                    client.closing = True
+                if out:
+                    await self._write(writer, out)
+                    out = bytearray()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            client.unwatch()
+            self.clients.discard(client)
+            writer.close()
+
+    async def cron(self):
+        """ Actively expires keys and hash fields ``hz`` times a second and
+        starts rewriting the append-only file once it has grown enough.
+        """
+        while True:
+            await asyncio.sleep(1.0 / self.hz)
+            for db in self.databases:
+                db.active_expire_cycle()
+            expiry.wheel.tick()
+            if self.aof is not None and not self.aof_rewrite_in_progress and self.aof.should_rewrite():
+                self.rewrite_aof()
+
+    def load(self):
+        "Loads ``appendfilename`` if it exists, otherwise ``dbfilename``"
+        if self.appendfilename is not None and os.path.exists(self.appendfilename):
+            aof.load(self.appendfilename, self.databases)
+        elif self.dbfilename is not None and os.path.exists(self.dbfilename):
+            if mapped.is_snapshot(self.dbfilename):
+                mapped.load(self.dbfilename, self.databases)
+            else:
+                rdb.load(self.dbfilename, self.databases)
+
+    @property
+    def aof_rewrite_in_progress(self):
+        return self._rewrite is not None and not self._rewrite.done()
+
+    def rewrite_aof(self):
+        "Starts rewriting the append-only file in the background"
+        if self.aof is None:
+            raise RedisError("the append only file is not enabled")
+        if self.aof_rewrite_in_progress:
+            raise RedisError("Background append only file rewriting already in progress")
+        self._rewrite = asyncio.ensure_future(self.aof.rewrite(self.databases))
+
+    def save(self):
+        "Saves every database to ``dbfilename`` in ``dbformat``"
+        if self.dbfilename is None:
+            raise RedisError("no dbfilename is configured")
+        if self.dbformat == 'mapped':
+            mapped.save(self.databases, self.dbfilename)
+        else:
+            rdb.save(self.databases, self.dbfilename)
+
+    async def start(self, host='127.0.0.1', port=6379, unixsocket=None):
+        """ Loads the databases from ``dbfilename`` and starts listening on
+        ``host`` and ``port``, unless ``port`` is None, and on the Unix
+        socket at the path ``unixsocket`` if given.
+        """
+        self.load()
+        if self.appendfilename is not None:
+            self.aof = aof.AppendOnlyFile(self.appendfilename, self.appendfsync)
+            if not self.aof.size:
+                # start the log from what dbfilename held
+                await self.aof.rewrite(self.databases)
+        if port is not None:
+            self._servers.append(await asyncio.start_server(self.handle, host, port))
+        if unixsocket is not None:
+            self._servers.append(await asyncio.start_unix_server(self.handle, unixsocket))
+        self._cron = asyncio.ensure_future(self.cron())
+
+    @property
+    def sockets(self):
+        return [sock for server in self._servers for sock in server.sockets]
+
+    async def serve_forever(self, host='127.0.0.1', port=6379, unixsocket=None):
+        await self.start(host, port, unixsocket)
+        await asyncio.gather(*(server.serve_forever() for server in self._servers))
+
+    async def close(self):
+        """ Stops listening, cancels the tasks serving the connections and
+        the background ones, and waits for them to finish.
+        """
+        tasks = [self._cron, self._rewrite] + [client.task for client in self.clients]
+        tasks = [task for task in tasks if task is not None and task is not asyncio.current_task()]
+        for server in self._servers:
+            server.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        if self.aof is not None:
+            self.aof.close()
+            self.aof = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve pyredis over the Redis protocol")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--unixsocket', default=None)
+    parser.add_argument('--databases', type=int, default=16)
+    parser.add_argument('--hz', type=int, default=10)
+    parser.add_argument('--dbfilename', default='dump.rdb')
+    parser.add_argument('--dbformat', choices=DB_FORMATS, default='rdb')
+    parser.add_argument('--appendonly', action='store_true')
+    parser.add_argument('--appendfilename', default='appendonly.aof')
+    parser.add_argument('--appendfsync', choices=aof.FSYNC_POLICIES, default='everysec')
+    parser.add_argument('--maxmemory', type=int, default=0)
+    parser.add_argument('--maxmemory-policy', choices=memory.POLICIES, default='noeviction')
+    parser.add_argument('--maxmemory-samples', type=int, default=memory.MAXMEMORY_SAMPLES)
+    parser.add_argument('--instrument', action='store_true')
+    parser.add_argument('--slowlog-log-slower-than', type=int, default=instrument.SlowLog.slower_than)
+    parser.add_argument('--slowlog-max-len', type=int, default=instrument.SlowLog.max_len)
+    args = parser.parse_args(argv)
+    instrument.SlowLog.slower_than = args.slowlog_log_slower_than
+    instrument.SlowLog.max_len = args.slowlog_max_len
+    if args.instrument:
+        instrument.enable()
+    server = Server(databases=args.databases, hz=args.hz, dbfilename=args.dbfilename,
+                    dbformat=args.dbformat,
+                    appendfilename=args.appendfilename if args.appendonly else None,
+                    appendfsync=args.appendfsync, maxmemory=args.maxmemory,
+                    maxmemory_policy=args.maxmemory_policy, maxmemory_samples=args.maxmemory_samples)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.unixsocket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
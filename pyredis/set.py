@@ -1,28 +1,175 @@
 import random
 
+from . import memory
+from .denseset import DenseSet
+from .exceptions import RedisError
+from .intset import IntSet, is_int64
+from .scan import filter_match, scan_sequence
+
+
+SET_MAX_INTSET_ENTRIES = 512
+
+
+def _iter_inter(sets):
+    """ Yields the members of the intersection of ``sets`` without building
+    any intermediate set.
+    """
+    if not sets:
+        return
+    # Walk the smallest input and probe the others, smallest first, so
+    # members that are missing somewhere are rejected as early as possible.
+    sets = sorted((s._set for s in sets), key=len)
+    smallest, others = sets[0], sets[1:]
+    for member in smallest:
+        for other in others:
+            if member not in other:
+                break
+        else:
+            yield member
+
+
+def _iter_diff(sets):
+    "Yields the members of the first of ``sets`` that are in none of the others"
+    if not sets:
+        return
+    first, others = sets[0]._set, [s._set for s in sets[1:]]
+    for member in first:
+        for other in others:
+            if member in other:
+                break
+        else:
+            yield member
+
+
+def _union(sets):
+    "Returns a Python set of the members of all of ``sets``"
+    return set().union(*(s._set for s in sets))
+
 
 class Set(object):
+    """ Sets of integers are stored in a compact sorted ``IntSet`` and
+    converted to a ``DenseSet`` once a member is not an int or they hold
+    more than ``max_intset_entries`` members, like Redis'
+    ``set-max-intset-entries``.  Both keep their members in an array, so
+    random members are picked in O(1).
+    """
+    __slots__ = ('_set', '_used')
+
+    max_intset_entries = SET_MAX_INTSET_ENTRIES
 
     def __init__(self, *values):
-        self._set = set()
-        self.sadd(*values)
+        self._set = IntSet()
+        # the bytes taken by the members of a DenseSet, see ``memory_usage``
+        self._used = 0
+        if values:
+            self.sadd(*values)
 
     def __and__(self, rhs):
+        if type(rhs._set) is IntSet:
+            return rhs._set & self._set
         return self._set & rhs._set
 
     def __or__(self, rhs):
+        if type(rhs._set) is IntSet:
+            return rhs._set | self._set
         return self._set | rhs._set
 
+    def _replace(self, members):
+        """ Replaces the contents of the set with ``members``, choosing the
+        encoding again, and returns the resulting cardinality.
+        """
+        members = list(members)
+        self._set = IntSet()
+        self._used = 0
+        self.sadd(*members)
+        return len(self._set)
+
+    def _sequence(self):
+        "Returns the members as a sequence that can be indexed in O(1)"
+        if type(self._set) is IntSet:
+            return self._set
+        return self._set._members
+
+    def _to_dense(self):
+        self._set = DenseSet(self._set)
+        self._used = sum(map(memory.sizeof, self._set._members))
+
+    def _pop(self):
+        value = self._set.pop()
+        if type(self._set) is not IntSet:
+            self._used -= memory.sizeof(value)
+        return value
+
+    def memory_usage(self):
+        """ Returns an estimate of the bytes used by the set, kept up to
+        date as members are added and removed rather than computed by
+        walking it.
+        """
+        if type(self._set) is IntSet:
+            return memory.STRUCTURE + len(self._set) * memory.INTSET_ENTRY
+        return memory.STRUCTURE + len(self._set) * memory.DENSESET_ENTRY + self._used
+
     def sadd(self, *values):
         "Add ``value(s)`` to set"
-        new = set(values) - self._set
-        self._set.update(new)
-        return len(new)
+        if type(self._set) is IntSet:
+            if all(is_int64(value) for value in values):
+                added = self._set.update(values)
+                if len(self._set) > self.max_intset_entries:
+                    self._to_dense()
+                return added
+            self._to_dense()
+        added = 0
+        for value in values:
+            if self._set.add(value):
+                added += 1
+                self._used += memory.sizeof(value)
+        return added
 
     def scard(self):
         "Return the number of elements in set"
         return len(self._set)
 
+    def sdiff(self, *others):
+        "Return the members of this set that are in none of ``others``"
+        return list(_iter_diff((self,) + others))
+
+    def sdiffstore(self, *sets):
+        """
+        Replace the contents of this set with the members of the first of
+        ``sets`` that are in none of the others.
+
+        Returns the number of members in the resulting set.
+        """
+        return self._replace(_iter_diff(sets))
+
+    def sinter(self, *others):
+        "Return the members that this set and all of ``others`` have in common"
+        return list(_iter_inter((self,) + others))
+
+    def sintercard(self, *others, limit=0):
+        """
+        Return the number of members in the intersection of this set and
+        ``others`` without building it.
+
+        If ``limit`` is positive, counting stops once it is reached.
+        """
+        if limit < 0:
+            raise RedisError("LIMIT can't be negative")
+        count = 0
+        for member in _iter_inter((self,) + others):
+            count += 1
+            if count == limit:
+                break
+        return count
+
+    def sinterstore(self, *sets):
+        """
+        Replace the contents of this set with the intersection of ``sets``.
+
+        Returns the number of members in the resulting set.
+        """
+        return self._replace(_iter_inter(sets))
+
     def sismember(self, value):
         "Return a boolean indicating if ``value`` is a member of set"
         return value in self._set
@@ -31,29 +178,85 @@ class Set(object):
         "Return all members of the set"
         return list(self._set)
 
-    def spop(self):
-        "Remove and return a random member of set"
-        try:
-            return self._set.pop()
-        except KeyError:
-            return None
+    def spop(self, count=None):
+        """
+        Remove and return a random member of set, or None if it is empty.
+
+        If ``count`` is supplied, removes and returns a list of up to
+        ``count`` random members.
+        """
+        if count is None:
+            try:
+                return self._pop()
+            except KeyError:
+                return None
+        if count < 0:
+            raise RedisError("value is out of range, must be positive")
+        return [self._pop() for i in range(min(count, len(self._set)))]
 
-    def srandmember(self, number=1):
+    def srandmember(self, number=None):
         """
-        If ``number`` is None, returns a random member of set.
+        If ``number`` is None, returns a random member of set, or None if
+        it is empty.
 
-        If ``number`` is supplied, returns a list of ``number`` random
-        memebers of set.
+        If ``number`` is positive, returns a list of up to ``number``
+        distinct random members of set.  If it is negative, returns a list
+        of exactly -``number`` random members, which may repeat.
         """
-        items = random.sample(self._set, number)
-        if len(items) == 1:
-            return items[0]
-        return items
+        members = self._sequence()
+        if number is None:
+            return random.choice(members) if members else None
+        if number >= 0:
+            return random.sample(members, min(number, len(members)))
+        if not members:
+            return []
+        return random.choices(members, k=-number)
 
     def srem(self, *values):
         "Remove ``values`` from set"
-        values = set(values)
-        values = self._set & values
-        for value in values:
-            self._set.remove(value)
-        return len(values)
+        if type(self._set) is IntSet:
+            return sum(self._set.discard(value) for value in set(values))
+        removed = 0
+        for value in set(values):
+            if self._set.discard(value):
+                removed += 1
+                self._used -= memory.sizeof(value)
+        return removed
+
+    def sscan(self, cursor=0, count=10, match=None):
+        """
+        Incrementally iterate over the members of the set.
+
+        Returns a ``(cursor, members)`` tuple with about ``count`` members,
+        only keeping those matching the glob-style ``match`` pattern if
+        given.  Pass the returned cursor back in to continue; a cursor of 0
+        means the iteration is complete.  Members present for the whole
+        iteration are returned at least once.
+        """
+        if type(self._set) is IntSet:
+            cursor, members = 0, self._set
+        else:
+            cursor, members = scan_sequence(self._set._members, cursor, count)
+        return cursor, filter_match(members, match)
+
+    def sscan_iter(self, count=10, match=None):
+        "Yields members by repeatedly calling ``sscan``"
+        cursor = 0
+        while True:
+            cursor, members = self.sscan(cursor, count, match)
+            for member in members:
+                yield member
+            if cursor == 0:
+                break
+
+    def sunion(self, *others):
+        "Return the members of this set and all of ``others``"
+        return list(_union((self,) + others))
+
+    def sunionstore(self, *sets):
+        """
+        Replace the contents of this set with the union of ``sets``.
+
+        Returns the number of members in the resulting set.
+        """
+        return self._replace(_union(sets))
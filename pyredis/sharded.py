@@ -0,0 +1,176 @@
+""" A keyspace split into shards with a lock each, for threads to share.
+
+A ``Database`` has a single lock, so threads sharing one run their
+commands one at a time.  A ``ShardedDatabase`` hashes each key to one of
+``shards`` databases, each with its own lock, and a command only holds the
+locks of the shards of its keys, so that commands on keys of different
+shards run in parallel on a free-threaded Python build, and without
+waiting on each other's locks otherwise.
+
+Commands are the ones of a pipeline, the methods of ``Database`` and of
+the datastructures called with the key first, see ``pyredis.pipeline``::
+
+    >>> db = ShardedDatabase()
+    >>> db.zadd('scores', alice=10)
+    1
+    >>> db.zunionstore('total', 'scores', 'bonus')
+    1
+
+A command over several keys, such as ``zunionstore`` or ``delete``, takes
+the locks of their shards in the order of the shards, so two of them never
+wait on each other, and runs with all of them held.  Commands over the
+whole keyspace such as ``dbsize`` or ``scan`` take one lock at a time and
+see each shard at a different moment.  ``locked`` takes the locks of a set
+of keys, or of every shard, to run several commands atomically or to
+modify a datastructure returned by ``lookup``.
+
+Each shard expires the fields of its hashes on a timer wheel of its own,
+which ``active_expire_cycle`` ticks with the lock of the shard held, one
+shard after the other, so active expiry never needs the locks of other
+shards.  The shared ``pyredis.expiry.wheel`` only holds the fields of the
+hashes outside any database.
+"""
+import contextlib
+
+from . import pipeline
+from .database import Database
+from .pipeline import COMMANDS, DATABASE_COMMANDS
+
+
+SHARDS = 16
+
+# The Database commands taking a single key first, the others being
+# handled by ShardedDatabase methods
+_KEY_COMMANDS = DATABASE_COMMANDS - frozenset(('dbsize', 'delete', 'exists', 'flushdb', 'keys', 'scan'))
+
+
+class ShardedDatabase(object):
+    """ A keyspace of ``shards`` ``Database`` shards, each key living in the
+    shard picked by its hash.
+    """
+
+    def __init__(self, shards=SHARDS):
+        self.shards = [Database() for i in range(shards)]
+
+    def _index(self, key):
+        return hash(key) % len(self.shards)
+
+    def shard(self, key):
+        "Returns the Database holding ``key``"
+        return self.shards[self._index(key)]
+
+    @contextlib.contextmanager
+    def locked(self, *keys):
+        """ Holds the locks of the shards of ``keys``, or of every shard if
+        none are given, taking them in the order of the shards.
+        """
+        shards = self.shards
+        if keys:
+            shards = [shards[i] for i in sorted(set(map(self._index, keys)))]
+        with contextlib.ExitStack() as stack:
+            for shard in shards:
+                stack.enter_context(shard.lock)
+            yield
+
+    def __getattr__(self, name):
+        if name in _KEY_COMMANDS:
+            def run(key, *args, **kwargs):
+                shard = self.shard(key)
+                with shard.lock:
+                    return getattr(shard, name)(key, *args, **kwargs)
+        elif name in COMMANDS:
+            flags = COMMANDS[name][1]
+            # how many of the arguments are keys, None for all of them
+            nkeys = None if 'keys' in flags else 2 if 'destination' in flags else 1
+
+            def run(*args, **kwargs):
+                indexes = set(map(self._index, args[:nkeys]))
+                if len(indexes) == 1:
+                    # the shard can run the command on its own
+                    shard = self.shards[indexes.pop()]
+                    with shard.lock:
+                        return pipeline.call(shard, name, args, kwargs)
+                with self.locked(*args[:nkeys]):
+                    return pipeline.call(self, name, args, kwargs)
+        else:
+            raise AttributeError(name)
+        run.__name__ = name
+        # found in the instance from now on
+        setattr(self, name, run)
+        return run
+
+    # What pipeline.call needs, the caller holding the locks of the keys
+
+    def lookup(self, key, cls=None, create=False):
+        "Returns the value of ``key`` like ``Database.lookup``, the caller holding the lock of its shard"
+        return self.shard(key).lookup(key, cls, create)
+
+    def touch(self, *keys):
+        "Touches ``keys`` like ``Database.touch``, the caller holding the locks of their shards"
+        for key in keys:
+            self.shard(key).touch(key)
+
+    # Commands over several keys or the whole keyspace
+
+    def active_expire_cycle(self, *args):
+        "Runs an active expire cycle on every shard and returns the number of keys removed"
+        removed = 0
+        for shard in self.shards:
+            with shard.lock:
+                removed += shard.active_expire_cycle(*args)
+        return removed
+
+    def dbsize(self):
+        return sum(len(shard._data) for shard in self.shards)
+
+    def delete(self, *keys):
+        "Delete ``keys`` and return the number of keys that existed"
+        with self.locked(*keys):
+            return sum(self.shard(key).delete(key) for key in keys)
+
+    def exists(self, *keys):
+        "Returns the number of ``keys`` that exist, counting repeats"
+        with self.locked(*keys):
+            return sum(self.shard(key).exists(key) for key in keys)
+
+    def flushdb(self):
+        "Delete every key"
+        with self.locked():
+            for shard in self.shards:
+                shard.flushdb()
+        return True
+
+    def keys(self, pattern='*'):
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(shard.keys(pattern))
+        return keys
+
+    def scan(self, cursor=0, count=10, match=None, _type=None):
+        """ Incrementally iterates over the keys like ``Database.scan``,
+        one shard after the other, the cursor of the shard and its index
+        making the cursor returned.
+        """
+        n = len(self.shards)
+        index, cursor = cursor % n, cursor // n
+        shard = self.shards[index]
+        with shard.lock:
+            cursor, keys = shard.scan(cursor, count, match, _type)
+        if cursor:
+            return cursor * n + index, keys
+        return (index + 1) % n, keys
+
+    def scan_iter(self, count=10, match=None, _type=None):
+        "Yields keys by repeatedly calling ``scan``"
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, count, match, _type)
+            for key in keys:
+                yield key
+            if cursor == 0:
+                break
+
+    @property
+    def used_memory(self):
+        return sum(shard.used_memory for shard in self.shards)
@@ -0,0 +1,361 @@
+import gc
+import random
+
+
+SKIPLIST_MAXLEVEL = 32
+SKIPLIST_P = 0.25
+
+
+class SkipListNode(object):
+    __slots__ = ('score', 'member', 'backward', 'forward', 'span')
+
+    def __init__(self, level, score, member):
+        self.score = score
+        self.member = member
+        self.backward = None
+        self.forward = [None] * level
+        self.span = [0] * level
+
+
+def _lt(node, score, member):
+    "Returns True if ``node`` sorts before (``score``, ``member``)"
+    return node.score < score or (node.score == score and node.member < member)
+
+
+def _gte_min(score, min, minex):
+    if minex:
+        return score > min
+    return score >= min
+
+
+def _lte_max(score, max, maxex):
+    if maxex:
+        return score < max
+    return score <= max
+
+
+class SkipList(object):
+    """ An indexable skiplist ordered by (score, member).
+
+    Every forward pointer records how many nodes it jumps over (its span),
+    so ranks can be computed and nodes found by rank in O(log n), the same
+    way Redis implements its ``zskiplist``.
+
+    The skiplist does not check for duplicates, callers must only insert
+    members that are not already present.
+    """
+
+    def __init__(self):
+        self.header = SkipListNode(SKIPLIST_MAXLEVEL, None, None)
+        self.tail = None
+        self.length = 0
+        self.level = 1
+
+    @classmethod
+    def from_sorted(cls, items):
+        """ Builds a skiplist in O(n) from an iterable of (score, member)
+        pairs that are already sorted and free of duplicate members.
+        """
+        zsl = cls()
+        update = [zsl.header] * SKIPLIST_MAXLEVEL
+        rank = [0] * SKIPLIST_MAXLEVEL
+        prev = None
+        length = 0
+        random_level = zsl._random_level
+        # None of the nodes allocated here can be garbage yet, so keep the
+        # cyclic collector from repeatedly walking them during big loads.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for score, member in items:
+                length += 1
+                level = random_level()
+                if level > zsl.level:
+                    zsl.level = level
+                x = SkipListNode(level, score, member)
+                for i in range(level):
+                    update[i].forward[i] = x
+                    update[i].span[i] = length - rank[i]
+                    update[i] = x
+                    rank[i] = length
+                x.backward = prev
+                prev = x
+        finally:
+            if gc_enabled:
+                gc.enable()
+        # the last node on every level spans to the end of the list
+        for i in range(zsl.level):
+            update[i].span[i] = length - rank[i]
+        zsl.tail = prev
+        zsl.length = length
+        return zsl
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        node = self.header.forward[0]
+        while node is not None:
+            yield node.score, node.member
+            node = node.forward[0]
+
+    def __reversed__(self):
+        node = self.tail
+        while node is not None:
+            yield node.score, node.member
+            node = node.backward
+
+    def _random_level(self):
+        level = 1
+        while random.random() < SKIPLIST_P and level < SKIPLIST_MAXLEVEL:
+            level += 1
+        return level
+
+    def insert(self, score, member):
+        """ Inserts a new node for ``member`` with ``score`` and returns it.
+        """
+        update = [None] * SKIPLIST_MAXLEVEL
+        rank = [0] * SKIPLIST_MAXLEVEL
+        x = self.header
+        traversed = 0
+        for i in range(self.level - 1, -1, -1):
+            next = x.forward[i]
+            while next is not None and (next.score < score or
+                                        (next.score == score and next.member < member)):
+                traversed += x.span[i]
+                x = next
+                next = x.forward[i]
+            rank[i] = traversed
+            update[i] = x
+
+        level = self._random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                rank[i] = 0
+                update[i] = self.header
+                update[i].span[i] = self.length
+            self.level = level
+
+        x = SkipListNode(level, score, member)
+        for i in range(level):
+            x.forward[i] = update[i].forward[i]
+            update[i].forward[i] = x
+            x.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = (rank[0] - rank[i]) + 1
+
+        # increment span for untouched levels
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+
+        x.backward = None if update[0] is self.header else update[0]
+        if x.forward[0] is not None:
+            x.forward[0].backward = x
+        else:
+            self.tail = x
+        self.length += 1
+        return x
+
+    def _delete_node(self, x, update):
+        for i in range(self.level):
+            if update[i].forward[i] is x:
+                update[i].span[i] += x.span[i] - 1
+                update[i].forward[i] = x.forward[i]
+            else:
+                update[i].span[i] -= 1
+        if x.forward[0] is not None:
+            x.forward[0].backward = x.backward
+        else:
+            self.tail = x.backward
+        while self.level > 1 and self.header.forward[self.level - 1] is None:
+            self.level -= 1
+        self.length -= 1
+
+    def delete(self, score, member):
+        """ Deletes the node matching ``score`` and ``member``.
+
+        Returns True if a node was found and deleted.
+        """
+        update = [None] * SKIPLIST_MAXLEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and _lt(x.forward[i], score, member):
+                x = x.forward[i]
+            update[i] = x
+        x = x.forward[0]
+        if x is not None and x.score == score and x.member == member:
+            self._delete_node(x, update)
+            return True
+        return False
+
+    def update_score(self, score, member, new_score):
+        """ Changes the score of ``member`` from ``score`` to ``new_score``.
+
+        If the node would stay in the same position it is updated in place,
+        otherwise it is removed and reinserted.
+        """
+        update = [None] * SKIPLIST_MAXLEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and _lt(x.forward[i], score, member):
+                x = x.forward[i]
+            update[i] = x
+        x = x.forward[0]
+
+        prev, next = x.backward, x.forward[0]
+        if ((prev is None or _lt(prev, new_score, member)) and
+                (next is None or not _lt(next, new_score, member))):
+            x.score = new_score
+            return x
+
+        self._delete_node(x, update)
+        return self.insert(new_score, member)
+
+    def get_rank(self, score, member):
+        """ Returns the 0-based rank of the node matching ``score`` and
+        ``member`` or None if it is not in the skiplist.
+        """
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and (
+                    _lt(x.forward[i], score, member) or
+                    (x.forward[i].score == score and x.forward[i].member == member)):
+                rank += x.span[i]
+                x = x.forward[i]
+            if x is not self.header and x.member == member and x.score == score:
+                return rank - 1
+        return None
+
+    def get_by_rank(self, rank):
+        """ Returns the node at 0-based ``rank`` or None if out of range.
+        """
+        if rank < 0 or rank >= self.length:
+            return None
+        rank += 1
+        traversed = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= rank:
+                traversed += x.span[i]
+                x = x.forward[i]
+            if traversed == rank:
+                return x
+        return None
+
+    def count_below(self, score, inclusive=False):
+        """ Returns the number of nodes with a score lower than ``score``.
+
+        If ``inclusive`` is True, nodes equal to ``score`` are counted too.
+        """
+        count = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and (
+                    x.forward[i].score < score or
+                    (inclusive and x.forward[i].score == score)):
+                count += x.span[i]
+                x = x.forward[i]
+        return count
+
+    def count_members_below(self, member, inclusive=False):
+        """ Returns the number of nodes with a member lower than ``member``.
+
+        If ``inclusive`` is True, a node equal to ``member`` is counted too.
+        This is only meaningful when every node has the same score, so the
+        skiplist is ordered by member.
+        """
+        count = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and (
+                    x.forward[i].member < member or
+                    (inclusive and x.forward[i].member == member)):
+                count += x.span[i]
+                x = x.forward[i]
+        return count
+
+    def is_in_range(self, min, max, minex=False, maxex=False):
+        "Returns True if any node has a score within ``min`` and ``max``"
+        if min > max or (min == max and (minex or maxex)):
+            return False
+        x = self.tail
+        if x is None or not _gte_min(x.score, min, minex):
+            return False
+        x = self.header.forward[0]
+        if x is None or not _lte_max(x.score, max, maxex):
+            return False
+        return True
+
+    def first_in_range(self, min, max, minex=False, maxex=False):
+        """ Returns the first node with a score within ``min`` and ``max``,
+        or None if there is no such node.
+        """
+        if not self.is_in_range(min, max, minex, maxex):
+            return None
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and not _gte_min(x.forward[i].score, min, minex):
+                x = x.forward[i]
+        x = x.forward[0]
+        if not _lte_max(x.score, max, maxex):
+            return None
+        return x
+
+    def last_in_range(self, min, max, minex=False, maxex=False):
+        """ Returns the last node with a score within ``min`` and ``max``,
+        or None if there is no such node.
+        """
+        if not self.is_in_range(min, max, minex, maxex):
+            return None
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and _lte_max(x.forward[i].score, max, maxex):
+                x = x.forward[i]
+        if not _gte_min(x.score, min, minex):
+            return None
+        return x
+
+    def delete_range_by_score(self, min, max, dict, minex=False, maxex=False):
+        """ Deletes every node with a score within ``min`` and ``max``, also
+        removing its member from ``dict``.  Returns the number removed.
+        """
+        update = [None] * SKIPLIST_MAXLEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and not _gte_min(x.forward[i].score, min, minex):
+                x = x.forward[i]
+            update[i] = x
+        x = x.forward[0]
+        removed = 0
+        while x is not None and _lte_max(x.score, max, maxex):
+            next = x.forward[0]
+            self._delete_node(x, update)
+            del dict[x.member]
+            removed += 1
+            x = next
+        return removed
+
+    def delete_range_by_rank(self, start, end, dict):
+        """ Deletes every node between the 0-based ranks ``start`` and ``end``
+        inclusive, also removing its member from ``dict``.  Returns the number
+        removed.
+        """
+        update = [None] * SKIPLIST_MAXLEVEL
+        traversed = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= start:
+                traversed += x.span[i]
+                x = x.forward[i]
+            update[i] = x
+        traversed += 1
+        x = x.forward[0]
+        removed = 0
+        while x is not None and traversed <= end + 1:
+            next = x.forward[0]
+            self._delete_node(x, update)
+            del dict[x.member]
+            removed += 1
+            traversed += 1
+            x = next
+        return removed
@@ -1,34 +1,153 @@
+import asyncio
+import gc
+import inspect
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
-from pyredis.exceptions import RedisError
+import weakref
+from collections import deque
+from pyredis.exceptions import RedisError, WatchError
 from pyredis.zset import ZSet
+from pyredis.database import Database
+from pyredis import aof, bench, expiry, instrument, mapped, memory, rdb
+from pyredis.columnar import ColumnarZSet, USE_NUMPY
+from pyredis.expiry import TimerWheel
+from pyredis.instrument import SlowLog
 from pyredis.hash import Hash
+from pyredis.listpack import ListPack
+from pyredis.denseset import DenseSet
+from pyredis.intset import IntSet
 from pyredis.set import Set
 from pyredis.list import List
+from pyredis.quicklist import QuickList
+from pyredis.resp import NULL_ARRAY, OK, Parser, ProtocolError, encode
+from pyredis.server import Client, Server
+from pyredis.sharded import ShardedDatabase
+from pyredis.scan import SCAN_LOG_SLACK, ScanDict, compile_match
+
+
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
 
 
 class ZSetTestCase(unittest.TestCase):
     def test_zadd(self):
         zset = ZSet()
-        zset.zadd(a=5, b=3, c=1)
-        self.assertEqual(zset._scores, [(1, 'c'), (3, 'b'), (5, 'a')])
-        self.assertEqual(zset._members, [('a', 5), ('b', 3), ('c', 1)])
-
-        zset.zadd(b=4)
-        self.assertEqual(zset._scores, [(1, 'c'), (4, 'b'), (5, 'a')])
-        self.assertEqual(zset._members, [('a', 5), ('b', 4), ('c', 1)])
+        self.assertEqual(zset.zadd(a=5, b=3, c=1), 3)
+        self.assertEqual(zset.zrange(0, -1, withscores=True, score_cast_func=int), [('c', 1), ('b', 3), ('a', 5)])
+        self.assertEqual(zset._dict, {'a': 5, 'b': 3, 'c': 1})
 
+        self.assertEqual(zset.zadd(b=4), 0)
+        self.assertEqual(zset.zrange(0, -1, withscores=True, score_cast_func=int), [('c', 1), ('b', 4), ('a', 5)])
+        self.assertEqual(zset._dict, {'a': 5, 'b': 4, 'c': 1})
 
     def test_zadd_adding_existing_member(self):
         zset = ZSet()
         zset.zadd(a=3)
         zset.zadd(a=4)
-        self.assertEqual(zset._members, [('a', 4)])
-        self.assertEqual(zset._scores, [(4, 'a')])
+        self.assertEqual(zset._dict, {'a': 4})
+        self.assertEqual(list(zset._zsl), [(4, 'a')])
 
         zset.zadd(b=1)
         zset.zadd(b=2)
-        self.assertEqual(zset._members, [('a', 4), ('b', 2)])
-        self.assertEqual(zset._scores, [(2, 'b'), (4, 'a')])
+        self.assertEqual(zset._dict, {'a': 4, 'b': 2})
+        self.assertEqual(list(zset._zsl), [(2, 'b'), (4, 'a')])
+
+    def test_zadd_matches_sorted_order(self):
+        zset = ZSet()
+        expected = {}
+        for i in range(2000):
+            member = 'm%d' % random.randint(0, 500)
+            score = random.randint(0, 100)
+            zset.zadd(**{member: score})
+            expected[member] = score
+        ordered = sorted((score, member) for member, score in expected.items())
+        self.assertEqual(list(zset._zsl), ordered)
+        self.assertEqual(list(reversed(zset._zsl)), ordered[::-1])
+        for rank, (score, member) in enumerate(ordered):
+            self.assertEqual(zset.zrank(member), rank)
+            self.assertEqual(zset.zrevrank(member), len(ordered) - 1 - rank)
+
+    def test_from_pairs(self):
+        zset = ZSet.from_pairs([('a', 3), ('b', 1), ('a', 2), ('c d', 5)])
+        self.assertEqual(zset.zrange(0, -1, withscores=True, score_cast_func=int), [('b', 1), ('a', 2), ('c d', 5)])
+        self.assertEqual(zset.zrank('c d'), 2)
+
+        zset = ZSet.from_pairs({'a': 1, 'b': 2})
+        self.assertEqual(zset.zrange(0, -1), ['a', 'b'])
+
+    def test_zadd_many(self):
+        zset = ZSet()
+        zset.zadd(a=5, b=3, c=1)
+        self.assertEqual(zset.zadd_many({'b': 6, 'd': 0, 'e-1': 4}), 2)
+        self.assertEqual(zset.zrange(0, -1, withscores=True, score_cast_func=int),
+                         [('d', 0), ('c', 1), ('e-1', 4), ('a', 5), ('b', 6)])
+        self.assertEqual(zset.zadd_many([]), 0)
+
+    def test_zadd_many_matches_sorted_order(self):
+        zset = ZSet()
+        expected = {}
+        for size in (1000, 10, 300):
+            pairs = [('m%d' % random.randint(0, 1500), random.randint(0, 100)) for i in range(size)]
+            expected.update(pairs)
+            zset.zadd_many(pairs)
+            zset.zadd(x=random.randint(0, 100))
+            expected['x'] = zset.zscore('x')
+        ordered = sorted((score, member) for member, score in expected.items())
+        self.assertEqual(list(zset._zsl), ordered)
+        self.assertEqual(list(reversed(zset._zsl)), ordered[::-1])
+        for rank, (score, member) in enumerate(ordered):
+            self.assertEqual(zset.zrank(member), rank)
+
+    def test_zunion(self):
+        a = ZSet.from_pairs({'x': 1, 'y': 2, 'z': 3})
+        b = ZSet.from_pairs({'y': 10, 'z': 20, 'w': 5})
+        self.assertEqual(a.zunion(b, withscores=True, score_cast_func=int),
+                         [('x', 1), ('w', 5), ('y', 12), ('z', 23)])
+        self.assertEqual(a.zunion(b, weights=[2, 1], aggregate='min', withscores=True, score_cast_func=int),
+                         [('x', 2), ('y', 4), ('w', 5), ('z', 6)])
+        with self.assertRaises(RedisError):
+            a.zunion(b, aggregate='avg')
+        with self.assertRaises(RedisError):
+            a.zunion(b, weights=[1])
+
+    def test_zinter(self):
+        a = ZSet.from_pairs({'x': 1, 'y': 2, 'z': 3})
+        b = ZSet.from_pairs({'y': 10, 'z': 20, 'w': 5})
+        c = ZSet.from_pairs({'z': 100, 'y': 1})
+        self.assertEqual(a.zinter(b, c), ['y', 'z'])
+        self.assertEqual(a.zinter(b, c, weights=[1, 2, 3], aggregate='MAX', withscores=True, score_cast_func=int),
+                         [('y', 20), ('z', 300)])
+        self.assertEqual(a.zinter(ZSet()), [])
+
+    def test_zdiff(self):
+        a = ZSet.from_pairs({'x': 1, 'y': 2, 'z': 3})
+        b = ZSet.from_pairs({'y': 10})
+        c = ZSet.from_pairs({'x': 5})
+        self.assertEqual(a.zdiff(b, c, withscores=True, score_cast_func=int), [('z', 3)])
+        dest = ZSet()
+        self.assertEqual(dest.zdiffstore(a, b), 2)
+        self.assertEqual(dest.zrange(0, -1), ['x', 'z'])
+
+    def test_zunionstore(self):
+        a = ZSet.from_pairs({'x': 1, 'y': 2})
+        b = ZSet.from_pairs({'y': 10, 'w': 5})
+        dest = ZSet.from_pairs({'old': 1})
+        self.assertEqual(dest.zunionstore(a, b, weights=[1, 10]), 3)
+        self.assertEqual(dest.zrange(0, -1, withscores=True, score_cast_func=int), [('x', 1), ('w', 50), ('y', 102)])
+        self.assertEqual(dest.zrank('y'), 2)
+
+    def test_zinterstore(self):
+        a = ZSet.from_pairs({'x': 1, 'y': 2, 'z': 3})
+        b = ZSet.from_pairs({'y': 10, 'z': 20})
+        self.assertEqual(a.zinterstore(a, b, aggregate='MIN'), 2)
+        self.assertEqual(a.zrange(0, -1, withscores=True, score_cast_func=int), [('y', 2), ('z', 3)])
+        self.assertEqual(a.zscore('x'), None)
 
     def test_zcard(self):
         zset = ZSet()
@@ -44,11 +163,30 @@ class ZSetTestCase(unittest.TestCase):
         zset = ZSet()
         zset.zadd(a=1, b=2, c=2, d=2, e=3)
         self.assertEqual(zset.zincrby('c', 3), 5)
+        self.assertEqual(zset.zrank('c'), 4)
+        self.assertEqual(zset.zincrby('z', 2), 2)
+        self.assertEqual(zset.zscore('z'), 2)
+
+    def test_zrem(self):
+        zset = ZSet()
+        zset.zadd(a=1, b=2, c=3)
+        self.assertEqual(zset.zrem('a', 'c', 'z'), 2)
+        self.assertEqual(zset.zrange(0, -1), ['b'])
+        self.assertEqual(zset.zcard(), 1)
+        self.assertEqual(zset.zrank('a'), None)
+
+    def test_zscore(self):
+        zset = ZSet()
+        zset.zadd(a=1, b=2)
+        self.assertEqual(zset.zscore('b'), 2)
+        self.assertEqual(zset.zscore('z'), None)
 
     def test_zrange(self):
         zset = ZSet()
         zset.zadd(a=9, b=7, c=5, d=3, e=1)
         self.assertEqual(zset.zrange(1, 3), ['d', 'c', 'b'])
+        self.assertEqual(zset.zrange(-2, -1), ['b', 'a'])
+        self.assertEqual(zset.zrange(0, 1, desc=True), ['a', 'b'])
 
     def test_zrange_with_scores(self):
         zset = ZSet()
@@ -64,6 +202,8 @@ class ZSetTestCase(unittest.TestCase):
         zset = ZSet()
         zset.zadd(a=9, b=7, c=5, d=3, e=1)
         self.assertEqual(zset.zrangebyscore(3, 8), ['d', 'c', 'b'])
+        self.assertEqual(zset.zrangebyscore(3, 8, start=1, num=1), ['c'])
+        self.assertEqual(zset.zrevrangebyscore(3, 8), ['b', 'c', 'd'])
 
     def test_zrangebyscore_with_scores(self):
         zset = ZSet()
@@ -75,6 +215,135 @@ class ZSetTestCase(unittest.TestCase):
         zset.zadd(a=9, b=7, c=5, d=3, e=1)
         self.assertEqual(zset.zrangebyscore(3, 8, withscores=True, score_cast_func=int), [('d', 3), ('c', 5), ('b', 7)])
 
+    def test_iter_range(self):
+        zset = ZSet()
+        zset.zadd(a=9, b=7, c=5, d=3, e=1)
+        items = zset.iter_range(1, 3)
+        self.assertFalse(isinstance(items, list))
+        self.assertEqual(list(items), ['d', 'c', 'b'])
+        self.assertEqual(list(zset.iter_range(0, 1, desc=True, withscores=True, score_cast_func=int)),
+                         [('a', 9), ('b', 7)])
+        self.assertEqual(list(zset.iter_range(5, 10)), [])
+
+    def test_iter_rangebyscore(self):
+        zset = ZSet.from_pairs(('m%03d' % i, i) for i in range(1000))
+        self.assertEqual(list(zset.iter_rangebyscore(100, 900, start=10, num=3)), ['m110', 'm111', 'm112'])
+        self.assertEqual(list(zset.iter_rangebyscore(100, 900, start=10, num=3, desc=True)), ['m890', 'm889', 'm888'])
+        self.assertEqual(list(zset.iter_rangebyscore(998, 2000, start=1, num=5, withscores=True)), [('m999', 999.0)])
+        self.assertEqual(list(zset.iter_rangebyscore(5, 1)), [])
+
+    def test_zscan(self):
+        zset = ZSet()
+        zset.zadd(a=9, b=7, c=5, d=3, e=1)
+        cursor, items = zset.zscan(0, count=3, score_cast_func=int)
+        self.assertEqual(len(items), 3)
+        cursor, more = zset.zscan(cursor, count=3, score_cast_func=int)
+        self.assertEqual(cursor, 0)
+        self.assertItemsEqual(items + more, [('a', 9), ('b', 7), ('c', 5), ('d', 3), ('e', 1)])
+        self.assertItemsEqual(zset.zscan_iter(count=2), zset.zrange(0, -1, withscores=True))
+        self.assertItemsEqual(zset.zscan_iter(match='[a-c]'), [('a', 9.0), ('b', 7.0), ('c', 5.0)])
+        with self.assertRaises(RedisError):
+            zset.zscan(0, count=0)
+
+    def test_zscan_while_changing(self):
+        zset = ZSet.from_pairs(('m%d' % i, i) for i in range(100))
+        seen = set()
+        cursor, items = zset.zscan(0, count=10)
+        while True:
+            seen.update(member for member, score in items)
+            # remove members that were returned and add new ones
+            zset.zrem(*[member for member, score in items[:5]])
+            zset.zadd_many(('new%d' % i, -i) for i in range(len(seen), len(seen) + 5))
+            zset.zincrby('m99', 1000)
+            if cursor == 0:
+                break
+            cursor, items = zset.zscan(cursor, count=10)
+        self.assertTrue(set('m%d' % i for i in range(100)) <= seen)
+
+    def test_zrangebylex(self):
+        zset = ZSet.from_pairs((member, 0) for member in ['apple', 'apricot', 'banana', 'blueberry', 'cherry'])
+        self.assertEqual(zset.zrangebylex('[ap', '(b'), ['apple', 'apricot'])
+        self.assertEqual(zset.zrangebylex('(apple', '[banana'), ['apricot', 'banana'])
+        self.assertEqual(zset.zrangebylex('-', '+', start=1, num=2), ['apricot', 'banana'])
+        self.assertEqual(zset.zrangebylex('[b', '+'), ['banana', 'blueberry', 'cherry'])
+        self.assertEqual(zset.zrangebylex('+', '-'), [])
+        with self.assertRaises(RedisError):
+            zset.zrangebylex('a', '+')
+
+    def test_zrevrangebylex(self):
+        zset = ZSet.from_pairs((member, 0) for member in ['a', 'b', 'c', 'd'])
+        self.assertEqual(zset.zrevrangebylex('[b', '+'), ['d', 'c', 'b'])
+        self.assertEqual(zset.zrevrangebylex('-', '(d', start=1, num=5), ['b', 'a'])
+
+    def test_zlexcount(self):
+        zset = ZSet.from_pairs((member, 0) for member in ['a', 'b', 'c', 'd'])
+        self.assertEqual(zset.zlexcount('-', '+'), 4)
+        self.assertEqual(zset.zlexcount('(a', '[c'), 2)
+        self.assertEqual(zset.zlexcount('[c', '[a'), 0)
+
+    def test_zremrangebylex(self):
+        zset = ZSet.from_pairs((member, 0) for member in ['a', 'b', 'c', 'd'])
+        self.assertEqual(zset.zremrangebylex('(a', '[c'), 2)
+        self.assertEqual(zset.zrange(0, -1), ['a', 'd'])
+        self.assertEqual(zset.zremrangebylex('[x', '+'), 0)
+
+    def test_zpopmin(self):
+        zset = ZSet()
+        zset.zadd(a=9, b=7, c=5, d=3, e=1)
+        self.assertEqual(zset.zpopmin(), [('e', 1.0)])
+        self.assertEqual(zset.zpopmin(2, score_cast_func=int), [('d', 3), ('c', 5)])
+        self.assertEqual(zset.zrange(0, -1), ['b', 'a'])
+        self.assertEqual(zset.zpopmin(10), [('b', 7.0), ('a', 9.0)])
+        self.assertEqual(zset.zpopmin(), [])
+
+    def test_zpopmax(self):
+        zset = ZSet()
+        zset.zadd(a=9, b=7, c=5, d=3, e=1)
+        self.assertEqual(zset.zpopmax(2, score_cast_func=int), [('a', 9), ('b', 7)])
+        self.assertEqual(zset.zrange(0, -1), ['e', 'd', 'c'])
+        self.assertEqual(zset.zpopmax(0), [])
+
+    def test_bzpopmin(self):
+        a, b = ZSet(), ZSet()
+        b.zadd(x=2, y=1)
+        self.assertEqual(a.bzpopmin(b, timeout=1), (b, 'y', 1.0))
+        self.assertEqual(ZSet().bzpopmin(timeout=0.01), None)
+
+        timer = threading.Timer(0.05, lambda: a.zadd(z=3))
+        timer.start()
+        self.assertEqual(a.bzpopmax(timeout=5), (a, 'z', 3.0))
+        timer.join()
+        self.assertEqual(a._waiters, deque())
+
+    def test_bzpopmin_serves_waiters_in_order(self):
+        zset = ZSet()
+        results = []
+        threads = []
+        for i in range(3):
+            thread = threading.Thread(target=lambda i=i: results.append((i, zset.bzpopmin(timeout=5)[1])))
+            thread.start()
+            threads.append(thread)
+            while len(zset._waiters or ()) < i + 1:
+                time.sleep(0.001)
+        zset.zadd_many([('a', 1), ('b', 2)])
+        zset.zadd(c=3)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [(0, 'a'), (1, 'b'), (2, 'c')])
+        self.assertEqual(zset.zcard(), 0)
+
+    def test_abzpopmin(self):
+        zset = ZSet()
+
+        async def consume():
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.01, lambda: zset.zadd(a=1))
+            first = await zset.abzpopmin(timeout=5)
+            second = await zset.abzpopmax(timeout=0.01)
+            return first, second
+
+        self.assertEqual(asyncio.run(consume()), ((zset, 'a', 1.0), None))
+
     def test_zrank(self):
         zset = ZSet()
         zset.zadd(a=9, b=7, c=5, d=3, e=1)
@@ -103,7 +372,76 @@ class ZSetTestCase(unittest.TestCase):
         zset = ZSet()
         zset.zadd(a=9, b=7, c=5, d=3, e=1)
         self.assertEqual(zset.zremrangebyrank(3, 10), 2)
-        self.assertEqual(zset._scores, [(1, 'e'), (3, 'd'), (5, 'c')])
+        self.assertEqual(list(zset._zsl), [(1, 'e'), (3, 'd'), (5, 'c')])
+        self.assertEqual(zset._dict, {'c': 5, 'd': 3, 'e': 1})
+
+    def test_zremrangebyscore(self):
+        zset = ZSet()
+        zset.zadd(a=9, b=7, c=5, d=3, e=1)
+        self.assertEqual(zset.zremrangebyscore(3, 7), 3)
+        self.assertEqual(list(zset._zsl), [(1, 'e'), (9, 'a')])
+        self.assertEqual(zset._dict, {'a': 9, 'e': 1})
+
+
+@unittest.skipUnless(USE_NUMPY, "numpy is not installed")
+class ColumnarZSetTestCase(unittest.TestCase):
+    def test_zadd(self):
+        zset = ColumnarZSet()
+        self.assertEqual(zset.zadd(a=5, b=3, c=1), 3)
+        self.assertEqual(zset.zadd(b=6), 0)
+        self.assertEqual(zset.zrange(0, -1, withscores=True), [('c', 1.0), ('a', 5.0), ('b', 6.0)])
+        self.assertEqual(zset.zscore('b'), 6.0)
+        with self.assertRaises(RedisError):
+            zset.zadd(d='x')
+
+    def test_zrangebyscore(self):
+        zset = ColumnarZSet.from_pairs(('m%d' % i, i) for i in range(100))
+        self.assertEqual(zset.zcount(10, 19), 10)
+        self.assertEqual(zset.zrangebyscore(10, 19, start=2, num=3), ['m12', 'm13', 'm14'])
+        self.assertEqual(zset.zrevrangebyscore(10, 19, start=2, num=3), ['m17', 'm16', 'm15'])
+        self.assertEqual(zset.zrangebyscore(0.5, 1.5, withscores=True), [('m1', 1.0)])
+
+    def test_zrangebyscore_arrays(self):
+        zset = ColumnarZSet.from_pairs(('m%d' % i, i) for i in range(100))
+        members, scores = zset.zrangebyscore_arrays(10, 12)
+        self.assertEqual(members.tolist(), ['m10', 'm11', 'm12'])
+        self.assertEqual(scores.tolist(), [10.0, 11.0, 12.0])
+        members, scores = zset.zrangebyscore_arrays(10, 12, desc=True)
+        self.assertEqual(members.tolist(), ['m12', 'm11', 'm10'])
+
+    def test_iter_range(self):
+        zset = ColumnarZSet.from_pairs(('m%03d' % i, i) for i in range(1000))
+        self.assertEqual(list(zset.iter_range(1, 3, desc=True)), ['m998', 'm997', 'm996'])
+        self.assertEqual(list(zset.iter_rangebyscore(100, 900, start=10, num=2, withscores=True)),
+                         [('m110', 110.0), ('m111', 111.0)])
+
+    def test_zrangebylex(self):
+        zset = ColumnarZSet.from_pairs((member, 0) for member in ['a', 'b', 'c', 'd'])
+        self.assertEqual(zset.zrangebylex('(a', '[c'), ['b', 'c'])
+        self.assertEqual(zset.zrevrangebylex('-', '+', start=0, num=2), ['d', 'c'])
+        self.assertEqual(zset.zlexcount('[b', '+'), 3)
+
+    def test_zrem(self):
+        zset = ColumnarZSet.from_pairs(('m%d' % i, i) for i in range(10))
+        self.assertEqual(zset.zrem('m0', 'm5', 'z'), 2)
+        self.assertEqual(zset.zremrangebyscore(7, 8), 2)
+        self.assertEqual(zset.zremrangebyrank(0, 1), 2)
+        self.assertEqual(zset.zrange(0, -1), ['m3', 'm4', 'm6', 'm9'])
+        self.assertEqual(zset.zrank('m9'), 3)
+
+    def test_matches_zset(self):
+        zset, columnar = ZSet(), ColumnarZSet()
+        for i in range(2000):
+            member = 'm%d' % random.randint(0, 300)
+            score = random.randint(0, 100)
+            if random.random() < 0.2:
+                self.assertEqual(zset.zrem(member), columnar.zrem(member))
+            else:
+                self.assertEqual(zset.zincrby(member, score), columnar.zincrby(member, score))
+        self.assertEqual(zset.zrange(0, -1, withscores=True), columnar.zrange(0, -1, withscores=True))
+        self.assertEqual(zset.zrangebyscore(50, 150), columnar.zrangebyscore(50, 150))
+        for member in zset.zrange(0, -1):
+            self.assertEqual(zset.zrank(member), columnar.zrank(member))
 
 
 class HashTestCase(unittest.TestCase):
@@ -187,6 +525,134 @@ class HashTestCase(unittest.TestCase):
         h.hmset({'a': 'aa', 'b': 'bb', 'c': 'cc'})
         self.assertItemsEqual(h.hvals(), ['aa', 'bb', 'cc'])
 
+    def test_hexpire(self):
+        h = Hash()
+        h.hmset({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(h.hexpire(100, 'a', 'b', 'z'), [1, 1, -2])
+        self.assertEqual(h.httl('a', 'c', 'z'), [100, -1, -2])
+        self.assertEqual(h.hexpire(50, 'a', nx=True), [0])
+        self.assertEqual(h.hexpire(50, 'a', 'c', xx=True), [1, 0])
+        self.assertEqual(h.hexpire(10, 'a', gt=True), [0])
+        self.assertEqual(h.hexpire(200, 'a', 'c', gt=True), [1, 0])
+        self.assertEqual(h.hexpire(10, 'a', 'c', lt=True), [1, 1])
+        self.assertEqual(h.httl('a', 'c'), [10, 10])
+        self.assertEqual(h.hpersist('a', 'b', 'c', 'z'), [1, 1, 1, -2])
+        self.assertEqual(h.hpersist('a'), [-1])
+        self.assertEqual(h.hexpire(0, 'a'), [2])
+        self.assertEqual(h.hgetall(), {'b': 2, 'c': 3})
+        with self.assertRaises(RedisError):
+            h.hexpire(10, 'b', nx=True, xx=True)
+
+    def test_hset_removes_ttl(self):
+        h = Hash()
+        h.hmset({'a': 1, 'b': 2})
+        h.hexpire(100, 'a', 'b')
+        h.hset('a', 'aa')
+        h.hincrby('b')
+        self.assertEqual(h.httl('a', 'b'), [-1, 100])
+
+    def test_hpexpire_lazy_expiry(self):
+        h = Hash()
+        h.hmset({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(h.hpexpire(10, 'a', 'b'), [1, 1])
+        self.assertTrue(0 < h.hpttl('a')[0] <= 10)
+        time.sleep(0.02)
+        self.assertEqual(h.hget('a'), None)
+        self.assertEqual(h.hincrby('b'), 1)
+        self.assertEqual(h.hlen(), 2)
+        self.assertEqual(h.httl('a', 'b'), [-2, -1])
+
+    def test_active_expiry(self):
+        class ExpiringHash(Hash):
+            timer_wheel = TimerWheel(resolution=10)
+
+        wheel = ExpiringHash.timer_wheel
+        h = ExpiringHash()
+        h.hmset(dict((i, i) for i in range(10)))
+        h.hpexpire(1000, *range(10))
+        h.hpersist(0)
+        h.hpexpire(5000, 1)
+        when = h._expires[2]
+        self.assertEqual(len(wheel), 11)
+        self.assertEqual(wheel.tick(now=when - 1), 0)
+        expired = wheel.tick(max_work=4, now=when + 10)
+        self.assertEqual(len(wheel), 7)
+        self.assertEqual(expired + wheel.tick(now=when + 10), 8)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(h.hgetall(), {0: 0, 1: 1})
+        self.assertEqual(wheel.tick(now=when + 5000), 1)
+        self.assertEqual(h.hgetall(), {0: 0})
+
+    def test_expired_fields_on_reads(self):
+        class ExpiringHash(Hash):
+            timer_wheel = TimerWheel(resolution=10)
+
+        h = ExpiringHash()
+        h.hmset(dict((i, i) for i in range(5)))
+        h.hpexpire(10, 0, 1)
+        time.sleep(0.02)
+        # expired fields are only counted until they are removed
+        self.assertEqual(h.hlen(), 5)
+        self.assertEqual(sorted(h.hkeys()), [2, 3, 4])
+        self.assertEqual(h.hlen(), 3)
+
+        h.hpexpire(10000, 2)
+        wheel = ExpiringHash.timer_wheel
+        self.assertEqual(len(wheel), 3)
+        # the wheel does not keep a hash nobody references alive
+        ref = weakref.ref(h)
+        del h
+        gc.collect()
+        self.assertIs(ref(), None)
+        self.assertEqual(wheel.tick(now=expiry.now_ms() + 20000), 0)
+        self.assertEqual(len(wheel), 0)
+
+    def test_hscan(self):
+        h = Hash()
+        h.hmset({'a': 1, 'b': 2, 'ab': 3})
+        self.assertEqual(h.hscan(), (0, {'a': 1, 'b': 2, 'ab': 3}))
+        self.assertEqual(h.hscan(match='a*'), (0, {'a': 1, 'ab': 3}))
+        h.hmset(dict(('f%d' % i, i) for i in range(200)))
+        fields = dict(h.hscan_iter(count=7, match='f1?'))
+        self.assertEqual(fields, dict(('f1%d' % i, 10 + i) for i in range(10)))
+        self.assertEqual(len(dict(h.hscan_iter(count=50))), 203)
+        h.hpexpire(-1, 'a')
+        self.assertEqual(dict(h.hscan_iter(match='a*')), {'ab': 3})
+
+    def test_listpack_encoding(self):
+        h = Hash()
+        h.hmset({'a': 'b', 'b': 'a', 1: 1.0})
+        self.assertIs(type(h._data), ListPack)
+        self.assertEqual(h.hget('b'), 'a')
+        self.assertEqual(h.hget(1.0), 1.0)
+        self.assertEqual(h.hget('aa'), None)
+        self.assertEqual(h.hdel('a', 'z'), 1)
+        self.assertEqual(h.hgetall(), {'b': 'a', 1: 1.0})
+        self.assertEqual(h.hkeys(), ['b', 1])
+        self.assertEqual(h.hvals(), ['a', 1.0])
+        self.assertEqual(h.hincrby(1, 2), 3.0)
+        self.assertEqual(list(h._data), ['b', 1])
+
+    def test_listpack_converts_to_dict(self):
+        class SmallHash(Hash):
+            max_listpack_entries = 3
+            max_listpack_value = 4
+
+        h = SmallHash()
+        h.hmset({'a': 1, 'b': 2, 'c': 3})
+        h.hset('c', 'long')
+        self.assertIs(type(h._data), ListPack)
+        h.hset('d', 4)
+        self.assertIs(type(h._data), ScanDict)
+        self.assertEqual(h.hgetall(), {'a': 1, 'b': 2, 'c': 'long', 'd': 4})
+
+        h = SmallHash()
+        h.hset('a', 'longer')
+        self.assertIs(type(h._data), ScanDict)
+        h = SmallHash()
+        h.hsetnx('longer', 1)
+        self.assertIs(type(h._data), ScanDict)
+
 
 class SetTestCase(unittest.TestCase):
     def test_sadd(self):
@@ -236,18 +702,208 @@ class SetTestCase(unittest.TestCase):
         self.assertTrue(type(items), list)
         self.assertEqual(len(items), 2)
 
+    def test_spop_count(self):
+        for values in (range(10), 'abcdefghij'):
+            s = Set(*values)
+            removed = s.spop(4)
+            self.assertEqual(len(removed), 4)
+            self.assertEqual(len(set(removed)), 4)
+            self.assertEqual(s.scard(), 6)
+            self.assertFalse(any(s.sismember(value) for value in removed))
+            self.assertItemsEqual(removed + s.spop(10), values)
+            self.assertEqual(s.spop(1), [])
+            self.assertEqual(s.spop(), None)
+
+    def test_srandmember_count(self):
+        for values in (range(5), 'abcde'):
+            s = Set(*values)
+            items = s.srandmember(3)
+            self.assertEqual(len(set(items)), 3)
+            self.assertTrue(set(items) <= set(values))
+            self.assertItemsEqual(s.srandmember(10), values)
+            items = s.srandmember(-20)
+            self.assertEqual(len(items), 20)
+            self.assertTrue(set(items) <= set(values))
+            self.assertEqual(s.scard(), 5)
+        self.assertEqual(Set().srandmember(), None)
+        self.assertEqual(Set().srandmember(-3), [])
+
+    def test_dense_set(self):
+        d = DenseSet('abcde')
+        self.assertTrue(d.discard('b'))
+        self.assertFalse(d.discard('b'))
+        self.assertTrue(d.discard('e'))
+        self.assertEqual(d, set('acd'))
+        self.assertEqual(sorted(d._members), ['a', 'c', 'd'])
+        for value in d._members:
+            self.assertEqual(d._members[d[value]], value)
+        with self.assertRaises(KeyError):
+            d.remove('z')
+
     def test_srem(self):
         s = Set()
         s.sadd('a', 'b', 'c')
         self.assertEqual(s.srem('b', 'c', 'z'), 2)
         self.assertItemsEqual(s._set, set(['a']))
 
+    def test_sinter(self):
+        a, b, c = Set('a', 'b', 'c', 'd'), Set('b', 'c', 'd', 'e'), Set('c', 'd', 'z')
+        self.assertItemsEqual(a.sinter(b, c), ['c', 'd'])
+        self.assertItemsEqual(a.sinter(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(a.sinter(b, Set()), [])
+        self.assertEqual(Set(*range(10)).sinter(Set(*range(5, 20)), Set(*range(0, 20, 2))), [6, 8])
+
+    def test_sintercard(self):
+        a, b = Set(*range(100)), Set(*range(50, 200))
+        self.assertEqual(a.sintercard(b), 50)
+        self.assertEqual(a.sintercard(b, limit=10), 10)
+        self.assertEqual(a.sintercard(b, limit=1000), 50)
+        self.assertEqual(a.sintercard(b, Set()), 0)
+        with self.assertRaises(RedisError):
+            a.sintercard(b, limit=-1)
+
+    def test_sunion(self):
+        a, b = Set('a', 'b'), Set('b', 1)
+        self.assertItemsEqual(a.sunion(b, Set(2)), ['a', 'b', 1, 2])
+        self.assertItemsEqual(a.sunion(), ['a', 'b'])
+
+    def test_sdiff(self):
+        a, b, c = Set('a', 'b', 'c', 'd'), Set('b', 'e'), Set('c')
+        self.assertItemsEqual(a.sdiff(b, c), ['a', 'd'])
+        self.assertItemsEqual(a.sdiff(), ['a', 'b', 'c', 'd'])
+
+    def test_store(self):
+        a, b, dest = Set(1, 2, 3), Set(2, 3, 'x'), Set('old')
+        self.assertEqual(dest.sinterstore(a, b), 2)
+        self.assertIs(type(dest._set), IntSet)
+        self.assertEqual(list(dest._set), [2, 3])
+        self.assertEqual(dest.sunionstore(a, b), 4)
+        self.assertEqual(dest._set, set([1, 2, 3, 'x']))
+        self.assertEqual(dest.sdiffstore(a, b), 1)
+        self.assertEqual(dest.smembers(), [1])
+        self.assertEqual(a.sinterstore(a, Set(3)), 1)
+        self.assertEqual(a.smembers(), [3])
+
+    def test_sscan(self):
+        s = Set(3, 1, 2, 11)
+        self.assertEqual(s.sscan(), (0, [1, 2, 3, 11]))
+        self.assertEqual(s.sscan(match='1*'), (0, [1, 11]))
+        s = Set(*('m%d' % i for i in range(100)))
+        cursor, members = s.sscan(count=30)
+        self.assertEqual(len(members), 30)
+        s.srem(*members)
+        s.sadd('new')
+        while cursor:
+            cursor, more = s.sscan(cursor, count=30)
+            members += more
+        self.assertItemsEqual(members, ['m%d' % i for i in range(100)])
+        self.assertItemsEqual(s.sscan_iter(match='m?'), ['m%d' % i for i in range(10)])
+        self.assertItemsEqual(s.sscan_iter(match='[n]*'), ['new'])
+
+    def test_match(self):
+        self.assertTrue(compile_match('h?llo')('hello'))
+        self.assertFalse(compile_match('h?llo')('hllo'))
+        self.assertTrue(compile_match('h*llo')('heeello'))
+        self.assertTrue(compile_match('h[^e]llo')('hallo'))
+        self.assertFalse(compile_match('h[^e]llo')('hello'))
+        self.assertTrue(compile_match('h[a-c]llo')('hbllo'))
+        self.assertFalse(compile_match('h[a-c]llo')('hdllo'))
+        self.assertTrue(compile_match('h\\*')('h*'))
+        self.assertFalse(compile_match('h\\*')('hx'))
+        self.assertFalse(compile_match('a.c')('abc'))
+        self.assertTrue(compile_match(b'a*')(b'abc'))
+        self.assertTrue(compile_match('1?')(12))
+        self.assertIs(compile_match('h*'), compile_match('h*'))
+
+    def test_scan_after_compaction(self):
+        data = ScanDict((i, i) for i in range(SCAN_LOG_SLACK + 2))
+        for i in range(SCAN_LOG_SLACK + 2):
+            del data[i]
+        # the last deletion compacted the log
+        self.assertEqual(data._keys, [])
+        data['new'] = 1
+        self.assertEqual(data._keys, ['new'])
+        self.assertEqual(data.scan(0, 1000), (0, ['new']))
+
+    def test_scan_readded_keys(self):
+        data = ScanDict()
+        for i in range(5):
+            for key in range(10):
+                data[key] = i
+                if i < 4:
+                    del data[key]
+        cursor, keys = data.scan(0, 1000)
+        self.assertEqual(cursor, 0)
+        self.assertEqual(sorted(keys), list(range(10)))
+        cursor, keys = data.scan(0, 3)
+        seen = list(keys)
+        while cursor:
+            cursor, keys = data.scan(cursor, 3)
+            seen.extend(keys)
+        self.assertEqual(sorted(seen), list(range(10)))
+
+    def test_scan_after_removals(self):
+        data = ScanDict((i, i) for i in range(10000))
+        for i in range(10, 10000):
+            if i % 3 == 0:
+                del data[i]
+            elif i % 3 == 1:
+                data.pop(i)
+            else:
+                data.pop(i, None)
+        # removals compact the log too
+        self.assertLessEqual(len(data._keys), 2 * len(data) + SCAN_LOG_SLACK)
+        self.assertEqual(len(data._positions), 10)
+        self.assertEqual(sorted(data.scan(0, 1000)[1]), list(range(10)))
+        key, value = data.popitem()
+        self.assertEqual(sorted(data.scan(0, 1000)[1] + [key]), list(range(10)))
+        data.clear()
+        data['new'] = 1
+        self.assertEqual(data.scan(0, 1000), (0, ['new']))
+
+
+    def test_intset_encoding(self):
+        s = Set(5, 1, 3)
+        self.assertIs(type(s._set), IntSet)
+        self.assertEqual(list(s._set), [1, 3, 5])
+        self.assertEqual(s.sadd(4, 5, 2), 2)
+        self.assertEqual(list(s._set), [1, 2, 3, 4, 5])
+        self.assertTrue(s.sismember(4))
+        self.assertFalse(s.sismember(6))
+        self.assertFalse(s.sismember('a'))
+        self.assertEqual(s.srem(1, 5, 6, 'a'), 2)
+        self.assertIn(s.spop(), [2, 3, 4])
+        self.assertEqual(s.scard(), 2)
+
+    def test_intset_converts_to_set(self):
+        class SmallSet(Set):
+            max_intset_entries = 3
+
+        s = SmallSet(1, 2, 3)
+        self.assertIs(type(s._set), IntSet)
+        s.sadd(4)
+        self.assertIs(type(s._set), DenseSet)
+        s = SmallSet(1, 2**63)
+        self.assertIs(type(s._set), DenseSet)
+        s = SmallSet(1)
+        self.assertEqual(s.sadd('a', 1), 1)
+        self.assertEqual(s._set, set([1, 'a']))
+
+    def test_and_or(self):
+        a, b, c = Set(*range(0, 20, 2)), Set(*range(0, 20, 3)), Set('a', 0, 3)
+        self.assertEqual(a & b, IntSet([0, 6, 12, 18]))
+        self.assertEqual(list(a | b), [0, 2, 3, 4, 6, 8, 9, 10, 12, 14, 15, 16, 18])
+        self.assertEqual(a & c, set([0]))
+        self.assertEqual(c & b, set([0, 3]))
+        self.assertEqual(c | Set(1), set(['a', 0, 1, 3]))
+        self.assertEqual(Set(*range(1000)) & Set(5, 999, 1000), IntSet([5, 999]))
+
 
 class ListTestCase(unittest.TestCase):
 
     def test_lindex(self):
         l = List()
-        l._list = ['a', 'b', 'c']
+        l.rpush('a', 'b', 'c')
         self.assertEqual(l.lindex(0), 'a')
         self.assertEqual(l.lindex(1), 'b')
         self.assertEqual(l.lindex(2), 'c')
@@ -274,7 +930,7 @@ class ListTestCase(unittest.TestCase):
 
     def test_lrange(self):
         l = List()
-        l._list = ['a', 'b', 'c', 'd']
+        l.rpush('a', 'b', 'c', 'd')
         self.assertEqual(l.lrange(1, -2), ['b', 'c'])
 
     def test_lpush(self):
@@ -282,11 +938,11 @@ class ListTestCase(unittest.TestCase):
         l.lpush('a')
         l.lpush('b')
         l.lpush('c')
-        self.assertEqual(l._list, ['c', 'b', 'a'])
+        self.assertEqual(list(l._list), ['c', 'b', 'a'])
 
     def test_lpop(self):
         l = List()
-        l._list = ['a', 'b', 'c']
+        l.rpush('a', 'b', 'c')
         self.assertEqual(l.lpop(), 'a')
         self.assertEqual(l.lpop(), 'b')
         self.assertEqual(l.lpop(), 'c')
@@ -294,22 +950,22 @@ class ListTestCase(unittest.TestCase):
 
     def test_lrem_gt_0(self):
         l = List()
-        l._list = ['a', 'b', 'a', 'b', 'a', 'b']
+        l.rpush('a', 'b', 'a', 'b', 'a', 'b')
         self.assertEqual(l.lrem(1, 'b'), 1)
-        self.assertEqual(l._list, ['a', 'a', 'b', 'a', 'b'])
+        self.assertEqual(list(l._list), ['a', 'a', 'b', 'a', 'b'])
 
     def test_lrem_lt_0(self):
         l = List()
-        l._list = ['a', 'b', 'a', 'b', 'a', 'b']
+        l.rpush('a', 'b', 'a', 'b', 'a', 'b')
 
         self.assertEqual(l.lrem(-2, 'b'), 2)
-        self.assertEqual(l._list, ['a', 'b', 'a', 'a'])
+        self.assertEqual(list(l._list), ['a', 'b', 'a', 'a'])
 
     def test_lrem_eq_0(self):
         l = List()
-        l._list = ['a', 'b', 'a', 'b', 'a', 'b']
+        l.rpush('a', 'b', 'a', 'b', 'a', 'b')
         self.assertEqual(l.lrem(0, 'a'), 3)
-        self.assertEqual(l._list, ['b', 'b', 'b'])
+        self.assertEqual(list(l._list), ['b', 'b', 'b'])
 
     def test_lset(self):
         l = List()
@@ -335,13 +991,13 @@ class ListTestCase(unittest.TestCase):
 
     def test_ltrim(self):
         l = List()
-        l._list = ['a', 'b', 'c', 'd']
+        l.rpush('a', 'b', 'c', 'd')
         l.ltrim(1, -2)
-        self.assertEqual(l._list, ['b', 'c'])
+        self.assertEqual(list(l._list), ['b', 'c'])
 
     def test_rpop(self):
         l = List()
-        l._list = ['a', 'b', 'c']
+        l.rpush('a', 'b', 'c')
         self.assertEqual(l.rpop(), 'c')
         self.assertEqual(l.rpop(), 'b')
         self.assertEqual(l.rpop(), 'a')
@@ -352,7 +1008,1379 @@ class ListTestCase(unittest.TestCase):
         l.rpush('a')
         l.rpush('b')
         l.rpush('c')
-        self.assertEqual(l._list, ['a', 'b', 'c'])
+        self.assertEqual(list(l._list), ['a', 'b', 'c'])
+
+    def test_lpush_rpush_multiple(self):
+        l = List()
+        self.assertEqual(l.rpush('c', 'd'), 2)
+        self.assertEqual(l.lpush('b', 'a'), 4)
+        self.assertEqual(l.lrange(0, -1), ['a', 'b', 'c', 'd'])
+
+    def test_lmove(self):
+        source, destination = List(), List()
+        source.rpush('a', 'b', 'c')
+        self.assertEqual(source.lmove(destination), 'a')
+        self.assertEqual(source.lmove(destination, 'RIGHT', 'LEFT'), 'c')
+        self.assertEqual(destination.lrange(0, -1), ['c', 'a'])
+        self.assertEqual(source.lmove(source, 'left', 'right'), 'b')
+        self.assertEqual(List().lmove(destination), None)
+        with self.assertRaises(RedisError):
+            source.lmove(destination, 'up', 'left')
+
+    def test_blpop(self):
+        a, b = List(), List()
+        b.rpush('x', 'y')
+        self.assertEqual(a.blpop(b, timeout=1), (b, 'x'))
+        self.assertEqual(a.brpop(b, timeout=1), (b, 'y'))
+        self.assertEqual(a.blpop(b, timeout=0.01), None)
+        self.assertEqual(a._waiters, deque())
+
+        timer = threading.Timer(0.05, lambda: b.rpush('z'))
+        timer.start()
+        self.assertEqual(a.blpop(b, timeout=5), (b, 'z'))
+        timer.join()
+
+    def test_blpop_wakes_one_waiter_per_item(self):
+        l = List()
+        results = []
+        threads = []
+        for i in range(3):
+            thread = threading.Thread(target=lambda i=i: results.append((i, l.blpop(timeout=0.5))))
+            thread.start()
+            threads.append(thread)
+            while len(l._waiters or ()) < i + 1:
+                time.sleep(0.001)
+        l.rpush('a', 'b')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [(0, (l, 'a')), (1, (l, 'b')), (2, None)])
+
+    def test_blmove(self):
+        source, destination = List(), List()
+        timer = threading.Timer(0.05, lambda: source.lpush('a'))
+        timer.start()
+        self.assertEqual(source.blmove(destination, 'left', 'left', timeout=5), 'a')
+        timer.join()
+        self.assertEqual(destination.lrange(0, -1), ['a'])
+        self.assertEqual(source.blmove(destination, timeout=0.01), None)
+
+    def test_ablpop(self):
+        source, destination = List(), List()
+
+        async def consume():
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.01, lambda: source.rpush('a', 'b'))
+            first = await source.ablpop(timeout=5)
+            second = await source.ablmove(destination, timeout=5)
+            third = await source.abrpop(timeout=0.01)
+            return first, second, third
+
+        self.assertEqual(asyncio.run(consume()), ((source, 'a'), 'b', None))
+        self.assertEqual(destination.lrange(0, -1), ['b'])
+
+    def test_matches_python_list(self):
+        l = List()
+        l._list = QuickList(chunk_size=4)
+        expected = []
+        for i in range(3000):
+            op = random.randint(0, 9)
+            value = random.randint(0, 20)
+            if op == 0:
+                l.lpush(value, value + 1)
+                expected[0:0] = [value + 1, value]
+            elif op == 1:
+                l.rpush(value)
+                expected.append(value)
+            elif op == 2:
+                self.assertEqual(l.lpop(), expected.pop(0) if expected else None)
+            elif op == 3:
+                self.assertEqual(l.rpop(), expected.pop() if expected else None)
+            elif op == 4 and expected:
+                index = random.randint(-len(expected), len(expected) - 1)
+                l.lset(index, value)
+                expected[index] = value
+            elif op == 5:
+                where = random.choice(['before', 'after'])
+                if value in expected:
+                    i = expected.index(value)
+                    expected.insert(i if where == 'before' else i + 1, -value)
+                self.assertEqual(l.linsert(where, value, -value), len(expected) if value in expected else -1)
+            elif op == 6:
+                count = random.randint(-2, 2)
+                positions = [i for i, item in enumerate(expected) if item == value]
+                if count > 0:
+                    positions = positions[:count]
+                elif count < 0:
+                    positions = positions[count:]
+                for i in reversed(positions):
+                    del expected[i]
+                self.assertEqual(l.lrem(count, value), len(positions))
+            elif op == 7 and random.random() < 0.1:
+                start, end = random.randint(-10, 10), random.randint(-10, 10)
+                l.ltrim(start, end)
+                start = max(len(expected) + start, 0) if start < 0 else start
+                end = len(expected) + end if end < 0 else end
+                expected = expected[start:end + 1] if start <= end else []
+            self.assertEqual(l.llen(), len(expected))
+            index = random.randint(-len(expected) - 1, len(expected))
+            self.assertEqual(l.lindex(index), expected[index] if -len(expected) <= index < len(expected) else None)
+        self.assertEqual(l.lrange(0, -1), expected)
+        self.assertEqual(list(reversed(l._list)), expected[::-1])
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def test_set_get(self):
+        db = Database()
+        self.assertEqual(db.get('a'), None)
+        self.assertTrue(db.set('a', 'aa'))
+        self.assertEqual(db.get('a'), 'aa')
+        self.assertEqual(db.set('a', 'bb', nx=True), None)
+        self.assertEqual(db.set('b', 'bb', xx=True), None)
+        self.assertTrue(db.set('a', 'bb', xx=True))
+        self.assertEqual(db.get('a'), 'bb')
+        with self.assertRaises(RedisError):
+            db.set('a', ZSet())
+        with self.assertRaises(RedisError):
+            db.set('a', 'x', ex=0)
+
+    def test_types(self):
+        db = Database()
+        db.set('s', 'x')
+        db.lookup('z', ZSet, create=True).zadd(a=1)
+        db.lookup('h', Hash, create=True).hset('a', 1)
+        db.lookup('l', List, create=True).rpush('a')
+        db.lookup('t', Set, create=True).sadd('a')
+        self.assertEqual([db.type(key) for key in 'szhltx'], ['string', 'zset', 'hash', 'list', 'set', 'none'])
+        self.assertEqual(db.lookup('z', ZSet).zscore('a'), 1)
+        with self.assertRaises(RedisError):
+            db.get('z')
+        with self.assertRaises(RedisError):
+            db.lookup('s', Hash)
+        with self.assertRaises(RedisError):
+            db.lookup('z', Hash, create=True)
+
+    def test_empty_collections_do_not_exist(self):
+        db = Database()
+        db.lookup('l', List, create=True).rpush('a')
+        self.assertEqual(db.exists('l'), 1)
+        db.lookup('l', List).lpop()
+        self.assertEqual(db.exists('l'), 0)
+        self.assertEqual(db.type('l'), 'none')
+        self.assertEqual(db.lookup('l', List), None)
+        self.assertEqual(db.dbsize(), 0)
+
+    def test_delete_exists_keys(self):
+        db = Database()
+        for key in ('user:1', 'user:2', 'item:1'):
+            db.set(key, 1)
+        self.assertEqual(db.exists('user:1', 'user:1', 'nope'), 2)
+        self.assertItemsEqual(db.keys('user:*'), ['user:1', 'user:2'])
+        self.assertEqual(db.delete('user:1', 'nope'), 1)
+        self.assertItemsEqual(db.keys(), ['user:2', 'item:1'])
+        db.flushdb()
+        self.assertEqual(db.keys(), [])
+
+    def test_expire(self):
+        db = Database()
+        db.set('a', 1)
+        self.assertEqual(db.ttl('a'), -1)
+        self.assertEqual(db.ttl('b'), -2)
+        self.assertFalse(db.expire('b', 10))
+        self.assertTrue(db.expire('a', 10))
+        self.assertEqual(db.ttl('a'), 10)
+        self.assertFalse(db.expire('a', 20, nx=True))
+        self.assertFalse(db.expire('a', 5, gt=True))
+        self.assertTrue(db.expire('a', 5, lt=True))
+        self.assertEqual(db.ttl('a'), 5)
+        db.set('a', 2, keepttl=True)
+        self.assertEqual(db.ttl('a'), 5)
+        self.assertTrue(db.persist('a'))
+        self.assertFalse(db.persist('a'))
+        db.set('a', 3, ex=100)
+        self.assertEqual(db.ttl('a'), 100)
+        db.set('a', 4)
+        self.assertEqual(db.ttl('a'), -1)
+        self.assertTrue(db.expire('a', 0))
+        self.assertEqual(db.exists('a'), 0)
+
+    def test_lazy_expiry(self):
+        db = Database()
+        db.set('a', 1, px=10)
+        db.set('b', 1)
+        db.pexpire('b', 10)
+        self.assertTrue(0 < db.pttl('a') <= 10)
+        time.sleep(0.02)
+        self.assertEqual(db.dbsize(), 2)
+        self.assertEqual(db.get('a'), None)
+        self.assertEqual(db.keys(), [])
+        self.assertEqual(db.dbsize(), 0)
+        self.assertTrue(db.set('b', 2, nx=True))
+
+    def test_active_expire_cycle(self):
+        db = Database()
+        for i in range(1000):
+            db.set(i, i)
+        # half of the keys expired long ago
+        for i in range(500):
+            db._expires[i] = 1
+            db._volatile.add(i)
+        db.expire(999, 100)
+        removed = 0
+        while True:
+            expired = db.active_expire_cycle(time_limit=1)
+            if not expired:
+                break
+            removed += expired
+        self.assertTrue(removed > 0)
+        self.assertEqual(db.dbsize(), 1000 - removed)
+        self.assertEqual(db.exists(999), 1)
+        self.assertEqual(len(db.keys()), 500)
+
+    def test_hash_field_expiry(self):
+        scheduled = len(Hash.timer_wheel)
+        db = Database()
+        h = db.lookup('h', Hash, create=True)
+        h.hmset({'a': 1, 'b': 2})
+        h.hpexpire(10, 'a')
+        db.touch('h')
+        version = db.watch('h')
+        used = db.used_memory
+        time.sleep(0.02)
+        db.active_expire_cycle()
+        self.assertEqual(h.hgetall(), {'b': 2})
+        self.assertLess(db.used_memory, used)
+        self.assertTrue(db.watched_changed('h', version))
+        db.unwatch('h')
+
+        # the last field expiring removes the key, and the wheel of the
+        # database skips the fields of the hashes deleted
+        h.hpexpire(10, 'b')
+        db.lookup('other', Hash, create=True).hset('a', 1)
+        db.lookup('other').hpexpire(10000, 'a')
+        db.delete('other')
+        time.sleep(0.02)
+        db.active_expire_cycle()
+        self.assertEqual(db.dbsize(), 0)
+        self.assertEqual(db.used_memory, 0)
+        # nothing was scheduled on the wheel of the hashes outside databases
+        self.assertEqual(len(Hash.timer_wheel), scheduled)
+
+    def test_lookup_leaves_hash_fields(self):
+        db = Database()
+        h = db.lookup('h', Hash, create=True)
+        h.hmset({'a': 1, 'b': 2, 'c': 3})
+        h.hpexpire(1, 'a', 'b')
+        time.sleep(0.01)
+        # looking a hash up does not sweep its expired fields
+        self.assertEqual(db.exists('h'), 1)
+        self.assertIs(db.lookup('h', Hash), h)
+        self.assertEqual(len(h._data), 3)
+        self.assertEqual(h.hgetall(), {'c': 3})
+
+    def test_scan(self):
+        db = Database()
+        for i in range(100):
+            db.set('k%d' % i, i)
+        db.lookup('z', ZSet, create=True).zadd(a=1)
+        self.assertItemsEqual(db.scan_iter(count=7), ['k%d' % i for i in range(100)] + ['z'])
+        self.assertItemsEqual(db.scan_iter(match='k1?'), ['k1%d' % i for i in range(10)])
+        self.assertEqual(list(db.scan_iter(_type='zset')), ['z'])
+
+
+class PipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+
+    def test_execute(self):
+        pipe = self.db.pipeline()
+        pipe.zadd('z', a=1, b=2).zincrby('z', 'a', 5).zrange('z', 0, -1)
+        pipe.set('s', 'x').get('s').sadd('set', 1, 2).sinter('set', 'missing')
+        self.assertEqual(len(pipe), 7)
+        self.assertEqual(pipe.execute(), [2, 6, ['b', 'a'], True, 'x', 2, []])
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(self.db.type('z'), 'zset')
+
+    def test_store_and_destination_keys(self):
+        self.db.lookup('a', Set, create=True).sadd(1, 2, 3)
+        self.db.lookup('b', Set, create=True).sadd(2, 3, 4)
+        with self.db.pipeline() as pipe:
+            pipe.sinterstore('c', 'a', 'b').rpush('l', 'x', 'y').lmove('l', 'm', 'left', 'left')
+            self.assertEqual(pipe.execute(), [2, 2, 'x'])
+        self.assertItemsEqual(self.db.lookup('c').smembers(), [2, 3])
+        self.assertEqual(self.db.lookup('m').lrange(0, -1), ['x'])
+
+    def test_writes_to_missing_keys(self):
+        with self.db.pipeline() as pipe:
+            pipe.zrem('z', 'a').srem('s', 1).hdel('h', 'f').lpop('l')
+            pipe.linsert('l', 'before', 'x', 'y').lmove('l', 'm', 'left', 'left')
+            self.assertEqual(pipe.execute(), [0, 0, 0, None, -1, None])
+        self.assertEqual(self.db.dbsize(), 0)
+
+        self.db.set('k', 'x' * 100)
+        self.db.maxmemory = 1
+        with self.db.pipeline() as pipe:
+            pipe.zrem('z', 'a').zadd('z', a=1).zrem('z', 'a')
+            results = pipe.execute(raise_on_error=False)
+        self.assertEqual(results[0], 0)
+        self.assertIsInstance(results[1], RedisError)
+        self.assertEqual(results[2], 0)
+        self.assertEqual(self.db.dbsize(), 1)
+
+    def test_errors(self):
+        self.db.set('s', 'x')
+        pipe = self.db.pipeline()
+        pipe.lpush('s', 'a').set('t', 'y')
+        self.assertRaises(RedisError, pipe.execute)
+        self.assertEqual(self.db.get('t'), 'y')
+        results = pipe.lpush('s', 'a').get('t').execute(raise_on_error=False)
+        self.assertTrue(isinstance(results[0], RedisError))
+        self.assertEqual(results[1], 'y')
+        self.assertRaises(AttributeError, getattr, pipe, 'blpop')
+
+    def test_watch(self):
+        self.db.set('balance', 10)
+        with self.db.pipeline() as pipe:
+            pipe.watch('balance')
+            balance = pipe.get('balance')
+            pipe.multi()
+            pipe.set('balance', balance - 3)
+            self.assertEqual(pipe.execute(), [True])
+        self.assertEqual(self.db.get('balance'), 7)
+
+        with self.db.pipeline() as pipe:
+            pipe.watch('balance')
+            pipe.multi()
+            pipe.set('balance', 0)
+            self.db.set('balance', 100)
+            self.assertRaises(WatchError, pipe.execute)
+        self.assertEqual(self.db.get('balance'), 100)
+        self.assertEqual(self.db._watched, {})
+
+    def test_watch_expiry_and_structures(self):
+        pipe = self.db.pipeline()
+        self.db.lookup('h', Hash, create=True).hset('f', 1)
+        pipe.watch('h')
+        pipe.multi()
+        pipe.hget('h', 'f')
+        other = self.db.pipeline()
+        other.hset('h', 'f', 2).execute()
+        self.assertRaises(WatchError, pipe.execute)
+
+        self.db.set('k', 'v', px=1)
+        pipe.watch('k')
+        time.sleep(0.005)
+        pipe.multi()
+        self.assertRaises(WatchError, pipe.execute)
+
+        pipe.watch('unrelated')
+        pipe.multi()
+        pipe.set('x', 1)
+        self.assertEqual(pipe.execute(), [True])
+
+    def test_threads(self):
+        self.db.set('counter', 0)
+
+        def increment():
+            for i in range(50):
+                while True:
+                    with self.db.pipeline() as pipe:
+                        pipe.watch('counter')
+                        value = pipe.get('counter')
+                        pipe.multi()
+                        pipe.set('counter', value + 1)
+                        try:
+                            pipe.execute()
+                            break
+                        except WatchError:
+                            pass
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.db.get('counter'), 200)
+
+
+class MemoryTestCase(unittest.TestCase):
+    def _payload(self, values):
+        return sum(memory.sizeof(value) for value in values)
+
+    def test_structure_accounting(self):
+        classes = [ZSet, ColumnarZSet] if USE_NUMPY else [ZSet]
+        for cls in classes:
+            z = cls()
+            z.zadd_many([(b'm%d' % i, i) for i in range(200)])
+            z.zincrby(b'new', 5)
+            z.zrem(b'm1', b'm2', b'missing')
+            z.zremrangebyrank(0, 9)
+            z.zremrangebyscore(100, 149)
+            z.zpopmin(3)
+            self.assertEqual(z._used, self._payload(z.zrange(0, -1)))
+            self.assertGreater(z.memory_usage(), z._used + z.zcard() * memory.DICT_ENTRY)
+
+        h = Hash()
+        h.hset(b'a', b'1')
+        h.hset(b'a', b'longer value')
+        h.hincrby(b'n', 3)
+        usage = h.memory_usage()
+        h.hmset(dict((b'f%d' % i, b'x' * i) for i in range(300)))
+        self.assertGreater(h.memory_usage(), usage)
+        h.hdel(b'a', b'f7', b'missing')
+        self.assertEqual(h._used, self._payload(f for pair in h.hgetall().items() for f in pair))
+
+        s = Set()
+        s.sadd(1, 2, 3)
+        self.assertEqual(s.memory_usage(), memory.STRUCTURE + 3 * memory.INTSET_ENTRY)
+        s.sadd(b'member', b'other')
+        s.srem(1, b'other')
+        s.spop()
+        self.assertEqual(s._used, self._payload(s.smembers()))
+
+        l = List()
+        l.rpush(*[b'v%d' % i for i in range(500)])
+        l.lpush(b'head')
+        l.lpop()
+        l.rpop()
+        l.lset(3, b'a much longer value')
+        l.linsert('before', b'v10', b'inserted')
+        l.lrem(0, b'v20')
+        l.ltrim(2, 400)
+        self.assertEqual(l._list._used, self._payload(l.lrange(0, -1)))
+
+    def test_database_accounting(self):
+        db = Database()
+        db.set(b's', b'value')
+        db.lookup(b'z', ZSet, create=True).zadd_many([(b'a', 1), (b'b', 2)])
+        db.touch(b'z')
+        db.set(b't', b'value', ex=100)
+        self.assertEqual(db.used_memory, sum(db.memory_usage(key) for key in db.keys()))
+        self.assertEqual(db.memory_usage(b'missing'), None)
+        self.assertGreater(db.memory_usage(b't'), db.memory_usage(b's'))
+        db.delete(b's')
+        self.assertEqual(db.used_memory, sum(db.memory_usage(key) for key in db.keys()))
+        db.flushdb()
+        self.assertEqual(db.used_memory, 0)
+
+    def _filled(self, policy, n=100):
+        db = Database()
+        db.maxmemory_policy = policy
+        for i in range(n):
+            db.set(b'k%03d' % i, b'x' * 100)
+        db.maxmemory = db.used_memory
+        return db
+
+    def test_lru(self):
+        random.seed(0)
+        db = self._filled('allkeys-lru')
+        for i in range(10):
+            db.get(b'k%03d' % i)
+        for i in range(50):
+            db.set(b'n%03d' % i, b'x' * 100)
+        # a write may take the memory over the limit, the next one evicts
+        self.assertLessEqual(db.used_memory, db.maxmemory + db.memory_usage(b'n049'))
+        self.assertEqual(db.exists(*[b'k%03d' % i for i in range(10)]), 10)
+
+    def test_lfu(self):
+        random.seed(0)
+        db = self._filled('allkeys-lfu')
+        for j in range(20):
+            for i in range(90, 100):
+                db.get(b'k%03d' % i)
+        for i in range(50):
+            db.set(b'n%03d' % i, b'x' * 100)
+        # a write may take the memory over the limit, the next one evicts
+        self.assertLessEqual(db.used_memory, db.maxmemory + db.memory_usage(b'n049'))
+        self.assertEqual(db.exists(*[b'k%03d' % i for i in range(90, 100)]), 10)
+
+    def test_evict_after_churn(self):
+        random.seed(0)
+        db = Database()
+        db.maxmemory_policy = 'allkeys-lru'
+        for j in range(50):
+            for i in range(SCAN_LOG_SLACK):
+                db.set(b't%d' % i, b'x')
+            db.delete(*[b't%d' % i for i in range(SCAN_LOG_SLACK)])
+            # delete and add the same keys again and again
+            for i in range(20):
+                db.delete(b'k%d' % i)
+                db.set(b'k%d' % i, b'x')
+        db.maxmemory = 1
+        self.assertEqual(len(db.evict()), 20)
+        self.assertEqual(db.dbsize(), 0)
+
+    def test_evict_after_deletions(self):
+        random.seed(0)
+        for kept in (10, 1):
+            db = Database()
+            db.maxmemory_policy = 'allkeys-lru'
+            for i in range(10000):
+                db.set(b'k%d' % i, b'x')
+            # the key log keeps up to SCAN_LOG_SLACK stale entries
+            db.delete(*[b'k%d' % i for i in range(10000) if i % (10000 // kept)])
+            db.maxmemory = 1
+            self.assertEqual(len(db.evict()), kept)
+            self.assertEqual(db.dbsize(), 0)
+
+    def test_scan_index_accounting(self):
+        db = Database()
+        db.set(b'k', b'v')
+        self.assertEqual(db.used_memory, memory.key_memory(b'k', b'v'))
+        self.assertGreaterEqual(db.used_memory, memory.DICT_ENTRY + memory.SCAN_ENTRY)
+        h = Hash()
+        h.hmset(dict((b'f%d' % i, b'v') for i in range(300)))
+        self.assertGreater(h.memory_usage(), h._used + 300 * (memory.DICT_ENTRY + memory.SCAN_ENTRY))
+
+    def test_volatile_ttl(self):
+        db = self._filled('volatile-ttl', 10)
+        db.expire(b'k000', 100)
+        db.expire(b'k001', 10)
+        db.maxmemory = db.used_memory
+        db.set(b'n0', b'x' * 100)
+        db.set(b'n1', b'x' * 100)
+        self.assertEqual(db.exists(b'k000', b'k001'), 1)
+        self.assertEqual(db.exists(b'k000'), 1)
+        with self.assertRaises(RedisError):
+            for i in range(2, 10):
+                db.set(b'n%d' % i, b'x' * 100)
+        # only the keys with a time to live are evicted
+        self.assertEqual(db.exists(b'k000'), 0)
+        self.assertEqual(db.exists(*[b'k%03d' % i for i in range(2, 10)]), 8)
+
+    def test_noeviction(self):
+        db = self._filled('noeviction', 10)
+        db.set(b'new', b'x' * 100)
+        with self.assertRaises(RedisError):
+            db.set(b'other', b'x' * 100)
+        self.assertEqual(db.delete(b'new', b'k000'), 2)
+        self.assertTrue(db.set(b'other', b'x' * 100))
+        self.assertEqual(db.evict(), [])
+
+    def test_server(self):
+        async def run():
+            server = Server(databases=1, maxmemory=1, maxmemory_policy='noeviction')
+            client = Client(server, 1, None)
+            call = lambda *args: server.call(client, [arg.encode() for arg in args])
+            self.assertEqual(call('set', 'a', 'value'), OK)
+            self.assertIsInstance(call('set', 'b', 'value'), RedisError)
+            self.assertIsInstance(call('memory', 'usage', 'a'), int)
+            self.assertEqual(call('memory', 'usage', 'b'), None)
+            self.assertEqual(call('del', 'a'), 1)
+            server.maxmemory_policy = 'allkeys-lru'
+            for key in 'abc':
+                call('set', key, 'value')
+            self.assertEqual(server.evicted_keys, 2)
+            self.assertEqual(call('dbsize'), 1)
+            self.assertIn('evicted_keys:2', call('info'))
+            self.assertIsInstance(call('memory', 'usage', 'c'), int)
+        asyncio.run(run())
+
+
+class ShardedTestCase(unittest.TestCase):
+    def test_commands(self):
+        db = ShardedDatabase(4)
+        keys = ['k%d' % i for i in range(20)]
+        # str hashes are randomized, all the shards may not get a key
+        self.assertGreater(len(set(db._index(key) for key in keys)), 1)
+        for i, key in enumerate(keys):
+            db.zadd(key, a=i, b=1)
+        self.assertEqual(db.zscore('k3', 'a'), 3)
+        self.assertEqual(db.zunionstore('total', *keys), 2)
+        self.assertEqual(db.zscore('total', 'a'), sum(range(20)))
+        self.assertEqual(db.type('total'), 'zset')
+        db.rpush('src', 'x')
+        self.assertEqual(db.lmove('src', 'dst'), 'x')
+        self.assertEqual(db.exists('src', 'dst', 'k0'), 2)
+        self.assertTrue(db.set('s', 'v', ex=10))
+        self.assertEqual(db.ttl('s'), 10)
+        self.assertEqual(db.dbsize(), 23)
+        self.assertItemsEqual(db.scan_iter(count=3), keys + ['total', 'dst', 's'])
+        self.assertItemsEqual(db.keys('k1*'), ['k1'] + ['k1%d' % i for i in range(10)])
+        self.assertEqual(db.delete(*keys), 20)
+        with self.assertRaises(RedisError):
+            db.sadd('s', 'x')
+        with self.assertRaises(AttributeError):
+            db.unknown
+        self.assertTrue(db.flushdb())
+        self.assertEqual(db.dbsize(), 0)
+        self.assertEqual(db.used_memory, 0)
+
+    def test_threads(self):
+        db = ShardedDatabase(8)
+        keys = ['k%d' % i for i in range(16)]
+
+        def work(seed):
+            rng = random.Random(seed)
+            for i in range(500):
+                db.zincrby(rng.choice(keys), 'n', 1)
+                # multi-key commands lock their shards in order, whatever
+                # the order of their keys
+                db.zunionstore('u%d' % seed, *rng.sample(keys, 3))
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(db.zscore(key, 'n') or 0 for key in keys), 2000)
+        with db.locked('k1', 'k2'):
+            value = db.shard('k1').lookup('k1')
+            self.assertEqual(db.lookup('k1'), value)
+
+    def test_hash_field_expiry(self):
+        scheduled = len(expiry.wheel)
+        db = ShardedDatabase(4)
+        keys = ['h%d' % i for i in range(8)]
+        for key in keys:
+            db.hset(key, 'a', 1)
+            db.hset(key, 'b', 2)
+            db.hpexpire(key, 10, 'a')
+        # each shard schedules the fields of its hashes on its own wheel
+        self.assertEqual(sum(len(shard._wheel) for shard in db.shards), 8)
+        self.assertEqual(len(expiry.wheel), scheduled)
+        time.sleep(0.02)
+        db.active_expire_cycle()
+        self.assertEqual(sum(len(shard._wheel) for shard in db.shards), 0)
+        for key in keys:
+            self.assertEqual(db.shard(key).lookup(key)._data, {'b': 2})
+
+
+# Written by redis-server 6.2: ziplists, an intset, a quicklist and an LZF string
+REDIS_6_DUMP = (
+    b'REDIS0009\xfa\tredis-ver\x066.2.14\xfa\nredis-bits\xc0@\xfa\x05ctime'
+    b'\xc2\xd1\x17\xd5j\xfa\x08used-mem\xc2\xe8Q\x0e\x00\xfa\x0caof-preamb'
+    b'le\xc0\x00\xfe\x00\xfb\x06\x00\r\x01h\x19\x19\x00\x00\x00\x12\x00'
+    b'\x00\x00\x04\x00\x00\x01f\x03\xf2\x02\x01g\x03\x04text\xff\x00\x01n'
+    b'\xc1\xd4\xfe\x0e\x01l\x01\x15\x15\x00\x00\x00\x0f\x00\x00\x00\x03'
+    b'\x00\x00\x01x\x03\xf8\x02\xf0`y\xfe\xff\x00\x03str\xc3\x0b\x1e\x03ab'
+    b'ca\xe0\x0f\x02\x01bc\x0b\x01s\x14\x04\x00\x00\x00\x03\x00\x00\x00'
+    b'\x01\x00\x00\x00\x02\x00\x00\x00p\x11\x01\x00\x0c\x01z\x18\x18\x00'
+    b'\x00\x00\x12\x00\x00\x00\x04\x00\x00\x01a\x03\xf2\x02\x01b\x03\x032.'
+    b'5\xff\xffZ\xc2\xf3\x92\xe6[Fx'
+)
+
+
+class RdbTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        db = Database()
+        db.set(b'str', b'hello')
+        db.set(b'num', 12345)
+        db.set(b'big', b'x' * 70000)
+        db.set(b'volatile', b'v', px=100000)
+        db.lookup(b'small', ZSet, create=True).zadd_many([(b'a', 1.0), (b'b', 2.5), (b'c', float('-inf'))])
+        db.lookup(b'large', ZSet, create=True).zadd_many([(b'm%d' % i, i / 3.0) for i in range(300)])
+        db.lookup(b'hash', Hash, create=True).hset(b'f', 10)
+        h = db.lookup(b'dict', Hash, create=True)
+        for i in range(200):
+            h.hset(b'f%d' % i, b'v%d' % i)
+        db.lookup(b'ints', Set, create=True).sadd(3, -70000, 2 ** 40)
+        db.lookup(b'strs', Set, create=True).sadd(b'a', 7)
+        db.lookup(b'list', List, create=True).rpush(*[b'e%d' % i for i in range(300)] + [b'-5'])
+        other = Database()
+        other.set(b'k', b'v')
+
+        f = io.BytesIO()
+        rdb.dump([db, Database(), other], f)
+        self.assertEqual(f.getvalue()[:9], b'REDIS0011')
+        loaded = rdb.loads(f.getvalue())
+
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded[1].dbsize(), 0)
+        self.assertEqual(loaded[2].get(b'k'), b'v')
+        db2 = loaded[0]
+        self.assertEqual(db2.dbsize(), db.dbsize())
+        self.assertEqual(db2.get(b'str'), b'hello')
+        self.assertEqual(db2.get(b'num'), b'12345')
+        self.assertEqual(db2.get(b'big'), b'x' * 70000)
+        self.assertTrue(99000 < db2.pttl(b'volatile') <= 100000)
+        self.assertEqual(db2.ttl(b'str'), -1)
+        for key in (b'small', b'large'):
+            self.assertEqual(db2.lookup(key).zrange(0, -1, withscores=True),
+                             db.lookup(key).zrange(0, -1, withscores=True))
+        self.assertEqual(db2.lookup(b'hash').hgetall(), {b'f': b'10'})
+        self.assertEqual(type(db2.lookup(b'hash')._data), ListPack)
+        self.assertEqual(db2.lookup(b'dict').hgetall(), db.lookup(b'dict').hgetall())
+        self.assertEqual(type(db2.lookup(b'dict')._data), ScanDict)
+        self.assertEqual(db2.lookup(b'ints')._set, IntSet([3, -70000, 2 ** 40]))
+        self.assertEqual(db2.lookup(b'strs')._set, set([b'a', 7]))
+        self.assertEqual(db2.lookup(b'list').lrange(0, -1), db.lookup(b'list').lrange(0, -1))
+
+    def test_hash_field_ttl(self):
+        db = Database()
+        h = db.lookup(b'h', Hash, create=True)
+        h.hset(b'a', b'1')
+        h.hset(b'b', b'2')
+        h.hpexpire(100000, b'a')
+        f = io.BytesIO()
+        rdb.dump(db, f)
+        self.assertEqual(f.getvalue()[:9], b'REDIS0012')
+        h = rdb.loads(f.getvalue())[0].lookup(b'h')
+        self.assertEqual(h.hgetall(), {b'a': b'1', b'b': b'2'})
+        ttl, persistent = h.hpttl(b'a', b'b')
+        self.assertTrue(99000 < ttl <= 100000)
+        self.assertEqual(persistent, -1)
+
+    def test_expired_keys_are_skipped(self):
+        db = Database()
+        db.set(b'a', b'1', px=1)
+        db.set(b'b', b'2')
+        time.sleep(0.005)
+        f = io.BytesIO()
+        rdb.dump(db, f)
+        self.assertEqual(rdb.loads(f.getvalue())[0].keys(b'*'), [b'b'])
+
+    def test_checksum(self):
+        db = Database()
+        db.set(b'a', b'hello')
+        f = io.BytesIO()
+        rdb.dump(db, f)
+        data = bytearray(f.getvalue())
+        data[-10] ^= 1
+        self.assertRaises(RedisError, rdb.loads, bytes(data))
+        self.assertEqual(rdb.loads(bytes(data), verify=False)[0].get(b'a'), b'helln')
+        self.assertEqual(rdb.crc64(0, b'123456789'), 0xe9c6d914c4b8d9ca)
+
+    def test_crc64(self):
+        table = rdb._CRC64_TABLE
+        for n in (0, 7, 8, 9, rdb.CRC64_BLOCK + 3, rdb.CRC64_NUMPY_MIN, 3 * rdb.CRC64_NUMPY_MIN + 5):
+            data = os.urandom(n)
+            expected = 1234
+            for byte in data:
+                expected = table[(expected ^ byte) & 0xff] ^ (expected >> 8)
+            self.assertEqual(rdb.crc64(1234, data), expected)
+            self.assertEqual(rdb._crc64_python(1234, bytearray(data)), expected)
+
+    def test_load_streams(self):
+        db = Database()
+        for i in range(5000):
+            db.set(b'k%d' % i, b'v' * (i % 50))
+        db.set(b'big', b'x' * (3 * rdb.READ_BUFFER_SIZE))
+        f = io.BytesIO()
+        rdb.dump(db, f)
+        data = f.getvalue()
+        sizes = []
+
+        class Reader(io.BytesIO):
+            def read(self, n=-1):
+                sizes.append(n)
+                return io.BytesIO.read(self, n)
+
+        loaded, length = rdb._load(Reader(data + b'tail'))
+        self.assertEqual(length, len(data))
+        self.assertEqual(loaded[0].dbsize(), 5001)
+        self.assertEqual(loaded[0].get(b'k4999'), b'v' * 49)
+        self.assertEqual(loaded[0].get(b'big'), b'x' * (3 * rdb.READ_BUFFER_SIZE))
+        self.assertTrue(-1 not in sizes and len(sizes) > 3)
+        corrupt = bytearray(data)
+        corrupt[len(data) // 3] ^= 1
+        self.assertRaises(RedisError, rdb.loads, bytes(corrupt))
+
+    def test_load_redis_dump(self):
+        db = rdb.loads(REDIS_6_DUMP)[0]
+        self.assertEqual(db.get(b'str'), b'abc' * 10)
+        self.assertEqual(db.get(b'n'), b'-300')
+        self.assertEqual(db.lookup(b'h').hgetall(), {b'f': b'1', b'g': b'text'})
+        self.assertEqual(db.lookup(b's')._set, IntSet([1, 2, 70000]))
+        self.assertEqual(db.lookup(b'z').zrange(0, -1, withscores=True), [(b'a', 1.0), (b'b', 2.5)])
+        self.assertEqual(db.lookup(b'l').lrange(0, -1), [b'x', b'7', b'-100000'])
+
+    def test_listpack(self):
+        values = [0, 127, 128, -4096, 4095, 40000, -8388608, 2 ** 31, -2 ** 63, b'', b'a' * 63, b'b' * 64, b'c' * 5000]
+        self.assertEqual(rdb.decode_listpack(rdb.encode_listpack(values)), values)
+        self.assertEqual(rdb.encode_listpack([b'7', b'ab']), b'\x0d\x00\x00\x00\x02\x00\x07\x01\x82ab\x03\xff')
+
+    def test_save_and_load_files(self):
+        db = Database()
+        db.set(b'a', b'1')
+        path = os.path.join(tempfile.mkdtemp(), 'dump.rdb')
+        rdb.save(db, path)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['dump.rdb'])
+        self.assertEqual(rdb.load(path)[0].get(b'a'), b'1')
+
+
+class MappedTestCase(unittest.TestCase):
+    def _round_trip(self, *databases):
+        path = os.path.join(tempfile.mkdtemp(), 'dump.map')
+        mapped.save(list(databases), path)
+        self.assertTrue(mapped.is_snapshot(path))
+        return mapped.load(path)
+
+    def test_round_trip(self):
+        db = Database()
+        db.set(b'str', b'hello')
+        db.set(b'volatile', b'v', px=100000)
+        db.set(b'expired', b'v', px=1)
+        db.lookup(b'ints', Set, create=True).sadd(3, -70000, 2 ** 40)
+        db.lookup(b'strs', Set, create=True).sadd(b'b', 7, b'a')
+        db.lookup(b'list', List, create=True).rpush(b'x', b'y', b'x')
+        h = db.lookup(b'ttl', Hash, create=True)
+        h.hmset({b'a': b'1', b'b': b'2'})
+        h.hpexpire(100000, b'a')
+        other = Database()
+        other.set(b'k', b'v')
+        time.sleep(0.005)
+
+        loaded = self._round_trip(db, Database(), other)
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded[2].get(b'k'), b'v')
+        db2 = loaded[0]
+        self.assertEqual(sorted(db2.keys(b'*')), [b'ints', b'list', b'str', b'strs', b'ttl', b'volatile'])
+        self.assertEqual(db2.get(b'str'), b'hello')
+        self.assertTrue(99000 < db2.pttl(b'volatile') <= 100000)
+        self.assertEqual(db2.lookup(b'list').lrange(0, -1), [b'x', b'y', b'x'])
+        s = db2.lookup(b'ints')
+        self.assertEqual(type(s), mapped.MappedSet)
+        self.assertEqual(s.smembers(), [-70000, 3, 2 ** 40])
+        self.assertTrue(s.sismember(3))
+        self.assertFalse(s.sismember(b'3'))
+        s = db2.lookup(b'strs')
+        self.assertEqual(s.smembers(), [7, b'a', b'b'])
+        self.assertTrue(s.sismember(7))
+        self.assertFalse(s.sismember(b'7'))
+        self.assertEqual(sorted(s.sinter(db.lookup(b'strs')), key=str), [7, b'a', b'b'])
+        self.assertEqual(sorted(s.srandmember(5), key=str), [7, b'a', b'b'])
+        self.assertEqual(sorted(s.sscan_iter(count=2), key=str), [7, b'a', b'b'])
+        h = db2.lookup(b'ttl')
+        self.assertEqual(h.hgetall(), {b'a': b'1', b'b': b'2'})
+        self.assertTrue(99000 < h.hpttl(b'a')[0] <= 100000)
+
+    def test_zset_is_served_from_the_mapping(self):
+        db = Database()
+        zset = db.lookup(b'z', ZSet, create=True)
+        zset.zadd_many([(b'm%03d' % i, i // 3) for i in range(300)] + [(b'lex', -1.0), (b'low', float('-inf'))])
+        db2 = self._round_trip(db)[0]
+        z = db2.lookup(b'z')
+        self.assertEqual(type(z), mapped.MappedZSet)
+        self.assertEqual(z.zcard(), 302)
+        self.assertEqual(z.zrange(0, -1, withscores=True), zset.zrange(0, -1, withscores=True))
+        self.assertEqual(z.zrevrange(3, 10), zset.zrevrange(3, 10))
+        self.assertEqual(z.zrangebyscore(10, 20, start=2, num=5, withscores=True),
+                         zset.zrangebyscore(10, 20, start=2, num=5, withscores=True))
+        self.assertEqual(z.zrevrangebyscore(30, 0), zset.zrevrangebyscore(30, 0))
+        self.assertEqual(z.zcount(5, 7), 9)
+        self.assertEqual(z.zcount(7, 5), 0)
+        for member in (b'low', b'lex', b'm000', b'm150', b'm299', b'missing', 'm001'):
+            self.assertEqual(z.zscore(member), zset.zscore(member))
+            self.assertEqual(z.zrank(member), zset.zrank(member))
+            self.assertEqual(z.zrevrank(member), zset.zrevrank(member))
+        self.assertEqual(z.zrangebylex(b'[m003', b'(m005'), [b'm003', b'm004'])
+        self.assertEqual(sorted(z.zscan_iter(count=7)), sorted(zset.zscan_iter()))
+        self.assertEqual(z.zunion(zset, withscores=True)[:2], [(b'low', float('-inf')), (b'lex', -2.0)])
+
+        # the first write turns it into a regular sorted set, in place
+        self.assertEqual(z.zpopmin(), [(b'low', float('-inf'))])
+        self.assertIs(type(z), ZSet)
+        self.assertIs(db2.lookup(b'z'), z)
+        self.assertEqual(z.zadd_many([(b'm000', 1000)]), 0)
+        zset.zrem(b'low')
+        zset.zadd_many([(b'm000', 1000)])
+        self.assertEqual(z.zrange(0, -1, withscores=True), zset.zrange(0, -1, withscores=True))
+
+    def test_set_and_hash_materialize_on_write(self):
+        db = Database()
+        s = db.lookup(b's', Set, create=True)
+        s.sadd(*range(1000))
+        h = db.lookup(b'h', Hash, create=True)
+        h.hmset(dict((b'f%d' % i, b'v%d' % i) for i in range(200)))
+        db2 = self._round_trip(db)[0]
+
+        s2 = db2.lookup(b's')
+        self.assertEqual(s2.scard(), 1000)
+        self.assertEqual(s2.sintercard(s), 1000)
+        self.assertEqual(s2.srem(3, 5000), 1)
+        self.assertIs(type(s2), Set)
+        self.assertEqual(s2.scard(), 999)
+
+        h2 = db2.lookup(b'h')
+        self.assertEqual(type(h2), mapped.MappedHash)
+        self.assertEqual(h2.hget(b'f7'), b'v7')
+        self.assertEqual(h2.hget('f7'), None)
+        self.assertEqual(h2.hgetall(), h.hgetall())
+        self.assertEqual(dict(h2.hscan_iter(count=9)), h.hgetall())
+        self.assertEqual(h2.hmget([b'f1', b'x']), [b'v1', None])
+        self.assertEqual(h2.hincrby(b'n', 2), 2)
+        self.assertIs(type(h2), Hash)
+        self.assertEqual(h2.hlen(), 201)
+
+    def test_server_loads_and_saves_mapped_snapshots(self):
+        path = os.path.join(tempfile.mkdtemp(), 'dump.map')
+        db = Database()
+        db.lookup(b'z', ZSet, create=True).zadd_many([(b'a', 1), (b'b', 2)])
+        mapped.save(db, path)
+
+        async def run():
+            server = Server(databases=1, dbfilename=path, dbformat='mapped')
+            await server.start(port=None)
+            z = server.databases[0].lookup(b'z')
+            self.assertEqual(type(z), mapped.MappedZSet)
+            z.zadd(c=3)
+            server.save()
+            await server.close()
+        asyncio.run(run())
+        self.assertEqual(mapped.load(path)[0].lookup(b'z').zrange(0, -1), [b'a', b'b', b'c'])
+        rdb.save(db, path)
+        self.assertFalse(mapped.is_snapshot(path))
+        self.assertRaises(RedisError, mapped.load, path)
+
+
+def _command(*args):
+    "Encodes ``args`` as a RESP multibulk request"
+    out = b'*%d\r\n' % len(args)
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode()
+        out += b'$%d\r\n%s\r\n' % (len(arg), arg)
+    return out
+
+
+class ServerTestCase(unittest.TestCase):
+    def _encode(self, value, protocol=2):
+        out = bytearray()
+        encode(out, value, protocol)
+        return bytes(out)
+
+    def _session(self, *requests):
+        """ Sends each of ``requests`` on its own connection, in a single
+        write, and returns the replies read on each.
+        """
+        async def run():
+            server = Server(databases=2)
+            await server.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            replies = []
+            for request in requests:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request)
+                writer.write_eof()
+                replies.append(await reader.read())
+                writer.close()
+            await server.close()
+            return replies
+        return asyncio.run(run())
+
+    def test_parser_pipeline_and_partial_input(self):
+        parser = Parser()
+        data = _command('SET', 'a', 'x\r\ny') + _command('GET', 'a')
+        parser.feed(data[:-3])
+        self.assertEqual(parser.parse(), [[b'SET', b'a', b'x\r\ny']])
+        parser.feed(data[-3:])
+        self.assertEqual(parser.parse(), [[b'GET', b'a']])
+        self.assertEqual(parser.parse(), [])
+
+    def test_parser_inline(self):
+        parser = Parser()
+        parser.feed(b'PING\r\n\r\nECHO  hi\nGET')
+        self.assertEqual(parser.parse(), [[b'PING'], [b'ECHO', b'hi']])
+        parser.feed(b' a\r\n')
+        self.assertEqual(parser.parse(), [[b'GET', b'a']])
+
+    def test_parser_errors(self):
+        parser = Parser()
+        parser.feed(b'*1\r\n$-5\r\n')
+        self.assertEqual(parser.parse(), [])
+        self.assertTrue(isinstance(parser.error, ProtocolError))
+        parser = Parser()
+        parser.feed(b'PING\r\n*1\r\n:5\r\nPING\r\n')
+        self.assertEqual(parser.parse(), [[b'PING']])
+        self.assertEqual(str(parser.error), "Protocol error: expected '$', got ':'")
+
+    def test_encode(self):
+        self.assertEqual(self._encode(OK), b'+OK\r\n')
+        self.assertEqual(self._encode(b'ab'), b'$2\r\nab\r\n')
+        self.assertEqual(self._encode(None), b'$-1\r\n')
+        self.assertEqual(self._encode(None, 3), b'_\r\n')
+        self.assertEqual(self._encode(NULL_ARRAY), b'*-1\r\n')
+        self.assertEqual(self._encode(-3), b':-3\r\n')
+        self.assertEqual(self._encode(True, 3), b'#t\r\n')
+        self.assertEqual(self._encode(1.5), b'$3\r\n1.5\r\n')
+        self.assertEqual(self._encode(2.0, 3), b',2\r\n')
+        self.assertEqual(self._encode(float('-inf'), 3), b',-inf\r\n')
+        self.assertEqual(self._encode([b'a', 1]), b'*2\r\n$1\r\na\r\n:1\r\n')
+        self.assertEqual(self._encode({b'a': 1}), b'*2\r\n$1\r\na\r\n:1\r\n')
+        self.assertEqual(self._encode({b'a': 1}, 3), b'%1\r\n$1\r\na\r\n:1\r\n')
+        self.assertEqual(self._encode({b'a'}, 3), b'~1\r\n$1\r\na\r\n')
+        self.assertEqual(self._encode(RedisError("syntax error")), b'-ERR syntax error\r\n')
+        self.assertEqual(self._encode(RedisError("WRONGTYPE bad")), b'-WRONGTYPE bad\r\n')
+
+    def test_pipeline(self):
+        request = b''.join([
+            _command('SET', 'a', '1'),
+            _command('INCRBY', 'a', '5'),
+            _command('GET', 'a'),
+            _command('RPUSH', 'l', 'x', 'y'),
+            _command('GET', 'l'),
+            _command('NOPE'),
+            _command('GET'),
+            b'PING\r\n',
+        ])
+        reply, = self._session(request)
+        self.assertEqual(reply, b''.join([
+            b'+OK\r\n', b':6\r\n', b'$1\r\n6\r\n', b':2\r\n',
+            b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n',
+            b"-ERR unknown command 'NOPE', with args beginning with: \r\n",
+            b"-ERR wrong number of arguments for 'get' command\r\n",
+            b'+PONG\r\n',
+        ]))
+
+    def test_resp3_and_select(self):
+        request = b''.join([
+            _command('ZADD', 'z', '1', 'a', '2.5', 'b'),
+            _command('ZRANGE', 'z', '0', '-1', 'WITHSCORES'),
+            _command('HELLO', '3'),
+            _command('ZRANGE', 'z', '(1', '+inf', 'BYSCORE', 'WITHSCORES'),
+            _command('SELECT', '1'),
+            _command('EXISTS', 'z'),
+            _command('HELLO', '4'),
+        ])
+        reply, = self._session(request)
+        self.assertTrue(reply.startswith(b':2\r\n*4\r\n$1\r\na\r\n$1\r\n1\r\n$1\r\nb\r\n$3\r\n2.5\r\n%7\r\n'))
+        self.assertTrue(reply.endswith(b'*1\r\n*2\r\n$1\r\nb\r\n,2.5\r\n+OK\r\n:0\r\n-NOPROTO unsupported protocol version\r\n'))
+
+    def test_blocking_pop(self):
+        async def run():
+            server = Server()
+            await server.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(_command('PING') + _command('BLPOP', 'a', 'b', '0'))
+            self.assertEqual(await reader.readexactly(7), b'+PONG\r\n')
+            producer_reader, producer = await asyncio.open_connection('127.0.0.1', port)
+            producer.write(_command('RPUSH', 'b', 'x', 'y') + _command('BLPOP', 'c', '0.01'))
+            self.assertEqual(await producer_reader.readexactly(9), b':2\r\n*-1\r\n')
+            self.assertEqual(await reader.readexactly(18), b'*2\r\n$1\r\nb\r\n$1\r\nx\r\n')
+            writer.close()
+            producer.close()
+            await server.close()
+        asyncio.run(run())
+
+    def test_blocked_keys(self):
+        async def run():
+            server = Server()
+            producer, consumer, other = [Client(server, i, None) for i in range(3)]
+            call = lambda client, *args: server.call(client, [arg.encode() for arg in args])
+            waiting = asyncio.ensure_future(call(consumer, 'BLPOP', 'l', '0'))
+            zwaiting = asyncio.ensure_future(call(other, 'BZPOPMIN', 'z', '0'))
+            await asyncio.sleep(0)
+            # blocking does not create the keys
+            self.assertEqual(call(producer, 'EXISTS', 'l', 'z'), 0)
+            self.assertEqual(call(producer, 'TYPE', 'l'), 'none')
+            self.assertEqual(call(producer, 'DBSIZE'), 0)
+            self.assertEqual(call(producer, 'DEL', 'l'), 0)
+            self.assertEqual(call(producer, 'LPUSH', 'l', 'v'), 1)
+            self.assertEqual(await waiting, [b'l', b'v'])
+            self.assertEqual(call(producer, 'ZADD', 'z', '1', 'm'), 1)
+            self.assertEqual(await zwaiting, [b'z', b'm', 1.0])
+            self.assertEqual(call(producer, 'DBSIZE'), 0)
+            self.assertEqual(await call(consumer, 'BLPOP', 'l', '0.01'), NULL_ARRAY)
+            self.assertEqual(server.databases[0]._blocked, {})
+        asyncio.run(run())
+
+    def test_close_cancels_connections(self):
+        async def run():
+            server = Server()
+            await server.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(_command('PING') + _command('BLPOP', 'l', '0'))
+            self.assertEqual(await reader.readexactly(7), b'+PONG\r\n')
+            client, = server.clients
+            await server.close()
+            self.assertTrue(client.task.cancelled())
+            self.assertEqual(server.clients, set())
+            self.assertEqual(server.databases[0]._blocked, {})
+            self.assertEqual(await reader.read(), b'')
+            writer.close()
+        asyncio.run(run())
+
+    def test_multi_exec(self):
+        request = b''.join([
+            _command('MULTI'),
+            _command('SET', 'a', '1'),
+            _command('INCR', 'a'),
+            _command('LPUSH', 'a', 'x'),
+            _command('BLPOP', 'l', '0'),
+            _command('EXEC'),
+            _command('MULTI'),
+            _command('SET', 'a', '5'),
+            _command('NOPE'),
+            _command('EXEC'),
+            _command('GET', 'a'),
+            _command('EXEC'),
+        ])
+        reply, = self._session(request)
+        self.assertEqual(reply, b''.join([
+            b'+OK\r\n', b'+QUEUED\r\n', b'+QUEUED\r\n', b'+QUEUED\r\n', b'+QUEUED\r\n',
+            b'*4\r\n+OK\r\n:2\r\n',
+            b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n*-1\r\n',
+            b'+OK\r\n', b'+QUEUED\r\n',
+            b"-ERR unknown command 'NOPE', with args beginning with: \r\n",
+            b'-EXECABORT Transaction discarded because of previous errors.\r\n',
+            b'$1\r\n2\r\n',
+            b'-ERR EXEC without MULTI\r\n',
+        ]))
+
+    def test_watch(self):
+        async def run():
+            server = Server()
+            await server.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            other_reader, other = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(_command('WATCH', 'h', 'x') + _command('MULTI') + _command('HGET', 'h', 'f'))
+            expected = b'+OK\r\n+OK\r\n+QUEUED\r\n'
+            self.assertEqual(await reader.readexactly(len(expected)), expected)
+            other.write(_command('HSET', 'h', 'f', 'v'))
+            self.assertEqual(await other_reader.readexactly(4), b':1\r\n')
+            writer.write(_command('EXEC') + _command('WATCH', 'h') + _command('MULTI')
+                         + _command('HGET', 'h', 'f') + _command('EXEC'))
+            expected = b'*-1\r\n+OK\r\n+OK\r\n+QUEUED\r\n*1\r\n$1\r\nv\r\n'
+            self.assertEqual(await reader.readexactly(len(expected)), expected)
+            self.assertEqual(server.databases[0]._watched, {})
+            writer.close()
+            other.close()
+            await server.close()
+        asyncio.run(run())
+
+    def test_save(self):
+        path = os.path.join(tempfile.mkdtemp(), 'dump.rdb')
+
+        async def run(request):
+            server = Server(dbfilename=path)
+            await server.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            writer.write_eof()
+            reply = await reader.read()
+            writer.close()
+            await server.close()
+            return reply
+        self.assertEqual(asyncio.run(run(_command('SADD', 's', '1', 'a') + _command('SAVE'))), b':2\r\n+OK\r\n')
+        self.assertEqual(asyncio.run(run(_command('SCARD', 's'))), b':2\r\n')
+
+    def test_protocol_error_closes_connection(self):
+        reply, = self._session(_command('PING') + b'*1\r\n$x\r\n' + _command('PING'))
+        self.assertEqual(reply, b'+PONG\r\n-ERR Protocol error: invalid bulk length\r\n')
+
+
+class AofTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'appendonly.aof')
+
+    def _run(self, *commands, **kwargs):
+        """ Runs ``commands`` against a server logging to ``path``, passing
+        it to a coroutine function among them, and returns the server.
+        """
+        async def run():
+            server = Server(databases=2, appendfilename=self.path, **kwargs)
+            await server.start(port=None)
+            client = Client(server, 1, None)
+            for command in commands:
+                if callable(command):
+                    await command(server, client)
+                else:
+                    server.call(client, [arg if isinstance(arg, bytes) else str(arg).encode() for arg in command])
+            await server.close()
+            return server
+        return asyncio.run(run())
+
+    def _log(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        return data[data.index(b'*'):]
+
+    def test_replay(self):
+        server = self._run(
+            ['SET', 'a', '1', 'EX', '100'],
+            ['SADD', 's', 'x', 'y', 'z'],
+            ['SPOP', 's'],
+            ['RPUSH', 'l', 'x', 'y'],
+            ['EXPIRE', 'l', '-1'],
+            ['SELECT', '1'],
+            ['HSET', 'h', 'f', 'v', 'g', 'w'],
+            ['HEXPIRE', 'h', '100', 'FIELDS', '2', 'f', 'nope'],
+            ['MULTI'], ['INCR', 'n'], ['INCRBY', 'n', '2'], ['EXEC'],
+            appendfsync='always')
+        log = self._log()
+        self.assertIn(b'$3\r\nset\r\n$1\r\na\r\n$1\r\n1\r\n$4\r\npxat\r\n', log)
+        self.assertIn(b'$4\r\nsrem\r\n', log)
+        self.assertIn(b'*2\r\n$3\r\ndel\r\n$1\r\nl\r\n', log)
+        self.assertIn(b'$10\r\nhpexpireat\r\n', log)
+        self.assertIn(b'$6\r\nselect\r\n$1\r\n1\r\n', log)
+        databases = aof.load(self.path, [Database(), Database()])
+        self.assertEqual(databases[0].get(b'a'), b'1')
+        self.assertTrue(99 <= databases[0].ttl(b'a') <= 100)
+        self.assertEqual(databases[0].lookup(b's').smembers(), server.databases[0].lookup(b's').smembers())
+        self.assertEqual(databases[0].exists(b'l'), 0)
+        h = databases[1].lookup(b'h')
+        self.assertEqual(h.hgetall(), {b'f': b'v', b'g': b'w'})
+        self.assertEqual(h.httl(b'f', b'g'), [100, -1])
+        self.assertEqual(databases[1].get(b'n'), 3)
+
+    def test_blocked_pop_is_logged_after_the_push(self):
+        async def block_and_push(server, client):
+            consumer = Client(server, 2, None)
+            waiting = asyncio.ensure_future(server.call(consumer, [b'BRPOP', b'l', b'0']))
+            await asyncio.sleep(0)
+            server.call(client, [b'RPUSH', b'l', b'x'])
+            server.call(client, [b'RPUSH', b'l', b'y'])
+            self.assertEqual(await waiting, [b'l', b'x'])
+        self._run(block_and_push)
+        self.assertEqual(aof.load(self.path)[0].lookup(b'l').lrange(0, -1), [b'y'])
+        self.assertLess(self._log().index(b'RPUSH'), self._log().index(b'rpop'))
+
+    def test_rewrite(self):
+        async def rewrite_while_writing(server, client):
+            rewriting = asyncio.ensure_future(server.aof.rewrite(server.databases))
+            for i in range(20):
+                server.call(client, [b'INCR', b'k%d' % (19 - i)])
+                server.call(client, [b'RPUSH', b'l', b'%d' % i])
+                if i == 5:
+                    server.call(client, [b'FLUSHALL'])
+                await asyncio.sleep(0)
+            await rewriting
+            server.call(client, [b'SET', b'after', b'1'])
+
+        original, aof.REWRITE_KEYS_PER_STEP = aof.REWRITE_KEYS_PER_STEP, 3
+        try:
+            server = self._run(*([['INCR', 'k%d' % i] for i in range(20)] + [rewrite_while_writing]))
+        finally:
+            aof.REWRITE_KEYS_PER_STEP = original
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(5), b'REDIS')
+        databases = aof.load(self.path, [Database(), Database()])
+        self.assertEqual(sorted(databases[0].keys()), sorted(server.databases[0].keys()))
+        for key in server.databases[0].keys():
+            value = server.databases[0].lookup(key)
+            if isinstance(value, List):
+                self.assertEqual(databases[0].lookup(key).lrange(0, -1), value.lrange(0, -1))
+            else:
+                self.assertEqual(int(databases[0].get(key)), int(value))
+
+    def test_truncated_log(self):
+        complete = aof.encode_command([b'select', b'0']) + aof.encode_command([b'rpush', b'l', b'a'])
+        with open(self.path, 'wb') as f:
+            f.write(complete + aof.encode_command([b'multi']) + aof.encode_command([b'rpush', b'l', b'b'])
+                    + aof.encode_command([b'rpush', b'l', b'c'])[:-3])
+        db, = aof.load(self.path)
+        self.assertEqual(db.lookup(b'l').lrange(0, -1), [b'a'])
+        self.assertEqual(os.path.getsize(self.path), len(complete))
+        with open(self.path, 'wb') as f:
+            f.write(complete + b'*1\r\n:1\r\n')
+        self.assertRaises(RedisError, aof.load, self.path)
+
+    def test_fsync_policies(self):
+        self.assertRaises(RedisError, aof.AppendOnlyFile, self.path, 'sometimes')
+        for policy in aof.FSYNC_POLICIES:
+            log = aof.AppendOnlyFile(self.path, policy)
+            log.feed(0, [b'set', b'a', policy.encode()])
+
+            async def sync():
+                await log.sync()
+            if policy == 'always':
+                asyncio.run(sync())
+            log.close()
+            self.assertTrue(self._log().endswith(aof.encode_command([b'set', b'a', policy.encode()])))
+        db, = aof.load(self.path)
+        self.assertEqual(db.get(b'a'), b'no')
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_commands_covered(self):
+        for name, (cls, element, build, other, commands) in bench.STRUCTURES.items():
+            public = set(attr for attr, func in inspect.getmembers(cls, inspect.isfunction)
+                         if not attr.startswith('_') and not inspect.iscoroutinefunction(func))
+            self.assertEqual(set(command[0] for command in commands), public, name)
+
+    def test_run_and_compare(self):
+        results = bench.run(sizes=[10], structures=['ZSet', 'List'], ops=20, time_limit=0.1)
+        stats = results['structures']['ZSet']['10']
+        self.assertGreater(stats['bytes_per_element'], 0)
+        self.assertEqual(stats['commands']['zadd']['calls'], 20)
+        self.assertLessEqual(stats['commands']['zadd']['p50_us'], stats['commands']['zadd']['p99_us'])
+        self.assertEqual(results['contention']['1']['4']['calls'], 20)
+        self.assertEqual(bench.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['structures']['List']['10']['commands']['lpush']['ops_per_sec'] /= 2
+        self.assertEqual([regression[:4] for regression in bench.compare(results, slower)],
+                         [('List', 10, 'lpush', 'ops_per_sec')])
+
+
+class InstrumentTestCase(unittest.TestCase):
+    def setUp(self):
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+        instrument.SlowLog.slower_than = SlowLog.slower_than
+
+    def test_histogram(self):
+        histogram = instrument.Histogram()
+        values = [random.randrange(10 ** 9) for i in range(10000)]
+        for value in values:
+            histogram.record(value)
+        values.sort()
+        for percentile in (50, 99, 99.9):
+            exact = values[int(len(values) * percentile / 100) - 1]
+            self.assertAlmostEqual(histogram.percentile(percentile) / exact, 1, delta=1.0 / instrument.SUB_BUCKETS)
+        self.assertEqual(histogram.percentile(100), values[-1])
+        self.assertEqual(histogram.count_below(2 * 10 ** 9), len(values))
+        self.assertLess(len(histogram.counts), 1000)
+
+    def test_enable_disable(self):
+        zadd = ZSet.zadd
+        instrument.enable()
+        self.assertNotEqual(ZSet.zadd, zadd)
+        self.assertTrue(instrument.enabled())
+        z = ZSet()
+        z.zadd(a=1, b=2)
+        ZSet().zunionstore(z, z)
+        l = List()
+        l.rpush(b'x')
+        l.lmove(List())
+        self.assertEqual(dict((key, histogram.count) for key, histogram in instrument.histograms.items()), {
+            ('ZSet', 'zadd'): 1, ('ZSet', 'zunionstore'): 1, ('List', 'rpush'): 1, ('List', 'lmove'): 1})
+        self.assertIn('cmdstat_ZSet.zadd:calls=1,', instrument.info())
+        self.assertIn('latency_percentiles_usec_List.lmove:p50=', instrument.info())
+        metrics = instrument.prometheus()
+        self.assertIn('pyredis_call_duration_seconds_count{structure="ZSet",method="zadd"} 1', metrics)
+        self.assertIn('pyredis_call_duration_seconds_bucket{structure="ZSet",method="zadd",le="+Inf"} 1', metrics)
+        instrument.disable()
+        self.assertEqual(ZSet.zadd, zadd)
+        z.zadd(c=3)
+        self.assertEqual(instrument.histograms[('ZSet', 'zadd')].count, 1)
+
+    def test_slowlog(self):
+        instrument.SlowLog.slower_than = 0
+        instrument.enable()
+        s = Set()
+        s.sadd(*[b'x' * 200] + list(range(40)))
+        entry, = instrument.slowlog.get()
+        self.assertEqual(entry[0], 0)
+        arguments = entry[3]
+        self.assertEqual(len(arguments), SlowLog.max_argc)
+        self.assertEqual(arguments[:3], [b'Set.sadd', b'x' * 128 + b'... (72 more bytes)', b'0'])
+        self.assertEqual(arguments[-1], b'... (11 more arguments)')
+        instrument.SlowLog.slower_than = -1
+        s.scard()
+        self.assertEqual(len(instrument.slowlog), 1)
+
+        async def run():
+            server = Server(databases=1)
+            client = Client(server, 1, None)
+            call = lambda *args: server.call(client, [arg.encode() for arg in args])
+            instrument.SlowLog.slower_than = 0
+            call('sadd', 's', 'a')
+            # the database also calls memory_usage to account for the key
+            self.assertEqual(call('slowlog', 'len'), 3)
+            self.assertIn([b'Set.sadd', b'a'], [entry[3] for entry in call('slowlog', 'get')])
+            self.assertEqual(len(call('slowlog', 'get', '1')), 1)
+            self.assertIn('cmdstat_Set.sadd:calls=2,', call('info'))
+            self.assertEqual(call('slowlog', 'reset'), OK)
+            self.assertEqual(call('slowlog', 'get'), [])
+            self.assertIsInstance(call('slowlog', 'foo'), RedisError)
+        asyncio.run(run())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,149 +1,378 @@
+import heapq
 from operator import xor
-import sys
-import bisect
 
-try:
-    from blist import blist
-    USE_BLIST = True
-except ImportError:
-    USE_BLIST = False
+from . import blocking, memory
+from .exceptions import RedisError
+from .scan import ScanDict, filter_match
+from .skiplist import SkipList
+
+
+AGGREGATES = {
+    'SUM': lambda a, b: a + b,
+    'MIN': min,
+    'MAX': max,
+}
+
+
+# Stand-ins for the "-" and "+" lexicographical range bounds
+LEX_MIN = object()
+LEX_MAX = object()
+
+
+def _parse_lex(bound):
+    """ Parses a ZRANGEBYLEX style ``bound`` into a (value, exclusive) tuple.
+
+    ``bound`` is "-" or "+" for the lowest and highest possible member, or
+    a member prefixed by "[" to include it or "(" to exclude it.
+    """
+    if bound in ('-', b'-'):
+        return LEX_MIN, False
+    if bound in ('+', b'+'):
+        return LEX_MAX, False
+    prefix = bound[:1]
+    if prefix in ('[', b'['):
+        return bound[1:], False
+    if prefix in ('(', b'('):
+        return bound[1:], True
+    raise RedisError("min or max not valid string range item")
+
+
+def _weighted(zsets, weights, aggregate):
+    """ Pairs every sorted set in ``zsets`` with its weight and looks up the
+    ``aggregate`` function, raising a RedisError for invalid arguments.
+    """
+    if weights is None:
+        weights = [1] * len(zsets)
+    elif len(weights) != len(zsets):
+        raise RedisError("syntax error")
+    try:
+        func = AGGREGATES[aggregate.upper()]
+    except KeyError:
+        raise RedisError("syntax error")
+    return list(zip(zsets, weights)), func
+
+
+def _union(zsets, weights=None, aggregate='SUM'):
+    "Returns a dict of member to aggregated score for the union of ``zsets``"
+    pairs, func = _weighted(zsets, weights, aggregate)
+    if not pairs:
+        return {}
+    # Seed the result from the largest input so most members are copied
+    # rather than looked up and aggregated.
+    pairs.sort(key=lambda pair: len(pair[0]._dict), reverse=True)
+    zset, weight = pairs[0]
+    if weight == 1:
+        result = dict(zset._dict)
+    else:
+        result = dict((member, score * weight) for member, score in zset._dict.items())
+    for zset, weight in pairs[1:]:
+        for member, score in zset._dict.items():
+            if weight != 1:
+                score *= weight
+            current = result.get(member)
+            result[member] = score if current is None else func(current, score)
+    return result
+
+
+def _inter(zsets, weights=None, aggregate='SUM'):
+    "Returns a dict of member to aggregated score for the intersection of ``zsets``"
+    pairs, func = _weighted(zsets, weights, aggregate)
+    if not pairs:
+        return {}
+    # Walk the smallest input and probe the others, smallest first, so
+    # members that are missing somewhere are rejected as early as possible.
+    pairs.sort(key=lambda pair: len(pair[0]._dict))
+    (smallest, smallest_weight), others = pairs[0], pairs[1:]
+    result = {}
+    for member, score in smallest._dict.items():
+        score *= smallest_weight
+        for zset, weight in others:
+            other = zset._dict.get(member)
+            if other is None:
+                break
+            score = func(score, other * weight)
+        else:
+            result[member] = score
+    return result
+
+
+def _diff(zsets):
+    """ Returns a dict of member to score for the members of the first of
+    ``zsets`` that are in none of the others.
+    """
+    if not zsets:
+        return {}
+    first, others = zsets[0], zsets[1:]
+    result = {}
+    for member, score in first._dict.items():
+        for zset in others:
+            if member in zset._dict:
+                break
+        else:
+            result[member] = score
+    return result
 
 
-EPSILON = sys.float_info.epsilon * 4
+def _pop_min(zset):
+    items = zset.zpopmin()
+    if items:
+        return (zset,) + items[0]
+    return None
 
 
-class ZSet(object):
+def _pop_max(zset):
+    items = zset.zpopmax()
+    if items:
+        return (zset,) + items[0]
+    return None
 
-    def __init__(self):
-        if USE_BLIST:
-            self._scores = blist([])
-            self._members = blist([])
-        else:
-            self._scores = []
-            self._members = []
 
-    def __add(self, member, score):
-        """ Private method to add the member and score to the sorted set.
-        This trusts that the member does not already exist in the sorted set.
+def _push_back(result):
+    zset, member, score = result
+    zset.zadd_many([(member, score)])
 
-        """
-        bisect.insort_left(self._members, (member, score))
-        bisect.insort_left(self._scores, (score, member))
+
+class ZSet(object):
+
+    # Consumers blocked in bzpopmin/bzpopmax, created on first use
+    _waiters = None
+
+    def __init__(self):
+        # ``_dict`` maps member -> score for O(1) score lookups while
+        # ``_zsl`` keeps (score, member) ordered for O(log n) rank queries.
+        self._dict = ScanDict()
+        self._zsl = SkipList()
+        # the bytes taken by the members, see ``memory_usage``
+        self._used = 0
 
     def _insert_or_update(self, member, score):
         """ Takes a member and score and inserts them into the sorted set. If
         the member already exists, it is just updated.
+
+        Returns 1 if the member was added, otherwise 0.
         """
-        # Find the index of the member if it exists in the sorted set
-        i = self._find_member(member)
-        if i is None:
-            self.__add(member, score)
-        else:
-            s = self._members[i][1]
-            self._members[i] = (member, score)
-            j = self._find_score(s)
-            _, member = self._scores.pop(j)
-            bisect.insort_left(self._scores, (score, member))
+        current = self._dict.get(member)
+        if current is None:
+            self._zsl.insert(score, member)
+            self._dict[member] = score
+            self._used += memory.sizeof(member)
+            return 1
+        if current != score:
+            self._zsl.update_score(current, member, score)
+            self._dict[member] = score
+        return 0
+
+    def _normalize_range(self, start, end):
+        """ Converts ``start`` and ``end`` (which can be negative) into
+        0-based inclusive ranks clamped to the sorted set.
+
+        Returns None if the range is empty.
+        """
+        llen = len(self._dict)
+        if start < 0:
+            start = llen + start
+        if end < 0:
+            end = llen + end
+        if start < 0:
+            start = 0
+        if start > end or start >= llen:
+            return None
+        if end >= llen:
+            end = llen - 1
+        return start, end
 
     def zadd(self, **kwargs):
         """
         Adds score, member to the sorted set if member doesn't exist or
         updates score if the member already exists.
+
+        Returns the number of members added.
         """
-        for member, score in kwargs.iteritems():
-            i = bisect.bisect_left(self._members, (member, None))
-            cardnality = self.zcard()
-            if cardnality == 0:
-                self._scores.append((score, member))
-                self._members.append((member, score))
-            else:
-                self._insert_or_update(member, score)
+        added = 0
+        for member, score in kwargs.items():
+            added += self._insert_or_update(member, score)
+        if self._waiters:
+            blocking.wake(self)
+        return added
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """ Builds a sorted set from ``pairs``, either a dict of member to
+        score or an iterable of (member, score) tuples.
+
+        The pairs are sorted once and the skiplist is built in a single
+        pass, which is much faster than adding members one by one.
+        """
+        zset = cls()
+        zset.zadd_many(pairs)
+        return zset
+
+    def zadd_many(self, pairs):
+        """ Adds ``pairs``, either a dict of member to score or an iterable
+        of (member, score) tuples, to the sorted set.  If a member appears
+        more than once the last score wins.
 
-    def _find_member(self, member):
-        """ Finds the position of the member in the sorted set.
+        Small batches are inserted one by one, larger ones are sorted once
+        and merged with the existing members in O(n + k log k).
 
-        Returns None if not found.
+        Returns the number of members added.
         """
-        cardnality = self.zcard()
-        if cardnality == 0:
-            return None
-        if self._members[0][0] == member:
+        if hasattr(pairs, 'items'):
+            pairs = pairs.items()
+        batch = dict(pairs)
+        if not batch:
             return 0
-        if self._members[-1][0] == member:
-            return cardnality - 1
-        i = bisect.bisect_left(self._members, (member, None))
-        if i >= cardnality - 1:
-            return None
-        if self._members[i][0] == member:
-            return i
-        return None
 
-    def _find_score(self, score, desc=False):
-        """ Find the position of the score in the sorted set.
+        added = 0
+        n = len(self._dict)
+        if len(batch) * n.bit_length() < n:
+            for member, score in batch.items():
+                added += self._insert_or_update(member, score)
+        else:
+            for member in batch:
+                if member not in self._dict:
+                    added += 1
+                    self._used += memory.sizeof(member)
+            items = sorted((score, member) for member, score in batch.items())
+            if n:
+                existing = ((score, member) for score, member in self._iter_sorted() if member not in batch)
+                items = heapq.merge(existing, items)
+            self._load_sorted(items)
+            self._dict.update(batch)
+        if self._waiters:
+            blocking.wake(self)
+        return added
+
+    def _iter_sorted(self):
+        "Iterates over (score, member) pairs in ascending order"
+        return iter(self._zsl)
+
+    def _load_sorted(self, items):
+        """ Rebuilds the ordered storage from ``items``, an iterable of
+        sorted (score, member) pairs.  ``_dict`` is left to the caller.
+        """
+        self._zsl = SkipList.from_sorted(items)
 
-        Optionally, specify ``desc`` as True to search in the reverse order
-        Returns None if ``score`` is not found.
+    def _replace(self, scores):
+        """ Replaces the contents of the sorted set with ``scores``, a dict
+        of member to score, sorting it once and building the ordered
+        storage in a single pass.
         """
-        cardnality = self.zcard()
-        scores = self._scores
-        if cardnality == 0:
-            return None
+        self._load_sorted(sorted((score, member) for member, score in scores.items()))
+        self._dict = ScanDict(scores)
+        self._used = sum(map(memory.sizeof, scores))
+        if self._waiters:
+            blocking.wake(self)
+        return len(scores)
+
+    def _sorted_result(self, scores, withscores, score_cast_func):
+        "Returns the members of ``scores`` ordered by score like ``zrange``"
+        items = sorted((score, member) for member, score in scores.items())
+        if withscores:
+            return [(member, score_cast_func(score)) for score, member in items]
+        return [member for score, member in items]
 
-        if desc:
-            if scores[-1][0] == score:
-                return 0
-            if scores[0][0] == score:
-                return cardnality - 1
-            i = bisect.bisect_right(scores, (score + EPSILON, None))
-            if i >= cardnality:
-                return None
-            if scores[i - 1][0] == score:
-                return cardnality - i
-        else:
-            if scores[0][0] == score:
-                return 0
-            if scores[-1][0] == score:
-                return cardnality - 1
-            i = bisect.bisect_left(scores, (score, None))
-            if i >= cardnality - 1:
-                return None
-            if scores[i][0] == score:
-                return i
-        return None
+    def zunion(self, *others, weights=None, aggregate='SUM', withscores=False, score_cast_func=float):
+        """ Returns the union of this sorted set and ``others`` ordered by
+        score.
+
+        ``weights`` can be given to multiply the scores of each input,
+        starting with this sorted set, and ``aggregate`` can be one of
+        SUM, MIN or MAX to choose how scores of the same member combine.
+
+        Optionally, you can provide ``withscores`` as True to include the
+        score values along with the members, and ``score_cast_func`` to cast
+        the scores to a particular type.
+        """
+        scores = _union((self,) + others, weights, aggregate)
+        return self._sorted_result(scores, withscores, score_cast_func)
+
+    def zinter(self, *others, weights=None, aggregate='SUM', withscores=False, score_cast_func=float):
+        """ Returns the intersection of this sorted set and ``others``
+        ordered by score.
+
+        Accepts the same ``weights``, ``aggregate``, ``withscores`` and
+        ``score_cast_func`` options as ``zunion``.
+        """
+        scores = _inter((self,) + others, weights, aggregate)
+        return self._sorted_result(scores, withscores, score_cast_func)
+
+    def zdiff(self, *others, withscores=False, score_cast_func=float):
+        """ Returns the members of this sorted set that are not in any of
+        ``others`` ordered by score.
+
+        Optionally, you can provide ``withscores`` as True to include the
+        score values along with the members, and ``score_cast_func`` to cast
+        the scores to a particular type.
+        """
+        scores = _diff((self,) + others)
+        return self._sorted_result(scores, withscores, score_cast_func)
+
+    def zunionstore(self, *zsets, weights=None, aggregate='SUM'):
+        """ Replaces the contents of this sorted set with the union of
+        ``zsets`` and returns the resulting cardinality.
+
+        ``weights`` can be given to multiply the scores of each input and
+        ``aggregate`` can be one of SUM, MIN or MAX.
+        """
+        return self._replace(_union(zsets, weights, aggregate))
+
+    def zinterstore(self, *zsets, weights=None, aggregate='SUM'):
+        """ Replaces the contents of this sorted set with the intersection
+        of ``zsets`` and returns the resulting cardinality.
+
+        ``weights`` can be given to multiply the scores of each input and
+        ``aggregate`` can be one of SUM, MIN or MAX.
+        """
+        return self._replace(_inter(zsets, weights, aggregate))
+
+    def zdiffstore(self, *zsets):
+        """ Replaces the contents of this sorted set with the members of the
+        first of ``zsets`` that are in none of the others and returns the
+        resulting cardinality.
+        """
+        return self._replace(_diff(zsets))
 
     def zrank(self, member):
         """ Finds the 0-based index of ``member``
 
         Returns None if member is not in the sorted set.
         """
-        i = self._find_member(member)
-        if i is None:
+        score = self._dict.get(member)
+        if score is None:
             return None
-        return self._find_score(self._members[i][1])
+        return self._zsl.get_rank(score, member)
 
     def zrevrank(self, member):
         """ Finds the 0-based index of ``member`` in the reverse order.
 
         Returns None if member is not in the sorted set.
         """
-        i = self._find_member(member)
-        if i is None:
+        score = self._dict.get(member)
+        if score is None:
             return None
-        return self._find_score(self._members[i][1], desc=True)
+        return len(self._dict) - 1 - self._zsl.get_rank(score, member)
+
+    def memory_usage(self):
+        """ Returns an estimate of the bytes used by the sorted set, kept up
+        to date as members are added and removed rather than computed by
+        walking it.
+        """
+        return memory.STRUCTURE + len(self._dict) * (memory.ZSET_ENTRY + memory.SCAN_ENTRY) + self._used
 
     def zcard(self):
         """ Returns the cardnality of the sorted set.
         """
-        return len(self._scores)
+        return len(self._dict)
 
     def zcount(self, low, high):
         """ Returns the number of elements in the sorted set between ``low``
         and ``high``.  The count should be inclusive.
 
         """
-        right = bisect.bisect_right(self._scores, (high + EPSILON, None))
-        left = bisect.bisect_left(self._scores, (low, None))
-        return right - left
+        if low > high:
+            return 0
+        return self._zsl.count_below(high, inclusive=True) - self._zsl.count_below(low)
 
     def zincrby(self, member, amount=1):
         """ Finds member in the sorted set and increments its score.
@@ -151,30 +380,19 @@ class ZSet(object):
         If no member is found, then member is insert and given a score of
         ``amount``.
         """
-        i = bisect.bisect_left(self._members, (member, None))
-        try:
-            # Check if the next member is the same.  If it is, then update the score
-            if self._members[i][0] == member:
-                j = self._scores.index((self._members[i][1], self._members[i][0]))
-                new_score = self._members[i][1] + amount
-                self._scores[j] = (new_score, member)
-                self._members[i] = (member, new_score)
-            elif self._members[i + 1][0] == member:
-                j = self._scores.index((self._members[i + 1][1], self._members[i + 1][0]))
-                new_score = self._members[i][1] + amount
-                self._scores[j] = (new_score, member)
-                self._members[i + 1] = (member, new_score)
-            else:
-                new_score = amount
-                self._members.insert(i, (member, amount))
-                bisect.insort_left(self._scores, (amount, member))
-        except IndexError:
+        current = self._dict.get(member)
+        if current is None:
             new_score = amount
-            self._members.insert(i, (member, amount))
-            bisect.insort_left(self._scores, (amount, member))
+            self._zsl.insert(new_score, member)
+            self._used += memory.sizeof(member)
+        else:
+            new_score = current + amount
+            self._zsl.update_score(current, member, new_score)
+        self._dict[member] = new_score
+        if self._waiters:
+            blocking.wake(self)
         return new_score
 
-
     def _zrange(self, start, end, desc=False, withscores=False, score_cast_func=float):
         """ Finds members that fall in the 0-index range of ``start`` and
         ``end``.
@@ -187,17 +405,52 @@ class ZSet(object):
         Also, you can provide ``score_cast_func`` to cast the scores to a
         particular type.
         """
-        if desc:
-            scores = reversed(self._scores)
-        else:
-            scores = self._scores
+        return list(self.iter_range(start, end, desc=desc, withscores=withscores, score_cast_func=score_cast_func))
 
+    def _walk(self, node, desc, limit=None):
+        """ Yields nodes starting at ``node`` and moving towards the head if
+        ``desc`` is True or the tail otherwise, stopping after ``limit``
+        nodes when it is given.
+        """
+        while node is not None and limit != 0:
+            yield node
+            if limit is not None:
+                limit -= 1
+            node = node.backward if desc else node.forward[0]
+
+    def _output(self, nodes, withscores, score_cast_func):
+        "Turns ``nodes`` into the members, or (member, score) pairs, they hold"
         if withscores:
-            data = [(member, score_cast_func(score)) for (score, member) in scores[start:end+1]]
+            for node in nodes:
+                yield node.member, score_cast_func(node.score)
         else:
-            data = [member for score, member in scores[start:end+1]]
+            for node in nodes:
+                yield node.member
+
+    def iter_range(self, start=0, end=-1, desc=False, withscores=False, score_cast_func=float):
+        """ Lazily yields the members that fall in the 0-index range of
+        ``start`` and ``end``, seeking straight to ``start`` rather than
+        building the whole range.
 
-        return data
+        If ``desc`` is True, the range will be taken from the reverse order.
+        Accepts the same ``withscores`` and ``score_cast_func`` options as
+        ``zrange``.  The sorted set must not be modified while iterating.
+        """
+        bounds = self._normalize_range(start, end)
+        if bounds is None:
+            return iter(())
+        start, end = bounds
+        if desc:
+            llen = len(self._dict)
+            start, end = llen - 1 - end, llen - 1 - start
+        return self._iter_between(start, end, desc, withscores, score_cast_func)
+
+    def _iter_between(self, first, last, desc, withscores, score_cast_func):
+        """ Lazily yields the members ranked ``first`` to ``last``, which
+        must be valid ranks, from ``last`` down if ``desc`` is True.
+        """
+        node = self._zsl.get_by_rank(last if desc else first)
+        return self._output(self._walk(node, desc, last - first + 1), withscores, score_cast_func)
 
     def zrange(self, start, end, desc=False, withscores=False, score_cast_func=float):
         """ Finds members that fall in the 0-index range of ``start`` and
@@ -236,29 +489,47 @@ class ZSet(object):
         Also, you can provide ``score_cast_func`` to cast the scores to a
         particular type.
         """
-        cardnality = self.zcard()
-
-        if cardnality == 0:
-            return []
+        return list(self.iter_rangebyscore(min, max, start=start, num=num, withscores=withscores,
+                                           score_cast_func=score_cast_func, desc=desc))
 
-        left = bisect.bisect_left(self._scores, (min, None))
+    def iter_rangebyscore(self, min, max, start=None, num=None, withscores=False, score_cast_func=float, desc=False):
+        """ Lazily yields the members that fall in the score range of ``min``
+        and ``max``.
 
-        right = bisect.bisect_right(self._scores, (max + EPSILON, None))
-
-        if withscores:
-            data = [(member, score_cast_func(score)) for (score, member) in self._scores[left:right]]
-        else:
-            data = [member for (score, member) in self._scores[left:right]]
-
-        if desc:
-            data.reverse()
+        ``start`` and ``num`` page through the range like LIMIT: the first
+        member is found by rank in O(log n) and iteration stops after
+        ``num`` members, so nothing outside the page is visited.
 
+        If ``desc`` is True, the range will be taken from the reverse order.
+        Accepts the same ``withscores`` and ``score_cast_func`` options as
+        ``zrangebyscore``.  The sorted set must not be modified while
+        iterating.
+        """
+        # ranks of the first and last members within the score range
+        first = self._zsl.count_below(min)
+        last = self._zsl.count_below(max, inclusive=True) - 1
+        return self._iter_ranks(first, last, start, num, desc, withscores, score_cast_func)
+
+    def _iter_ranks(self, first, last, start, num, desc, withscores, score_cast_func):
+        """ Lazily yields the members ranked ``first`` to ``last`` after
+        skipping ``start`` of them and stopping after ``num``, counting from
+        ``last`` if ``desc`` is True.
+        """
         if xor(start is None, num is None):
             raise Exception("``start`` and ``num`` must both be specified")
-        elif start is not None:
-            data = data[start:start + num]
-
-        return data
+        if start:
+            if desc:
+                last -= start
+            else:
+                first += start
+        if num is not None and 0 <= num < last - first + 1:
+            if desc:
+                first = last - num + 1
+            else:
+                last = first + num - 1
+        if first > last:
+            return iter(())
+        return self._iter_between(first, last, desc, withscores, score_cast_func)
 
     def zrangebyscore(self, *args, **kwargs):
         """ Returns members that fall the score range of ``min`` and ``max``.
@@ -284,36 +555,185 @@ class ZSet(object):
         kwargs['desc'] = True
         return self._zrangebyscore(*args, **kwargs)
 
-    def zscore(self, value):
-        """ Returns the member of the sorted set with a score of ``value``.
+    def _count_members_below(self, member, inclusive=False):
+        "Returns the number of members lower than ``member`` when all scores are equal"
+        return self._zsl.count_members_below(member, inclusive)
 
-        If ``value`` does not exist in the sorted set, None is returned.
+    def _lex_ranks(self, min, max):
+        """ Returns the ranks of the first and last members within the
+        lexicographical range of ``min`` and ``max``.
         """
-        i = self._find_score(value)
-        if i is None:
-            return None
-        return self._scores[i][1]
+        min, minex = _parse_lex(min)
+        max, maxex = _parse_lex(max)
+        llen = len(self._dict)
+        if min is LEX_MIN:
+            first = 0
+        elif min is LEX_MAX:
+            first = llen
+        else:
+            first = self._count_members_below(min, inclusive=minex)
+        if max is LEX_MIN:
+            last = -1
+        elif max is LEX_MAX:
+            last = llen - 1
+        else:
+            last = self._count_members_below(max, inclusive=not maxex) - 1
+        return first, last
+
+    def zrangebylex(self, min, max, start=None, num=None):
+        """ Returns the members that fall in the lexicographical range of
+        ``min`` and ``max``.
+
+        The bounds are "-" and "+" for the lowest and highest member, or a
+        member prefixed by "[" to include it or "(" to exclude it.  Like in
+        Redis, every member is expected to have the same score, so that the
+        score order is the member order.
+
+        ``start`` and ``num`` can be given to page through the range.
+        """
+        first, last = self._lex_ranks(min, max)
+        return list(self._iter_ranks(first, last, start, num, False, False, float))
+
+    def zrevrangebylex(self, min, max, start=None, num=None):
+        """ Returns the members that fall in the lexicographical range of
+        ``min`` and ``max``, but in the reverse order.
+
+        Accepts the same bounds as ``zrangebylex``.
+        """
+        first, last = self._lex_ranks(min, max)
+        return list(self._iter_ranks(first, last, start, num, True, False, float))
+
+    def zlexcount(self, min, max):
+        """ Returns the number of members in the lexicographical range of
+        ``min`` and ``max``.
+
+        Accepts the same bounds as ``zrangebylex``.
+        """
+        first, last = self._lex_ranks(min, max)
+        return last - first + 1 if last >= first else 0
+
+    def zremrangebylex(self, min, max):
+        """ Removes the members in the lexicographical range of ``min`` and
+        ``max`` and returns the number removed.
+
+        Accepts the same bounds as ``zrangebylex``.
+        """
+        first, last = self._lex_ranks(min, max)
+        if last < first:
+            return 0
+        return self.zremrangebyrank(first, last)
+
+    def zscore(self, member):
+        """ Returns the score of ``member``.
+
+        If ``member`` does not exist in the sorted set, None is returned.
+        """
+        return self._dict.get(member)
+
+    def zscan(self, cursor=0, count=10, score_cast_func=float, match=None):
+        """ Incrementally iterates over the sorted set.
+
+        Returns a ``(cursor, items)`` tuple where ``items`` is a list of
+        about ``count`` (member, score) pairs, only keeping members matching
+        the glob-style ``match`` pattern if given.  Pass the returned cursor
+        back in to continue; a cursor of 0 means the iteration is complete.
+        Members present for the whole iteration are returned at least once,
+        however the sorted set changes in between.
+        """
+        cursor, members = self._dict.scan(cursor, count)
+        members = filter_match(members, match)
+        return cursor, [(member, score_cast_func(self._dict[member])) for member in members]
+
+    def zscan_iter(self, count=10, score_cast_func=float, match=None):
+        """ Yields (member, score) pairs by repeatedly calling ``zscan`` with
+        ``count``, so at most ``count`` members are materialised at a time.
+        """
+        cursor = 0
+        while True:
+            cursor, items = self.zscan(cursor, count, score_cast_func, match)
+            for item in items:
+                yield item
+            if cursor == 0:
+                break
+
+    def zpopmin(self, count=1, score_cast_func=float):
+        """ Removes and returns up to ``count`` members with the lowest
+        scores as a list of (member, score) tuples.
+        """
+        if count < 1:
+            return []
+        items = self._zrange(0, count - 1, withscores=True, score_cast_func=score_cast_func)
+        if items:
+            self.zremrangebyrank(0, len(items) - 1)
+        return items
+
+    def zpopmax(self, count=1, score_cast_func=float):
+        """ Removes and returns up to ``count`` members with the highest
+        scores as a list of (member, score) tuples, highest first.
+        """
+        if count < 1:
+            return []
+        items = self._zrange(0, count - 1, desc=True, withscores=True, score_cast_func=score_cast_func)
+        if items:
+            self.zremrangebyrank(-len(items), -1)
+        return items
+
+    def bzpopmin(self, *others, timeout=0):
+        """ Removes and returns the member with the lowest score from the
+        first of this sorted set and ``others`` that is not empty.
+
+        If they are all empty, blocks the calling thread for up to
+        ``timeout`` seconds (0 waits forever) until a member is added.
+        Blocked callers are served in the order they arrived.  Producers in
+        other threads should hold ``pyredis.blocking.lock`` while adding.
+
+        Returns a (zset, member, score) tuple or None on timeout.
+        """
+        return blocking.block((self,) + others, _pop_min, _push_back, timeout)
+
+    def bzpopmax(self, *others, timeout=0):
+        """ Like ``bzpopmin`` but pops the member with the highest score.
+        """
+        return blocking.block((self,) + others, _pop_max, _push_back, timeout)
+
+    async def abzpopmin(self, *others, timeout=0):
+        """ The asyncio version of ``bzpopmin``, which suspends the calling
+        task rather than blocking the thread.
+        """
+        return await blocking.block_async((self,) + others, _pop_min, _push_back, timeout)
+
+    async def abzpopmax(self, *others, timeout=0):
+        """ The asyncio version of ``bzpopmax``, which suspends the calling
+        task rather than blocking the thread.
+        """
+        return await blocking.block_async((self,) + others, _pop_max, _push_back, timeout)
+
+    def zrem(self, *members):
+        """ Removes ``members`` from the sorted set and returns the number
+        removed.
+        """
+        removed = 0
+        for member in members:
+            score = self._dict.pop(member, None)
+            if score is not None:
+                self._zsl.delete(score, member)
+                self._used -= memory.sizeof(member)
+                removed += 1
+        return removed
 
     def zremrangebyrank(self, min, max):
         """ Removes members by between the 0-indexed values of ``min`` and
         ``max`` and returns the number removed.
         """
-        subset = self._scores[min:max + 1]
-        del self._scores[min:max + 1]
-        for (score, member) in subset:
-            i = self._find_member(member)
-            del self._members[i]
-        return len(subset)
+        bounds = self._normalize_range(min, max)
+        if bounds is None:
+            return 0
+        self._used -= sum(map(memory.sizeof, self._iter_between(bounds[0], bounds[1], False, False, float)))
+        return self._zsl.delete_range_by_rank(bounds[0], bounds[1], self._dict)
 
     def zremrangebyscore(self, min, max):
         """ Removes members by between the score values of ``min`` and
         ``max`` and returns the number removed.
         """
-        left = bisect.bisect_left(self._scores, (min, None))
-        right = bisect.bisect_right(self._scores, (max + EPSILON, None))
-        subset = self._scores[left:right+1]
-        del self._scores[left:right+1]
-        for (score, member) in subset:
-            i = self._find_member(member)
-            del self._members[i]
-        return len(subset)
+        self._used -= sum(map(memory.sizeof, self.iter_rangebyscore(min, max)))
+        return self._zsl.delete_range_by_score(min, max, self._dict)